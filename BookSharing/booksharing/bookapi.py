@@ -0,0 +1,390 @@
+﻿"""图书共享系统的 HTTP JSON 接口
+
+    python bookapi.py --port 8000
+
+基于标准库 ThreadingHTTPServer，每个请求一个线程，所有请求共用一个 BookService（读连接池加一个写连接）。
+当前用户由请求头 X-User 指定，写操作必须提供。
+写操作可以带上读到的书籍版本号 version，书籍在此期间被修改过时返回 409（VersionConflict）；
+书籍已被别人借走等状态冲突同样返回 409（BookUnavailable）。
+
+    GET    /books?after=0&limit=100     按 id 分页列出书籍
+    GET    /books/<id>                  书籍详情
+    POST   /books                       添加书籍
+    PUT    /books/<id>                  修改书籍，请求体可带 "version"
+    DELETE /books/<id>?version=<版本>   删除书籍
+    POST   /books/<id>/borrow           借阅，请求体 {"days": 30, "version": 可选}
+    POST   /books/<id>/return           归还，请求体 {"version": 可选}；有人预约时直接借给排在最前的预约者
+    POST   /books/<id>/reserve          预约借出中的书，请求体 {"days": 30}，返回排队位置；轮到时自动借出
+    DELETE /books/<id>/reserve          取消预约
+    GET    /books/<id>/reservations     预约排队的人数
+    GET    /books/<id>/similar          借过这本书的读者也借了（预先算好的推荐，?limit=10）
+    GET    /search?q=<词>&limit=1000    搜索，按相关度排序
+    GET    /stats                       各状态的书籍数量
+    GET    /users/<用户>/stats          用户的借阅/共享次数
+    GET    /users/<用户>/borrows        用户的借阅记录（分页与筛选参数同下）
+    GET    /users/<用户>/shares         用户书籍的共享记录，?limit=200&status=借阅中&since=&until=&order=asc&after=<next>
+    GET    /users/<用户>/reminders      用户收到的到期/逾期提醒
+    GET    /overdue                     已逾期的书籍
+    GET    /metrics                     性能剖析统计（Prometheus 文本格式）
+    GET    /debug/profile               性能剖析统计和最近的慢查询（JSON）
+
+每个请求的处理函数和执行的 SQL 语句按 --profile-sample 的比例抽样计时（见 bookprofile.py）。
+"""
+import argparse
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import sys
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from bookdb import BUSY_TIMEOUT, DB_PATH
+from bookprofile import SAMPLE_RATE, SLOW_QUERY_MS, Profiler
+from bookrecommend import TOP_K
+from bookservice import (BOOK_COLUMNS, LIST_COLUMNS, RECORD_PAGE_SIZE, SEARCH_LIMIT, BookService, ServiceError,
+                         ValidationError)
+from bookshard import library_db
+
+# 分页大小上限
+MAX_PAGE_SIZE = 500
+
+# 请求体大小上限（字节）
+MAX_BODY = 64 * 1024
+
+OWNER_RECORD_COLUMNS = ("id", "book_id", "title", "borrower", "borrow_date", "return_date", "status")
+BORROW_RECORD_COLUMNS = ("id", "book_id", "title", "borrow_date", "return_date", "status")
+USER_STATS_COLUMNS = ("borrow_total", "borrowing", "share_total", "sharing")
+REMINDER_COLUMNS = ("book_id", "title", "due_date", "kind", "created_at")
+OVERDUE_COLUMNS = ("id", "title", "borrower", "owner", "borrow_until")
+SIMILAR_COLUMNS = ("id", "title", "author", "status", "score")
+RESERVATION_COLUMNS = ("book_id", "title", "status", "position", "created_at", "expires")
+
+
+def _rows(columns, rows):
+    """查询结果转为字典列表"""
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def _delta(delta):
+    """写操作结果：变更后的书籍（删除时为 null）"""
+    return {"op": delta.op, "id": delta.book_id, "book": dict(zip(LIST_COLUMNS, delta.row)) if delta.row else None}
+
+
+def _int(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValidationError(f"{name} 必须是整数") from None
+
+
+def _record_page(page):
+    """一页共享记录；next 为 "借阅日期天数:记录ID"，作为下一页的 after 参数"""
+    return {"total": page.total, "borrowing": page.borrowing,
+            "next": f"{page.next[0]}:{page.next[1]}" if page.next else None}
+
+
+def _days(body):
+    """借阅天数，默认 30"""
+    days = _int(body.get("days", 30), "days")
+    if not 1 <= days <= 365:
+        raise ValidationError("借阅天数必须在 1 到 365 之间")
+    return days
+
+
+def _version(value):
+    """可选的书籍版本号"""
+    return None if value is None else _int(value, "version")
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """把请求分派到 BookService；业务错误按 ServiceError.status 返回"""
+    server_version = "BookSharing/1.0"
+    protocol_version = "HTTP/1.1"
+    # 响应头和响应体分两次写出，关闭 Nagle 算法避免保持连接时每个请求多等 40ms
+    disable_nagle_algorithm = True
+
+    # (方法, 路径正则, 处理函数名)
+    ROUTES = [
+        ("GET", r"/books", "list_books"),
+        ("POST", r"/books", "add_book"),
+        ("GET", r"/books/(\d+)", "get_book"),
+        ("PUT", r"/books/(\d+)", "update_book"),
+        ("DELETE", r"/books/(\d+)", "delete_book"),
+        ("POST", r"/books/(\d+)/borrow", "borrow_book"),
+        ("POST", r"/books/(\d+)/return", "return_book"),
+        ("GET", r"/books/(\d+)/similar", "similar_books"),
+        ("POST", r"/books/(\d+)/reserve", "reserve_book"),
+        ("DELETE", r"/books/(\d+)/reserve", "cancel_reservation"),
+        ("GET", r"/books/(\d+)/reservations", "queue_length"),
+        ("GET", r"/search", "search"),
+        ("GET", r"/stats", "stats"),
+        ("GET", r"/users/([^/]+)/stats", "user_stats"),
+        ("GET", r"/users/([^/]+)/borrows", "user_borrows"),
+        ("GET", r"/users/([^/]+)/shares", "user_shares"),
+        ("GET", r"/users/([^/]+)/reminders", "user_reminders"),
+        ("GET", r"/users/([^/]+)/reservations", "user_reservations"),
+        ("GET", r"/overdue", "overdue"),
+        ("GET", r"/metrics", "metrics"),
+        ("GET", r"/debug/profile", "profile"),
+    ]
+
+    @property
+    def service(self):
+        return self.server.service
+
+    @property
+    def profiler(self):
+        return self.service.manager.profiler
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method):
+        """按路由调用处理函数并返回 JSON（处理函数返回字符串时为纯文本）"""
+        url = urlsplit(self.path)
+        self.query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+        # 先读完请求体，出错返回时连接仍可复用
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY:
+            self.close_connection = True
+            self.send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "请求体过大"})
+            return
+        self.body = self.rfile.read(length)
+
+        path_matched = False
+        for route_method, pattern, handler in self.ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if not match:
+                continue
+            path_matched = True
+            if route_method != method:
+                continue
+            try:
+                args = [unquote(group) for group in match.groups()]
+                if self.profiler is None:
+                    body = getattr(self, handler)(*args)
+                else:
+                    body = self.profiler.call("handler", handler, getattr(self, handler), *args)
+            except ServiceError as error:
+                self.send_json(error.status, {"error": str(error), "type": type(error).__name__})
+            except Exception as error:
+                self.log_error("%s %s 失败: %r", method, self.path, error)
+                self.send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "服务器内部错误"})
+            else:
+                status = HTTPStatus.CREATED if method == "POST" and handler == "add_book" else HTTPStatus.OK
+                if isinstance(body, str):
+                    self.send_text(status, body)
+                else:
+                    self.send_json(status, body)
+            return
+        if path_matched:
+            self.send_json(HTTPStatus.METHOD_NOT_ALLOWED, {"error": "不支持的请求方法"})
+        else:
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": "接口不存在"})
+
+    def send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_text(self, status, text):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def read_json(self):
+        """解析 JSON 请求体"""
+        if not self.body:
+            return {}
+        try:
+            body = json.loads(self.body)
+        except ValueError:
+            raise ValidationError("请求体不是合法的 JSON") from None
+        if not isinstance(body, dict):
+            raise ValidationError("请求体必须是 JSON 对象")
+        return body
+
+    @property
+    def user(self):
+        """当前用户（请求头 X-User，UTF-8 百分号编码）"""
+        user = unquote(self.headers.get("X-User", "")).strip()
+        if not user:
+            raise ValidationError("缺少请求头 X-User")
+        return user
+
+    # ---- 书籍 ----
+
+    def list_books(self):
+        after = _int(self.query.get("after", 0), "after")
+        limit = min(max(_int(self.query.get("limit", 100), "limit"), 1), MAX_PAGE_SIZE)
+        books = self.service.list_books(after, limit)
+        return {"books": _rows(LIST_COLUMNS, books), "next": books[-1][0] if len(books) == limit else None}
+
+    def get_book(self, book_id):
+        return dict(zip(BOOK_COLUMNS, self.service.get_book(int(book_id))))
+
+    def add_book(self):
+        return _delta(self.service.add_book(self.user, self.read_json()))
+
+    def update_book(self, book_id):
+        body = self.read_json()
+        return _delta(self.service.update_book(self.user, int(book_id), body, _version(body.get("version"))))
+
+    def delete_book(self, book_id):
+        return _delta(self.service.delete_book(self.user, int(book_id), _version(self.query.get("version"))))
+
+    def borrow_book(self, book_id):
+        body = self.read_json()
+        return _delta(self.service.borrow_book(self.user, int(book_id), _days(body), _version(body.get("version"))))
+
+    def return_book(self, book_id):
+        body = self.read_json()
+        return _delta(self.service.return_book(self.user, int(book_id), _version(body.get("version"))))
+
+    def reserve_book(self, book_id):
+        return {"position": self.service.reserve_book(self.user, int(book_id), _days(self.read_json()))}
+
+    def cancel_reservation(self, book_id):
+        return {"cancelled": self.service.cancel_reservation(self.user, int(book_id))}
+
+    def queue_length(self, book_id):
+        return {"queue": self.service.queue_length(int(book_id))}
+
+    def similar_books(self, book_id):
+        limit = min(max(_int(self.query.get("limit", TOP_K), "limit"), 1), TOP_K)
+        return {"books": _rows(SIMILAR_COLUMNS, self.service.similar_books(int(book_id), limit))}
+
+    # ---- 搜索与统计 ----
+
+    def search(self):
+        limit = min(max(_int(self.query.get("limit", SEARCH_LIMIT), "limit"), 1), SEARCH_LIMIT)
+        ids = self.service.search(self.query.get("q", ""), limit)
+        return {"books": _rows(LIST_COLUMNS, self.service.books_by_ids(ids))}
+
+    def stats(self):
+        return self.service.book_counts()
+
+    def user_stats(self, user):
+        return dict(zip(USER_STATS_COLUMNS, self.service.user_counts(user)))
+
+    def record_query(self):
+        """共享记录的分页、筛选和排序参数"""
+        after = self.query.get("after")
+        if after is not None:
+            day, _, record_id = after.partition(":")
+            after = (_int(day, "after"), _int(record_id, "after"))
+        order = self.query.get("order", "desc")
+        if order not in ("asc", "desc"):
+            raise ValidationError("order 只能是 asc 或 desc")
+        return {
+            "after": after,
+            "limit": min(max(_int(self.query.get("limit", RECORD_PAGE_SIZE), "limit"), 1), MAX_PAGE_SIZE),
+            "status": self.query.get("status"),
+            "since": self.query.get("since"),
+            "until": self.query.get("until"),
+            "ascending": order == "asc",
+        }
+
+    def user_borrows(self, user):
+        page = self.service.borrow_records(user, **self.record_query())
+        return {"records": _rows(BORROW_RECORD_COLUMNS, page.rows), **_record_page(page)}
+
+    def user_shares(self, user):
+        page = self.service.owner_records(user, **self.record_query())
+        return {"records": _rows(OWNER_RECORD_COLUMNS, page.rows), **_record_page(page)}
+
+    def user_reminders(self, user):
+        return {"reminders": _rows(REMINDER_COLUMNS, self.service.reminders(user))}
+
+    def user_reservations(self, user):
+        return {"reservations": _rows(RESERVATION_COLUMNS, self.service.reservations(user))}
+
+    def overdue(self):
+        return {"books": _rows(OVERDUE_COLUMNS, self.service.overdue_books())}
+
+    # ---- 性能剖析 ----
+
+    def metrics(self):
+        return self.profiler.to_prometheus()
+
+    def profile(self):
+        return self.profiler.to_json()
+
+
+class ApiServer(ThreadingHTTPServer):
+    """多线程 HTTP 服务，所有请求线程共用一个 BookService"""
+    daemon_threads = True
+
+    def __init__(self, address, service, quiet=False):
+        super().__init__(address, ApiHandler)
+        self.service = service
+        self.quiet = quiet
+
+
+def make_server(host="127.0.0.1", port=8000, db_path=DB_PATH, quiet=False, **options):
+    """创建服务（先升级数据库结构），port 为 0 时自动选择端口；没有指定 profiler 时按默认比例抽样剖析"""
+    options.setdefault("profiler", Profiler())
+    service = BookService(db_path, **options)
+    service.migrate()
+    return ApiServer((host, port), service, quiet)
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="图书共享系统 HTTP JSON 接口")
+    parser.add_argument("--db", default=DB_PATH, help="数据库文件")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=8000, help="监听端口")
+    parser.add_argument("--readers", type=int, default=8, help="读连接池大小")
+    parser.add_argument("--busy-timeout", type=float, default=BUSY_TIMEOUT, help="等待其他进程释放锁的秒数")
+    parser.add_argument("--profile-sample", type=float, default=SAMPLE_RATE,
+                        help="性能剖析的抽样比例（0 关闭，1 记录每个请求）")
+    parser.add_argument("--slow-ms", type=float, default=SLOW_QUERY_MS, help="慢查询阈值（毫秒）")
+    parser.add_argument("--quiet", action="store_true", help="不输出访问日志")
+    parser.add_argument("--shards", default="libraries", help="多馆分库的根目录（bookshard.py）")
+    parser.add_argument("--library", help="馆名：打开该馆所在分片中的数据库文件，代替 --db")
+    args = parser.parse_args(argv)
+
+    db_path = args.db
+    if args.library:
+        try:
+            db_path = library_db(args.shards, args.library)
+        except ServiceError as error:
+            parser.error(str(error))
+    server = make_server(args.host, args.port, db_path, args.quiet,
+                         readers=args.readers, busy_timeout=args.busy_timeout,
+                         profiler=Profiler(args.profile_sample, args.slow_ms))
+    host, port = server.server_address[:2]
+    print(f"图书共享接口: http://{host}:{port}/books")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1698 @@
+﻿"""图书共享系统的性能测试
+
+    python bookbench.py concurrency --processes 4 --cycles 200
+    python bookbench.py contention --processes 8 --books 1
+    python bookbench.py api --clients 8 --requests 200
+    python bookbench.py import --rows 100000
+    python bookbench.py export --rows 10000000
+    python bookbench.py normalize --books 1000000 --records 2000000
+    python bookbench.py ops --books 100000 --output results.json
+    python bookbench.py ops --db big.db --compare results.json
+    python bookbench.py ops --db big.db --compare results.json --profile-sample 0.05
+    python bookbench.py shards --shards 4 --processes 8
+    xvfb-run python bookbench.py startup --db big.db --output startup.json
+    python bookbench.py recommend --db big.db
+    python bookbench.py reserve --users 5000 --books 4
+    python bookbench.py sync --db big.db --changes 100,1000
+    python bookbench.py batch --books 200
+
+concurrency：多个进程同时对同一个数据库反复借阅、归还书籍，另有进程同时翻页读取书籍列表，
+结束后检查数据一致性并报告读写吞吐量。
+contention：多个进程争抢极少几本书，借到后持有一会儿再归还，报告借阅吞吐量、冲突率，并持续检查有没有重复借出。
+api：启动 HTTP 接口，多个客户端线程同时翻页、查看详情和借还书籍，报告请求吞吐量与延迟。
+import：生成书目文件并批量导入，报告只读取校验、首次导入和重复导入（全部按 ISBN 去重）的每秒行数。
+export：生成大量共享记录，逐个格式在子进程中导出，报告每秒行数、文件大小和子进程内存峰值（不含内存映射的数据库文件）；
+导出期间主进程持续借还书籍，报告写操作的延迟，检验导出不阻塞写入。
+normalize：在旧结构（版本 7，用户、分类和状态都是文本）上生成数据，迁移到整数编号的新结构，
+报告迁移耗时、前后的数据库大小，以及常用查询在旧结构、兼容视图（旧的 SQL 不变）和新结构上的耗时。
+ops：在 bookgen.py 生成的数据上按界面的调用方式测试各操作（打开列表、跳转滚动、查看详情、搜索、我的共享、借阅记录、借还），
+包括把结果填入表格；有图形界面时（或用 xvfb-run 运行）使用真实的 ttk.Treeview，否则使用模拟的表格。
+报告每个操作的 p50/p99 耗时和 Python 内存分配峰值，可以保存为 JSON，并与以前保存的结果对比。
+指定 --profile-sample 时打开性能剖析（bookprofile.py），与不打开时的结果对比即为剖析的开销，并列出总耗时最多的语句。
+shards：同样数量的进程并发借还，分别把所有馆放在 1、2、4…个分片（每个分片一个馆的数据库文件，bookshard.py）上，
+报告各自的写吞吐量和相对一个分片的倍数，并检查每个馆的数据一致性。写事务主要受单个文件的写锁限制时，
+吞吐量随分片数近似线性增长，直到 CPU 核数或磁盘成为瓶颈。
+startup：在新的 Python 进程中打开界面（需要图形界面或 xvfb-run），从启动进程开始计时，报告导入模块、
+建立窗口、首次绘制（窗口显示出来）、统计数字到达和第一页书籍显示（可以操作）的时间，多次运行取中位数和最长值。
+recommend：借阅推荐（bookrecommend.py）分别用 NumPy 和标准库全部重建的耗时，两者的结果是否一致；
+随机借还产生新的借阅后增量更新的速度（本/秒），以及读取一本书推荐的 p50/p99 耗时。
+reserve：几本热门书都已借出，几千个用户由多个进程同时预约；然后每本书一个进程反复归还，每次归还在同一个事务中
+借给排在最前的预约者，直到队列排空。报告预约和归还（含转借）的吞吐量与延迟，并检查每本书的借出顺序与预约顺序一致、
+没有重复借出，统计表与实际一致。
+sync：把数据库复制一份作为另一个节点（booksync.py），先做第一次同步（发送全部数据），然后每轮在两个节点上
+各做若干次随机借还（同一本书可能在两边同时借出）再双向同步，报告每轮同步的耗时、批次数和压缩后的字节数，
+并检查两个节点的书籍和共享记录一致。增量同步的耗时应随变更数增长，与数据库大小无关。
+batch：界面多选的一批书分别逐本调用（每本一个事务）和一次批量调用（一个事务，executemany）编辑、借阅、归还，
+报告两者的耗时和倍数，并检查统计表与共享记录一致。
+"""
+import argparse
+from collections import defaultdict
+from contextlib import closing
+import csv
+import hashlib
+from datetime import datetime
+import http.client
+from itertools import accumulate
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from urllib.parse import quote
+
+from bookdb import (BORROWING, BUSY_TIMEOUT, RETURNED, ConnectionManager, archive_tables, category_id, connect, day_sql,
+                    fts_available, is_busy, migrate, to_day, user_id)
+from bookprofile import Profiler
+from bookrecommend import Recommender, np
+from bookservice import LIST_COLUMNS, BookConflict, BookNotFound, BookService
+from bookshard import ShardRouter
+from booksync import LocalTransport, SyncNode, new_node
+
+
+def _prepare_db(db_path, books, journal_mode):
+    """建立测试数据库并插入书籍"""
+    service = BookService(db_path, readers=1, journal_mode=journal_mode)
+    try:
+        service.migrate()
+
+        def seed(conn):
+            category = category_id(conn, "测试")
+            owners = [user_id(conn, f"拥有者{i}", True) for i in range(5)]
+            conn.executemany(
+                "INSERT INTO book_items (title, author, category_id, owner_id) VALUES (?, ?, ?, ?)",
+                [(f"测试书籍{i}", f"作者{i}", category, owners[i % 5]) for i in range(books)],
+            )
+        service.manager.run_write(seed)
+        return [row[0] for row in service.list_books(0, books)]
+    finally:
+        service.close()
+
+
+def _worker(db_path, user, book_ids, cycles, hold, options, start, results):
+    """一个进程：随机挑书借阅，持有 hold 秒后归还，记录每次借还的耗时"""
+    service = BookService(db_path, readers=1, **options)
+    rng = random.Random(user)
+    borrowed = conflicts = failures = 0
+    latencies = []
+    start.wait()
+    try:
+        for _ in range(cycles):
+            book_id = rng.choice(book_ids)
+            began = time.perf_counter()
+            try:
+                service.borrow_book(user, book_id)
+                borrowed += 1
+                if hold:
+                    time.sleep(hold)
+                service.return_book(user, book_id)
+            except BookConflict:
+                conflicts += 1
+            except Exception as error:
+                if not is_busy(error):
+                    raise
+                failures += 1
+            latencies.append(time.perf_counter() - began)
+    finally:
+        service.close()
+    results.put((user, borrowed, conflicts, failures, latencies))
+
+
+def _reader(db_path, options, start, stop, results):
+    """一个进程：写入进行期间反复读取统计和书籍列表，记录读取次数、锁等待失败次数和看到的重复借出"""
+    manager = ConnectionManager(db_path, readers=1, **options)
+
+    def read_page(conn):
+        conn.execute("SELECT s.name, book_stats.count FROM book_stats "
+                     "JOIN statuses s ON s.code = book_stats.status_code").fetchall()
+        conn.execute(
+            "SELECT id, title, status, borrower FROM books WHERE id > ? ORDER BY id LIMIT 100", (0,)
+        ).fetchall()
+        # 同一本书同时有多条借阅中的记录即为重复借出
+        return conn.execute('''
+            SELECT COUNT(*) FROM (
+                SELECT book_id FROM sharing_records WHERE status = '借阅中'
+                GROUP BY book_id HAVING COUNT(*) > 1
+            )
+        ''').fetchone()[0]
+
+    reads = failures = double_bookings = 0
+    start.wait()
+    try:
+        while not stop.is_set():
+            try:
+                double_bookings += manager.run_read(read_page)
+                reads += 1
+            except Exception as error:
+                if not is_busy(error):
+                    raise
+                failures += 1
+    finally:
+        manager.close()
+    results.put((reads, failures, double_bookings))
+
+
+def check_consistency(conn, expected_borrows):
+    """检查并发借还后的数据，返回问题列表"""
+    problems = []
+
+    # 所有书籍都已归还
+    borrowing = conn.execute("SELECT COUNT(*) FROM books WHERE status != '可借阅'").fetchone()[0]
+    if borrowing:
+        problems.append(f"{borrowing} 本书未归还")
+    open_records = conn.execute("SELECT COUNT(*) FROM sharing_records WHERE status = '借阅中'").fetchone()[0]
+    if open_records:
+        problems.append(f"{open_records} 条共享记录未关闭")
+
+    # 每次成功借阅恰好对应一条共享记录
+    records = conn.execute("SELECT COUNT(*) FROM sharing_records").fetchone()[0]
+    if records != expected_borrows:
+        problems.append(f"共享记录 {records} 条，成功借阅 {expected_borrows} 次")
+
+    # 物化统计表与重新统计的结果一致
+    stats = dict(conn.execute(
+        "SELECT s.name, book_stats.count FROM book_stats JOIN statuses s ON s.code = book_stats.status_code "
+        "WHERE book_stats.count != 0"
+    ))
+    actual = dict(conn.execute("SELECT COALESCE(status, ''), COUNT(*) FROM books GROUP BY 1"))
+    if stats != actual:
+        problems.append(f"书籍统计 {stats} 与实际 {actual} 不一致")
+    mismatched = conn.execute(f'''
+        SELECT COUNT(*) FROM user_stats us
+        WHERE us.borrow_total != (SELECT COUNT(*) FROM loan_history WHERE borrower_id = us.user_id)
+           OR us.borrowing != (SELECT COUNT(*) FROM loans WHERE borrower_id = us.user_id AND status_code = {BORROWING})
+    ''').fetchone()[0]
+    if mismatched:
+        problems.append(f"{mismatched} 个用户的借阅统计与实际不一致")
+    return problems
+
+
+def run_concurrency(db_path, processes, cycles, books, readers, options, hold=0):
+    """启动多个进程并发借还（以及并发读取），返回 (汇总, 问题列表)"""
+    book_ids = _prepare_db(db_path, books, options["journal_mode"])
+
+    start = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    read_results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=_worker, args=(db_path, f"用户{n}", book_ids, cycles, hold, options, start, results)
+        )
+        for n in range(processes)
+    ]
+    reader_processes = [
+        multiprocessing.Process(target=_reader, args=(db_path, options, start, stop, read_results))
+        for _ in range(readers)
+    ]
+    for process in workers + reader_processes:
+        process.start()
+    began = time.perf_counter()
+    start.set()
+    reports = [results.get() for _ in workers]
+    elapsed = time.perf_counter() - began
+    stop.set()
+    read_reports = [read_results.get() for _ in reader_processes]
+    for process in workers + reader_processes:
+        process.join()
+
+    borrowed = sum(r[1] for r in reports)
+    conflicts = sum(r[2] for r in reports)
+    failures = sum(r[3] for r in reports)
+    latencies = sorted(latency for r in reports for latency in r[4])
+    summary = {
+        "elapsed": elapsed,
+        "borrowed": borrowed,
+        "conflicts": conflicts,
+        "failures": failures,
+        # 每次成功借阅包含借、还两个写事务
+        "transactions_per_second": (2 * borrowed + conflicts) / elapsed,
+        "borrows_per_second": borrowed / elapsed,
+        "conflict_rate": conflicts / max(borrowed + conflicts, 1),
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "reads_per_second": sum(r[0] for r in read_reports) / elapsed,
+        "read_failures": sum(r[1] for r in read_reports),
+        "double_bookings": sum(r[2] for r in read_reports),
+    }
+
+    manager = ConnectionManager(db_path, readers=1)
+    try:
+        problems = manager.run_read(check_consistency, borrowed)
+    finally:
+        manager.close()
+    if summary["double_bookings"]:
+        problems.append(f"读取时发现 {summary['double_bookings']} 次重复借出")
+    return summary, problems
+
+
+def _reserver(db_path, users, book_ids, start, results):
+    """一个进程：每个用户随机预约一本热门书，记录每次预约的耗时"""
+    service = BookService(db_path, readers=1)
+    rng = random.Random(users[0] if users else 0)
+    latencies = []
+    start.wait()
+    try:
+        for user in users:
+            book_id = rng.choice(book_ids)
+            began = time.perf_counter()
+            service.reserve_book(user, book_id)
+            latencies.append(time.perf_counter() - began)
+    finally:
+        service.close()
+    results.put(latencies)
+
+
+def _drainer(db_path, book_id, start, results):
+    """一个进程：当前借阅人反复归还一本书（归还时转借给下一位预约者），直到没有人预约，记录每次归还的耗时"""
+    service = BookService(db_path, readers=1)
+    latencies = []
+    start.wait()
+    try:
+        while True:
+            borrower = service.get_book(book_id)[9]
+            if borrower is None:
+                break
+            began = time.perf_counter()
+            service.return_book(borrower, book_id)
+            latencies.append(time.perf_counter() - began)
+    finally:
+        service.close()
+    results.put(latencies)
+
+
+def _run_processes(target, argument_lists):
+    """同时启动一组进程，返回 (耗时, 各进程的结果)"""
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=target, args=(*arguments, start, results))
+                 for arguments in argument_lists]
+    for process in processes:
+        process.start()
+    began = time.perf_counter()
+    start.set()
+    reports = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - began
+    for process in processes:
+        process.join()
+    return elapsed, reports
+
+
+def run_reserve(db_path, users, books, processes):
+    """热门书的预约排队与归还转借，返回 (汇总, 问题列表)"""
+    book_ids = _prepare_db(db_path, books, "WAL")
+    service = BookService(db_path, readers=1)
+    try:
+        for book_id in book_ids:
+            service.borrow_book("首位读者", book_id)
+    finally:
+        service.close()
+
+    names = [f"读者{n}" for n in range(users)]
+    reserve_elapsed, reserve_reports = _run_processes(
+        _reserver, [(db_path, names[n::processes], book_ids) for n in range(processes)])
+
+    def queues(conn):
+        expected = defaultdict(list)
+        for book_id, user in conn.execute(
+            "SELECT r.book_id, u.name FROM reservations r JOIN users u ON u.id = r.user_id "
+            "ORDER BY r.book_id, r.created_at, r.id"
+        ):
+            expected[book_id].append(user)
+        return expected
+
+    manager = ConnectionManager(db_path, readers=1)
+    try:
+        expected = manager.run_read(queues)
+    finally:
+        manager.close()
+
+    drain_elapsed, drain_reports = _run_processes(_drainer, [(db_path, book_id) for book_id in book_ids])
+
+    def check(conn):
+        problems = check_consistency(conn, books + users)
+        waiting = conn.execute("SELECT COUNT(*) FROM reservations").fetchone()[0]
+        if waiting:
+            problems.append(f"还有 {waiting} 个预约没有轮到")
+        for book_id in book_ids:
+            served = [name for (name,) in conn.execute(
+                "SELECT borrower FROM sharing_records WHERE book_id = ? ORDER BY id", (book_id,))][1:]
+            if served != expected[book_id]:
+                problems.append(f"书籍 {book_id} 的借出顺序与预约顺序不一致")
+        return problems
+
+    manager = ConnectionManager(db_path, readers=1)
+    try:
+        problems = manager.run_read(check)
+    finally:
+        manager.close()
+
+    reserve_latencies = sorted(latency for report in reserve_reports for latency in report)
+    drain_latencies = sorted(latency for report in drain_reports for latency in report)
+    return {
+        "longest_queue": max(map(len, expected.values()), default=0),
+        "reserve_elapsed": reserve_elapsed,
+        "reserves_per_second": users / reserve_elapsed,
+        "reserve_p50_ms": statistics.median(reserve_latencies) * 1000,
+        "reserve_p99_ms": _percentile(reserve_latencies, 0.99) * 1000,
+        "returns": len(drain_latencies),
+        "drain_elapsed": drain_elapsed,
+        "returns_per_second": len(drain_latencies) / drain_elapsed,
+        "return_p50_ms": statistics.median(drain_latencies) * 1000,
+        "return_p99_ms": _percentile(drain_latencies, 0.99) * 1000,
+    }, problems
+
+
+def run_batch(db_path, books, repeat):
+    """同样的一批书逐本调用与一次批量调用的耗时，返回 ({操作: (逐本秒数, 批量秒数)}, 问题列表)"""
+    book_ids = _prepare_db(db_path, books, "WAL")
+    service = BookService(db_path, readers=1)
+    owner = "拥有者0"
+    try:
+        owned = [row[0] for row in service.list_books(0, books) if row[5] == owner]
+        # 逐本编辑时由界面带上书籍原有的字段，只改出版社
+        fields = {book[0]: {"title": book[1], "author": book[2], "category": book[4], "publisher": "批量"}
+                  for book in map(service.get_book, owned)}
+        operations = [
+            ("编辑", lambda: [service.update_book(owner, book_id, fields[book_id]) for book_id in owned],
+             lambda: service.update_books(owner, owned, {"publisher": "批量"})),
+            ("借阅", lambda: [service.borrow_book("读者", book_id) for book_id in book_ids],
+             lambda: service.borrow_books("读者", book_ids)),
+            ("归还", lambda: [service.return_book("读者", book_id) for book_id in book_ids],
+             lambda: service.return_books("读者", book_ids)),
+        ]
+        timings = {action: [[], []] for action, _, _ in operations}
+        problems = []
+        for _ in range(repeat):
+            for mode in (0, 1):
+                for action, single, batch in operations:
+                    began = time.perf_counter()
+                    result = (single, batch)[mode]()
+                    timings[action][mode].append(time.perf_counter() - began)
+                    if mode and result.failures:
+                        problems.append(f"批量{action}失败 {len(result.failures)} 本：{result.failures[0][2]}")
+        problems.extend(service.manager.run_read(check_consistency, 2 * repeat * books))
+    finally:
+        service.close()
+    return {action: (statistics.median(single), statistics.median(batch))
+            for action, (single, batch) in timings.items()}, problems
+
+
+def run_shards(shard_counts, processes, cycles, books):
+    """按不同的分片数并发借还：进程轮流分到各馆，每个分片一个馆，返回 [(分片数, 汇总, 问题列表)]"""
+    results = []
+    for shards in shard_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            router = ShardRouter(directory, readers=1)
+            try:
+                libraries = []
+                for n in range(shards):
+                    library = f"馆{n}"
+                    router.add_library(library, router.add_shard())
+                    path = router.library_path(library)
+                    libraries.append((library, path, _prepare_db(path, books, "WAL")))
+            finally:
+                router.close()
+
+            start = multiprocessing.Event()
+            queue = multiprocessing.Queue()
+            workers = []
+            for n in range(processes):
+                _, path, book_ids = libraries[n % shards]
+                workers.append(multiprocessing.Process(
+                    target=_worker, args=(path, f"用户{n}", book_ids, cycles, 0, {}, start, queue)))
+            for process in workers:
+                process.start()
+            began = time.perf_counter()
+            start.set()
+            reports = [queue.get() for _ in workers]
+            elapsed = time.perf_counter() - began
+            for process in workers:
+                process.join()
+
+            by_user = {report[0]: report for report in reports}
+            problems = []
+            for n, (library, path, _) in enumerate(libraries):
+                borrowed = sum(by_user[f"用户{m}"][1] for m in range(n, processes, shards))
+                manager = ConnectionManager(path, readers=1)
+                try:
+                    problems.extend(f"{library}: {problem}" for problem in manager.run_read(check_consistency, borrowed))
+                finally:
+                    manager.close()
+
+        borrowed = sum(r[1] for r in reports)
+        conflicts = sum(r[2] for r in reports)
+        latencies = sorted(latency for r in reports for latency in r[4])
+        results.append((shards, {
+            "elapsed": elapsed,
+            "transactions_per_second": (2 * borrowed + conflicts) / elapsed,
+            "failures": sum(r[3] for r in reports),
+            "p50_ms": statistics.median(latencies) * 1000,
+            "p99_ms": _percentile(latencies, 0.99) * 1000,
+        }, problems))
+    return results
+
+
+def _percentile(values, fraction):
+    """已排序列表的分位数"""
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def _api_client(port, user, book_ids, requests, start, results):
+    """一个客户端线程：按 6:3:1 的比例翻页、查看详情、借还书籍"""
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    headers = {"X-User": quote(user), "Content-Type": "application/json"}
+    rng = random.Random(user)
+    latencies = []
+    errors = 0
+
+    def call(method, path, body=None):
+        conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+
+    start.wait()
+    try:
+        for _ in range(requests):
+            choice = rng.random()
+            book_id = rng.choice(book_ids)
+            began = time.perf_counter()
+            if choice < 0.6:
+                status = call("GET", f"/books?after={book_id}&limit=50")
+            elif choice < 0.9:
+                status = call("GET", f"/books/{book_id}")
+            else:
+                status = call("POST", f"/books/{book_id}/borrow", {"days": 7})
+                if status == 200:
+                    status = call("POST", f"/books/{book_id}/return")
+                elif status == 409:
+                    status = 200
+            latencies.append(time.perf_counter() - began)
+            errors += status != 200
+    finally:
+        conn.close()
+    results.append((latencies, errors))
+
+
+def run_api(clients, requests, books, readers):
+    """在临时数据库上启动 HTTP 接口并发起并发请求，返回汇总"""
+    # 延迟导入：concurrency 测试不需要 HTTP 服务
+    from bookapi import make_server
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "bench.db")
+        book_ids = _prepare_db(db_path, books, "WAL")
+        server = make_server(port=0, db_path=db_path, quiet=True, readers=readers)
+        port = server.server_address[1]
+        serving = threading.Thread(target=server.serve_forever, daemon=True)
+        serving.start()
+        try:
+            start = threading.Event()
+            results = []
+            threads = [
+                threading.Thread(target=_api_client, args=(port, f"用户{n}", book_ids, requests, start, results))
+                for n in range(clients)
+            ]
+            for thread in threads:
+                thread.start()
+            began = time.perf_counter()
+            start.set()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - began
+        finally:
+            server.shutdown()
+            server.server_close()
+            server.service.close()
+
+    latencies = sorted(latency for r in results for latency in r[0])
+    return {
+        "elapsed": elapsed,
+        "requests": len(latencies),
+        "errors": sum(r[1] for r in results),
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+    }
+
+
+def _write_catalog(path, rows, invalid_every=100):
+    """生成 CSV 书目文件，每 invalid_every 行有一行缺少书名"""
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["书名", "作者", "ISBN", "分类", "出版社", "出版年份", "描述"])
+        for i in range(rows):
+            title = "" if invalid_every and i % invalid_every == invalid_every - 1 else f"测试书籍{i}"
+            writer.writerow([title, f"作者{i % 1000}", f"978{i:010d}", "测试", "某出版社", 1950 + i % 70,
+                             "批量导入性能测试用的书籍"])
+
+
+def run_import(rows, batch_size):
+    """在临时数据库上导入生成的书目，返回汇总"""
+    # 延迟导入：其他测试不需要导入模块
+    from bookimport import import_books, read_records
+    from bookservice import ServiceError, validate_book
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "catalog.csv")
+        _write_catalog(path, rows)
+
+        # 只读取和校验，不写数据库：导入速度的上限
+        began = time.perf_counter()
+        for _, record in read_records(path):
+            try:
+                validate_book(record)
+            except ServiceError:
+                pass
+        parse_elapsed = time.perf_counter() - began
+
+        service = BookService(os.path.join(directory, "bench.db"), readers=1)
+        try:
+            service.migrate()
+            first = import_books(service, path, "导入测试", batch_size=batch_size)
+            again = import_books(service, path, "导入测试", batch_size=batch_size, restart=True)
+        finally:
+            service.close()
+
+        # 没有一两个字的索引（books_grams）时的首次导入，与上面的差即为这个索引的开销
+        service = BookService(os.path.join(directory, "plain.db"), readers=1)
+        try:
+            service.migrate()
+            service.manager.run_write(_drop_grams)
+            plain = import_books(service, path, "导入测试", batch_size=batch_size)
+        finally:
+            service.close()
+
+    return {
+        "parse_rows_per_second": rows / parse_elapsed,
+        "first": first,
+        "again": again,
+        "without_grams": plain,
+    }
+
+
+def _drop_grams(conn):
+    """去掉一两个字的索引及维护它的触发器"""
+    for event in ("insert", "delete", "update"):
+        conn.execute(f"DROP TRIGGER IF EXISTS books_grams_{event}")
+    conn.execute("DROP TABLE IF EXISTS books_grams")
+
+
+def _seed_records(db_path, rows):
+    """用递归 CTE 生成 rows 条共享记录；生成时暂时去掉逐行维护用户统计的触发器"""
+    manager = ConnectionManager(db_path, readers=1)
+
+    def seed(conn):
+        sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'user_stats_insert'").fetchone()
+        if sql:
+            conn.execute("DROP TRIGGER user_stats_insert")
+        conn.execute('''
+            INSERT OR IGNORE INTO users (name)
+            WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < 500)
+            SELECT '用户' || i FROM n
+        ''')
+        conn.execute(f'''
+            INSERT INTO loans (book_id, borrower_id, borrow_date, return_date, status_code)
+            WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < ?)
+            SELECT i % 1000 + 1, (SELECT id FROM users WHERE name = '用户' || (i % 500)),
+                   {to_day("2020-01-01")} + i % 1800,
+                   CASE WHEN i % 10 THEN {to_day("2020-01-01")} + i % 1800 + 30 END,
+                   CASE WHEN i % 10 THEN {RETURNED} ELSE {BORROWING} END
+            FROM n
+        ''', (rows,))
+        if sql:
+            conn.execute(sql[0])
+    try:
+        manager.run_write(seed)
+    finally:
+        manager.close()
+
+
+def _anonymous_memory():
+    """进程的匿名内存（MB），不含内存映射的数据库文件；只在 Linux 上可用"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _exporter(db_path, fmt, path, results):
+    """子进程：导出共享记录，返回 (导出结果, 导出过程中匿名内存的峰值 MB)"""
+    from bookexport import export_tables
+
+    peak = None
+
+    def sample(table, rows):
+        nonlocal peak
+        memory = _anonymous_memory()
+        if memory is not None:
+            peak = max(peak or 0, memory)
+
+    service = BookService(db_path, readers=1)
+    try:
+        result = export_tables(service, [("sharing_records", path)], fmt, progress=sample)[0]
+    finally:
+        service.close()
+    results.put((result, peak))
+
+
+def run_export(rows, formats):
+    """在临时数据库上生成共享记录并逐个格式导出，同时持续写入，返回每个格式的汇总"""
+    from bookexport import FORMATS
+
+    summaries = []
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "bench.db")
+        book_ids = _prepare_db(db_path, 10, "WAL")
+        began = time.perf_counter()
+        _seed_records(db_path, rows)
+        seed_elapsed = time.perf_counter() - began
+
+        service = BookService(db_path, readers=1)
+        try:
+            for fmt in formats:
+                path = os.path.join(directory, "sharing_records" + FORMATS[fmt])
+                results = multiprocessing.Queue()
+                process = multiprocessing.Process(target=_exporter, args=(db_path, fmt, path, results))
+                process.start()
+
+                # 导出期间不停地借还同一本书，记录每个写事务的耗时
+                latencies = []
+                while process.is_alive() and results.empty():
+                    start = time.perf_counter()
+                    service.borrow_book("写入测试", book_ids[0])
+                    service.return_book("写入测试", book_ids[0])
+                    latencies.append((time.perf_counter() - start) / 2)
+                result, peak = results.get()
+                process.join()
+                os.remove(path)
+                summaries.append({
+                    "format": fmt,
+                    "rows": result.rows,
+                    "elapsed": result.elapsed,
+                    "rows_per_second": result.rows / result.elapsed,
+                    "megabytes": result.bytes / 1024 / 1024,
+                    "peak_mb": peak,
+                    "writes": len(latencies) * 2,
+                    "write_max_ms": max(latencies, default=0) * 1000,
+                })
+        finally:
+            service.close()
+    return seed_elapsed, summaries
+
+
+# 规范化前后对比的查询：(名称, 旧结构上的 SQL, 新结构上的 SQL, 参数)；新 SQL 为 None 表示与旧的相同（在新结构上读视图）
+NORMALIZE_QUERIES = [
+    ("书籍分页",
+     "SELECT id, title, author, category, status, owner, borrower, borrow_until FROM books "
+     "WHERE id > ? ORDER BY id LIMIT 100", None, (1000,)),
+    ("按拥有者查书", "SELECT id, title FROM books WHERE owner = ?",
+     "SELECT id, title FROM book_items WHERE owner_id = (SELECT id FROM users WHERE name = ?)", ("用户7",)),
+    ("按状态计数", "SELECT COUNT(*) FROM books WHERE status = ?",
+     "SELECT COUNT(*) FROM book_items WHERE status_code = (SELECT code FROM statuses WHERE name = ?)", ("共享中",)),
+    ("按分类计数（全表扫描）", "SELECT COUNT(*) FROM books WHERE category = ?",
+     "SELECT COUNT(*) FROM book_items WHERE category_id = (SELECT id FROM categories WHERE name = ?)", ("文学",)),
+    ("借阅中的记录（全表扫描）", "SELECT COUNT(*) FROM sharing_records WHERE status = ?",
+     "SELECT COUNT(*) FROM loans WHERE status_code = (SELECT code FROM statuses WHERE name = ?)", ("借阅中",)),
+    ("借阅记录", '''
+        SELECT sr.id, sr.book_id, sr.book_title, sr.borrow_date, sr.return_date, sr.status
+        FROM sharing_records sr WHERE sr.borrower = ? ORDER BY sr.borrow_date DESC
+    ''', f'''
+        SELECT l.id, l.book_id, b.title, {day_sql("l.borrow_date")}, {day_sql("l.return_date")}, s.name
+        FROM loan_history l
+        LEFT JOIN book_items b ON b.id = l.book_id
+        LEFT JOIN statuses s ON s.code = l.status_code
+        WHERE l.borrower_id = (SELECT id FROM users WHERE name = ?)
+        ORDER BY l.borrow_date DESC
+    ''', ("用户7",)),
+    ("我的共享", '''
+        SELECT sr.id, b.id, b.title, sr.borrower, sr.borrow_date, sr.return_date, sr.status
+        FROM sharing_records sr JOIN books b ON sr.book_id = b.id
+        WHERE b.owner = ? ORDER BY sr.borrow_date DESC
+    ''', f'''
+        SELECT l.id, b.id, b.title, u.name, {day_sql("l.borrow_date")}, {day_sql("l.return_date")}, s.name
+        FROM loan_history l
+        JOIN book_items b ON l.book_id = b.id
+        JOIN users u ON u.id = l.borrower_id
+        LEFT JOIN statuses s ON s.code = l.status_code
+        WHERE b.owner_id = (SELECT id FROM users WHERE name = ?)
+        ORDER BY l.borrow_date DESC
+    ''', ("用户7",)),
+]
+
+# 生成测试数据用的分类
+NORMALIZE_CATEGORIES = ("计算机", "文学", "历史", "经济", "哲学", "艺术", "科学", "教育", "心理学", "社会学",
+                        "政治", "法律", "医学", "军事", "地理", "传记", "小说", "诗歌", "漫画", "外语")
+
+
+def _seed_legacy(conn, books, records, users):
+    """在旧结构上用递归 CTE 生成书籍和共享记录；不建全文索引和一两个字的索引，生成时暂时去掉逐行维护统计的触发器"""
+    conn.execute("BEGIN IMMEDIATE")
+    for name in ("books_fts_insert", "books_fts_delete", "books_fts_update"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+    conn.execute("DROP TABLE IF EXISTS books_fts")
+    _drop_grams(conn)
+    triggers = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name IN ('book_stats_insert', 'user_stats_insert')"
+    ).fetchall()
+    conn.execute("DROP TRIGGER book_stats_insert")
+    conn.execute("DROP TRIGGER user_stats_insert")
+
+    categories = ", ".join(f"({i}, '{name}')" for i, name in enumerate(NORMALIZE_CATEGORIES))
+    conn.execute(f'''
+        INSERT INTO books (title, author, isbn, category, publisher, publish_year, status, owner, borrower,
+                           borrow_until, description)
+        WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < ?1),
+             c(k, name) AS (VALUES {categories})
+        SELECT '测试书籍' || i, '作者' || (i % 5000), printf('978%010d', i), c.name, '出版社' || (i % 200),
+               1950 + i % 75,
+               CASE WHEN i % 5 THEN '可借阅' ELSE '共享中' END,
+               '用户' || (i % ?2),
+               CASE WHEN i % 5 THEN NULL ELSE '用户' || (i * 7 % ?2) END,
+               CASE WHEN i % 5 THEN NULL ELSE date('2024-01-01', '+' || (i % 365) || ' days') END,
+               '第 ' || i || ' 本测试书籍的简介'
+        FROM n JOIN c ON c.k = i % {len(NORMALIZE_CATEGORIES)}
+    ''', (books, users))
+    conn.execute('''
+        INSERT INTO sharing_records (book_id, book_title, borrower, borrow_date, return_date, status)
+        WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < ?1)
+        SELECT i % ?2 + 1, '测试书籍' || (i % ?2), '用户' || (i * 7 % ?3),
+               date('2020-01-01', '+' || (i % 1800) || ' days'),
+               CASE WHEN i % 10 THEN date('2020-01-01', '+' || (i % 1800 + 30) || ' days') END,
+               CASE WHEN i % 10 THEN '已归还' ELSE '借阅中' END
+        FROM n
+    ''', (records, books, users))
+    for (sql,) in triggers:
+        conn.execute(sql)
+    conn.commit()
+
+
+def _database_size(conn):
+    """VACUUM 后的 (数据库字节数, {表名: 表和索引的字节数})；SQLite 未编译 dbstat 时只有总大小"""
+    conn.execute("VACUUM")
+    total = conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+    try:
+        tables = dict(conn.execute('''
+            SELECT m.tbl_name, SUM(d.pgsize) FROM dbstat d JOIN sqlite_master m ON m.name = d.name
+            GROUP BY m.tbl_name ORDER BY 2 DESC
+        '''))
+    except Exception:
+        tables = {}
+    return total, tables
+
+
+def _time_query(conn, sql, params, repeat):
+    """查询耗时的中位数（毫秒）"""
+    timings = []
+    for _ in range(repeat):
+        began = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        timings.append(time.perf_counter() - began)
+    return statistics.median(timings) * 1000
+
+
+def run_normalize(books, records, users, repeat):
+    """在旧结构上生成数据并迁移到新结构，返回前后的大小和查询耗时"""
+    with tempfile.TemporaryDirectory() as directory:
+        conn = connect(os.path.join(directory, "bench.db"))
+        try:
+            migrate(conn, target=7)
+            began = time.perf_counter()
+            _seed_legacy(conn, books, records, users)
+            seed_elapsed = time.perf_counter() - began
+
+            before = _database_size(conn)
+            legacy = {name: _time_query(conn, old, params, repeat) for name, old, new, params in NORMALIZE_QUERIES}
+
+            began = time.perf_counter()
+            migrate(conn)
+            migrate_elapsed = time.perf_counter() - began
+
+            after = _database_size(conn)
+            compatible = {name: _time_query(conn, old, params, repeat) for name, old, new, params in NORMALIZE_QUERIES}
+            normalized = {name: _time_query(conn, new or old, params, repeat)
+                          for name, old, new, params in NORMALIZE_QUERIES}
+        finally:
+            conn.close()
+    return {
+        "seed_elapsed": seed_elapsed,
+        "migrate_elapsed": migrate_elapsed,
+        "before": before,
+        "after": after,
+        "queries": [(name, legacy[name], compatible[name], normalized[name]) for name, *_ in NORMALIZE_QUERIES],
+    }
+
+
+def _peak_memory():
+    """进程的物理内存峰值（MB）；只在 Linux 上可用"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class _MockWidget:
+    """没有图形界面时代替 ttk.Treeview 和滚动条：只保存行的值，提供界面代码用到的方法"""
+    def __init__(self, height=20):
+        self.height = height
+        self.rows = {}
+        self._selection = ()
+
+    def insert(self, parent, index, iid=None, values=()):
+        iid = iid or f"I{len(self.rows) + 1:03X}"
+        self.rows[iid] = tuple(values)
+        return iid
+
+    def item(self, iid, values=None):
+        if values is not None:
+            self.rows[iid] = tuple(values)
+        return {"values": self.rows[iid]}
+
+    def delete(self, *items):
+        for iid in items:
+            self.rows.pop(iid, None)
+
+    def get_children(self, item=""):
+        return tuple(self.rows)
+
+    def selection(self):
+        return self._selection
+
+    def selection_set(self, items):
+        self._selection = tuple(items)
+
+    def cget(self, option):
+        return self.height
+
+    def detach(self, *items):
+        pass
+
+    def move(self, item, parent, index):
+        pass
+
+    def bind(self, *args, **kwargs):
+        pass
+
+    def configure(self, **options):
+        pass
+
+    def set(self, first, last):
+        pass
+
+    def destroy(self):
+        pass
+
+
+class _InlineExecutor:
+    """代替 DBExecutor：任务在提交时直接执行，回调在 deliver() 时执行，与界面中回调的时机相同"""
+    def __init__(self):
+        self._done = []
+
+    def submit(self, fn, *args, callback=None, errback=None, key=None, write=False):
+        self._done.append((callback, fn(*args)))
+
+    def deliver(self):
+        while self._done:
+            callback, result = self._done.pop(0)
+            if callback:
+                callback(result)
+
+
+def _tree_factory(mock):
+    """返回 (名称, make(columns, height) -> (表格, 滚动条), flush(), close())；
+    能打开 Tk 窗口（有桌面或在 Xvfb 下运行）且 mock 为 False 时使用隐藏窗口中真实的 ttk.Treeview"""
+    if not mock:
+        try:
+            import tkinter as tk
+            from tkinter import ttk
+            root = tk.Tk()
+        except Exception:
+            pass
+        else:
+            root.withdraw()
+
+            def make(columns, height=20):
+                tree = ttk.Treeview(root, columns=columns, show="headings", height=height)
+                scrollbar = ttk.Scrollbar(root, orient=tk.VERTICAL, command=tree.yview)
+                tree.configure(yscrollcommand=scrollbar.set)
+                tree.pack()
+                return tree, scrollbar
+            return "ttk.Treeview", make, root.update_idletasks, root.destroy
+
+    def make(columns, height=20):
+        return _MockWidget(height), _MockWidget()
+    return "模拟表格", make, lambda: None, lambda: None
+
+
+def _summarize(timings, peak):
+    """一个操作的耗时分布（毫秒）与 Python 内存分配峰值（KB）"""
+    timings = sorted(timings)
+    return {
+        "runs": len(timings),
+        "p50_ms": statistics.median(timings) * 1000,
+        "p99_ms": _percentile(timings, 0.99) * 1000,
+        "max_ms": timings[-1] * 1000,
+        "mean_ms": statistics.fmean(timings) * 1000,
+        "python_peak_kb": peak / 1024,
+    }
+
+
+def run_ops(db_path, repeat, mock=False, seed=0, profile_sample=None):
+    """在 db_path 上按界面的调用方式逐个测试各操作，返回结果（可保存为 JSON）
+
+    profile_sample 不为 None 时按这个抽样比例剖析 SQL 语句和各操作（与界面中的处理函数相同）。
+    """
+    # 延迟导入：其他测试不需要界面模块
+    from booksharing import PREFETCH_RADIUS, SEARCH_FIRST_BATCH, VirtualBookList
+
+    rng = random.Random(seed)
+    tree_kind, make_tree, flush, close_tree = _tree_factory(mock)
+    profiler = Profiler(sample_rate=profile_sample) if profile_sample is not None else None
+    service = BookService(db_path, readers=1, profiler=profiler)
+    try:
+        service.migrate()
+
+        def dataset(conn):
+            first, last = conn.execute("SELECT MIN(id), MAX(id) FROM book_items").fetchone()
+            users = conn.execute('''
+                SELECT u.name, COALESCE(us.borrow_total + us.share_total, 0) + 1
+                FROM users u LEFT JOIN user_stats us ON us.user_id = u.id
+            ''').fetchall()
+            return {
+                "books": conn.execute("SELECT COUNT(*) FROM book_items").fetchone()[0],
+                "users": len(users),
+                "loans": conn.execute("SELECT COUNT(*) FROM loan_history").fetchone()[0],
+                "archive_tables": len(archive_tables(conn)),
+                "fts": fts_available(conn),
+            }, first, last, users
+        info, first_id, last_id, users = service.manager.run_read(dataset)
+        if not info["books"]:
+            raise ValueError("数据库中没有书籍，请先用 bookgen.py 生成数据")
+
+        # 当前用户按活跃程度抽取：借阅、共享多的用户被抽到的次数多
+        names = [name for name, _ in users]
+        weights = list(accumulate(weight for _, weight in users))
+
+        def pick_user():
+            return rng.choices(names, cum_weights=weights)[0]
+
+        # 搜索词：随机书名中连续的 2~4 个字，像用户输入的一部分书名
+        terms = []
+        while len(terms) < 50:
+            try:
+                title = service.get_book(rng.randint(first_id, last_id))[1]
+            except BookNotFound:
+                continue
+            length = min(len(title), rng.randint(2, 4))
+            start = rng.randrange(len(title) - length + 1)
+            terms.append(title[start:start + length])
+
+        db = _InlineExecutor()
+        tree, scrollbar = make_tree(LIST_COLUMNS)
+        book_list = VirtualBookList(tree, scrollbar, db, service)
+
+        def load_books():
+            service.book_counts()
+            service.user_counts(pick_user())
+            book_list.reset(total=service.count_books())
+            db.deliver()
+            flush()
+
+        def scroll_books():
+            book_list.top = rng.randrange(book_list.total)
+            book_list.render()
+            db.deliver()
+            flush()
+
+        def show_details():
+            book_id = rng.randint(first_id, last_id)
+            try:
+                service.get_book(book_id)
+            except BookNotFound:
+                pass
+            service.get_books(range(book_id - PREFETCH_RADIUS, book_id + PREFETCH_RADIUS + 1))
+            service.similar_books(book_id)
+
+        def search_books():
+            term = rng.choice(terms)
+            book_list.reset_ids(service.search(term, limit=SEARCH_FIRST_BATCH, ranked=False))
+            db.deliver()
+            book_list.reset_ids(service.search(term))
+            db.deliver()
+            flush()
+
+        def show_records(query, columns):
+            # 与界面相同：打开窗口时读取第一页（带统计数），再滚动到底部读取一页
+            def show():
+                user = pick_user()
+                page = query(user)
+                window, window_scrollbar = make_tree(columns)
+                for record in page.rows:
+                    window.insert("", "end", values=record)
+                if page.next is not None:
+                    for record in query(user, after=page.next).rows:
+                        window.insert("", "end", values=record)
+                flush()
+                window.destroy()
+                window_scrollbar.destroy()
+            return show
+
+        def borrow_return():
+            user = pick_user()
+            for _ in range(20):
+                book_id = rng.randint(first_id, last_id)
+                try:
+                    service.borrow_book(user, book_id)
+                except (BookConflict, BookNotFound):
+                    continue
+                service.return_book(user, book_id)
+                return
+
+        operations = [
+            ("load_books", load_books),
+            ("scroll_books", scroll_books),
+            ("show_details", show_details),
+            ("search_books", search_books),
+            ("show_my_sharing", show_records(service.owner_records,
+                                             ("ID", "书籍ID", "书名", "借阅人", "借阅日期", "归还日期", "状态"))),
+            ("show_borrow_records", show_records(service.borrow_records,
+                                                 ("ID", "书籍ID", "书名", "借阅日期", "归还日期", "状态"))),
+            ("borrow_return", borrow_return),
+        ]
+        if profiler is not None:
+            profiler.reset()
+            operations = [(name, profiler.wrap("handler", name, operation)) for name, operation in operations]
+        results = {}
+        for name, operation in operations:
+            timings = []
+            states = []
+            for _ in range(repeat):
+                states.append(rng.getstate())
+                began = time.perf_counter()
+                operation()
+                timings.append(time.perf_counter() - began)
+
+            # 内存峰值另外测量：tracemalloc 会让 Python 代码变慢几倍，不能与计时同时进行；
+            # 按同样的随机选择（同一个用户、同一本书）重放最慢的一次
+            state = rng.getstate()
+            rng.setstate(states[timings.index(max(timings))])
+            tracemalloc.start()
+            operation()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            rng.setstate(state)
+            results[name] = _summarize(timings, peak)
+    finally:
+        service.close()
+        close_tree()
+
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "tree": tree_kind,
+        "repeat": repeat,
+        "dataset": info,
+        "operations": results,
+        "peak_rss_mb": _peak_memory(),
+        "profile": profiler.to_json() if profiler is not None else None,
+    }
+
+
+# 剖析结果中列出的语句数
+OPS_TOP_QUERIES = 8
+
+
+def _report_ops(summary, baseline=None):
+    """输出各操作的耗时；有 baseline（以前保存的结果）时加上 p50 与它的比值"""
+    info = summary["dataset"]
+    print(f"{info['books']} 本书，{info['users']} 个用户，{info['loans']} 条借阅记录（归档表 {info['archive_tables']} 张，"
+          f"全文索引{'有' if info['fts'] else '无'}）；表格：{summary['tree']}，每个操作 {summary['repeat']} 次")
+    header = f"{'操作':<20}{'p50 ms':>10}{'p99 ms':>10}{'最长 ms':>10}{'Python 内存峰值 KB':>20}"
+    if baseline:
+        header += f"{'p50 / 基准':>12}"
+    print(header)
+    for name, result in summary["operations"].items():
+        line = (f"{name:<20}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['max_ms']:>10.2f}"
+                f"{result['python_peak_kb']:>20.0f}")
+        before = (baseline or {}).get("operations", {}).get(name)
+        if before and before["p50_ms"]:
+            line += f"{result['p50_ms'] / before['p50_ms']:>11.2f}×"
+        print(line)
+    if summary["peak_rss_mb"] is not None:
+        print(f"进程内存峰值 {summary['peak_rss_mb']:.0f} MB")
+    profile = summary.get("profile")
+    if profile:
+        queries = [metric for metric in profile["metrics"] if metric["kind"] == "query"][:OPS_TOP_QUERIES]
+        print(f"性能剖析：抽样比例 {profile['sample_rate']}，慢查询 {len(profile['slow_queries'])} 条；总耗时最多的语句：")
+        for metric in queries:
+            print(f"{metric['seconds'] * 1000:>10.1f}ms{metric['count']:>7} 次{metric['rows']:>10} 行  {metric['name'][:80]}")
+
+
+# 启动测试在新进程中执行的脚本：参数为数据库、启动时刻（time.time()）和超时秒数，输出各阶段距启动的秒数（JSON）
+STARTUP_PROBE = '''
+import json, sys, time
+launched, timeout = float(sys.argv[2]), float(sys.argv[3])
+marks = {"python": time.time() - launched}
+import tkinter as tk
+from booksharing import BookSharingSystem
+marks["imported"] = time.time() - launched
+root = tk.Tk()
+app = BookSharingSystem(root, sys.argv[1])
+marks["constructed"] = time.time() - launched
+deadline = launched + timeout
+while time.time() < deadline and ("first_paint" not in marks or "first_page" not in app.startup):
+    root.update()
+    if "first_paint" not in marks and root.winfo_ismapped():
+        marks["first_paint"] = time.time() - launched
+    time.sleep(0.001)
+began = app.startup_began - time.perf_counter() + time.time() - launched
+marks.update((stage, began + elapsed) for stage, elapsed in app.startup.items())
+root.destroy()
+print(json.dumps(marks))
+'''
+
+# 启动测试报告的阶段（顺序即显示顺序）
+STARTUP_STAGES = [("python", "Python 启动"), ("imported", "导入模块"), ("constructed", "建立窗口"),
+                  ("first_paint", "首次绘制"), ("stats", "统计数字"), ("first_page", "第一页（可操作）")]
+
+
+def run_startup(db_path, repeat, timeout=60):
+    """在新进程中打开界面 repeat 次，返回 {阶段: {p50_ms, max_ms}}；不能打开窗口时抛出 RuntimeError"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(repeat):
+        launched = time.time()
+        result = subprocess.run([sys.executable, "-c", STARTUP_PROBE, os.path.abspath(db_path), repr(launched),
+                                 str(timeout)], cwd=directory, capture_output=True, text=True, timeout=timeout + 30)
+        if result.returncode:
+            lines = result.stderr.strip().splitlines()
+            raise RuntimeError(lines[-1] if lines else f"退出码 {result.returncode}")
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    stages = {}
+    for stage, _ in STARTUP_STAGES:
+        timings = sorted(run[stage] for run in runs if stage in run)
+        if timings:
+            stages[stage] = {"p50_ms": statistics.median(timings) * 1000, "max_ms": timings[-1] * 1000}
+    return {"repeat": repeat, "stages": stages}
+
+
+def _report_startup(summary, baseline=None):
+    """输出启动各阶段距进程启动的时间；有 baseline 时加上与它的比值"""
+    print(f"启动 {summary['repeat']} 次，{summary['books']} 本书（从启动 Python 进程开始计时）")
+    header = f"{'阶段':<16}{'p50 ms':>10}{'最长 ms':>10}"
+    if baseline:
+        header += f"{'p50 / 基准':>12}"
+    print(header)
+    for stage, label in STARTUP_STAGES:
+        result = summary["stages"].get(stage)
+        if result is None:
+            print(f"{label:<16}{'未到达':>10}")
+            continue
+        line = f"{label:<16}{result['p50_ms']:>10.0f}{result['max_ms']:>10.0f}"
+        before = (baseline or {}).get("stages", {}).get(stage)
+        if before and before["p50_ms"]:
+            line += f"{result['p50_ms'] / before['p50_ms']:>11.2f}×"
+        print(line)
+
+
+def _neighbors_digest(conn):
+    """全部推荐列表的摘要，用于比较两次重建的结果"""
+    digest = hashlib.sha1()
+    for row in conn.execute("SELECT book_id, neighbor_id FROM book_neighbors ORDER BY book_id, rank"):
+        digest.update(b"%d,%d;" % row)
+    return digest.hexdigest()
+
+
+def run_recommend(db_path, loans, lookups, backends, seed=0):
+    """测试借阅推荐：各计算方式全部重建的耗时，新增 loans 条借阅后增量更新的速度，lookups 次读取推荐的耗时"""
+    rng = random.Random(seed)
+    service = BookService(db_path, readers=1)
+    try:
+        service.migrate()
+        manager = service.manager
+        info = manager.run_read(lambda conn: {
+            "books": conn.execute("SELECT COUNT(*) FROM book_items").fetchone()[0],
+            "loans": conn.execute("SELECT COUNT(*) FROM loan_history").fetchone()[0],
+        })
+
+        rebuild = {}
+        digests = set()
+        for backend in backends:
+            began = time.perf_counter()
+            Recommender(manager, vectorized=backend == "numpy").rebuild()
+            rebuild[backend] = time.perf_counter() - began
+            digests.add(manager.run_read(_neighbors_digest))
+
+        # 随机的用户借阅再归还随机的书，产生新的借阅记录
+        def sample(conn):
+            users = [name for (name,) in conn.execute("SELECT name FROM users ORDER BY random() LIMIT 100")]
+            first, last = conn.execute("SELECT MIN(id), MAX(id) FROM book_items").fetchone()
+            return users, first, last
+        users, first_id, last_id = manager.run_read(sample)
+        added = 0
+        for _ in range(loans * 5):
+            if added == loans:
+                break
+            user, book_id = rng.choice(users), rng.randint(first_id, last_id)
+            try:
+                service.borrow_book(user, book_id)
+            except (BookConflict, BookNotFound):
+                continue
+            service.return_book(user, book_id)
+            added += 1
+
+        recommender = Recommender(manager)
+        stale = recommender.stale_count()
+        began = time.perf_counter()
+        while recommender.refresh():
+            pass
+        refresh_elapsed = time.perf_counter() - began
+
+        timings = []
+        for _ in range(lookups):
+            book_id = rng.randint(first_id, last_id)
+            began = time.perf_counter()
+            service.similar_books(book_id)
+            timings.append(time.perf_counter() - began)
+        timings.sort()
+    finally:
+        service.close()
+    return {
+        **info,
+        "rebuild": rebuild,
+        "consistent": len(digests) == 1,
+        "new_loans": added,
+        "stale_books": stale,
+        "refresh_elapsed": refresh_elapsed,
+        "refresh_books_per_second": stale / refresh_elapsed if refresh_elapsed else 0,
+        "lookup_p50_ms": _percentile(timings, 0.5) * 1000,
+        "lookup_p99_ms": _percentile(timings, 0.99) * 1000,
+    }
+
+
+def _replica_digest(conn):
+    """书籍和共享记录内容的摘要（不含各节点不同的 id），用于检查同步后两个节点是否一致"""
+    books = conn.execute("SELECT title, author, status, owner, borrower, borrow_until FROM books").fetchall()
+    loans = conn.execute('''
+        SELECT b.title, b.author, b.owner, r.borrower, r.borrow_date, r.return_date, r.status
+        FROM sharing_records r JOIN books b ON b.id = r.book_id
+    ''').fetchall()
+    digest = hashlib.sha1()
+    for row in sorted(books, key=repr) + sorted(loans, key=repr):
+        digest.update(repr(row).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _random_loans(service, rng, users, book_ids, count):
+    """随机借还 count 次：借阅中的书归还，可借阅的书借出"""
+    for _ in range(count):
+        book_id = rng.choice(book_ids)
+        try:
+            borrower = service.get_book(book_id)[9]
+            if borrower:
+                service.return_book(borrower, book_id)
+            else:
+                service.borrow_book(rng.choice(users), book_id)
+        except (BookConflict, BookNotFound):
+            pass
+
+
+def run_sync(db_path, peer_path, rounds, seed=0):
+    """测试节点间同步：复制 db_path 为另一个节点，第一次同步后按 rounds 中的变更数逐轮随机借还并双向同步"""
+    rng = random.Random(seed)
+    with closing(connect(db_path)) as conn:
+        migrate(conn)
+        with closing(sqlite3.connect(peer_path)) as destination:
+            conn.backup(destination)
+    services = [BookService(db_path, readers=1), BookService(peer_path, readers=1)]
+    try:
+        for service in services:
+            service.migrate()
+        services[1].manager.run_write(new_node)
+        nodes = [SyncNode(service.manager) for service in services]
+
+        def sample(conn):
+            users = [name for (name,) in conn.execute("SELECT name FROM users ORDER BY random() LIMIT 100")]
+            book_ids = [book_id for (book_id,) in conn.execute("SELECT id FROM book_items ORDER BY random() LIMIT 1000")]
+            return users, book_ids
+        users, book_ids = services[0].manager.run_read(sample)
+        info = services[0].manager.run_read(lambda conn: {
+            "books": conn.execute("SELECT COUNT(*) FROM book_items").fetchone()[0],
+            "loans": conn.execute("SELECT COUNT(*) FROM loan_history").fetchone()[0],
+        })
+
+        def sync_round():
+            transports = [LocalTransport(nodes[1]), LocalTransport(nodes[0])]
+            began = time.perf_counter()
+            results = [nodes[0].pull(transports[0]), nodes[1].pull(transports[1])]
+            return {
+                "elapsed": time.perf_counter() - began,
+                "batches": sum(result[0] for result in results),
+                "rows": sum(result[1] for result in results),
+                "conflicts": sum(result[2] for result in results),
+                "bytes": sum(transport.received for transport in transports),
+            }
+
+        first = sync_round()
+        summary = []
+        for changes in rounds:
+            # 两个节点从同一份数据出发，同一本书可能在两边同时借出
+            for service in services:
+                _random_loans(service, rng, users, book_ids, changes)
+            summary.append(dict(sync_round(), changes=changes * 2))
+        digests = [service.manager.run_read(_replica_digest) for service in services]
+    finally:
+        for service in services:
+            service.close()
+    return {**info, "first": first, "rounds": summary, "consistent": digests[0] == digests[1]}
+
+
+def _report_concurrency(args, summary, problems):
+    """输出并发借还测试的结果，返回退出码"""
+    print(f"{args.processes} 个进程 × {args.cycles} 次借还，{args.books} 本书，{args.journal} 日志")
+    print(f"耗时 {summary['elapsed']:.2f}s，{summary['transactions_per_second']:.0f} 个写事务/秒，"
+          f"p50 {summary['p50_ms']:.1f}ms，p99 {summary['p99_ms']:.1f}ms")
+    print(f"成功借阅 {summary['borrowed']} 次（{summary['borrows_per_second']:.0f} 次/秒），"
+          f"书已被借走 {summary['conflicts']} 次（冲突率 {summary['conflict_rate']:.0%}），锁超时 {summary['failures']} 次")
+    if args.readers:
+        print(f"{args.readers} 个读取进程：{summary['reads_per_second']:.0f} 次读取/秒，锁超时 {summary['read_failures']} 次")
+    for problem in problems:
+        print(f"数据不一致: {problem}")
+    if problems or summary["failures"] or summary["read_failures"]:
+        return 1
+    print("数据一致，没有重复借出")
+    return 0
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="图书共享系统性能测试")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    concurrency = commands.add_parser("concurrency", help="多进程并发借还")
+    concurrency.add_argument("--processes", type=int, default=4, help="进程数")
+    concurrency.add_argument("--cycles", type=int, default=200, help="每个进程的借还次数")
+    concurrency.add_argument("--books", type=int, default=20, help="书籍数量，越少冲突越多")
+    concurrency.add_argument("--readers", type=int, default=2, help="同时读取列表的进程数")
+    concurrency.add_argument("--hold", type=float, default=0, help="借到后持有的秒数")
+
+    contention = commands.add_parser("contention", help="多进程争抢少数几本书")
+    contention.add_argument("--processes", type=int, default=8, help="进程数")
+    contention.add_argument("--cycles", type=int, default=100, help="每个进程的借阅尝试次数")
+    contention.add_argument("--books", type=int, default=1, help="被争抢的书籍数量")
+    contention.add_argument("--readers", type=int, default=1, help="检查重复借出的读取进程数")
+    contention.add_argument("--hold", type=float, default=0.002, help="借到后持有的秒数")
+
+    for command in (concurrency, contention):
+        command.add_argument("--journal", default="WAL", choices=["WAL", "DELETE"], help="日志模式")
+        command.add_argument("--busy-timeout", type=float, default=BUSY_TIMEOUT, help="等待锁的秒数")
+
+    api = commands.add_parser("api", help="HTTP 接口并发请求")
+    api.add_argument("--clients", type=int, default=8, help="客户端线程数")
+    api.add_argument("--requests", type=int, default=200, help="每个客户端的请求数")
+    api.add_argument("--books", type=int, default=1000, help="书籍数量")
+    api.add_argument("--readers", type=int, default=8, help="服务的读连接池大小")
+
+    export = commands.add_parser("export", help="导出大量共享记录")
+    export.add_argument("--rows", type=int, default=10000000, help="共享记录的行数")
+    export.add_argument("--formats", default="csv,jsonl,columnar", help="要测试的格式，逗号分隔")
+
+    bulk = commands.add_parser("import", help="批量导入书目")
+    bulk.add_argument("--rows", type=int, default=100000, help="书目文件的行数")
+    bulk.add_argument("--batch-size", type=int, default=10000, help="每个事务写入的行数")
+
+    normalize = commands.add_parser("normalize", help="规范化前后的数据库大小与查询耗时")
+    normalize.add_argument("--books", type=int, default=1000000, help="书籍数量")
+    normalize.add_argument("--records", type=int, default=2000000, help="共享记录数量")
+    normalize.add_argument("--users", type=int, default=10000, help="用户数量")
+    normalize.add_argument("--repeat", type=int, default=5, help="每个查询执行的次数（取中位数）")
+    ops = commands.add_parser("ops", help="界面各操作的耗时与内存（不需要图形界面）")
+    ops.add_argument("--db", help="已有的数据库（如 bookgen.py 生成的；借还测试会写入记录），默认生成临时数据库")
+    ops.add_argument("--books", type=int, default=100000, help="临时数据库的书籍数量")
+    ops.add_argument("--loans-per-book", type=float, default=5, help="临时数据库中每本书的平均借阅次数")
+    ops.add_argument("--repeat", type=int, default=50, help="每个操作执行的次数")
+    ops.add_argument("--seed", type=int, default=0, help="随机数种子")
+    ops.add_argument("--mock-tree", action="store_true", help="即使有图形界面也使用模拟的表格")
+    ops.add_argument("--output", help="把结果保存为 JSON 文件")
+    ops.add_argument("--compare", help="与以前保存的 JSON 结果对比")
+    ops.add_argument("--profile-sample", type=float, help="打开性能剖析的抽样比例（0~1），默认不剖析")
+    shards = commands.add_parser("shards", help="写吞吐量随分片数的变化")
+    shards.add_argument("--shards", type=int, default=4, help="最多的分片数（依次测试 1、2、4…）")
+    shards.add_argument("--processes", type=int, default=8, help="借还进程数")
+    shards.add_argument("--cycles", type=int, default=200, help="每个进程的借还次数")
+    shards.add_argument("--books", type=int, default=200, help="每个馆的书籍数量")
+    startup = commands.add_parser("startup", help="界面冷启动的首次绘制和可操作时间（需要图形界面或 xvfb-run）")
+    startup.add_argument("--db", help="已有的数据库（如 bookgen.py 生成的），默认生成临时数据库")
+    startup.add_argument("--books", type=int, default=100000, help="临时数据库的书籍数量")
+    startup.add_argument("--repeat", type=int, default=5, help="启动次数")
+    startup.add_argument("--output", help="把结果保存为 JSON 文件")
+    startup.add_argument("--compare", help="与以前保存的 JSON 结果对比")
+    reserve = commands.add_parser("reserve", help="大量用户预约几本热门书，归还时按顺序转借")
+    reserve.add_argument("--users", type=int, default=5000, help="预约的用户数")
+    reserve.add_argument("--books", type=int, default=4, help="热门书的数量")
+    reserve.add_argument("--processes", type=int, default=4, help="预约的进程数")
+    recommend = commands.add_parser("recommend", help="借阅推荐的全部重建、增量更新和读取耗时")
+    recommend.add_argument("--db", help="已有的数据库（如 bookgen.py 生成的；会写入借阅记录），默认生成临时数据库")
+    recommend.add_argument("--books", type=int, default=100000, help="临时数据库的书籍数量")
+    recommend.add_argument("--loans", type=int, default=1000, help="增量更新前新增的借阅数")
+    recommend.add_argument("--lookups", type=int, default=1000, help="读取推荐的次数")
+    recommend.add_argument("--backends", default="numpy,python" if np is not None else "python",
+                           help="全部重建的计算方式，逗号分隔（numpy、python）")
+    sync = commands.add_parser("sync", help="两个节点之间增量同步的耗时与数据量")
+    sync.add_argument("--db", help="已有的数据库（不会被修改，另一个节点和变更都在它的副本上），默认生成临时数据库")
+    sync.add_argument("--books", type=int, default=100000, help="临时数据库的书籍数量")
+    sync.add_argument("--changes", default="10,100,1000", help="每轮在每个节点上随机借还的次数，逗号分隔")
+    batch = commands.add_parser("batch", help="多选的书逐本操作与批量操作（一个事务）的耗时")
+    batch.add_argument("--books", type=int, default=200, help="选中的书籍数量")
+    batch.add_argument("--repeat", type=int, default=5, help="每种操作执行的次数")
+    args = parser.parse_args(argv)
+
+    if args.command == "sync":
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = os.path.join(directory, "a.db")
+            if args.db:
+                with closing(connect(args.db, readonly=True)) as source, closing(sqlite3.connect(db_path)) as target:
+                    source.backup(target)
+            else:
+                from bookgen import generate
+
+                service = BookService(db_path, readers=1)
+                try:
+                    service.migrate()
+                    generate(service.manager, args.books)
+                finally:
+                    service.close()
+            summary = run_sync(db_path, os.path.join(directory, "b.db"),
+                               [int(count) for count in args.changes.split(",")])
+        first = summary["first"]
+        print(f"{summary['books']} 本书，{summary['loans']} 条借阅记录")
+        print(f"第一次同步（全部数据）：{first['elapsed']:.1f}s，{first['batches']} 批，"
+              f"{first['bytes'] / 1024 / 1024:.1f}MB")
+        for result in summary["rounds"]:
+            print(f"{result['changes']} 次借还后同步：{result['elapsed'] * 1000:.0f}ms，{result['batches']} 批，"
+                  f"{result['bytes'] / 1024:.1f}KB，应用 {result['rows']} 行，取消冲突的借阅 {result['conflicts']} 条")
+        print("两个节点的数据一致" if summary["consistent"] else "两个节点的数据不一致")
+        return 0 if summary["consistent"] else 1
+
+    if args.command == "batch":
+        with tempfile.TemporaryDirectory() as directory:
+            timings, problems = run_batch(os.path.join(directory, "bench.db"), args.books, args.repeat)
+        print(f"{args.books} 本书（编辑其中一个拥有者的书），逐本调用与一次批量调用的耗时（{args.repeat} 次的中位数）：")
+        for action, (single, batch) in timings.items():
+            print(f"{action}：逐本 {single * 1000:.0f}ms，批量 {batch * 1000:.0f}ms，快 {single / batch:.1f} 倍")
+        for problem in problems:
+            print(f"数据不一致: {problem}")
+        return 1 if problems else 0
+
+    if args.command == "reserve":
+        with tempfile.TemporaryDirectory() as directory:
+            summary, problems = run_reserve(os.path.join(directory, "bench.db"), args.users, args.books,
+                                            args.processes)
+        print(f"{args.users} 个用户预约 {args.books} 本热门书（最长的队列 {summary['longest_queue']} 人），"
+              f"{args.processes} 个进程同时预约")
+        print(f"预约：{summary['reserves_per_second']:.0f} 次/秒，p50 {summary['reserve_p50_ms']:.1f}ms，"
+              f"p99 {summary['reserve_p99_ms']:.1f}ms")
+        print(f"归还 {summary['returns']} 次（其中 {args.users} 次转借给预约者，每本书一个进程）："
+              f"{summary['returns_per_second']:.0f} 次/秒，"
+              f"p50 {summary['return_p50_ms']:.1f}ms，p99 {summary['return_p99_ms']:.1f}ms")
+        for problem in problems:
+            print(f"数据不一致: {problem}")
+        if problems:
+            return 1
+        print("每本书都按预约顺序借出，没有重复借出")
+        return 0
+
+    if args.command == "recommend":
+        backends = args.backends.split(",")
+        if "numpy" in backends and np is None:
+            print("没有安装 NumPy", file=sys.stderr)
+            return 1
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = args.db
+            if not db_path:
+                from bookgen import generate
+
+                db_path = os.path.join(directory, "bench.db")
+                service = BookService(db_path, readers=1)
+                try:
+                    service.migrate()
+                    generate(service.manager, args.books)
+                finally:
+                    service.close()
+            summary = run_recommend(db_path, args.loans, args.lookups, backends)
+        print(f"{summary['books']} 本书，{summary['loans']} 条借阅记录")
+        for backend, elapsed in summary["rebuild"].items():
+            print(f"全部重建（{backend}）：{elapsed:.1f}s")
+        if len(backends) > 1:
+            print("各计算方式的结果一致" if summary["consistent"] else "各计算方式的结果不一致")
+        print(f"新增 {summary['new_loans']} 条借阅后增量更新 {summary['stale_books']} 本书：{summary['refresh_elapsed']:.2f}s，"
+              f"{summary['refresh_books_per_second']:.0f} 本/秒")
+        print(f"读取推荐：p50 {summary['lookup_p50_ms']:.3f}ms，p99 {summary['lookup_p99_ms']:.3f}ms")
+        return 0 if summary["consistent"] else 1
+
+    if args.command == "startup":
+        baseline = None
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as file:
+                baseline = json.load(file)
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = args.db
+            if not db_path:
+                from bookgen import generate
+
+                db_path = os.path.join(directory, "bench.db")
+                service = BookService(db_path, readers=1)
+                try:
+                    service.migrate()
+                    generate(service.manager, args.books)
+                finally:
+                    service.close()
+            try:
+                summary = run_startup(db_path, args.repeat)
+            except RuntimeError as error:
+                print(f"无法打开界面（需要图形界面，或用 xvfb-run 运行）: {error}", file=sys.stderr)
+                return 1
+            service = BookService(db_path, readers=1)
+            try:
+                summary["books"] = service.count_books()
+            finally:
+                service.close()
+        _report_startup(summary, baseline)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as file:
+                json.dump(summary, file, ensure_ascii=False, indent=2)
+            print(f"结果已保存到 {args.output}")
+        return 0
+
+    if args.command == "shards":
+        counts = [1 << n for n in range(args.shards.bit_length()) if 1 << n < args.shards] + [args.shards]
+        results = run_shards(counts, args.processes, args.cycles, args.books)
+        print(f"{args.processes} 个进程 × {args.cycles} 次借还，每个馆 {args.books} 本书，CPU {os.cpu_count()} 核")
+        base = results[0][1]["transactions_per_second"]
+        failed = False
+        for count, summary, problems in results:
+            print(f"{count:>3} 个分片：{summary['transactions_per_second']:.0f} 个写事务/秒"
+                  f"（{summary['transactions_per_second'] / base:.2f} 倍），p50 {summary['p50_ms']:.1f}ms，"
+                  f"p99 {summary['p99_ms']:.1f}ms，锁超时 {summary['failures']} 次")
+            for problem in problems:
+                print(f"数据不一致: {problem}")
+            failed = failed or bool(problems or summary["failures"])
+        return 1 if failed else 0
+
+    if args.command == "ops":
+        baseline = None
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as file:
+                baseline = json.load(file)
+        if args.db:
+            summary = run_ops(args.db, args.repeat, args.mock_tree, args.seed, args.profile_sample)
+        else:
+            # 延迟导入：只有生成临时数据库时需要
+            from bookgen import generate
+
+            with tempfile.TemporaryDirectory() as directory:
+                db_path = os.path.join(directory, "bench.db")
+                service = BookService(db_path, readers=1)
+                try:
+                    service.migrate()
+                    generate(service.manager, args.books, loans_per_book=args.loans_per_book, seed=args.seed)
+                finally:
+                    service.close()
+                summary = run_ops(db_path, args.repeat, args.mock_tree, args.seed, args.profile_sample)
+        _report_ops(summary, baseline)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as file:
+                json.dump(summary, file, ensure_ascii=False, indent=2)
+            print(f"结果已保存到 {args.output}")
+        return 0
+
+    if args.command == "normalize":
+        summary = run_normalize(args.books, args.records, args.users, args.repeat)
+        print(f"{args.books} 本书，{args.records} 条共享记录，{args.users} 个用户（生成耗时 {summary['seed_elapsed']:.1f}s，"
+              f"迁移耗时 {summary['migrate_elapsed']:.1f}s，不含全文索引）")
+        for label, (total, tables) in (("旧结构", summary["before"]), ("新结构", summary["after"])):
+            detail = "，".join(f"{table} {size / 1024 / 1024:.1f}" for table, size in tables.items())
+            print(f"{label}：{total / 1024 / 1024:.1f} MB（{detail}）" if detail else f"{label}：{total / 1024 / 1024:.1f} MB")
+        print(f"{'查询':<16}{'旧结构':>10}{'兼容视图':>10}{'新结构':>10}  （毫秒，中位数）")
+        for name, legacy, compatible, normalized in summary["queries"]:
+            print(f"{name:<16}{legacy:>10.2f}{compatible:>10.2f}{normalized:>10.2f}")
+        return 0
+
+    if args.command == "export":
+        seed_elapsed, summaries = run_export(args.rows, args.formats.split(","))
+        print(f"{args.rows} 条共享记录（生成耗时 {seed_elapsed:.1f}s）")
+        for summary in summaries:
+            peak = f"{summary['peak_mb']:.0f} MB" if summary["peak_mb"] is not None else "未知"
+            print(f"{summary['format']:>8}：{summary['rows_per_second']:.0f} 行/秒，耗时 {summary['elapsed']:.1f}s，"
+                  f"文件 {summary['megabytes']:.0f} MB，进程内存峰值 {peak}；"
+                  f"期间写入 {summary['writes']} 次，最长 {summary['write_max_ms']:.1f}ms")
+        return 0
+
+    if args.command == "import":
+        summary = run_import(args.rows, args.batch_size)
+        print(f"{args.rows} 行，每批 {args.batch_size} 行")
+        print(f"只读取校验：{summary['parse_rows_per_second']:.0f} 行/秒")
+        for name, result in (("首次导入", summary["first"]), ("重复导入", summary["again"]),
+                             ("不含一两个字的索引", summary["without_grams"])):
+            print(f"{name}：{result.rows / result.elapsed:.0f} 行/秒，新增 {result.inserted}，"
+                  f"重复 {result.duplicates}，无效 {result.invalid}")
+        cost = summary["first"].elapsed / summary["without_grams"].elapsed - 1
+        print(f"一两个字的索引使首次导入的耗时增加 {cost:.0%}")
+        return 0
+
+    if args.command == "api":
+        summary = run_api(args.clients, args.requests, args.books, args.readers)
+        print(f"{args.clients} 个客户端 × {args.requests} 个请求，{args.books} 本书")
+        print(f"耗时 {summary['elapsed']:.2f}s，{summary['requests_per_second']:.0f} 个请求/秒，"
+              f"p50 {summary['p50_ms']:.1f}ms，p99 {summary['p99_ms']:.1f}ms，失败 {summary['errors']} 个")
+        return 1 if summary["errors"] else 0
+
+    options = {"journal_mode": args.journal, "busy_timeout": args.busy_timeout}
+    with tempfile.TemporaryDirectory() as directory:
+        summary, problems = run_concurrency(
+            os.path.join(directory, "bench.db"), args.processes, args.cycles, args.books, args.readers, options,
+            args.hold,
+        )
+    return _report_concurrency(args, summary, problems)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1824 @@
+﻿"""图书共享系统的数据库结构与版本迁移
+
+数据库版本记录在 PRAGMA user_version 中，启动时只执行尚未执行过的迁移。
+每个迁移都可以重复执行，中途失败后再次启动会从失败处继续。
+
+多个程序实例可以同时打开同一个数据库文件：数据库使用 WAL 日志，读连接池与唯一的写连接分开，
+写事务以 BEGIN IMMEDIATE 开始，遇到 SQLITE_BUSY 时退避重试。
+"""
+import argparse
+from collections import defaultdict
+from contextlib import closing, contextmanager
+from datetime import date, timedelta
+import queue
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from bookprofile import ProfiledConnection, callable_name
+
+# 默认数据库文件
+DB_PATH = 'book_sharing.db'
+
+# 等待其他进程释放锁的时长（秒），超时后返回 SQLITE_BUSY
+BUSY_TIMEOUT = 5.0
+
+# SQLITE_BUSY 的重试次数与首次退避时长（秒），每次重试退避时长翻倍
+BUSY_RETRIES = 8
+BUSY_BACKOFF = 0.01
+
+# 读连接池大小
+READ_POOL_SIZE = 2
+
+# 日志模式；WAL 下读写互不阻塞
+JOURNAL_MODE = "WAL"
+
+# 每个连接的调优参数
+PRAGMAS = [
+    # WAL 下 NORMAL 在断电时可能丢失最后几个事务，但不会损坏数据库
+    ("synchronous", "NORMAL"),
+    # 用内存映射读取数据库文件的前 256MB
+    ("mmap_size", 256 * 1024 * 1024),
+    # 页缓存 16MB（负数表示 KiB）
+    ("cache_size", -16 * 1024),
+    # 临时表和排序用内存
+    ("temp_store", "MEMORY"),
+]
+
+# 书籍与共享记录的状态码（statuses 表）
+AVAILABLE, SHARED, BORROWING, RETURNED = 0, 1, 2, 3
+STATUSES = [(AVAILABLE, "可借阅"), (SHARED, "共享中"), (BORROWING, "借阅中"), (RETURNED, "已归还")]
+
+# 日期以 1970-01-01 起的天数（整数）保存
+EPOCH = date(1970, 1, 1)
+
+# 归还超过这么多天的共享记录移入按年分表的归档表
+ARCHIVE_AFTER_DAYS = 365
+
+# 归档时每个事务移动的记录数
+ARCHIVE_BATCH = 10000
+
+# 书籍 id 每 2^ID_BLOCK_BITS 个分为一块计数（book_id_blocks），按序号定位书籍时块内最多跳过这么多行
+ID_BLOCK_BITS = 10
+
+
+def to_day(value):
+    """'YYYY-MM-DD' 或 date 转为天数；None 保持 None"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = date.fromisoformat(value)
+    return (value - EPOCH).days
+
+
+def from_day(day):
+    """天数转为 date；None 保持 None"""
+    return None if day is None else EPOCH + timedelta(days=day)
+
+
+def day_sql(column):
+    """SQL 中把天数转为 'YYYY-MM-DD' 的表达式"""
+    return f"date({column} * 86400, 'unixepoch')"
+
+
+def _create_base_tables(conn):
+    """书籍表与共享记录表"""
+    # 书籍表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS books (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            isbn TEXT,
+            category TEXT,
+            publisher TEXT,
+            publish_year INTEGER,
+            status TEXT DEFAULT '可借阅',
+            owner TEXT NOT NULL,
+            borrower TEXT,
+            borrow_until TEXT,
+            description TEXT
+        )
+    ''')
+
+    # 共享记录表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sharing_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL,
+            book_title TEXT NOT NULL,
+            borrower TEXT NOT NULL,
+            borrow_date TEXT NOT NULL,
+            return_date TEXT,
+            status TEXT DEFAULT '借阅中',
+            FOREIGN KEY (book_id) REFERENCES books (id)
+        )
+    ''')
+
+    # 书籍 id 分块计数：按 id 排序后第 n 本书所在的块由各块的书籍数累加得到（块数约为书籍数的千分之一），
+    # 再在块内用主键跳过，滚动条拖到很远的位置时不必从头数 n 行
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'book_id_blocks'").fetchone() is not None
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS book_id_blocks (
+            block INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL
+        )
+    ''')
+    if not exists:
+        conn.execute(f"INSERT INTO book_id_blocks SELECT id >> {ID_BLOCK_BITS}, COUNT(*) FROM books GROUP BY 1")
+    _create_id_block_triggers(conn, "books")
+
+
+def _create_id_block_triggers(conn, table):
+    """添加、删除书籍（table 表）时更新所在块的书籍数（书籍的 id 不会被修改）"""
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS book_id_blocks_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO book_id_blocks (block, count) VALUES (new.id >> {ID_BLOCK_BITS}, 1)
+            ON CONFLICT (block) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS book_id_blocks_delete AFTER DELETE ON {table} BEGIN
+            UPDATE book_id_blocks SET count = count - 1 WHERE block = old.id >> {ID_BLOCK_BITS};
+        END
+    ''')
+
+
+def book_grams_sql(row, category="{}.category"):
+    """由书籍行（别名 row，如 new、b）算出一两个字的索引内容：可搜索字段中每个位置的单字和两字，空格分隔
+
+    category 为分类名的表达式，{} 处填入 row。递归 CTE 不能用在触发器中，用 json_each 遍历一个与文本等长的数组代替；
+    分隔符和标点由 unicode61 分词去掉（“楼，”只剩“楼”），查询时用同样的分词，结果仍由 LIKE 核对。
+    """
+    text = (f"coalesce({row}.title, '') || ' ' || coalesce({row}.author, '') || ' ' || "
+            f"coalesce({category.format(row)}, '') || ' ' || "
+            f"coalesce({row}.description, '') || ' ' || coalesce({row}.publisher, '')")
+    return (f"(SELECT group_concat(substr(text, key + 1, 1) || ' ' || substr(text, key + 1, 2), ' ') "
+            f"FROM (SELECT {text} AS text), "
+            "json_each('[' || rtrim(replace(hex(zeroblob(length(text))), '00', '0,'), ',') || ']'))")
+
+
+def _create_fts_index(conn):
+    """书籍全文索引；SQLite 未编译 FTS5 时跳过，搜索退回 LIKE"""
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'books_fts'").fetchone() is not None
+
+    # trigram 分词按字符切分，中文书名无需词典即可做子串匹配
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+                title, author, category, description, publisher,
+                content='books', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError:
+        return
+
+    # 触发器保持索引与 books 表同步
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books {_unless_paused(conn, "books_fts_insert")} BEGIN
+            INSERT INTO books_fts (rowid, title, author, category, description, publisher)
+            VALUES (new.id, new.title, new.author, new.category, new.description, new.publisher);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author, category, description, publisher)
+            VALUES ('delete', old.id, old.title, old.author, old.category, old.description, old.publisher);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_update
+        AFTER UPDATE OF title, author, category, description, publisher ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author, category, description, publisher)
+            VALUES ('delete', old.id, old.title, old.author, old.category, old.description, old.publisher);
+            INSERT INTO books_fts (rowid, title, author, category, description, publisher)
+            VALUES (new.id, new.title, new.author, new.category, new.description, new.publisher);
+        END
+    ''')
+
+    # 旧数据库首次建立索引时回填已有书籍
+    if not exists:
+        conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+    _create_short_index(conn)
+
+
+def _create_short_index(conn):
+    """一两个字的搜索索引：trigram 只能匹配三个字及以上的词，中文最常见的两字词只能 LIKE 扫描全表
+
+    books_grams 是无内容的 FTS5 表（只存词和 rowid，detail=none 不存位置），每本书的单字和两字各为一个词，
+    一两个字的搜索词按词精确匹配。
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'books_grams'").fetchone() is not None
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS books_grams USING fts5(
+            grams, content='', detail='none', columnsize=0
+        )
+    ''')
+    _create_grams_triggers(conn, "books", "category")
+    if not exists:
+        insert_grams(conn)
+
+
+def _create_grams_triggers(conn, table, category_column, category="{}.category"):
+    """table 表上维护 books_grams 的触发器（category_column、category 为分类的字段和分类名的表达式）；
+    无内容表删除时须给出与写入时相同的内容，由旧行重新算出"""
+    delete = ("INSERT INTO books_grams (books_grams, rowid, grams) "
+              f"VALUES ('delete', old.id, {book_grams_sql('old', category)});")
+    insert = f"INSERT INTO books_grams (rowid, grams) VALUES (new.id, {book_grams_sql('new', category)});"
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS books_grams_insert AFTER INSERT ON {table} "
+                 f"{_unless_paused(conn, 'books_grams_insert')} BEGIN {insert} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS books_grams_delete AFTER DELETE ON {table} BEGIN {delete} END")
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_grams_update
+        AFTER UPDATE OF title, author, {category_column}, description, publisher ON {table} BEGIN
+            {delete}
+            {insert}
+        END
+    ''')
+
+
+def book_grams(title, author, category, description, publisher):
+    """与 book_grams_sql 相同的索引内容，在 Python 中算出
+
+    SQL 中逐字展开要经过 json_each，批量写入时占了导入的大部分时间；整批写入（导入、重建）时用这里算出的内容。
+    删除时触发器仍用 book_grams_sql 重新算出，两者须逐字相同。
+    """
+    text = " ".join("" if value is None else str(value) for value in (title, author, category, description, publisher))
+    # 每个位置的单字和两字；最后一个位置的“两字”只有一个字
+    grams = [f"{char} {char}{following}" for char, following in zip(text, text[1:])]
+    grams.append(f"{text[-1]} {text[-1]}")
+    return " ".join(grams)
+
+
+def insert_grams(conn, after_id=0):
+    """为 id 大于 after_id 的书籍写入 books_grams（导入时为本批新增的书，建立索引时为全部）"""
+    rows = conn.execute("SELECT id, title, author, category, description, publisher FROM books WHERE id > ?",
+                        (after_id,))
+    conn.executemany("INSERT INTO books_grams (rowid, grams) VALUES (?, ?)",
+                     ((row[0], book_grams(*row[1:])) for row in rows))
+
+
+def _create_query_indexes(conn):
+    """常用查询的二级索引；逐个建立并提交，每次只短暂持有写锁"""
+    indexes = [
+        # 按状态统计书籍
+        "CREATE INDEX IF NOT EXISTS idx_books_status ON books (status)",
+        # 我的共享：按拥有者查找书籍
+        "CREATE INDEX IF NOT EXISTS idx_books_owner ON books (owner)",
+        # 借阅记录：按借阅人查找并按借阅日期倒序，带上状态以覆盖统计查询
+        "CREATE INDEX IF NOT EXISTS idx_records_borrower ON sharing_records (borrower, borrow_date DESC, status)",
+        # 归还、删除与联表：按书籍和状态查找共享记录
+        "CREATE INDEX IF NOT EXISTS idx_records_book ON sharing_records (book_id, status)",
+    ]
+    for sql in indexes:
+        conn.execute(sql)
+        conn.commit()
+
+
+def _create_stats_tables(conn):
+    """物化统计表：按状态的书籍数量，以及每个用户的借阅/共享次数，由触发器在同一事务内维护"""
+    # 建表、回填与建触发器放在同一个事务里，避免回填后、触发器生效前的写入被漏计
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS book_stats (
+            status TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user TEXT PRIMARY KEY,
+            borrow_total INTEGER NOT NULL DEFAULT 0,
+            borrowing INTEGER NOT NULL DEFAULT 0,
+            share_total INTEGER NOT NULL DEFAULT 0,
+            sharing INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+
+    # 回填已有数据
+    conn.execute("DELETE FROM book_stats")
+    conn.execute('''
+        INSERT INTO book_stats (status, count)
+        SELECT COALESCE(status, ''), COUNT(*) FROM books GROUP BY 1
+    ''')
+    conn.execute("DELETE FROM user_stats")
+    conn.execute('''
+        INSERT INTO user_stats (user, borrow_total, borrowing)
+        SELECT borrower, COUNT(*), SUM(status = '借阅中') FROM sharing_records GROUP BY borrower
+    ''')
+    conn.execute('''
+        INSERT INTO user_stats (user, share_total, sharing)
+        SELECT b.owner, COUNT(*), SUM(sr.status = '借阅中')
+        FROM sharing_records sr JOIN books b ON b.id = sr.book_id
+        WHERE b.owner IS NOT NULL
+        GROUP BY b.owner
+        ON CONFLICT (user) DO UPDATE SET share_total = excluded.share_total, sharing = excluded.sharing
+    ''')
+
+    # 书籍增删改时修正状态计数
+    _create_book_stats_insert(conn)
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS book_stats_delete AFTER DELETE ON books BEGIN
+            UPDATE book_stats SET count = count - 1 WHERE status = COALESCE(old.status, '');
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS book_stats_update AFTER UPDATE OF status ON books
+        WHEN old.status IS NOT new.status BEGIN
+            UPDATE book_stats SET count = count - 1 WHERE status = COALESCE(old.status, '');
+            INSERT INTO book_stats (status, count) VALUES (COALESCE(new.status, ''), 1)
+            ON CONFLICT (status) DO UPDATE SET count = count + 1;
+        END
+    ''')
+
+    # 共享记录增删改时修正借阅人和拥有者的次数（删除书籍时需先删除其共享记录）
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS user_stats_insert AFTER INSERT ON sharing_records BEGIN
+            INSERT INTO user_stats (user, borrow_total, borrowing)
+            VALUES (new.borrower, 1, new.status = '借阅中')
+            ON CONFLICT (user) DO UPDATE SET
+                borrow_total = borrow_total + 1,
+                borrowing = borrowing + excluded.borrowing;
+            INSERT INTO user_stats (user, share_total, sharing)
+            SELECT owner, 1, new.status = '借阅中' FROM books WHERE id = new.book_id
+            ON CONFLICT (user) DO UPDATE SET
+                share_total = share_total + 1,
+                sharing = sharing + excluded.sharing;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS user_stats_delete AFTER DELETE ON sharing_records BEGIN
+            UPDATE user_stats SET
+                borrow_total = borrow_total - 1,
+                borrowing = borrowing - (old.status = '借阅中')
+            WHERE user = old.borrower;
+            UPDATE user_stats SET
+                share_total = share_total - 1,
+                sharing = sharing - (old.status = '借阅中')
+            WHERE user = (SELECT owner FROM books WHERE id = old.book_id);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS user_stats_update AFTER UPDATE OF status ON sharing_records
+        WHEN old.status IS NOT new.status BEGIN
+            UPDATE user_stats SET borrowing = borrowing - (old.status = '借阅中') + (new.status = '借阅中')
+            WHERE user = new.borrower;
+            UPDATE user_stats SET sharing = sharing - (old.status = '借阅中') + (new.status = '借阅中')
+            WHERE user = (SELECT owner FROM books WHERE id = new.book_id);
+        END
+    ''')
+
+
+def _create_book_stats_insert(conn):
+    """添加书籍时修正状态计数的触发器（可暂停，见 pause_triggers）"""
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS book_stats_insert AFTER INSERT ON books {_unless_paused(conn, "book_stats_insert")} BEGIN
+            INSERT INTO book_stats (status, count) VALUES (COALESCE(new.status, ''), 1)
+            ON CONFLICT (status) DO UPDATE SET count = count + 1;
+        END
+    ''')
+
+
+def _add_book_version(conn):
+    """书籍版本号：每次修改加一，客户端提交修改时带上读到的版本号，检测并发修改"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(books)")]
+    if "version" not in columns:
+        conn.execute("ALTER TABLE books ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+
+def _create_import_tables(conn):
+    """批量导入：按 ISBN 去重的索引，记录导入进度的表（与每批数据在同一事务中更新，用于断点续传），
+    以及可以暂停的插入触发器"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_books_isbn ON books (isbn)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            source TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            position INTEGER NOT NULL DEFAULT 0,
+            rows INTEGER NOT NULL DEFAULT 0,
+            inserted INTEGER NOT NULL DEFAULT 0,
+            duplicates INTEGER NOT NULL DEFAULT 0,
+            invalid INTEGER NOT NULL DEFAULT 0,
+            finished INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        )
+    ''')
+
+    # 逐行维护全文索引、一两个字的索引和状态计数的插入触发器改为可暂停：批量导入时整批插入后一次补上
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    conn.execute("CREATE TABLE IF NOT EXISTS paused_triggers (name TEXT PRIMARY KEY) WITHOUT ROWID")
+    for name in ("books_fts_insert", "books_grams_insert", "book_stats_insert"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+    _create_fts_index(conn)
+    _create_book_stats_insert(conn)
+
+
+def _unless_paused(conn, name):
+    """触发器 name 的 WHEN 条件：name 在 paused_triggers 中时不执行（见 pause_triggers）；还没有这张表的旧版本不加条件
+
+    暂停而不是 DROP TRIGGER 后重建：那样每一批都改变数据库结构（schema cookie），
+    其他连接（界面的读连接池、接口）都要重新编译语句；暂停只改一张小表的数据。
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'paused_triggers'").fetchone() is None:
+        return ""
+    return f"WHEN NOT EXISTS (SELECT 1 FROM paused_triggers WHERE name = '{name}')"
+
+
+def _create_due_tables(conn):
+    """借阅到期：逾期标记、只收录借出书籍的到期索引，以及到期/逾期提醒记录"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(books)")]
+    if "overdue" not in columns:
+        conn.execute("ALTER TABLE books ADD COLUMN overdue INTEGER NOT NULL DEFAULT 0")
+    # 部分索引只收录借出中的书：查找即将到期（overdue = 0）和已逾期（overdue = 1）的书都只读取相关的行
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_books_due ON books (overdue, borrow_until)
+        WHERE borrow_until IS NOT NULL
+    ''')
+    # 同一次借阅的同一种提醒只记录一次，调度器重复处理时不会重复提醒
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL,
+            borrower TEXT NOT NULL,
+            due_date TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            UNIQUE (book_id, borrower, due_date, kind)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reminders_borrower ON reminders (borrower, created_at DESC)")
+
+
+def _copy_sequence(conn, old, new):
+    """新表沿用旧表的自增序号，删除过的 id 不会被重新使用"""
+    conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (new,))
+    conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT ?, seq FROM sqlite_sequence WHERE name = ?", (new, old))
+
+
+def _create_book_triggers(conn):
+    """book_items 上的触发器：全文索引（内容表为视图 books，分类名由编号查出）、一两个字的索引、id 分块计数和状态计数；
+    插入时维护索引和计数的触发器可以暂停（批量导入整批插入后一次补上）"""
+    category = "(SELECT name FROM categories WHERE id = {}.category_id)"
+    if fts_available(conn):
+        conn.execute(f'''
+            CREATE TRIGGER books_fts_insert AFTER INSERT ON book_items {_unless_paused(conn, "books_fts_insert")} BEGIN
+                INSERT INTO books_fts (rowid, title, author, category, description, publisher)
+                VALUES (new.id, new.title, new.author, {category.format("new")}, new.description, new.publisher);
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER books_fts_delete AFTER DELETE ON book_items BEGIN
+                INSERT INTO books_fts (books_fts, rowid, title, author, category, description, publisher)
+                VALUES ('delete', old.id, old.title, old.author, {category.format("old")}, old.description, old.publisher);
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER books_fts_update
+            AFTER UPDATE OF title, author, category_id, description, publisher ON book_items BEGIN
+                INSERT INTO books_fts (books_fts, rowid, title, author, category, description, publisher)
+                VALUES ('delete', old.id, old.title, old.author, {category.format("old")}, old.description, old.publisher);
+                INSERT INTO books_fts (rowid, title, author, category, description, publisher)
+                VALUES (new.id, new.title, new.author, {category.format("new")}, new.description, new.publisher);
+            END
+        ''')
+    if fts_available(conn, "books_grams"):
+        _create_grams_triggers(conn, "book_items", "category_id", category)
+    _create_id_block_triggers(conn, "book_items")
+
+    conn.execute(f'''
+        CREATE TRIGGER book_stats_insert AFTER INSERT ON book_items {_unless_paused(conn, "book_stats_insert")} BEGIN
+            INSERT INTO book_stats (status_code, count) VALUES (new.status_code, 1)
+            ON CONFLICT (status_code) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER book_stats_delete AFTER DELETE ON book_items BEGIN
+            UPDATE book_stats SET count = count - 1 WHERE status_code = old.status_code;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER book_stats_update AFTER UPDATE OF status_code ON book_items
+        WHEN old.status_code IS NOT new.status_code BEGIN
+            UPDATE book_stats SET count = count - 1 WHERE status_code = old.status_code;
+            INSERT INTO book_stats (status_code, count) VALUES (new.status_code, 1)
+            ON CONFLICT (status_code) DO UPDATE SET count = count + 1;
+        END
+    ''')
+
+
+def _create_loan_triggers(conn):
+    """loans 上维护借阅人和拥有者借阅次数的触发器；删除的触发器可以暂停（归档时移动记录不改变借阅次数）"""
+    conn.execute(f'''
+        CREATE TRIGGER user_stats_insert AFTER INSERT ON loans BEGIN
+            INSERT INTO user_stats (user_id, borrow_total, borrowing)
+            VALUES (new.borrower_id, 1, new.status_code = {BORROWING})
+            ON CONFLICT (user_id) DO UPDATE SET
+                borrow_total = borrow_total + 1,
+                borrowing = borrowing + excluded.borrowing;
+            INSERT INTO user_stats (user_id, share_total, sharing)
+            SELECT owner_id, 1, new.status_code = {BORROWING} FROM book_items WHERE id = new.book_id
+            ON CONFLICT (user_id) DO UPDATE SET
+                share_total = share_total + 1,
+                sharing = sharing + excluded.sharing;
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER user_stats_delete AFTER DELETE ON loans {_unless_paused(conn, "user_stats_delete")} BEGIN
+            UPDATE user_stats SET
+                borrow_total = borrow_total - 1,
+                borrowing = borrowing - (old.status_code = {BORROWING})
+            WHERE user_id = old.borrower_id;
+            UPDATE user_stats SET
+                share_total = share_total - 1,
+                sharing = sharing - (old.status_code = {BORROWING})
+            WHERE user_id = (SELECT owner_id FROM book_items WHERE id = old.book_id);
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER user_stats_update AFTER UPDATE OF status_code ON loans
+        WHEN old.status_code IS NOT new.status_code BEGIN
+            UPDATE user_stats SET
+                borrowing = borrowing - (old.status_code = {BORROWING}) + (new.status_code = {BORROWING})
+            WHERE user_id = new.borrower_id;
+            UPDATE user_stats SET
+                sharing = sharing - (old.status_code = {BORROWING}) + (new.status_code = {BORROWING})
+            WHERE user_id = (SELECT owner_id FROM book_items WHERE id = new.book_id);
+        END
+    ''')
+
+
+def _normalize_tables(conn):
+    """用户、分类和状态改为整数编号：books、sharing_records 的数据移入 book_items、loans，原名改为只读的兼容视图
+
+    共享记录不再重复保存书名（由视图关联书籍得到）。索引和触发器在新表上重建，统计表改为按编号计数。
+    迁移在一个事务中完成；旧数据中为空的状态按空字符串的状态保存。
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'book_items'").fetchone():
+        return
+
+    # 编号表：先放入固定的状态码，旧数据中其他的状态、用户和分类依次编号
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    conn.execute("CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    conn.execute("CREATE TABLE statuses (code INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    conn.executemany("INSERT INTO statuses (code, name) VALUES (?, ?)", STATUSES)
+    conn.execute('''
+        INSERT OR IGNORE INTO statuses (name)
+        SELECT COALESCE(status, '') FROM books UNION SELECT COALESCE(status, '') FROM sharing_records
+    ''')
+    conn.execute('''
+        INSERT OR IGNORE INTO users (name)
+        SELECT owner FROM books UNION SELECT borrower FROM books WHERE borrower IS NOT NULL
+        UNION SELECT borrower FROM sharing_records
+    ''')
+    conn.execute("INSERT OR IGNORE INTO categories (name) SELECT DISTINCT category FROM books WHERE category IS NOT NULL")
+
+    conn.execute(f'''
+        CREATE TABLE book_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            isbn TEXT,
+            category_id INTEGER REFERENCES categories (id),
+            publisher TEXT,
+            publish_year INTEGER,
+            status_code INTEGER NOT NULL DEFAULT {AVAILABLE} REFERENCES statuses (code),
+            owner_id INTEGER NOT NULL REFERENCES users (id),
+            borrower_id INTEGER REFERENCES users (id),
+            borrow_until TEXT,
+            description TEXT,
+            version INTEGER NOT NULL DEFAULT 0,
+            overdue INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute(f'''
+        CREATE TABLE loans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL REFERENCES book_items (id),
+            borrower_id INTEGER NOT NULL REFERENCES users (id),
+            borrow_date TEXT NOT NULL,
+            return_date TEXT,
+            status_code INTEGER NOT NULL DEFAULT {BORROWING} REFERENCES statuses (code)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO book_items (id, title, author, isbn, category_id, publisher, publish_year, status_code,
+                                owner_id, borrower_id, borrow_until, description, version, overdue)
+        SELECT b.id, b.title, b.author, b.isbn, c.id, b.publisher, b.publish_year, s.code,
+               o.id, u.id, b.borrow_until, b.description, b.version, b.overdue
+        FROM books b
+        LEFT JOIN categories c ON c.name = b.category
+        JOIN statuses s ON s.name = COALESCE(b.status, '')
+        JOIN users o ON o.name = b.owner
+        LEFT JOIN users u ON u.name = b.borrower
+        ORDER BY b.id
+    ''')
+    conn.execute('''
+        INSERT INTO loans (id, book_id, borrower_id, borrow_date, return_date, status_code)
+        SELECT sr.id, sr.book_id, u.id, sr.borrow_date, sr.return_date, s.code
+        FROM sharing_records sr
+        JOIN users u ON u.name = sr.borrower
+        JOIN statuses s ON s.name = COALESCE(sr.status, '')
+        ORDER BY sr.id
+    ''')
+
+    _copy_sequence(conn, "books", "book_items")
+    _copy_sequence(conn, "sharing_records", "loans")
+
+    # 旧表的索引和触发器随表删除，原名改为兼容视图
+    conn.execute("DROP TABLE sharing_records")
+    conn.execute("DROP TABLE books")
+    conn.execute('''
+        CREATE VIEW books AS
+        SELECT b.id, b.title, b.author, b.isbn, c.name AS category, b.publisher, b.publish_year,
+               s.name AS status, o.name AS owner, u.name AS borrower, b.borrow_until, b.description,
+               b.version, b.overdue
+        FROM book_items b
+        LEFT JOIN categories c ON c.id = b.category_id
+        LEFT JOIN statuses s ON s.code = b.status_code
+        LEFT JOIN users o ON o.id = b.owner_id
+        LEFT JOIN users u ON u.id = b.borrower_id
+    ''')
+    conn.execute('''
+        CREATE VIEW sharing_records AS
+        SELECT l.id, l.book_id, b.title AS book_title, u.name AS borrower, l.borrow_date, l.return_date,
+               s.name AS status
+        FROM loans l
+        LEFT JOIN book_items b ON b.id = l.book_id
+        LEFT JOIN users u ON u.id = l.borrower_id
+        LEFT JOIN statuses s ON s.code = l.status_code
+    ''')
+
+    for sql in (
+        "CREATE INDEX idx_books_status ON book_items (status_code)",
+        "CREATE INDEX idx_books_owner ON book_items (owner_id)",
+        "CREATE INDEX idx_books_isbn ON book_items (isbn)",
+        "CREATE INDEX idx_books_due ON book_items (overdue, borrow_until) WHERE borrow_until IS NOT NULL",
+        "CREATE INDEX idx_records_borrower ON loans (borrower_id, borrow_date DESC, status_code)",
+        "CREATE INDEX idx_records_book ON loans (book_id, status_code)",
+    ):
+        conn.execute(sql)
+
+    _create_book_triggers(conn)
+
+    # 统计表改为按状态码和用户编号计数
+    conn.execute("DROP TABLE book_stats")
+    conn.execute("DROP TABLE user_stats")
+    conn.execute('''
+        CREATE TABLE book_stats (
+            status_code INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE user_stats (
+            user_id INTEGER PRIMARY KEY,
+            borrow_total INTEGER NOT NULL DEFAULT 0,
+            borrowing INTEGER NOT NULL DEFAULT 0,
+            share_total INTEGER NOT NULL DEFAULT 0,
+            sharing INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute("INSERT INTO book_stats (status_code, count) SELECT status_code, COUNT(*) FROM book_items GROUP BY 1")
+    conn.execute(f'''
+        INSERT INTO user_stats (user_id, borrow_total, borrowing)
+        SELECT borrower_id, COUNT(*), SUM(status_code = {BORROWING}) FROM loans GROUP BY borrower_id
+    ''')
+    conn.execute(f'''
+        INSERT INTO user_stats (user_id, share_total, sharing)
+        SELECT b.owner_id, COUNT(*), SUM(l.status_code = {BORROWING})
+        FROM loans l JOIN book_items b ON b.id = l.book_id
+        GROUP BY b.owner_id
+        ON CONFLICT (user_id) DO UPDATE SET share_total = excluded.share_total, sharing = excluded.sharing
+    ''')
+    _create_loan_triggers(conn)
+
+
+# 兼容视图：以前的 books、sharing_records 表的字段和内容不变（日期为 'YYYY-MM-DD'），旧的查询（导出、外部工具）可以照常读取；
+# LEFT JOIN 的都是主键，查询没有用到的关联表会被 SQLite 省略
+BOOKS_VIEW = f'''
+    CREATE VIEW books AS
+    SELECT b.id, b.title, b.author, b.isbn, c.name AS category, b.publisher, b.publish_year,
+           s.name AS status, o.name AS owner, u.name AS borrower, {day_sql("b.borrow_until")} AS borrow_until,
+           b.description, b.version, b.overdue
+    FROM book_items b
+    LEFT JOIN categories c ON c.id = b.category_id
+    LEFT JOIN statuses s ON s.code = b.status_code
+    LEFT JOIN users o ON o.id = b.owner_id
+    LEFT JOIN users u ON u.id = b.borrower_id
+'''
+
+SHARING_RECORDS_VIEW = f'''
+    CREATE VIEW sharing_records AS
+    SELECT l.id, l.book_id, b.title AS book_title, u.name AS borrower, {day_sql("l.borrow_date")} AS borrow_date,
+           {day_sql("l.return_date")} AS return_date, s.name AS status
+    FROM loan_history l
+    LEFT JOIN book_items b ON b.id = l.book_id
+    LEFT JOIN users u ON u.id = l.borrower_id
+    LEFT JOIN statuses s ON s.code = l.status_code
+'''
+
+LOAN_COLUMNS = "id, book_id, borrower_id, borrow_date, return_date, status_code"
+
+
+def _rebuild_table(conn, table, create_sql, select_sql):
+    """按 create_sql（表名为 {}）新建表并复制数据后替换原表；原表的索引和触发器随表删除，须由调用方重建"""
+    conn.execute(create_sql.format(f"{table}_new"))
+    conn.execute(f"INSERT INTO {table}_new {select_sql}")
+    _copy_sequence(conn, table, f"{table}_new")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+
+def _store_days(conn):
+    """日期改为 1970-01-01 起的天数（整数）：按整数比较和排序，也比文本短
+
+    book_items 和 loans 按新的列类型重建（列类型决定存入的值是否被转成文本），兼容视图把天数转换回 'YYYY-MM-DD'。
+    共享记录的查询改读 loan_history 视图：loans 加上按年归档的 loans_archive_<年份> 表（见 archive_loans）。
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'loan_history'").fetchone():
+        return
+
+    # 视图和其他表上的触发器引用了要重建的表，先删除，否则改表名时会报错
+    conn.execute("DROP VIEW books")
+    conn.execute("DROP VIEW sharing_records")
+    for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name IN ('book_items', 'loans')"
+    ).fetchall():
+        conn.execute(f"DROP TRIGGER {name}")
+
+    day = "CAST(julianday({}) - 2440587.5 AS INTEGER)"
+    _rebuild_table(conn, "book_items", f'''
+        CREATE TABLE {{}} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            isbn TEXT,
+            category_id INTEGER REFERENCES categories (id),
+            publisher TEXT,
+            publish_year INTEGER,
+            status_code INTEGER NOT NULL DEFAULT {AVAILABLE} REFERENCES statuses (code),
+            owner_id INTEGER NOT NULL REFERENCES users (id),
+            borrower_id INTEGER REFERENCES users (id),
+            borrow_until INTEGER,
+            description TEXT,
+            version INTEGER NOT NULL DEFAULT 0,
+            overdue INTEGER NOT NULL DEFAULT 0
+        )
+    ''', f'''
+        SELECT id, title, author, isbn, category_id, publisher, publish_year, status_code, owner_id, borrower_id,
+               {day.format("borrow_until")}, description, version, overdue
+        FROM book_items ORDER BY id
+    ''')
+    _rebuild_table(conn, "loans", f'''
+        CREATE TABLE {{}} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL REFERENCES book_items (id),
+            borrower_id INTEGER NOT NULL REFERENCES users (id),
+            borrow_date INTEGER NOT NULL,
+            return_date INTEGER,
+            status_code INTEGER NOT NULL DEFAULT {BORROWING} REFERENCES statuses (code)
+        )
+    ''', f'''
+        SELECT id, book_id, borrower_id, {day.format("borrow_date")}, {day.format("return_date")}, status_code
+        FROM loans ORDER BY id
+    ''')
+
+    for sql in (
+        "CREATE INDEX idx_books_status ON book_items (status_code)",
+        "CREATE INDEX idx_books_owner ON book_items (owner_id)",
+        "CREATE INDEX idx_books_isbn ON book_items (isbn)",
+        "CREATE INDEX idx_books_due ON book_items (overdue, borrow_until) WHERE borrow_until IS NOT NULL",
+        "CREATE INDEX idx_records_borrower ON loans (borrower_id, borrow_date DESC, status_code)",
+        "CREATE INDEX idx_records_book ON loans (book_id, status_code)",
+    ):
+        conn.execute(sql)
+    _create_book_triggers(conn)
+    _create_loan_triggers(conn)
+
+    _create_history_view(conn)
+    conn.execute(BOOKS_VIEW)
+    conn.execute(SHARING_RECORDS_VIEW)
+
+
+def _create_recommend_tables(conn):
+    """借阅推荐（bookrecommend.py）：每本书的借阅次数与预先算好的相似书籍
+
+    book_loans.loans 由 loans 的插入触发器维护（归档不改变次数），refreshed 为上次计算推荐时的次数，
+    两者不同的书由部分索引列出，等待后台更新推荐。
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS book_loans (
+            book_id INTEGER PRIMARY KEY,
+            loans INTEGER NOT NULL DEFAULT 0,
+            refreshed INTEGER NOT NULL DEFAULT -1
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_book_loans_stale ON book_loans (book_id) WHERE loans != refreshed")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS book_neighbors (
+            book_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            neighbor_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (book_id, rank)
+        ) WITHOUT ROWID
+    ''')
+    # 回填与建触发器在同一个事务里，避免漏计
+    conn.execute("DELETE FROM book_loans")
+    conn.execute("INSERT INTO book_loans (book_id, loans) SELECT book_id, COUNT(*) FROM loan_history GROUP BY book_id")
+    _create_recommend_triggers(conn)
+
+
+def _create_recommend_triggers(conn):
+    """新的借阅记录使书籍的推荐过期；删除书籍时一并删除它的借阅次数和推荐"""
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS book_loans_insert AFTER INSERT ON loans BEGIN
+            INSERT INTO book_loans (book_id, loans) VALUES (new.book_id, 1)
+            ON CONFLICT (book_id) DO UPDATE SET loans = loans + 1;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS book_loans_delete AFTER DELETE ON book_items BEGIN
+            DELETE FROM book_loans WHERE book_id = old.id;
+            DELETE FROM book_neighbors WHERE book_id = old.id;
+        END
+    ''')
+
+
+def _create_reservation_tables(conn):
+    """借阅预约：每本书的等候队列按 (book_id, created_at) 索引，队首由归还的事务直接读取
+
+    days 为借阅天数，轮到时按它借出；expires（天数）之前没有轮到的预约由调度器批量删除。
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS reservations (
+            id INTEGER PRIMARY KEY,
+            book_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            days INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            expires INTEGER NOT NULL,
+            UNIQUE (book_id, user_id)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reservations_queue ON reservations (book_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reservations_user ON reservations (user_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reservations_expires ON reservations (expires)")
+
+
+def _create_sync_tables(conn):
+    """节点间同步（booksync.py）：本节点的编号与逻辑时钟、行的全局键与时间戳、变更日志和从各节点已收到的位置
+
+    迁移前已有的行在 sync_rows 中没有记录，全局键视为 (本节点, id)，时间戳为 (0, 本节点)。
+    本节点删除的书籍保留 deleted = 1 的记录（墓碑），从其他节点收到、本地没有的书籍的墓碑 row_id 为 NULL。
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_node (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            node TEXT NOT NULL,
+            clock INTEGER NOT NULL DEFAULT 0,
+            applying TEXT
+        )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO sync_node (id, node) VALUES (1, ?)", (uuid.uuid4().hex,))
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_rows (
+            tbl TEXT NOT NULL,
+            row_id INTEGER,
+            node TEXT NOT NULL,
+            origin_id INTEGER NOT NULL,
+            clock INTEGER NOT NULL,
+            writer TEXT NOT NULL,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (tbl, node, origin_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sync_rows_local ON sync_rows (tbl, row_id)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tbl TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            origin TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_peers (
+            node TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL DEFAULT 0,
+            book_after INTEGER,
+            loan_after INTEGER,
+            synced_at TEXT
+        )
+    ''')
+    _create_sync_triggers(conn)
+
+
+def _create_sync_triggers(conn):
+    """本地修改书籍和共享记录时推进逻辑时钟，记下行的时间戳并追加一条变更日志
+
+    应用其他节点的变更时 sync_node.applying 为对方的节点编号，触发器不执行，由 booksync 按对方的时间戳记录。
+    共享记录只在删除书籍和归档时删除，删除不记日志（书籍的墓碑会让对方一并删除）。
+    """
+    stamp = '''
+        UPDATE sync_node SET clock = clock + 1;
+        UPDATE sync_rows SET clock = (SELECT clock FROM sync_node), writer = (SELECT node FROM sync_node),
+                             deleted = {deleted}
+        WHERE tbl = '{table}' AND row_id = {row}.id;
+        INSERT INTO sync_rows (tbl, row_id, node, origin_id, clock, writer, deleted)
+        SELECT '{table}', {row}.id, node, {row}.id, clock, node, {deleted} FROM sync_node
+        WHERE NOT EXISTS (SELECT 1 FROM sync_rows WHERE tbl = '{table}' AND row_id = {row}.id);
+        INSERT INTO change_log (tbl, row_id) VALUES ('{table}', {row}.id);
+    '''
+    local = "WHEN (SELECT applying FROM sync_node) IS NULL"
+    for name, event, table, row, deleted in (
+        ("sync_books_insert", "INSERT", "book_items", "new", 0),
+        ("sync_books_update", "UPDATE OF title, author, isbn, category_id, publisher, publish_year, status_code, "
+                              "owner_id, borrower_id, borrow_until, description", "book_items", "new", 0),
+        ("sync_books_delete", "DELETE", "book_items", "old", 1),
+        ("sync_loans_insert", "INSERT", "loans", "new", 0),
+        ("sync_loans_update", "UPDATE OF book_id, borrower_id, borrow_date, return_date, status_code", "loans", "new", 0),
+    ):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table} {local} BEGIN
+                {stamp.format(table=table, row=row, deleted=deleted)}
+            END
+        ''')
+
+
+# (版本号, 说明, 迁移函数)，只能在末尾追加
+MIGRATIONS = [
+    (1, "基础数据表", _create_base_tables),
+    (2, "书籍全文索引与一两个字的搜索索引", _create_fts_index),
+    (3, "常用查询索引", _create_query_indexes),
+    (4, "物化统计表", _create_stats_tables),
+    (5, "书籍版本号", _add_book_version),
+    (6, "批量导入", _create_import_tables),
+    (7, "借阅到期提醒", _create_due_tables),
+    (8, "用户、分类与状态编号", _normalize_tables),
+    (9, "日期改为天数，共享记录按年归档", _store_days),
+    (10, "借阅推荐", _create_recommend_tables),
+    (11, "借阅预约", _create_reservation_tables),
+    (12, "节点间同步", _create_sync_tables),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    """读取数据库当前版本"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, target=SCHEMA_VERSION):
+    """执行尚未执行的迁移（最多到 target 版本），返回迁移前的版本"""
+    version = schema_version(conn)
+    for number, description, step in MIGRATIONS:
+        if number <= version or number > target:
+            continue
+        try:
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return version
+
+
+def fts_available(conn, table="books_fts"):
+    """数据库中是否建立了全文索引（table 为 books_grams 时检查一两个字的索引）"""
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table,)).fetchone() is not None
+
+
+@contextmanager
+def pause_triggers(conn, *names):
+    """在当前写事务中暂停 names 中的触发器（须是按 _unless_paused 建立的），退出时恢复；
+    其他连接看不到中间状态，数据库结构不变"""
+    conn.executemany("INSERT OR IGNORE INTO paused_triggers (name) VALUES (?)", [(name,) for name in names])
+    try:
+        yield
+    finally:
+        conn.executemany("DELETE FROM paused_triggers WHERE name = ?", [(name,) for name in names])
+
+
+def short_match(terms):
+    """一两个字的搜索词在 books_grams 中的 MATCH 表达式（各词都须匹配）；有词全是标点等分词后为空的字符时返回 None
+
+    books_grams 中每个位置的单字和两字各为一个词，一两个字的搜索词按同样的分词后整词匹配。
+    """
+    if not terms or not all(any(char.isalnum() for char in term) for term in terms):
+        return None
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def search_sql(terms, fts=True, grams=True, ranked=True, schema=None):
+    """搜索书名、作者、分类、描述和出版社的查询 SELECT b.id, rank ... LIMIT :limit 及其命名参数（不含 :limit）
+
+    BookService.search、跨馆搜索和 HOT_QUERIES 都用它生成 SQL，检查执行计划的就是应用执行的查询。
+    fts、grams 为数据库中有没有 books_fts、books_grams：trigram 索引只能匹配三个字及以上的词，更短的词用 LIKE 过滤；
+    全是一两个字的词时先在 books_grams 中按词匹配，LIKE 只核对匹配到的书，不必扫描全表。
+    ranked 为 False 时不按 BM25 排序（rank 为 0）。schema 为附加数据库的别名，同时作为参数名的前缀，各馆不重复。
+    """
+    table = f"{schema}." if schema else ""
+    key = f"{schema}_" if schema else ""
+    long_terms = [t for t in terms if len(t) >= 3] if fts else []
+    short_terms = [t for t in terms if t not in long_terms]
+    grams = short_match(short_terms) if grams else None
+
+    conditions = []
+    params = {}
+    for index, term in enumerate(short_terms):
+        # 分类只有几十个，先在分类表中匹配，再按编号过滤；词中的 %、_ 按字面匹配
+        like = f":{key}term{index} ESCAPE '\\'"
+        conditions.append(f"(b.title LIKE {like} OR b.author LIKE {like} "
+                          f"OR b.category_id IN (SELECT id FROM {table}categories WHERE name LIKE {like}) "
+                          f"OR b.description LIKE {like} OR b.publisher LIKE {like})")
+        escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        params[f"{key}term{index}"] = f"%{escaped}%"
+
+    if long_terms:
+        # 每个词作为短语匹配（子串匹配同时覆盖前缀匹配），按 BM25 排序，书名权重最高；
+        # 全文索引表用表名引用（不能起别名）
+        params[f"{key}match"] = " ".join('"' + t.replace('"', '""') + '"' for t in long_terms)
+        rank = "bm25(books_fts, 10.0, 5.0, 2.0, 1.0, 1.0)" if ranked else "0.0"
+        sql = (f"SELECT b.id, {rank} AS rank FROM {table}books_fts "
+               f"JOIN {table}book_items b ON b.id = books_fts.rowid WHERE books_fts MATCH :{key}match")
+        sql += "".join(f" AND {condition}" for condition in conditions)
+        return sql + (" ORDER BY rank" if ranked else "") + " LIMIT :limit", params
+    if grams:
+        params[f"{key}grams"] = grams
+        return (f"SELECT b.id, 0.0 AS rank FROM {table}books_grams "
+                f"JOIN {table}book_items b ON b.id = books_grams.rowid "
+                f"WHERE books_grams MATCH :{key}grams AND {' AND '.join(conditions)} "
+                "ORDER BY books_grams.rowid LIMIT :limit"), params
+    return (f"SELECT b.id, 0.0 AS rank FROM {table}book_items b "
+            f"WHERE {' AND '.join(conditions)} ORDER BY b.id LIMIT :limit"), params
+
+
+def _search_query(name, search_term, **options):
+    """HOT_QUERIES 中的一条搜索：BookService.search 对 search_term 执行的查询（有全文索引和一两个字的索引时）"""
+    sql, params = search_sql(search_term.split(), **options)
+    return name, sql, dict(params, limit=1000)
+
+
+def _name_id(conn, table, name, create):
+    """按名称查编号；create 为 True 时不存在的名称自动加入（须在写事务中）"""
+    if name is None:
+        return None
+    if create:
+        conn.execute(f"INSERT INTO {table} (name) VALUES (?) ON CONFLICT (name) DO NOTHING", (name,))
+    row = conn.execute(f"SELECT id FROM {table} WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def user_id(conn, name, create=False):
+    """用户编号；用户不存在且 create 为 False 时返回 None"""
+    return _name_id(conn, "users", name, create)
+
+
+def category_id(conn, name):
+    """分类编号，分类不存在时自动加入（须在写事务中）；name 为 None 时返回 None"""
+    return _name_id(conn, "categories", name, True)
+
+
+def drop_write_triggers(conn):
+    """去掉 book_items、loans 上逐行维护全文索引、id 分块计数、统计和同步日志的触发器（批量生成数据用），写完后须调用 rebuild_derived
+
+    这期间写入的行不记变更日志，只在其他节点第一次同步时随全部数据发送。
+    """
+    for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name IN ('book_items', 'loans')"
+    ).fetchall():
+        conn.execute(f"DROP TRIGGER {name}")
+
+
+def rebuild_derived(conn):
+    """按现有数据重建全文索引（含 books_grams）、book_stats、user_stats、book_loans（含已归档的共享记录）和 book_id_blocks，
+    并重新建立 drop_write_triggers 去掉的触发器；推荐全部过期，须用 bookrecommend.py rebuild 重新计算"""
+    drop_write_triggers(conn)
+    if fts_available(conn):
+        conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+    if fts_available(conn, "books_grams"):
+        conn.execute("INSERT INTO books_grams (books_grams) VALUES ('delete-all')")
+        insert_grams(conn)
+    conn.execute("DELETE FROM book_stats")
+    conn.execute("INSERT INTO book_stats (status_code, count) SELECT status_code, COUNT(*) FROM book_items GROUP BY 1")
+    conn.execute("DELETE FROM user_stats")
+    conn.execute(f'''
+        INSERT INTO user_stats (user_id, borrow_total, borrowing)
+        SELECT borrower_id, COUNT(*), SUM(status_code = {BORROWING}) FROM loan_history GROUP BY borrower_id
+    ''')
+    conn.execute(f'''
+        INSERT INTO user_stats (user_id, share_total, sharing)
+        SELECT b.owner_id, COUNT(*), SUM(l.status_code = {BORROWING})
+        FROM loan_history l JOIN book_items b ON b.id = l.book_id
+        GROUP BY b.owner_id
+        ON CONFLICT (user_id) DO UPDATE SET share_total = excluded.share_total, sharing = excluded.sharing
+    ''')
+    conn.execute("DELETE FROM book_loans")
+    conn.execute("INSERT INTO book_loans (book_id, loans) SELECT book_id, COUNT(*) FROM loan_history GROUP BY book_id")
+
+    conn.execute("DELETE FROM book_id_blocks")
+    conn.execute(f"INSERT INTO book_id_blocks SELECT id >> {ID_BLOCK_BITS}, COUNT(*) FROM book_items GROUP BY 1")
+    _create_book_triggers(conn)
+    _create_loan_triggers(conn)
+    _create_recommend_triggers(conn)
+    _create_sync_triggers(conn)
+
+
+def archive_tables(conn):
+    """已有的归档表名，按年份排序"""
+    return [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'loans_archive_[0-9]*' ORDER BY name"
+    )]
+
+
+def loan_union(conn, select):
+    """把写给一张共享记录表的查询（表名写作 {loans}）对每张归档表和 loans 各写一遍，用 UNION ALL 连接；
+    参数用命名参数，各部分共用"""
+    return " UNION ALL ".join(select.format(loans=table) for table in archive_tables(conn) + ["loans"])
+
+
+def record_page_sql(conn, source, columns, conditions=(), keyset=False, ascending=False):
+    """共享记录按 (借阅日期, 记录ID) 键集分页的查询，每页 :limit 条
+
+    source 为写给一张共享记录表 {loans}（别名 l）的 FROM ... WHERE 子句，用 loan_union 对每张分表各写一遍，
+    conditions 为追加的筛选条件；columns 为结果列，可以引用共享记录 l、书籍 b、借阅人 u 和状态 s，
+    其后是三个附加列：借阅日期（天数，用于下一页的位置）、符合条件的记录总数、其中借阅中的数量。
+    第一页（keyset 为 False）用窗口函数在同一个查询中算出两个统计数；
+    之后的页从 (:after_day, :after_id) 之后读取，不计算统计，每张分表只按顺序读取一页，再合并取前 :limit 条。
+    排序和统计只用记录编号、借阅日期和状态（借阅人索引中都有，不用读表），其余字段、书名和用户名只为这一页的记录读取。
+    """
+    direction, operator = ("ASC", ">") if ascending else ("DESC", "<")
+    conditions = list(conditions)
+    if keyset:
+        conditions.append(f"l.borrow_date {operator}= :after_day "
+                          f"AND (l.borrow_date {operator} :after_day OR l.id {operator} :after_id)")
+    arm = f"SELECT l.id, l.borrow_date, l.status_code {source}{''.join(f' AND {c}' for c in conditions)}"
+    if keyset:
+        arm = f"SELECT * FROM ({arm} ORDER BY l.borrow_date {direction}, l.id {direction} LIMIT :limit)"
+        totals = "NULL AS total, NULL AS borrowing"
+    else:
+        totals = f"COUNT(*) OVER () AS total, SUM(status_code = {BORROWING}) OVER () AS borrowing"
+    # 其余字段按编号用相关子查询读取：编号条件会推入 loan_history 的每张分表走主键，
+    # 直接连接 loan_history 则会对每张分表重新计算一遍这一页
+    fields = ", ".join(f"(SELECT {name} FROM loan_history h WHERE h.id = p.id) AS {name}"
+                       for name in ("book_id", "borrower_id", "return_date"))
+    return f'''
+        WITH page AS (
+            SELECT *, {totals} FROM ({loan_union(conn, arm)})
+            ORDER BY borrow_date {direction}, id {direction} LIMIT :limit
+        ), l AS (
+            SELECT p.*, {fields} FROM page p
+        )
+        SELECT {columns}, l.borrow_date, l.total, l.borrowing
+        FROM l
+        LEFT JOIN book_items b ON b.id = l.book_id
+        LEFT JOIN users u ON u.id = l.borrower_id
+        LEFT JOIN statuses s ON s.code = l.status_code
+        ORDER BY l.borrow_date {direction}, l.id {direction}
+    '''
+
+
+def _create_history_view(conn):
+    """loan_history：各年的归档表（早的在前）加上 loans；
+    借阅人、书籍编号等于常量的条件会下推到每张表，各自走索引（含子查询或连接的条件不会，见 loan_union）"""
+    conn.execute("DROP VIEW IF EXISTS loan_history")
+    conn.execute("CREATE VIEW loan_history AS " + " UNION ALL ".join(
+        f"SELECT {LOAN_COLUMNS} FROM {table}" for table in archive_tables(conn) + ["loans"]
+    ))
+
+
+def _archive_table(conn, year):
+    """某一年的归档表，不存在时建立并加入 loan_history"""
+    table = f"loans_archive_{year:04d}"
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table,)).fetchone():
+        return table
+    conn.execute(f'''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY,
+            book_id INTEGER NOT NULL,
+            borrower_id INTEGER NOT NULL,
+            borrow_date INTEGER NOT NULL,
+            return_date INTEGER,
+            status_code INTEGER NOT NULL
+        )
+    ''')
+    conn.execute(f"CREATE INDEX idx_{table}_borrower ON {table} (borrower_id, borrow_date DESC, status_code)")
+    conn.execute(f"CREATE INDEX idx_{table}_book ON {table} (book_id)")
+    # 删除书籍时连同归档的记录一起删除，借阅次数同样减去（归档的记录都已归还，不影响借阅中的数量）
+    conn.execute(f'''
+        CREATE TRIGGER {table}_stats_delete AFTER DELETE ON {table} BEGIN
+            UPDATE user_stats SET borrow_total = borrow_total - 1 WHERE user_id = old.borrower_id;
+            UPDATE user_stats SET share_total = share_total - 1
+            WHERE user_id = (SELECT owner_id FROM book_items WHERE id = old.book_id);
+        END
+    ''')
+    _create_history_view(conn)
+    return table
+
+
+def _archive_batch(conn, before_day, after_id, limit):
+    """在当前写事务中把 id 大于 after_id、在 before_day 之前归还的至多 limit 条记录移入归档表，返回 (移动数, 最后的 id)"""
+    rows = conn.execute(f'''
+        SELECT {LOAN_COLUMNS} FROM loans
+        WHERE id > ? AND status_code = {RETURNED} AND return_date < ?
+        ORDER BY id LIMIT ?
+    ''', (after_id, before_day, limit)).fetchall()
+    if not rows:
+        return 0, None
+
+    # 按借阅日期的年份分表
+    by_year = defaultdict(list)
+    for row in rows:
+        by_year[from_day(row[3]).year].append(row)
+    for year, group in by_year.items():
+        conn.executemany(f"INSERT INTO {_archive_table(conn, year)} ({LOAN_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)", group)
+
+    # 移动不改变借阅次数：删除时暂停维护用户统计的触发器
+    with pause_triggers(conn, "user_stats_delete"):
+        conn.executemany("DELETE FROM loans WHERE id = ?", [(row[0],) for row in rows])
+    return len(rows), rows[-1][0]
+
+
+def archive_loans(manager, days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH, today=None):
+    """把归还超过 days 天的共享记录移入按年分表的归档表，每批一个写事务，返回移动的记录数"""
+    before_day = to_day(today or date.today()) - days
+    moved = 0
+    after_id = 0
+    while True:
+        count, after_id = manager.run_write(_archive_batch, before_day, after_id, batch_size)
+        if not count:
+            return moved
+        moved += count
+
+
+class StatsCache:
+    """统计数字缓存：读取物化统计表，本进程写入后由调用方失效，其他连接写入后按 data_version 自动失效
+
+    data_version 是每个连接各自的计数，使用连接池时按连接分别记录。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data_versions = {}
+        self._book_counts = None
+        self._user_counts = {}
+
+    def invalidate(self, *args):
+        """丢弃缓存（可直接作为变更通知的回调）"""
+        with self._lock:
+            self._book_counts = None
+            self._user_counts.clear()
+
+    def _check_external_changes(self, conn):
+        """其他连接提交过数据时 data_version 会变化，丢弃缓存并返回 True"""
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_versions.get(id(conn)):
+            return False
+        self._data_versions[id(conn)] = data_version
+        self._book_counts = None
+        self._user_counts.clear()
+        return True
+
+    def changed(self, conn):
+        """上次检查以来其他连接是否提交过数据（只执行 PRAGMA data_version，不读统计表）"""
+        with self._lock:
+            return self._check_external_changes(conn)
+
+    def book_counts(self, conn):
+        """各状态的书籍数量 {状态: 数量}"""
+        with self._lock:
+            self._check_external_changes(conn)
+            if self._book_counts is None:
+                self._book_counts = dict(conn.execute('''
+                    SELECT s.name, book_stats.count FROM book_stats JOIN statuses s ON s.code = book_stats.status_code
+                ''').fetchall())
+            return self._book_counts
+
+    def user_counts(self, conn, user):
+        """用户的 (借阅次数, 借阅中, 共享次数, 共享借阅中)"""
+        with self._lock:
+            self._check_external_changes(conn)
+            if user not in self._user_counts:
+                row = conn.execute('''
+                    SELECT us.borrow_total, us.borrowing, us.share_total, us.sharing
+                    FROM user_stats us JOIN users u ON u.id = us.user_id
+                    WHERE u.name = ?
+                ''', (user,)).fetchone()
+                self._user_counts[user] = row or (0, 0, 0, 0)
+            return self._user_counts[user]
+
+
+def is_busy(error):
+    """是否为数据库被其他连接锁定（SQLITE_BUSY / SQLITE_LOCKED）"""
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(error)
+    return "locked" in message or "busy" in message
+
+
+def connect(db_path, busy_timeout=BUSY_TIMEOUT, readonly=False, profiler=None):
+    """打开一个连接并设置调优参数；连接可以交给其他线程使用，但同一时刻只能有一个线程使用
+
+    指定 profiler（bookprofile.Profiler）时，连接上执行的语句按它的抽样比例计时。
+    """
+    if profiler is None:
+        conn = sqlite3.connect(db_path, timeout=busy_timeout, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(db_path, timeout=busy_timeout, check_same_thread=False, factory=ProfiledConnection)
+        conn.profiler = profiler
+    for name, value in PRAGMAS:
+        conn.execute(f"PRAGMA {name} = {value}")
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+class ConnectionManager:
+    """连接管理：WAL 日志，只读连接池加一个串行使用的写连接
+
+    读操作互不阻塞，也不阻塞写操作；同一进程内的写操作排队使用写连接，
+    不同进程之间的写锁冲突由 busy_timeout 等待，仍然失败时整个事务退避后重试。
+    """
+    def __init__(self, db_path=DB_PATH, readers=READ_POOL_SIZE, busy_timeout=BUSY_TIMEOUT,
+                 retries=BUSY_RETRIES, backoff=BUSY_BACKOFF, journal_mode=JOURNAL_MODE, profiler=None):
+        self.db_path = db_path
+        self.readers = readers
+        self.busy_timeout = busy_timeout
+        self.journal_mode = journal_mode
+        self.retries = retries
+        self.backoff = backoff
+        self.profiler = profiler
+        self._pool = queue.LifoQueue()
+        self._opened = 0
+        self._pool_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._active = {}
+
+    def _writer_connection(self):
+        """写连接，首次使用时打开并设置日志模式（WAL 模式保存在数据库文件中）"""
+        if self._writer is None:
+            conn = connect(self.db_path, self.busy_timeout, profiler=self.profiler)
+            self.retry(lambda: conn.execute(f"PRAGMA journal_mode = {self.journal_mode}"))
+            self._writer = conn
+        return self._writer
+
+    def retry(self, fn, *args):
+        """执行 fn(*args)，遇到 SQLITE_BUSY 时按指数退避（带随机抖动）重试"""
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args)
+            except sqlite3.OperationalError as error:
+                if not is_busy(error) or attempt == self.retries:
+                    raise
+            time.sleep(delay * (0.5 + random.random()))
+            delay *= 2
+
+    @contextmanager
+    def read(self):
+        """从连接池借出一个只读连接"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                can_open = self._opened < self.readers
+                if can_open:
+                    self._opened += 1
+            conn = connect(self.db_path, self.busy_timeout, readonly=True, profiler=self.profiler) if can_open else self._pool.get()
+        try:
+            with self._using(conn):
+                yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put(conn)
+
+    @contextmanager
+    def _using(self, conn):
+        """记录当前线程正在使用的连接，以便其他线程中断它的查询"""
+        thread_id = threading.get_ident()
+        previous = self._active.get(thread_id)
+        self._active[thread_id] = conn
+        try:
+            yield conn
+        finally:
+            if previous is None:
+                del self._active[thread_id]
+            else:
+                self._active[thread_id] = previous
+
+    def interrupt(self, thread_id):
+        """中断某个线程正在执行的查询，该查询抛出 OperationalError"""
+        conn = self._active.get(thread_id)
+        if conn is not None:
+            conn.interrupt()
+
+    def run_read(self, fn, *args):
+        """用只读连接执行 fn(conn, *args)"""
+        with self.read() as conn:
+            return self.retry(fn, conn, *args)
+
+    def run_snapshot(self, fn, *args):
+        """用单独打开的只读连接执行 fn(conn, *args)，用完关闭：持续很久的读取（导出）不占用连接池"""
+        with closing(connect(self.db_path, self.busy_timeout, readonly=True, profiler=self.profiler)) as conn:
+            with self._using(conn):
+                return self.retry(fn, conn, *args)
+
+    def run_write(self, fn, *args):
+        """在写事务中执行 fn(conn, *args) 并提交，返回 fn 的结果
+
+        事务以 BEGIN IMMEDIATE 开始，先拿到写锁再读取，避免读后升级写锁时的死锁；
+        遇到 SQLITE_BUSY 时回滚整个事务，退避后重新执行 fn。
+        """
+        with self._write_lock:
+            conn = self._writer_connection()
+
+            def transaction():
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    result = fn(conn, *args)
+                    if conn.in_transaction:
+                        conn.commit()
+                    return result
+                except BaseException:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    raise
+
+            with self._using(conn):
+                return self.retry(transaction)
+
+    def close(self):
+        """关闭所有连接"""
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class DBFuture:
+    """提交给数据库执行器的任务"""
+    def __init__(self, fn, args, callback, errback, key, after):
+        self.fn = fn
+        self.args = args
+        self.callback = callback
+        self.errback = errback
+        self.key = key
+        self.after = after
+        self.cancelled = False
+        self.thread_id = None
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """阻塞等待任务完成（界面线程中不要调用），返回结果或抛出任务中的异常"""
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class DBExecutor:
+    """后台任务执行器：一个写线程，加上与读连接池同样多的读线程
+
+    任务函数在工作线程中以 fn(*args) 调用，通常是 BookService 的方法，由它自己选择读连接或写连接。
+    写任务（write=True）按提交顺序在写线程中执行；读任务并发执行，但会等待提交前最后一个写任务完成，保证读到自己的写入。
+    导入这样持续很久的任务用 submit_job 在各自的线程中执行，不占用读线程。
+    回调不会在工作线程中执行，而是由调用方线程（Tk 主线程）定期调用 deliver() 时执行，因此回调中可以直接操作界面。
+    提交时指定 key 的任务会取消同一 key 下尚未完成的旧任务，正在执行的旧查询通过 interrupt() 中断。
+    """
+    def __init__(self, manager, on_error=None):
+        self.manager = manager
+        self.on_error = on_error
+        self._reads = queue.Queue()
+        self._writes = queue.Queue()
+        self._done = queue.Queue()
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._last_write = None
+        self._pending = 0
+        self._threads = [threading.Thread(target=self._run, args=(self._writes,), name="db-writer", daemon=True)]
+        for number in range(manager.readers):
+            self._threads.append(
+                threading.Thread(target=self._run, args=(self._reads,), name=f"db-reader-{number}", daemon=True)
+            )
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def busy(self):
+        """是否有尚未交付的任务"""
+        return self._pending > 0
+
+    def submit(self, fn, *args, callback=None, errback=None, key=None, write=False):
+        """提交任务，返回 DBFuture"""
+        with self._lock:
+            future = DBFuture(fn, args, callback, errback, key, None if write else self._last_write)
+            if key is not None:
+                previous = self._keys.get(key)
+                if previous is not None:
+                    self._cancel(previous)
+                self._keys[key] = future
+            if write:
+                self._last_write = future
+            self._pending += 1
+        (self._writes if write else self._reads).put(future)
+        return future
+
+    def submit_job(self, fn, *args, callback=None, errback=None):
+        """在单独的线程中执行持续很久的任务（导入、导出），返回 DBFuture；回调同样由 deliver() 执行
+
+        读线程只有读连接池那么多个，长任务占住读线程时，界面的翻页、搜索和统计都要排在它后面。
+        任务等待提交前最后一个写任务完成后开始，自己通过连接管理器取得连接。
+        """
+        with self._lock:
+            future = DBFuture(fn, args, callback, errback, None, self._last_write)
+            self._pending += 1
+        threading.Thread(target=self._execute, args=(future,), name="db-job", daemon=True).start()
+        return future
+
+    def cancel(self, future):
+        """取消任务；已完成的任务不再执行回调"""
+        with self._lock:
+            self._cancel(future)
+
+    def _cancel(self, future):
+        future.cancelled = True
+        if future.thread_id is not None:
+            self.manager.interrupt(future.thread_id)
+
+    def _run(self, jobs):
+        """工作线程"""
+        while True:
+            future = jobs.get()
+            if future is None:
+                break
+            self._execute(future)
+
+    def _execute(self, future):
+        """在当前线程中执行一个任务，完成后放入待交付的队列"""
+        if future.after is not None:
+            future.after._done.wait()
+        with self._lock:
+            if not future.cancelled:
+                future.thread_id = threading.get_ident()
+        if future.thread_id is not None:
+            try:
+                future.result = self._call("job", future.fn, future.args)
+            except Exception as error:
+                future.error = error
+            with self._lock:
+                future.thread_id = None
+        future._done.set()
+        self._done.put(future)
+
+    def deliver(self):
+        """执行已完成任务的回调，由调用方线程定期调用"""
+        while True:
+            try:
+                future = self._done.get_nowait()
+            except queue.Empty:
+                return
+            with self._lock:
+                self._pending -= 1
+                if future.key is not None and self._keys.get(future.key) is future:
+                    del self._keys[future.key]
+            if future.cancelled:
+                continue
+            if future.error is not None:
+                handler = future.errback or self.on_error
+                if handler is None:
+                    raise future.error
+                self._call("callback", handler, (future.error,))
+            elif future.callback is not None:
+                self._call("callback", future.callback, (future.result,))
+
+    def _call(self, kind, fn, args):
+        """执行任务函数或回调；连接管理器带 profiler 时记录耗时"""
+        profiler = self.manager.profiler
+        if profiler is None:
+            return fn(*args)
+        return profiler.call(kind, callable_name(fn), fn, *args)
+
+    def close(self):
+        """处理完已提交的任务后结束工作线程"""
+        self._writes.put(None)
+        for _ in self._threads[1:]:
+            self._reads.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+
+# 应用中的常用查询，用于检查执行计划：(名称, SQL 或由连接生成 SQL 的函数, 参数)
+HOT_QUERIES = [
+    ("书籍统计", "SELECT s.name, book_stats.count FROM book_stats JOIN statuses s ON s.code = book_stats.status_code", ()),
+    ("用户统计", '''
+        SELECT us.borrow_total, us.borrowing, us.share_total, us.sharing
+        FROM user_stats us JOIN users u ON u.id = us.user_id
+        WHERE u.name = ?
+    ''', ("张三",)),
+    ("书籍分页",
+     "SELECT id, title, author, category, status, owner, borrower, borrow_until FROM books "
+     "WHERE id > ? ORDER BY id LIMIT ?", (0, 100)),
+    ("书籍详情", "SELECT * FROM books WHERE id = ?", (1,)),
+    ("按序号定位书籍", "SELECT id FROM book_items WHERE id >= ? ORDER BY id LIMIT 1 OFFSET ?", (1 << ID_BLOCK_BITS, 100)),
+    _search_query("全文搜索", "计算机"),
+    _search_query("全文搜索（不排序）", "计算机", ranked=False),
+    _search_query("短词搜索", "计算"),
+    _search_query("全文与短词搜索", "计算机 网络"),
+    ("我的共享", lambda conn: record_page_sql(
+        conn, "FROM book_items b JOIN {loans} l ON l.book_id = b.id WHERE b.owner_id = :user",
+        f'l.id, l.book_id, b.title, u.name, {day_sql("l.borrow_date")}, {day_sql("l.return_date")}, s.name',
+    ), {"user": 1, "limit": 201}),
+    ("我的共享（下一页）", lambda conn: record_page_sql(
+        conn, "FROM book_items b JOIN {loans} l ON l.book_id = b.id WHERE b.owner_id = :user",
+        f'l.id, l.book_id, b.title, u.name, {day_sql("l.borrow_date")}, {day_sql("l.return_date")}, s.name',
+        ["l.status_code = :status"], keyset=True,
+    ), {"user": 1, "limit": 201, "status": BORROWING, "after_day": 19723, "after_id": 1000}),
+    ("借阅记录", lambda conn: record_page_sql(
+        conn, "FROM {loans} l WHERE l.borrower_id = :user",
+        f'l.id, l.book_id, b.title, {day_sql("l.borrow_date")}, {day_sql("l.return_date")}, s.name',
+    ), {"user": 1, "limit": 201}),
+    ("借阅记录（下一页）", lambda conn: record_page_sql(
+        conn, "FROM {loans} l WHERE l.borrower_id = :user",
+        f'l.id, l.book_id, b.title, {day_sql("l.borrow_date")}, {day_sql("l.return_date")}, s.name',
+        ["l.borrow_date >= :since"], keyset=True, ascending=True,
+    ), {"user": 1, "limit": 201, "since": 19000, "after_day": 19723, "after_id": 1000}),
+    ("归还记录", f'''
+        UPDATE loans
+        SET return_date=?, status_code={RETURNED}
+        WHERE book_id=? AND borrower_id=? AND status_code={BORROWING}
+    ''', (19723, 1, 1)),
+    ("删除共享记录", "DELETE FROM loans WHERE book_id = ?", (1,)),
+    ("即将到期", f'''
+        SELECT b.id, u.name, {day_sql("b.borrow_until")} FROM book_items b
+        JOIN users u ON u.id = b.borrower_id
+        WHERE b.overdue = 0 AND b.borrow_until <= ?
+        ORDER BY b.borrow_until
+    ''', (19723,)),
+    ("逾期书籍", f'''
+        SELECT b.id, b.title, u.name, o.name, {day_sql("b.borrow_until")} FROM book_items b
+        LEFT JOIN users u ON u.id = b.borrower_id
+        LEFT JOIN users o ON o.id = b.owner_id
+        WHERE b.overdue = 1 AND b.borrow_until IS NOT NULL
+        ORDER BY b.borrow_until LIMIT ?
+    ''', (1000,)),
+    ("借阅推荐", '''
+        SELECT b.id, b.title, b.author, b.status, n.score
+        FROM book_neighbors n JOIN books b ON b.id = n.neighbor_id
+        WHERE n.book_id = ? ORDER BY n.rank LIMIT ?
+    ''', (1, 10)),
+    ("推荐已过期的书籍", "SELECT book_id, loans FROM book_loans WHERE loans != refreshed LIMIT ?", (20,)),
+    ("预约队首", "SELECT id, user_id, days, expires FROM reservations WHERE book_id = ? ORDER BY created_at, id LIMIT 1",
+     (1,)),
+    ("过期的预约", "DELETE FROM reservations WHERE expires < ?", (19723,)),
+    ("变更日志", "SELECT seq, tbl, row_id, origin FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?", (0, 2000)),
+    ("行的全局键", "SELECT row_id, clock, writer, deleted FROM sync_rows WHERE tbl = ? AND node = ? AND origin_id = ?",
+     ("book_items", "", 1)),
+    ("行的时间戳", "SELECT node, origin_id, clock, writer FROM sync_rows WHERE tbl = ? AND row_id = ?",
+     ("book_items", 1)),
+    # 兼容视图上的旧查询
+    ("旧的借阅记录查询", '''
+        SELECT sr.id, sr.book_id, sr.book_title, sr.borrow_date, sr.return_date, sr.status
+        FROM sharing_records sr
+        WHERE sr.borrower = ?
+        ORDER BY sr.borrow_date DESC
+    ''', ("张三",)),
+]
+
+
+# 可以整张读取的表及原因：行数与书籍、借阅的数量无关
+LOOKUP_TABLES = {
+    "book_stats": "每个状态一行",
+    "categories": "分类只有几十个，搜索词先在分类名称中 LIKE 匹配（search_sql）",
+}
+
+
+def _is_lookup_table(detail):
+    """SCAN 的是 LOOKUP_TABLES 中的表（不用别名，别名可能指向任何表）"""
+    return detail.split()[1] in LOOKUP_TABLES
+
+
+def _is_index_match(detail):
+    """全文索引按 MATCH（idxStr 含 M）或 rowid（含 =）查找；不带条件的 SCAN 虚拟表（idxStr 为空）仍算全表扫描"""
+    match = re.search(r"VIRTUAL TABLE INDEX \d+:(\S*)", detail)
+    return match is not None and any(flag in match.group(1) for flag in "M=")
+
+
+def _subquery_names(sql, plan):
+    """计划中 CO-ROUTINE / MATERIALIZE 的子查询名称（视图、CTE 或 (subquery-N)），以及 SQL 中给它们起的别名"""
+    names = {detail.split(" ", 1)[1] for _, _, _, detail in plan if detail.startswith(("CO-ROUTINE ", "MATERIALIZE "))}
+    for name in list(names):
+        if not name.startswith("("):
+            names.update(re.findall(rf"\b{re.escape(name)}\s+(?:AS\s+)?(\w+)", sql, re.IGNORECASE))
+    return names - {"ON", "WHERE", "JOIN", "LEFT", "ORDER", "GROUP", "LIMIT", "AS"}
+
+
+def _is_partial_index_scan(conn, sql, detail):
+    """SCAN 的是部分索引，且查询的条件中原样包含索引的 WHERE 条件（如推荐已过期的书籍 loans != refreshed）：
+    索引只收录符合条件的行，按设计只有少数几行；查询没有重复这个条件时不豁免"""
+    match = re.match(r"SCAN (\w+) USING (?:COVERING )?INDEX (\w+)", detail)
+    if match is None:
+        return False
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = ?", (match.group(2),)).fetchone()
+    if row is None or " WHERE " not in row[0]:
+        return False
+    condition = " ".join(row[0].split(" WHERE ", 1)[1].split())
+    return condition in " ".join(sql.split())
+
+
+def check_query_plans(conn, queries=HOT_QUERIES):
+    """用 EXPLAIN QUERY PLAN 检查常用查询，返回发生全表扫描的 (名称, 计划) 列表
+
+    以下 SCAN 不算全表扫描，其余的都算：
+    - 读取子查询（视图、CTE）结果的 SCAN，且扫描的名称是计划中某个 CO-ROUTINE / MATERIALIZE 子查询或它在 SQL 中的别名；
+      子查询内部的表另有计划行，同样检查；
+    - 全文索引的 MATCH 或 rowid 查找（_is_index_match）；
+    - LOOKUP_TABLES 中的表；
+    - 查询条件与索引条件一致的部分索引（_is_partial_index_scan）。
+    """
+    problems = []
+    for name, sql, params in queries:
+        if callable(sql):
+            # 随归档表变化的查询
+            sql = sql(conn)
+        if any(table in sql and not fts_available(conn, table) for table in ("books_fts", "books_grams")):
+            continue
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        subqueries = _subquery_names(sql, plan)
+        for _, _, _, detail in plan:
+            if not detail.startswith("SCAN "):
+                continue
+            target = detail.split()[1]
+            if target in subqueries or _is_index_match(detail) or _is_lookup_table(detail):
+                continue
+            if not _is_partial_index_scan(conn, sql, detail):
+                problems.append((name, detail))
+    return problems
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="图书共享系统数据库工具")
+    parser.add_argument("--db", default=DB_PATH, help="数据库文件")
+    parser.add_argument("--busy-timeout", type=float, default=BUSY_TIMEOUT, help="等待其他进程释放锁的秒数")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate", help="升级数据库结构")
+    commands.add_parser("check-plans", help="检查常用查询是否走索引")
+    archive = commands.add_parser("archive", help="把早已归还的共享记录移入按年分表的归档表")
+    archive.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="归还超过多少天的记录")
+    archive.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH, help="每个事务移动的记录数")
+    args = parser.parse_args(argv)
+
+    manager = ConnectionManager(args.db, readers=1, busy_timeout=args.busy_timeout)
+    try:
+        if args.command == "migrate":
+            before = manager.run_write(migrate)
+            print(f"数据库版本: {before} -> {manager.run_read(schema_version)}")
+            return 0
+
+        manager.run_write(migrate)
+        if args.command == "archive":
+            began = time.perf_counter()
+            moved = archive_loans(manager, args.days, args.batch_size)
+            tables = manager.run_read(archive_tables)
+            print(f"归档 {moved} 条共享记录，耗时 {time.perf_counter() - began:.1f}s；归档表: {', '.join(tables) or '无'}")
+            return 0
+
+        problems = manager.run_read(check_query_plans)
+        for name, detail in problems:
+            print(f"全表扫描: {name}: {detail}")
+        if problems:
+            return 1
+        print(f"{len(HOT_QUERIES)} 个常用查询均使用索引")
+        return 0
+    finally:
+        manager.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,346 @@
+﻿"""导出书目与共享记录（CSV / JSON Lines / 列式二进制）
+
+    python bookexport.py books -o books.csv
+    python bookexport.py all --format columnar --output-dir dumps
+
+在一个只读事务中用 fetchmany 分批读取，逐批写出文件，内存占用与表的大小无关。
+WAL 模式下读事务看到的是开始时的快照，不阻塞写入；同时导出的多个表来自同一个快照，彼此一致。
+文件先写到 .part 临时文件，完成后再改名，导出中断不会留下不完整的文件。
+
+列式格式（.bkc）：
+    文件头 MAGIC，随后若干行组，每个行组每列一个 zlib 压缩的列块；
+    文件尾为 JSON 元数据（表名、列名、各行组的行数与列块位置），再跟 4 字节元数据长度和 MAGIC。
+列块第一个字节为编码：整数列为 int64 数组；文本列为偏移数组加 UTF-8 数据，
+不同值较少的文本列（状态、日期、用户名）使用字典编码。第二个字节表示是否有空值，有空值时随后是每行一个字节的空值标记。
+read_columnar() 可以把文件读回为行。
+"""
+import argparse
+from array import array
+import csv
+from collections import namedtuple
+import io
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+
+from bookdb import DB_PATH
+from bookservice import BookService
+
+# 每次 fetchmany 读取的行数
+FETCH_SIZE = 10000
+
+# 列式格式每个行组的行数
+ROW_GROUP_SIZE = 65536
+
+# 可导出的表及查询（按表的存储顺序读取，不需要排序）：书籍按 id；
+# 共享记录先是各年的归档表，再是未归档的记录，各表内按 id，整体不按 id 排序（排序要把全部历史放进临时表）
+EXPORT_TABLES = {
+    "books": "SELECT * FROM books ORDER BY id",
+    "sharing_records": "SELECT * FROM sharing_records",
+}
+
+# 格式 -> 文件扩展名
+FORMATS = {"csv": ".csv", "jsonl": ".jsonl", "columnar": ".bkc"}
+
+MAGIC = b"BKCOL1\n"
+
+# 列块编码
+INT64, TEXT, DICT = 0, 1, 2
+
+# 导出结果：bytes 为文件大小
+ExportResult = namedtuple("ExportResult", ["table", "path", "rows", "bytes", "elapsed"])
+
+
+def iter_batches(cursor, size=FETCH_SIZE):
+    """逐批生成查询结果"""
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+
+
+def detect_format(path):
+    """按扩展名判断文件格式"""
+    extension = os.path.splitext(path)[1].lower()
+    for fmt, known in FORMATS.items():
+        if extension == known:
+            return fmt
+    if extension == ".ndjson":
+        return "jsonl"
+    raise ValueError(f"无法识别的文件格式: {path}（支持 {'、'.join(FORMATS.values())}）")
+
+
+class CsvWriter:
+    """CSV，第一行为列名；带 BOM，Excel 可以直接打开"""
+    def __init__(self, file, table, columns):
+        # 每批先写入内存缓冲再整体写出，文件只需按批编码，而不是每行一次
+        self.file = file
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        file.write("\ufeff")
+        self.write([columns])
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        self.file.write(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def close(self):
+        pass
+
+
+class JsonlWriter:
+    """JSON Lines，每行一个以列名为键的对象"""
+    def __init__(self, file, table, columns):
+        self.file = file
+        self.columns = columns
+        # json.dumps 带参数时每次调用都会新建编码器，这里复用同一个
+        self.encode = json.JSONEncoder(ensure_ascii=False).encode
+
+    def write(self, rows):
+        columns, encode = self.columns, self.encode
+        self.file.write("".join(encode(dict(zip(columns, row))) + "\n" for row in rows))
+
+    def close(self):
+        pass
+
+
+def _text_payload(values):
+    """文本值编码为 (n+1 个 uint32 偏移, UTF-8 数据)"""
+    data = [value.encode("utf-8") for value in values]
+    offsets = array("I", [0])
+    total = 0
+    for item in data:
+        total += len(item)
+        offsets.append(total)
+    return _le(offsets) + b"".join(data)
+
+
+def _le(values):
+    """数组按小端字节序输出"""
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode_column(values):
+    """编码一个列块（未压缩）"""
+    has_nulls = None in values
+    nulls = bytes(value is None for value in values) if has_nulls else b""
+
+    if all(type(value) is int for value in values if value is not None):
+        ints = array("q", (0 if value is None else value for value in values) if has_nulls else values)
+        return bytes([INT64, has_nulls]) + nulls + _le(ints)
+
+    texts = ["" if value is None else value if type(value) is str else str(value) for value in values]
+    distinct = dict.fromkeys(texts)
+    if len(distinct) <= min(len(texts) // 4, 65535):
+        for code, text in enumerate(distinct):
+            distinct[text] = code
+        codes = array("H", map(distinct.__getitem__, texts))
+        return (bytes([DICT, has_nulls]) + nulls + struct.pack("<I", len(distinct))
+                + _text_payload(list(distinct)) + _le(codes))
+    return bytes([TEXT, has_nulls]) + nulls + _text_payload(texts)
+
+
+def _text_values(data, count):
+    """解码 _text_payload，返回 (文本列表, 读过的字节数)"""
+    offsets = array("I")
+    offsets.frombytes(data[:(count + 1) * 4])
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    start = (count + 1) * 4
+    blob = data[start:start + offsets[-1]]
+    values = [blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(count)]
+    return values, start + offsets[-1]
+
+
+def decode_column(data, count):
+    """解码一个列块（已解压），返回值列表"""
+    encoding, has_nulls = data[0], data[1]
+    body = data[2 + count if has_nulls else 2:]
+    if encoding == INT64:
+        values = array("q")
+        values.frombytes(body[:count * 8])
+        if sys.byteorder == "big":
+            values.byteswap()
+        values = values.tolist()
+    elif encoding == TEXT:
+        values, _ = _text_values(body, count)
+    elif encoding == DICT:
+        size = struct.unpack_from("<I", body)[0]
+        dictionary, used = _text_values(body[4:], size)
+        codes = array("H")
+        codes.frombytes(body[4 + used:4 + used + count * 2])
+        if sys.byteorder == "big":
+            codes.byteswap()
+        values = [dictionary[code] for code in codes]
+    else:
+        raise ValueError(f"未知的列块编码: {encoding}")
+    if has_nulls:
+        nulls = data[2:2 + count]
+        values = [None if nulls[i] else value for i, value in enumerate(values)]
+    return values
+
+
+class ColumnarWriter:
+    """列式二进制格式：按行组缓存，每满一个行组按列编码、压缩后写出"""
+    def __init__(self, file, table, columns, row_group_size=ROW_GROUP_SIZE):
+        self.file = file
+        self.table = table
+        self.columns = columns
+        self.row_group_size = row_group_size
+        self.pending = []
+        self.groups = []
+        file.write(MAGIC)
+
+    def write(self, rows):
+        self.pending.extend(rows)
+        while len(self.pending) >= self.row_group_size:
+            self._flush(self.pending[:self.row_group_size])
+            del self.pending[:self.row_group_size]
+
+    def _flush(self, rows):
+        chunks = []
+        for values in zip(*rows):
+            data = zlib.compress(encode_column(values), 1)
+            chunks.append((self.file.tell(), len(data)))
+            self.file.write(data)
+        self.groups.append({"rows": len(rows), "chunks": chunks})
+
+    def close(self):
+        if self.pending:
+            self._flush(self.pending)
+            self.pending = []
+        footer = json.dumps({"table": self.table, "columns": self.columns, "row_groups": self.groups},
+                            ensure_ascii=False).encode("utf-8")
+        self.file.write(footer + struct.pack("<I", len(footer)) + MAGIC)
+
+
+def read_columnar_footer(file):
+    """读取列式文件的元数据"""
+    file.seek(-(4 + len(MAGIC)), os.SEEK_END)
+    tail = file.read()
+    if tail[4:] != MAGIC:
+        raise ValueError("不是列式导出文件")
+    length = struct.unpack("<I", tail[:4])[0]
+    file.seek(-(4 + len(MAGIC) + length), os.SEEK_END)
+    return json.loads(file.read(length))
+
+
+def read_columnar(path, columns=None):
+    """逐行读回列式文件，columns 为要读取的列名（默认全部），只解压需要的列块"""
+    with open(path, "rb") as file:
+        footer = read_columnar_footer(file)
+        names = footer["columns"]
+        wanted = [names.index(name) for name in columns] if columns else range(len(names))
+        for group in footer["row_groups"]:
+            values = []
+            for index in wanted:
+                offset, length = group["chunks"][index]
+                file.seek(offset)
+                values.append(decode_column(zlib.decompress(file.read(length)), group["rows"]))
+            yield from zip(*values)
+
+
+# 格式 -> (写入器, 是否文本文件)
+WRITERS = {"csv": (CsvWriter, True), "jsonl": (JsonlWriter, True), "columnar": (ColumnarWriter, False)}
+
+
+def _export(conn, targets, fmt, fetch_size, progress):
+    """在一个读事务（同一快照）中依次导出各表"""
+    writer_class, text = WRITERS[fmt]
+    results = []
+    conn.execute("BEGIN")
+    try:
+        for table, path in targets:
+            began = time.perf_counter()
+            cursor = conn.execute(EXPORT_TABLES[table])
+            columns = [column[0] for column in cursor.description]
+            temp_path = path + ".part"
+            if text:
+                file = open(temp_path, "w", encoding="utf-8", newline="")
+            else:
+                file = open(temp_path, "wb")
+            rows = 0
+            try:
+                writer = writer_class(file, table, columns)
+                for batch in iter_batches(cursor, fetch_size):
+                    writer.write(batch)
+                    rows += len(batch)
+                    if progress:
+                        progress(table, rows)
+                writer.close()
+            except BaseException:
+                file.close()
+                os.remove(temp_path)
+                raise
+            file.close()
+            os.replace(temp_path, path)
+            results.append(ExportResult(table, path, rows, os.path.getsize(path), time.perf_counter() - began))
+    finally:
+        conn.rollback()
+    return results
+
+
+def export_tables(service, targets, fmt=None, fetch_size=FETCH_SIZE, progress=None):
+    """导出 targets [(表名, 文件路径)]，返回 ExportResult 列表
+
+    所有表在同一个读快照中导出，使用单独的只读连接，不占用连接池；fmt 默认按第一个文件的扩展名判断。
+    progress(表名, 已导出行数) 在每批写出后调用。
+    """
+    for table, _ in targets:
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"不能导出的表: {table}")
+    fmt = fmt or detect_format(targets[0][1])
+    return service.manager.run_snapshot(_export, targets, fmt, fetch_size, progress)
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="导出书目与共享记录")
+    parser.add_argument("table", choices=list(EXPORT_TABLES) + ["all"], help="要导出的表，all 为全部")
+    parser.add_argument("--format", choices=list(FORMATS), help="文件格式，默认按输出文件扩展名判断，否则为 csv")
+    parser.add_argument("-o", "--output", help="输出文件（只导出一个表时）")
+    parser.add_argument("--output-dir", default=".", help="输出目录，文件名为 <表名><扩展名>")
+    parser.add_argument("--db", default=DB_PATH, help="数据库文件")
+    parser.add_argument("--fetch-size", type=int, default=FETCH_SIZE, help="每次读取的行数")
+    args = parser.parse_args(argv)
+
+    tables = list(EXPORT_TABLES) if args.table == "all" else [args.table]
+    if args.output:
+        if len(tables) > 1:
+            parser.error("导出全部表时使用 --output-dir")
+        fmt = args.format or detect_format(args.output)
+        targets = [(tables[0], args.output)]
+    else:
+        fmt = args.format or "csv"
+        os.makedirs(args.output_dir, exist_ok=True)
+        targets = [(table, os.path.join(args.output_dir, table + FORMATS[fmt])) for table in tables]
+
+    def show(table, rows):
+        print(f"\r{table}: {rows} 行", end="", file=sys.stderr, flush=True)
+
+    service = BookService(args.db, readers=1)
+    try:
+        service.migrate()
+        results = export_tables(service, targets, fmt, args.fetch_size, show)
+    finally:
+        service.close()
+
+    print(file=sys.stderr)
+    for result in results:
+        rate = result.rows / result.elapsed if result.elapsed else 0
+        print(f"{result.table}: {result.rows} 行 -> {result.path}（{result.bytes / 1024 / 1024:.1f} MB，"
+              f"耗时 {result.elapsed:.2f}s，{rate:.0f} 行/秒）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
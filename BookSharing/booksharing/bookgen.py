@@ -0,0 +1,261 @@
+﻿"""生成测试数据：大规模的中文书目、偏斜的用户分布与多年的借阅历史
+
+    python bookgen.py --db big.db --books 1000000
+    python bookgen.py --db huge.db --books 10000000 --users 200000 --loans-per-book 8 --no-fts --archive
+
+书名、作者、出版社和简介由常见的字词组合而成，ISBN 带正确的校验位。
+拥有书籍的数量和借阅的次数都按 Zipf 分布偏斜：少数用户拥有、借阅了大部分书籍，拥有多的用户不一定借阅多。
+每本书的借阅次数按 Pareto 分布，少数热门书有很长的借阅历史；同一本书的借阅在时间上首尾相接，
+最近一次借阅可能还没有归还（书籍为共享中，其中一部分已过应还日期）。
+生成时去掉逐行维护全文索引和统计的触发器，写完后一次重建。相同的参数和 --seed 生成相同的数据。
+"""
+import argparse
+from collections import namedtuple
+from datetime import date
+from itertools import accumulate
+import random
+import sys
+import time
+
+from bookdb import (AVAILABLE, BORROWING, DB_PATH, RETURNED, SHARED, ConnectionManager, archive_loans, drop_write_triggers,
+                    migrate, rebuild_derived, to_day)
+from bookrecommend import Recommender
+
+# 每个事务写入的书籍数（连同它们的借阅记录）
+BATCH_SIZE = 20000
+
+# 用户拥有、借阅书籍的 Zipf 指数，越大越集中在少数用户
+USER_SKEW = 1.1
+
+# 各分类书籍数量的 Zipf 指数
+CATEGORY_SKEW = 0.8
+
+# 每本书借阅次数的 Pareto 指数，越小热门书的借阅历史越长
+LOAN_SKEW = 1.5
+
+# 每次借阅的天数范围，以及当前借阅的期限（与 BookService.borrow_book 的默认值相同）
+LOAN_DAYS = (7, 45)
+BORROW_DAYS = 30
+
+SURNAMES = ("王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗郑梁谢宋唐许韩冯邓曹彭曾肖田董袁潘于蒋蔡余杜叶程苏魏吕丁任沈姚卢"
+            "姜崔钟谭陆汪范金石廖贾夏韦方白邹孟熊秦邱江尹薛段雷侯龙史陶黎贺顾毛郝龚邵万钱严武戴莫孔向汤")
+GIVEN_CHARS = ("伟芳娜敏静丽强磊军洋勇艳杰娟涛明超霞平刚桂英华玉兰萍红玲芬燕彬辉建国志文斌鹏宇浩然欣怡子涵梓轩思远晨曦"
+               "雨婷嘉豪俊晓东海峰春梅立新永佳琪雪松德安宁慧颖博瑞泽凯")
+
+CATEGORIES = ("计算机", "文学", "历史", "经济", "哲学", "艺术", "科学", "教育", "心理学", "社会学",
+              "政治", "法律", "医学", "军事", "地理", "传记", "小说", "诗歌", "漫画", "外语")
+
+PUBLISHERS = ("人民文学出版社", "商务印书馆", "中华书局", "生活·读书·新知三联书店", "机械工业出版社", "清华大学出版社",
+              "北京大学出版社", "人民邮电出版社", "上海译文出版社", "译林出版社", "中信出版社", "科学出版社",
+              "电子工业出版社", "作家出版社", "浙江文艺出版社", "广西师范大学出版社", "上海古籍出版社", "南海出版公司")
+
+TOPICS = ("中国", "世界", "城市", "乡村", "历史", "经济", "哲学", "艺术", "科学", "数学", "物理", "化学", "生物",
+          "人工智能", "机器学习", "数据库", "算法", "计算机网络", "操作系统", "心理", "教育", "法律", "医学", "音乐",
+          "电影", "诗词", "建筑", "宇宙", "海洋", "森林", "唐代", "宋代", "明清", "近代", "现代", "古典", "东方",
+          "西方", "江南", "丝绸之路", "长安", "敦煌", "草原", "丝绸", "瓷器", "茶", "货币", "语言", "文字", "战争")
+NOUNS = ("时光", "记忆", "旅程", "秘密", "故事", "河流", "灯火", "岁月", "远方", "风景", "黎明", "梦想", "少年",
+         "家族", "王朝", "星空", "迷宫", "花园", "书信", "传说", "边城", "荒原", "月光", "群山", "孩子", "旧事")
+ADJECTIVES = ("寂静的", "遥远的", "消失的", "最后的", "漫长的", "温柔的", "看不见的", "失落的", "燃烧的", "孤独的",
+              "沉默的", "明亮的")
+TITLE_FORMS = ("{t}简史", "{t}导论", "{t}概论", "{t}原理", "{t}研究", "{t}入门", "{t}与{u}", "{t}的故事", "{t}十讲",
+               "{t}之美", "{t}的{n}", "走进{t}", "{a}{n}", "{t}{n}", "我的{n}", "{n}与{m}", "{a}{t}", "{t}三百年")
+TITLE_SUFFIXES = ("",) * 12 + ("（第2版）", "（第3版）", "（上册）", "（下册）", "（修订版）", "（插图本）")
+DESCRIPTIONS = ("介绍了{t}的基本概念与发展脉络", "通过大量案例讲述{t}", "以{n}为线索，写出了一段{a}往事",
+                "是一部关于{t}的经典读物", "从{t}的角度重新审视{u}", "收录作者多年来关于{t}的文章")
+
+# 生成结果：books、users、loans 为写入的数量，borrowing 为尚未归还的借阅数，elapsed 为秒数
+GenerateResult = namedtuple("GenerateResult", ["books", "users", "loans", "borrowing", "elapsed"])
+
+
+def isbn13(number):
+    """以 9787 开头、带校验位的 ISBN-13"""
+    digits = f"9787{number % 10 ** 8:08d}"
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits))
+    return digits + str(-total % 10)
+
+
+def person_name(rng):
+    """一个中文姓名：单姓加一到两个字的名"""
+    return rng.choice(SURNAMES) + "".join(rng.choice(GIVEN_CHARS) for _ in range(rng.choice((1, 2, 2))))
+
+
+def user_names(rng, count):
+    """count 个互不相同的中文姓名，重名时加上序号"""
+    seen = {}
+    names = []
+    for _ in range(count):
+        name = person_name(rng)
+        seen[name] = seen.get(name, 0) + 1
+        names.append(name if seen[name] == 1 else f"{name}{seen[name]}")
+    return names
+
+
+def random_title(rng):
+    """由常见字词组合的书名"""
+    form = rng.choice(TITLE_FORMS)
+    return form.format(t=rng.choice(TOPICS), u=rng.choice(TOPICS), n=rng.choice(NOUNS), m=rng.choice(NOUNS),
+                       a=rng.choice(ADJECTIVES)) + rng.choice(TITLE_SUFFIXES)
+
+
+def _skewed(rng, population, skew, batch=65536):
+    """按 Zipf 分布不断抽取 population 中的元素（排在前面的被抽到的次数多）"""
+    weights = list(accumulate(1 / (rank + 1) ** skew for rank in range(len(population))))
+    while True:
+        yield from rng.choices(population, cum_weights=weights, k=batch)
+
+
+def _loan_count(rng, mean):
+    """一本书的借阅次数：均值为 mean 的 Pareto 分布取整"""
+    if mean <= 0:
+        return 0
+    scale = mean * (LOAN_SKEW - 1) / LOAN_SKEW
+    return int(rng.paretovariate(LOAN_SKEW) * scale + rng.random())
+
+
+def _book_rows(rng, first_id, count, owners, borrowers, categories, loans_per_book, first_day, today):
+    """生成 count 本书及其借阅记录，返回 (书籍行, 借阅行, 尚未归还的借阅数)"""
+    books = []
+    loans = []
+    borrowing = 0
+    span = today - first_day
+    for book_id in range(first_id, first_id + count):
+        title = random_title(rng)
+        author = person_name(rng)
+        description = (f"{title}，{author}著。本书" + rng.choice(DESCRIPTIONS).format(
+            t=rng.choice(TOPICS), u=rng.choice(TOPICS), n=rng.choice(NOUNS), a=rng.choice(ADJECTIVES)) + "。")
+
+        # 借阅历史：从书籍加入的那天起，一次借阅归还后隔几天再被借走
+        added = first_day + rng.randrange(span)
+        count_loans = _loan_count(rng, loans_per_book)
+        gap = max(1, (today - added) // max(count_loans, 1) - sum(LOAN_DAYS) // 2)
+        day = added
+        status, borrower, until = AVAILABLE, None, None
+        for _ in range(count_loans):
+            day += rng.randrange(gap * 2)
+            if day > today:
+                break
+            reader = next(borrowers)
+            length = rng.randint(*LOAN_DAYS)
+            if day + length > today:
+                # 最近一次借阅还没有归还
+                status, borrower, until = SHARED, reader, day + BORROW_DAYS
+                loans.append((book_id, reader, day, None, BORROWING))
+                borrowing += 1
+                break
+            loans.append((book_id, reader, day, day + length, RETURNED))
+            day += length
+
+        books.append((book_id, title, author, isbn13(book_id), next(categories), rng.choice(PUBLISHERS),
+                      rng.randint(1950, 2025), status, next(owners), borrower, until,
+                      int(until is not None and until < today), description))
+    return books, loans, borrowing
+
+
+def generate(manager, books, users=None, loans_per_book=5, years=5, seed=0, fts=True, today=None, progress=None):
+    """在空数据库中生成 books 本书、users 个用户（默认每 50 本书一个）和约 books × loans_per_book 条借阅记录
+
+    借阅历史覆盖最近 years 年；fts 为 False 时删除全文索引（搜索退回 LIKE）。
+    progress(已写入的书籍数, 书籍总数) 在每批提交后调用。返回 GenerateResult。
+    """
+    began = time.perf_counter()
+    rng = random.Random(seed)
+    users = users or max(10, books // 50)
+    today = to_day(today or date.today())
+    first_day = today - years * 365
+
+    def prepare(conn):
+        if conn.execute("SELECT 1 FROM book_items LIMIT 1").fetchone():
+            raise ValueError("数据库中已有书籍，请使用新的数据库文件")
+        conn.executemany("INSERT OR IGNORE INTO users (name) VALUES (?)", [(name,) for name in user_names(rng, users)])
+        conn.executemany("INSERT OR IGNORE INTO categories (name) VALUES (?)", [(name,) for name in CATEGORIES])
+        drop_write_triggers(conn)
+        if not fts:
+            conn.execute("DROP TABLE IF EXISTS books_fts")
+            conn.execute("DROP TABLE IF EXISTS books_grams")
+        first_id = conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) + 1 FROM sqlite_sequence WHERE name = 'book_items'"
+        ).fetchone()[0]
+        return ([row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")],
+                [row[0] for row in conn.execute("SELECT id FROM categories ORDER BY id")],
+                first_id)
+
+    def insert(conn, book_rows, loan_rows):
+        conn.executemany('''
+            INSERT INTO book_items (id, title, author, isbn, category_id, publisher, publish_year, status_code,
+                                    owner_id, borrower_id, borrow_until, overdue, description)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', book_rows)
+        conn.executemany('''
+            INSERT INTO loans (book_id, borrower_id, borrow_date, return_date, status_code) VALUES (?, ?, ?, ?, ?)
+        ''', loan_rows)
+
+    user_ids, category_ids, first_id = manager.run_write(prepare)
+    # 拥有多的用户排在前面；借阅按另一个顺序偏斜，与拥有的多少无关
+    owners = _skewed(rng, user_ids, USER_SKEW)
+    readers = user_ids[:]
+    rng.shuffle(readers)
+    borrowers = _skewed(rng, readers, USER_SKEW)
+    categories = _skewed(rng, category_ids, CATEGORY_SKEW)
+
+    written = loans = borrowing = 0
+    try:
+        while written < books:
+            count = min(BATCH_SIZE, books - written)
+            book_rows, loan_rows, lent = _book_rows(rng, first_id + written, count, owners, borrowers, categories,
+                                                    loans_per_book, first_day, today)
+            manager.run_write(insert, book_rows, loan_rows)
+            written += count
+            loans += len(loan_rows)
+            borrowing += lent
+            if progress:
+                progress(written, books)
+    finally:
+        # 中途失败时也要恢复触发器，已写入的数据保持一致
+        manager.run_write(rebuild_derived)
+    return GenerateResult(written, users, loans, borrowing, time.perf_counter() - began)
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="生成测试用的书目、用户和借阅历史")
+    parser.add_argument("--db", default=DB_PATH, help="数据库文件（须没有书籍）")
+    parser.add_argument("--books", type=int, default=100000, help="书籍数量")
+    parser.add_argument("--users", type=int, help="用户数量，默认每 50 本书一个")
+    parser.add_argument("--loans-per-book", type=float, default=5, help="每本书的平均借阅次数")
+    parser.add_argument("--years", type=int, default=5, help="借阅历史覆盖的年数")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    parser.add_argument("--no-fts", action="store_true", help="不建全文索引（搜索退回 LIKE），生成大数据集时更快更小")
+    parser.add_argument("--archive", action="store_true", help="生成后把归还超过一年的借阅移入归档表")
+    parser.add_argument("--no-recommend", action="store_true", help="生成后不计算借阅推荐（之后可用 bookrecommend.py rebuild）")
+    args = parser.parse_args(argv)
+
+    def show(done, total):
+        print(f"\r{done * 100 // total:3d}%  已写入 {done} 本书", end="", file=sys.stderr, flush=True)
+
+    manager = ConnectionManager(args.db, readers=1)
+    try:
+        manager.run_write(migrate)
+        try:
+            result = generate(manager, args.books, args.users, args.loans_per_book, args.years, args.seed,
+                              fts=not args.no_fts, progress=show)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            return 1
+        print(file=sys.stderr)
+        print(f"{result.books} 本书，{result.users} 个用户，{result.loans} 条借阅记录（未归还 {result.borrowing}），"
+              f"耗时 {result.elapsed:.1f}s")
+        if args.archive:
+            began = time.perf_counter()
+            moved = archive_loans(manager)
+            print(f"归档 {moved} 条共享记录，耗时 {time.perf_counter() - began:.1f}s")
+        if not args.no_recommend:
+            began = time.perf_counter()
+            books = Recommender(manager).rebuild()
+            print(f"计算 {books} 本书的借阅推荐，耗时 {time.perf_counter() - began:.1f}s")
+    finally:
+        manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,277 @@
+﻿"""批量导入书目（CSV / JSON Lines）
+
+    python bookimport.py catalog.csv --owner 张三
+    python bookimport.py catalog.jsonl --owner 张三 --errors rejected.jsonl
+
+逐行流式读取文件，每行按 BookDialog 相同的规则校验，分批用 executemany 写入，每批一个事务。
+按 ISBN 去重（与数据库中已有的书籍和文件中前面的行比较，空 ISBN 不去重）。
+每批提交时同一事务内记录读到的文件位置，中途失败后再次导入同一文件会从上次提交处继续。
+"""
+import argparse
+import csv
+from collections import namedtuple
+from datetime import datetime
+import hashlib
+import json
+import os
+import sys
+import time
+
+from bookdb import AVAILABLE, DB_PATH, category_id, insert_grams, pause_triggers, user_id
+from bookservice import BOOK_FIELDS, BookService, ServiceError, validate_book
+
+# 每个事务写入的行数
+BATCH_SIZE = 10000
+
+# CSV 表头别名（也接受 BOOK_FIELDS 中的英文字段名）
+HEADER_ALIASES = {
+    "书名": "title",
+    "作者": "author",
+    "ISBN": "isbn",
+    "分类": "category",
+    "出版社": "publisher",
+    "出版年份": "publish_year",
+    "描述": "description",
+}
+
+# 导入结果（整个文件的累计数字）：resumed_from 为续传开始的行数，already_done 表示文件之前已完整导入过
+ImportResult = namedtuple("ImportResult", ["rows", "inserted", "duplicates", "invalid", "elapsed",
+                                           "resumed_from", "already_done"])
+
+INSERT_SQL = f'''
+    INSERT INTO book_items (title, author, isbn, category_id, publisher, publish_year, description, owner_id, status_code)
+    SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, {AVAILABLE}
+    WHERE ?3 = '' OR NOT EXISTS (SELECT 1 FROM book_items WHERE isbn = ?3)
+'''
+
+# 逐行执行的插入触发器（全文索引、一两个字的索引、状态计数）是导入的主要开销：
+# 每批在同一个事务里暂停它们（bookdb.pause_triggers，不改变数据库结构），插入后整体补上索引和计数；
+# 其他连接看不到中间状态
+DEFERRED_TRIGGERS = ("books_fts_insert", "books_grams_insert", "book_stats_insert")
+
+
+class _LineReader:
+    """逐行读取二进制文件并解码，记录已读到的字节位置（csv.reader 不会预读，记录结束处即为该位置）"""
+    def __init__(self, file):
+        self.file = file
+        self.position = file.tell()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.file.readline()
+        if not line:
+            raise StopIteration
+        encoding = "utf-8-sig" if self.position == 0 else "utf-8"
+        self.position += len(line)
+        return line.decode(encoding)
+
+    def seek(self, position):
+        self.file.seek(position)
+        self.position = position
+
+
+def detect_format(path):
+    """按扩展名判断文件格式"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        return "csv"
+    if extension in (".jsonl", ".ndjson", ".json"):
+        return "jsonl"
+    raise ValueError(f"无法识别的文件格式: {path}（支持 .csv 和 .jsonl）")
+
+
+def read_records(path, fmt=None, start=0):
+    """逐条生成 (记录结束处的字节位置, 字段字典)，start 为续传的字节位置"""
+    fmt = fmt or detect_format(path)
+    with open(path, "rb") as file:
+        lines = _LineReader(file)
+        if fmt == "csv":
+            reader = csv.reader(lines)
+            header = [HEADER_ALIASES.get(name.strip(), name.strip()) for name in next(reader, [])]
+            if start:
+                lines.seek(start)
+            for values in reader:
+                if values:
+                    yield lines.position, dict(zip(header, values))
+        else:
+            if start:
+                lines.seek(start)
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                yield lines.position, record if isinstance(record, dict) else {"_error": "不是合法的 JSON 对象"}
+
+
+def fingerprint(path):
+    """文件指纹：大小加前 1MB 的摘要；文件被替换后不会误用旧的续传位置"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        digest.update(file.read(1024 * 1024))
+    return f"{os.path.getsize(path)}:{digest.hexdigest()}"
+
+
+def _load_job(conn, source, print_):
+    """读取导入进度 (位置, 行数, 新增, 重复, 无效, 是否完成)；指纹不同时视为新文件"""
+    row = conn.execute('''
+        SELECT position, rows, inserted, duplicates, invalid, finished FROM import_jobs
+        WHERE source = ? AND fingerprint = ?
+    ''', (source, print_)).fetchone()
+    return row or (0, 0, 0, 0, 0, 0)
+
+
+def _save_job(conn, source, print_, position, counts, finished):
+    """在当前事务中保存导入进度"""
+    conn.execute('''
+        INSERT INTO import_jobs (source, fingerprint, position, rows, inserted, duplicates, invalid, finished, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (source) DO UPDATE SET
+            fingerprint = excluded.fingerprint, position = excluded.position, rows = excluded.rows,
+            inserted = excluded.inserted, duplicates = excluded.duplicates, invalid = excluded.invalid,
+            finished = excluded.finished, updated_at = excluded.updated_at
+    ''', (source, print_, position) + tuple(counts) + (int(finished), datetime.now().isoformat(timespec="seconds")))
+
+
+def _insert_batch(conn, batch):
+    """在当前写事务中批量插入书籍，返回实际新增的行数（ISBN 重复的行被跳过）"""
+    # 分类和拥有者换成编号，同一批中相同的名称只查一次
+    categories = {}
+    owners = {}
+    rows = []
+    for row in batch:
+        category, owner = row[3], row[7]
+        if category not in categories:
+            categories[category] = category_id(conn, category)
+        if owner not in owners:
+            owners[owner] = user_id(conn, owner, True)
+        rows.append(row[:3] + (categories[category],) + row[4:7] + (owners[owner],))
+
+    deferred = {name for (name,) in conn.execute(
+        f"SELECT name FROM sqlite_master WHERE type = 'trigger' AND name IN ({','.join('?' * len(DEFERRED_TRIGGERS))})",
+        DEFERRED_TRIGGERS,
+    )}
+    with pause_triggers(conn, *deferred):
+        # AUTOINCREMENT 保证新书的 id 都大于当前最大 id
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM book_items").fetchone()[0]
+        added = conn.executemany(INSERT_SQL, rows).rowcount
+
+        if "books_fts_insert" in deferred:
+            conn.execute('''
+                INSERT INTO books_fts (rowid, title, author, category, description, publisher)
+                SELECT id, title, author, category, description, publisher FROM books WHERE id > ?
+            ''', (last_id,))
+        if "books_grams_insert" in deferred:
+            insert_grams(conn, last_id)
+        if "book_stats_insert" in deferred and added:
+            conn.execute(f'''
+                INSERT INTO book_stats (status_code, count) VALUES ({AVAILABLE}, ?)
+                ON CONFLICT (status_code) DO UPDATE SET count = count + excluded.count
+            ''', (added,))
+    return added
+
+
+def import_books(service, path, owner, fmt=None, batch_size=BATCH_SIZE, restart=False,
+                 progress=None, errors=None):
+    """导入文件中的书籍，拥有者为 owner，返回 ImportResult
+
+    progress(已读字节, 文件字节, 行数, 新增, 重复, 无效) 在每批提交后调用；
+    errors 为可写的文本文件时，无效行以 JSON Lines 写入 {"row": 行号, "error": 原因, "record": 原始字段}。
+    """
+    source = os.path.abspath(path)
+    print_ = fingerprint(path)
+    total_bytes = os.path.getsize(path)
+    began = time.perf_counter()
+
+    position, rows, inserted, duplicates, invalid, finished = (
+        (0, 0, 0, 0, 0, 0) if restart else service.manager.run_read(_load_job, source, print_)
+    )
+    resumed_from = rows
+    if finished:
+        return ImportResult(rows, inserted, duplicates, invalid, time.perf_counter() - began, rows, True)
+
+    def write_batch(conn, batch, position, rows, invalid, finished):
+        """写入一批并在同一事务中保存进度，返回实际新增的行数"""
+        added = _insert_batch(conn, batch) if batch else 0
+        counts = (rows, inserted + added, duplicates + len(batch) - added, invalid)
+        _save_job(conn, source, print_, position, counts, finished)
+        return added
+
+    def commit(batch, position, finished=False):
+        nonlocal inserted, duplicates
+        added = service.manager.run_write(write_batch, batch, position, rows, invalid, finished)
+        inserted += added
+        duplicates += len(batch) - added
+        service.stats.invalidate()
+        if progress:
+            progress(position, total_bytes, rows, inserted, duplicates, invalid)
+
+    batch = []
+    for position, record in read_records(path, fmt, position):
+        rows += 1
+        try:
+            if "_error" in record:
+                raise ServiceError(record["_error"])
+            book = validate_book(record)
+        except ServiceError as error:
+            invalid += 1
+            if errors is not None:
+                errors.write(json.dumps({"row": rows, "error": str(error), "record": record}, ensure_ascii=False) + "\n")
+            continue
+        batch.append(tuple(book[name] for name in BOOK_FIELDS) + (owner,))
+
+        if len(batch) >= batch_size:
+            commit(batch, position)
+            batch = []
+
+    # 最后一批与完成标记一起提交
+    commit(batch, total_bytes, finished=True)
+    return ImportResult(rows, inserted, duplicates, invalid, time.perf_counter() - began, resumed_from, False)
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="批量导入书目（CSV / JSON Lines）")
+    parser.add_argument("file", help="要导入的文件（.csv 或 .jsonl）")
+    parser.add_argument("--owner", required=True, help="导入书籍的拥有者")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="文件格式，默认按扩展名判断")
+    parser.add_argument("--db", default=DB_PATH, help="数据库文件")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="每个事务写入的行数")
+    parser.add_argument("--restart", action="store_true", help="忽略上次的导入进度，从头导入")
+    parser.add_argument("--errors", help="把无效行写入该文件（JSON Lines）")
+    args = parser.parse_args(argv)
+
+    def show(done, total, rows, inserted, duplicates, invalid):
+        percent = done * 100 // total if total else 100
+        print(f"\r{percent:3d}%  已读 {rows} 行，新增 {inserted}，重复 {duplicates}，无效 {invalid}",
+              end="", file=sys.stderr, flush=True)
+
+    service = BookService(args.db, readers=1)
+    errors = open(args.errors, "a", encoding="utf-8") if args.errors else None
+    try:
+        service.migrate()
+        result = import_books(service, args.file, args.owner, args.format, args.batch_size,
+                              args.restart, show, errors)
+    finally:
+        if errors:
+            errors.close()
+        service.close()
+
+    if result.already_done:
+        print("该文件已完整导入过，使用 --restart 重新导入")
+        return 0
+    print(file=sys.stderr)
+    if result.resumed_from:
+        print(f"从第 {result.resumed_from + 1} 行继续导入")
+    rate = result.rows / result.elapsed if result.elapsed else 0
+    print(f"共 {result.rows} 行：新增 {result.inserted}，重复 {result.duplicates}，无效 {result.invalid}，"
+          f"耗时 {result.elapsed:.2f}s（{rate:.0f} 行/秒）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,356 @@
+﻿"""性能剖析：SQL 语句与界面处理函数的耗时直方图、返回行数和慢查询记录
+
+    profiler = Profiler(sample_rate=0.05)
+    service = BookService(db_path, profiler=profiler)         # 连接上执行的每条 SQL 都会计时
+    handler = profiler.wrap("handler", "add_book", handler)   # 界面处理函数、回调同样包装
+
+耗时记入与 Prometheus histogram 相同的固定分桶，按语句（空白和 IN 列表归一化后的 SQL）或函数名分别统计。
+抽样模式下每次执行以 sample_rate 的概率计时，没有抽中的调用只多一次随机数比较，可以在生产环境中一直开启。
+查询的耗时包括执行和读取结果（fetchall、逐行迭代等），行数为读到的行数，写语句为影响的行数。
+超过 slow_ms 的语句连同 EXPLAIN QUERY PLAN 的输出保存在最近 SLOW_LOG_SIZE 条慢查询中。
+统计结果可以导出为 JSON（to_json）或 Prometheus 文本格式（to_prometheus）。
+"""
+from collections import deque
+from datetime import datetime
+import functools
+import random
+import re
+import sqlite3
+import threading
+from time import perf_counter
+
+# 默认抽样比例：0 关闭，1 记录每一次调用
+SAMPLE_RATE = 0.05
+
+# 慢查询阈值（毫秒）
+SLOW_QUERY_MS = 100
+
+# 保留最近多少条慢查询
+SLOW_LOG_SIZE = 50
+
+# 直方图分桶的上界（秒），最后还有一个 +Inf 桶
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 统计的类型：SQL 语句、界面处理函数、数据库回调（在界面线程中执行）、后台任务
+KINDS = ("query", "handler", "callback", "job")
+
+# 语句名称的最大长度
+NAME_LENGTH = 200
+
+# 会生成执行计划的语句
+_EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+_PLACEHOLDERS = re.compile(r"\?(?:\s*,\s*\?)+")
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_name(sql):
+    """统计用的语句名称：合并空白，把 (?, ?, ...) 列表合并为一项，过长的截断"""
+    name = _PLACEHOLDERS.sub("?, …", " ".join(sql.split()))
+    return name if len(name) <= NAME_LENGTH else name[:NAME_LENGTH - 1] + "…"
+
+
+def callable_name(fn):
+    """函数的显示名称（去掉 functools.partial 和 <locals>）"""
+    while isinstance(fn, functools.partial):
+        fn = fn.func
+    name = getattr(fn, "__qualname__", None) or getattr(fn, "__name__", None) or type(fn).__name__
+    return name.replace(".<locals>", "")
+
+
+class Histogram:
+    """固定分桶的耗时直方图，另外统计行数"""
+    __slots__ = ("counts", "count", "total", "max", "rows")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+    def observe(self, seconds, rows=0):
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.rows += rows
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """按分桶估计分位数：取累计次数达到 q 的桶的上界（不超过最大值）"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Profiler:
+    """收集耗时统计；可以在任意线程中记录"""
+    def __init__(self, sample_rate=SAMPLE_RATE, slow_ms=SLOW_QUERY_MS, slow_log_size=SLOW_LOG_SIZE):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self._random = random.Random().random
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._slow = deque(maxlen=slow_log_size)
+        self._slow_total = 0
+        self.since = datetime.now()
+
+    def sampled(self):
+        """这一次调用是否计时"""
+        rate = self.sample_rate
+        return rate >= 1 or (rate > 0 and self._random() < rate)
+
+    def record(self, kind, name, seconds, rows=0):
+        """记录一次耗时"""
+        with self._lock:
+            histogram = self._metrics.get((kind, name))
+            if histogram is None:
+                histogram = self._metrics[(kind, name)] = Histogram()
+            histogram.observe(seconds, rows)
+
+    def record_query(self, conn, sql, params, seconds, rows):
+        """记录一条 SQL；超过慢查询阈值时在同一连接上取执行计划"""
+        self.record("query", statement_name(sql), seconds, rows)
+        if seconds * 1000 < self.slow_ms:
+            return
+        plan = []
+        if sql.lstrip()[:7].upper().startswith(_EXPLAINABLE):
+            try:
+                # 用普通游标执行，执行计划本身不计入统计
+                cursor = sqlite3.Cursor(conn)
+                plan = [detail for _, _, _, detail in cursor.execute("EXPLAIN QUERY PLAN " + sql, params)]
+                cursor.close()
+            except sqlite3.Error as error:
+                plan = [f"无法获取执行计划：{error}"]
+        entry = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "seconds": round(seconds, 6),
+            "rows": rows,
+            "sql": " ".join(sql.split()),
+            "params": repr(params)[:NAME_LENGTH],
+            "plan": plan,
+        }
+        with self._lock:
+            self._slow.append(entry)
+            self._slow_total += 1
+
+    def call(self, kind, name, fn, *args, **kwargs):
+        """执行 fn 并（抽样）记录耗时"""
+        if not self.sampled():
+            return fn(*args, **kwargs)
+        began = perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.record(kind, name, perf_counter() - began)
+
+    def wrap(self, kind, name, fn):
+        """返回记录耗时的 fn"""
+        @functools.wraps(fn)
+        def profiled(*args, **kwargs):
+            return self.call(kind, name, fn, *args, **kwargs)
+        return profiled
+
+    def reset(self):
+        """清空统计和慢查询"""
+        with self._lock:
+            self._metrics.clear()
+            self._slow.clear()
+            self._slow_total = 0
+            self.since = datetime.now()
+
+    def snapshot(self):
+        """当前统计：[{kind, name, count, seconds, max, p50, p99, rows, buckets}]，按总耗时从大到小排序"""
+        with self._lock:
+            items = [(kind, name, histogram.count, histogram.total, histogram.max, histogram.rows,
+                      histogram.quantile(0.5), histogram.quantile(0.99), list(histogram.counts))
+                     for (kind, name), histogram in self._metrics.items()]
+        items.sort(key=lambda item: item[3], reverse=True)
+        return [
+            {"kind": kind, "name": name, "count": count, "seconds": total, "max": longest,
+             "p50": p50, "p99": p99, "rows": rows, "buckets": counts}
+            for kind, name, count, total, longest, rows, p50, p99, counts in items
+        ]
+
+    def slow_queries(self):
+        """最近的慢查询，最新的在前"""
+        with self._lock:
+            return list(reversed(self._slow))
+
+    def to_json(self):
+        """可以直接 json.dump 的统计结果"""
+        metrics = self.snapshot()
+        for metric in metrics:
+            metric["buckets"] = dict(zip([str(bound) for bound in BUCKETS] + ["+Inf"], metric.pop("buckets")))
+        return {
+            "since": self.since.isoformat(timespec="seconds"),
+            "sample_rate": self.sample_rate,
+            "slow_ms": self.slow_ms,
+            "metrics": metrics,
+            "slow_queries": self.slow_queries(),
+        }
+
+    def to_prometheus(self):
+        """Prometheus 文本格式（text/plain; version=0.0.4）"""
+        metrics = self.snapshot()
+        lines = []
+        for kind in KINDS:
+            selected = [metric for metric in metrics if metric["kind"] == kind]
+            if not selected:
+                continue
+            family = f"booksharing_{kind}_seconds"
+            lines.append(f"# HELP {family} 耗时（秒），按 sample_rate 抽样")
+            lines.append(f"# TYPE {family} histogram")
+            for metric in selected:
+                label = f'name="{_escape_label(metric["name"])}"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), metric["buckets"]):
+                    cumulative += count
+                    lines.append(f'{family}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f"{family}_sum{{{label}}} {metric['seconds']:.6f}")
+                lines.append(f"{family}_count{{{label}}} {metric['count']}")
+            if kind == "query":
+                lines.append("# HELP booksharing_query_rows_total 查询读到的行数或写语句影响的行数（抽样）")
+                lines.append("# TYPE booksharing_query_rows_total counter")
+                for metric in selected:
+                    lines.append(f'booksharing_query_rows_total{{name="{_escape_label(metric["name"])}"}} {metric["rows"]}')
+        with self._lock:
+            slow_total = self._slow_total
+        lines.append("# HELP booksharing_slow_queries_total 超过慢查询阈值的语句数（抽样）")
+        lines.append("# TYPE booksharing_slow_queries_total counter")
+        lines.append(f"booksharing_slow_queries_total {slow_total}")
+        lines.append("# HELP booksharing_profile_sample_rate 抽样比例")
+        lines.append("# TYPE booksharing_profile_sample_rate gauge")
+        lines.append(f"booksharing_profile_sample_rate {self.sample_rate}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """计时的游标：从 execute 开始，到结果读完（或游标关闭、重新执行）为止"""
+    __slots__ = ("_sql", "_params", "_elapsed", "_rows")
+
+    def __init__(self, conn):
+        super().__init__(conn)
+        self._sql = None
+
+    def _finish(self):
+        sql = self._sql
+        if sql is not None:
+            self._sql = None
+            self.connection.profiler.record_query(self.connection, sql, self._params, self._elapsed, self._rows)
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        profiler = self.connection.profiler
+        if profiler is None or not profiler.sampled():
+            return super().execute(sql, parameters)
+        began = perf_counter()
+        super().execute(sql, parameters)
+        self._elapsed = perf_counter() - began
+        self._sql, self._params, self._rows = sql, parameters, 0
+        if self.description is None:
+            # 不返回结果的语句执行完就结束，行数为影响的行数
+            self._rows = max(self.rowcount, 0)
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        profiler = self.connection.profiler
+        if profiler is None or not profiler.sampled():
+            return super().executemany(sql, seq_of_parameters)
+        began = perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self._sql, self._params = sql, ()
+        self._elapsed, self._rows = perf_counter() - began, max(self.rowcount, 0)
+        self._finish()
+        return self
+
+    def fetchone(self):
+        if self._sql is None:
+            return super().fetchone()
+        began = perf_counter()
+        row = super().fetchone()
+        self._elapsed += perf_counter() - began
+        self._rows += row is not None
+        # 只取一行的用法最常见，取完就结束计时
+        self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        if self._sql is None:
+            return super().fetchmany(size or self.arraysize)
+        size = size or self.arraysize
+        began = perf_counter()
+        rows = super().fetchmany(size)
+        self._elapsed += perf_counter() - began
+        self._rows += len(rows)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        if self._sql is None:
+            return super().fetchall()
+        began = perf_counter()
+        rows = super().fetchall()
+        self._elapsed += perf_counter() - began
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._sql is None:
+            return super().__next__()
+        began = perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._elapsed += perf_counter() - began
+            self._finish()
+            raise
+        self._elapsed += perf_counter() - began
+        self._rows += 1
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # 没有读完就丢弃的游标（例如 for 循环中途 break）
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """语句由 ProfiledCursor 执行的连接；profiler 为 None 时不计时"""
+    profiler = None
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
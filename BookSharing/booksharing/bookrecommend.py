@@ -0,0 +1,438 @@
+﻿"""借阅推荐：“借过这本书的读者也借了”
+
+    python bookrecommend.py --db big.db rebuild              # 按全部借阅记录重新计算（生成数据或升级后执行一次）
+    python bookrecommend.py --db big.db refresh              # 更新有新借阅的书籍，处理完后退出
+    python bookrecommend.py --db big.db refresh --watch 60   # 每 60 秒更新一次（只运行 HTTP 接口时）
+    python bookrecommend.py --db big.db show 123
+
+物品-物品协同过滤：读者的借阅画像是他最近 MAX_HISTORY 条借阅记录中的书；一本书的读者取画像中有这本书、
+最近借过它的 MAX_READERS 个读者。书 a 对书 x 的得分为这些读者中画像里也有 x 的读者的权重之和，
+除以 sqrt(a 的借阅次数 × x 的借阅次数)；读者的权重为 1 / log2(2 + 借阅总次数)，借得越多的读者分量越轻。
+每本书得分最高的 TOP_K 本存在 book_neighbors 中，显示时按主键读取一次，与借阅记录的数量无关。
+
+新的借阅记录使书籍的推荐过期（book_loans 中的借阅次数与上次计算时不同，见 bookdb 的迁移 10）。
+refresh() 每次取一批过期的书，读取它们的读者和这些读者的画像（compute()，只读），算好后在一个短的写事务中写回（store()），
+并把新的得分并入邻居书籍的列表（邻居书籍自己有新借阅时再完整计算）。
+rebuild() 在一个读快照中读取全部借阅记录，按书籍分块展开 (书, 书) 对计数，每块最多 PAIR_BLOCK 对，内存有上限。
+有 NumPy 时计数和打分都是数组运算；没有时用标准库计算，结果相同，但全部重建慢得多，内存占用也大。
+"""
+import argparse
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+from itertools import chain
+import math
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from bookdb import DB_PATH, ConnectionManager, loan_union, migrate
+
+# 每本书保存的推荐数
+TOP_K = 10
+
+# 读者画像：最近多少条借阅记录
+MAX_HISTORY = 100
+
+# 每本书最多看最近的多少个读者
+MAX_READERS = 100
+
+# 增量更新时最多检查的读者数（画像中已经没有这本书的读者跳过）
+READER_SCAN = 4 * MAX_READERS
+
+# 后台每次更新的书籍数
+REFRESH_BATCH = 20
+
+# 全部重建时每块最多展开的 (书, 书) 对数
+PAIR_BLOCK = 1000000
+
+# 全部重建时每次读取的借阅记录行数
+FETCH_SIZE = 100000
+
+# IN (...) 中每批的编号个数
+ID_BATCH = 500
+
+
+def neighbors(conn, book_id, limit=TOP_K):
+    """一本书的推荐 [(id, 书名, 作者, 状态, 得分)]：按主键读取预先算好的列表"""
+    return conn.execute('''
+        SELECT b.id, b.title, b.author, b.status, n.score
+        FROM book_neighbors n JOIN books b ON b.id = n.neighbor_id
+        WHERE n.book_id = ? ORDER BY n.rank LIMIT ?
+    ''', (book_id, limit)).fetchall()
+
+
+def reader_weight(borrow_total):
+    """读者的权重：借阅总次数越多越轻"""
+    return 1.0 / math.log2(2 + borrow_total)
+
+
+def _lookup(conn, sql, ids, default):
+    """按编号分批读取 {编号: 值}，没有的编号取 default"""
+    ids = list(ids)
+    found = dict.fromkeys(ids, default)
+    for start in range(0, len(ids), ID_BATCH):
+        chunk = ids[start:start + ID_BATCH]
+        found.update(conn.execute(sql.format(ids=",".join("?" * len(chunk))), chunk))
+    return found
+
+
+def _profile_sql(conn):
+    """读者最近 :limit 条借阅记录的书籍（新的在前）；每张分表各自按借阅人索引取前 :limit 条"""
+    union = loan_union(conn, "SELECT * FROM (SELECT book_id, borrow_date, id FROM {loans} WHERE borrower_id = :user "
+                             "ORDER BY borrow_date DESC, id DESC LIMIT :limit)")
+    return f"SELECT book_id FROM ({union}) ORDER BY borrow_date DESC, id DESC LIMIT :limit"
+
+
+def _collect(conn, book_ids):
+    """读取一批书的读者和读者画像，返回 ({书: [读者]}, {读者: 画像}, {读者: 权重}, {书: 借阅次数})
+
+    画像为 dict（书 -> None），保持从新到旧的顺序；读者按最近借阅这本书的日期从新到旧排列。
+    """
+    profile_sql = _profile_sql(conn)
+    profiles = {}
+    readers_of = {}
+    for book_id in book_ids:
+        chosen = []
+        for user_id, _ in conn.execute('''
+            SELECT borrower_id, MAX(borrow_date) AS last FROM loan_history WHERE book_id = ?
+            GROUP BY borrower_id ORDER BY last DESC, borrower_id DESC LIMIT ?
+        ''', (book_id, READER_SCAN)).fetchall():
+            profile = profiles.get(user_id)
+            if profile is None:
+                profile = profiles[user_id] = dict.fromkeys(
+                    row[0] for row in conn.execute(profile_sql, {"user": user_id, "limit": MAX_HISTORY}))
+            if book_id in profile:
+                chosen.append(user_id)
+                if len(chosen) == MAX_READERS:
+                    break
+        readers_of[book_id] = chosen
+
+    totals = _lookup(conn, "SELECT user_id, borrow_total FROM user_stats WHERE user_id IN ({ids})", profiles, 0)
+    weights = {user_id: reader_weight(total) for user_id, total in totals.items()}
+    candidates = set(book_ids).union(*profiles.values())
+    loans = _lookup(conn, "SELECT book_id, loans FROM book_loans WHERE book_id IN ({ids})", candidates, 1)
+    return readers_of, profiles, weights, loans
+
+
+def _top_neighbors(book_id, readers, profiles, weights, loans, top_k, vectorized):
+    """一本书的 [(邻居, 得分)]，得分从高到低（相同时编号小的在前），最多 top_k 个"""
+    if not readers:
+        return []
+    base = max(loans.get(book_id, 1), 1)
+    if vectorized:
+        books = np.fromiter(chain.from_iterable(profiles[u] for u in readers), dtype=np.int64)
+        reader_weights = np.repeat([weights[u] for u in readers], [len(profiles[u]) for u in readers])
+        other = books != book_id
+        ids, inverse = np.unique(books[other], return_inverse=True)
+        sums = np.bincount(inverse, weights=reader_weights[other], minlength=len(ids))
+        popularity = np.fromiter((max(loans.get(x, 1), 1) for x in ids.tolist()), dtype=np.float64, count=len(ids))
+        scores = sums / np.sqrt(base * popularity)
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        return [(int(ids[i]), float(scores[i])) for i in order]
+
+    sums = defaultdict(float)
+    for user_id in readers:
+        weight = weights[user_id]
+        for other in profiles[user_id]:
+            if other != book_id:
+                sums[other] += weight
+    scored = [(other, total / math.sqrt(base * max(loans.get(other, 1), 1))) for other, total in sums.items()]
+    scored.sort(key=lambda item: (-item[1], item[0]))
+    return scored[:top_k]
+
+
+def _replace(conn, book_id, top):
+    """替换一本书的推荐列表（须在写事务中）"""
+    conn.execute("DELETE FROM book_neighbors WHERE book_id = ?", (book_id,))
+    conn.executemany("INSERT INTO book_neighbors (book_id, rank, neighbor_id, score) VALUES (?, ?, ?, ?)",
+                     [(book_id, rank, other, score) for rank, (other, score) in enumerate(top)])
+
+
+def _merge(conn, book_id, neighbor_id, score, top_k):
+    """把 (邻居, 得分) 并入一本书的推荐列表：列表未满或得分高于列表中最低的得分时加入（须在写事务中）"""
+    current = conn.execute("SELECT neighbor_id, score FROM book_neighbors WHERE book_id = ? ORDER BY rank",
+                           (book_id,)).fetchall()
+    merged = [row for row in current if row[0] != neighbor_id] + [(neighbor_id, score)]
+    merged.sort(key=lambda item: (-item[1], item[0]))
+    merged = merged[:top_k]
+    if merged != current:
+        _replace(conn, book_id, merged)
+
+
+def _store(conn, results, top_k):
+    """写回一批书的推荐并标记为最新，新的得分并入邻居书籍的列表（须在写事务中）
+
+    results 为 [(书, 读取时的借阅次数, [(邻居, 得分)])]；读取之后又有新借阅的书仍是过期的，下次再算。
+    """
+    for book_id, loans, top in results:
+        if not conn.execute("UPDATE book_loans SET refreshed = ? WHERE book_id = ?", (loans, book_id)).rowcount:
+            continue  # 书已被删除
+        _replace(conn, book_id, top)
+        for other, score in top:
+            _merge(conn, other, book_id, score, top_k)
+
+
+def _group_starts(keys):
+    """已排序数组中每组的起始位置"""
+    return np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+
+def _rank_in_groups(keys):
+    """已排序数组中每个元素在本组中的序号"""
+    starts = _group_starts(keys)
+    return np.arange(len(keys)) - np.repeat(starts, np.diff(np.append(starts, len(keys))))
+
+
+class Recommender:
+    """推荐的计算与后台更新；方法可以在任意线程中调用（通过 ConnectionManager 读写）
+
+    vectorized 默认在装有 NumPy 时为 True。
+    """
+    def __init__(self, manager, top_k=TOP_K, vectorized=None):
+        self.manager = manager
+        self.top_k = top_k
+        self.vectorized = np is not None if vectorized is None else vectorized and np is not None
+
+    def stale_count(self):
+        """推荐已过期的书籍数"""
+        return self.manager.run_read(lambda conn: conn.execute(
+            "SELECT COUNT(*) FROM book_loans WHERE loans != refreshed").fetchone()[0])
+
+    def compute(self, limit=REFRESH_BATCH):
+        """在读连接中计算至多 limit 本推荐已过期的书的新推荐，结果交给 store() 写回"""
+        def compute(conn):
+            stale = conn.execute("SELECT book_id, loans FROM book_loans WHERE loans != refreshed LIMIT ?",
+                                 (limit,)).fetchall()
+            if not stale:
+                return []
+            readers_of, profiles, weights, loans = _collect(conn, [book_id for book_id, _ in stale])
+            return [(book_id, count, _top_neighbors(book_id, readers_of[book_id], profiles, weights, loans,
+                                                    self.top_k, self.vectorized))
+                    for book_id, count in stale]
+
+        return self.manager.run_read(compute)
+
+    def store(self, results):
+        """在一个短的写事务中写回 compute() 的结果，返回书籍数"""
+        if results:
+            self.manager.run_write(_store, results, self.top_k)
+        return len(results)
+
+    def refresh(self, limit=REFRESH_BATCH):
+        """更新至多 limit 本推荐已过期的书，返回更新的本数"""
+        return self.store(self.compute(limit))
+
+    def rebuild(self, progress=None):
+        """按全部借阅记录重新计算所有书籍的推荐，返回计算的书籍数
+
+        读取在一个读快照中完成，写入按块分成多个短事务；progress(已完成的书籍数, 总数) 在每块写入后调用。
+        """
+        snapshot = self.manager.run_read(_read_snapshot)
+        if self.vectorized:
+            blocks = _rebuild_vectorized(snapshot, self.top_k)
+        else:
+            blocks = _rebuild_python(snapshot, self.top_k)
+
+        loans = sorted(snapshot[4].items())
+        total = len(loans)
+        done = 0
+        low = 0
+        for high, rows in blocks:
+            end = bisect_right(loans, (high, math.inf))
+            counts = [(count, book_id) for book_id, count in loans[done:end]]
+
+            def write(conn, low=low, high=high, rows=rows, counts=counts):
+                conn.execute("DELETE FROM book_neighbors WHERE book_id BETWEEN ? AND ?", (low, high))
+                conn.executemany("INSERT INTO book_neighbors (book_id, rank, neighbor_id, score) VALUES (?, ?, ?, ?)",
+                                 rows)
+                conn.executemany("UPDATE book_loans SET refreshed = ? WHERE book_id = ?", counts)
+
+            self.manager.run_write(write)
+            done += len(counts)
+            low = high + 1
+            if progress:
+                progress(done, total)
+        return total
+
+
+def _read_snapshot(conn):
+    """在一个读事务中读取 (借阅人, 书, 借阅日期, 记录 id) 四列数组、{借阅人: 权重} 和 {书: 借阅次数}"""
+    conn.execute("BEGIN")
+    try:
+        users, books, days, ids = array("i"), array("i"), array("i"), array("i")
+        cursor = conn.execute("SELECT borrower_id, book_id, borrow_date, id FROM loan_history")
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            user_column, book_column, day_column, id_column = zip(*rows)
+            users.extend(user_column)
+            books.extend(book_column)
+            days.extend(day_column)
+            ids.extend(id_column)
+        weights = {user_id: reader_weight(total)
+                   for user_id, total in conn.execute("SELECT user_id, borrow_total FROM user_stats")}
+        loans = dict(conn.execute("SELECT book_id, loans FROM book_loans"))
+    finally:
+        conn.rollback()
+    return users, books, days, ids, loans, weights
+
+
+def _rebuild_vectorized(snapshot, top_k):
+    """NumPy 计算全部推荐，逐块产生 (块内最大的书籍编号, [(书, 名次, 邻居, 得分)])"""
+    users, books, days, ids, loans, weights = snapshot
+    users, books, days, ids = (np.frombuffer(column, dtype=np.int32).astype(np.int64)
+                               for column in (users, books, days, ids))
+    max_book = max(int(books.max()) if len(books) else 0, max(loans, default=0))
+    if not len(users):
+        yield max_book, []
+        return
+
+    # 画像：每个读者按 (借阅日期, id) 从新到旧的前 MAX_HISTORY 条记录，同一本书只保留最近的一条
+    order = np.lexsort((-ids, -days, users))
+    users, books, days = users[order], books[order], days[order]
+    recent = _rank_in_groups(users) < MAX_HISTORY
+    users, books, days = users[recent], books[recent], days[recent]
+    order = np.lexsort((np.arange(len(users)), books, users))
+    first = np.concatenate(([True], (users[order][1:] != users[order][:-1]) | (books[order][1:] != books[order][:-1])))
+    keep = np.sort(order[first])
+    users, books, days = users[keep], books[keep], days[keep]
+    starts = _group_starts(users)
+    lengths = np.diff(np.append(starts, len(users)))
+    span_start = np.repeat(starts, lengths)
+    span_length = np.repeat(lengths, lengths)
+
+    # 每本书的读者：画像中有这本书的条目按 (借阅日期, 借阅人) 从新到旧，取前 MAX_READERS 个
+    order = np.lexsort((-users, -days, books))
+    targets = order[_rank_in_groups(books[order]) < MAX_READERS]
+
+    user_weight = np.ones(int(users.max()) + 1)
+    for user_id, weight in weights.items():
+        if user_id < len(user_weight):
+            user_weight[user_id] = weight
+    popularity = np.ones(max_book + 1)
+    for book_id, count in loans.items():
+        popularity[book_id] = max(count, 1)
+    width = max_book + 1
+
+    # 按书分块：每块展开的对数不超过 PAIR_BLOCK（一本书的读者多到超过上限时单独成块）
+    group_starts = _group_starts(books[targets])
+    group_pairs = np.add.reduceat(span_length[targets], group_starts)
+    cumulative = np.cumsum(group_pairs)
+    group = 0
+    while group < len(group_starts):
+        base = cumulative[group - 1] if group else 0
+        end = max(int(np.searchsorted(cumulative, base + PAIR_BLOCK, side="right")), group + 1)
+        entries = targets[group_starts[group]:group_starts[end] if end < len(group_starts) else len(targets)]
+
+        # 每个 (读者, 书 a) 条目与该读者画像中的每本书 x 组成一对
+        counts = span_length[entries]
+        owner = np.repeat(np.arange(len(entries)), counts)
+        offsets = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+        first_book = books[entries][owner]
+        other_book = books[span_start[entries][owner] + offsets]
+        pair_weight = user_weight[users[entries]][owner]
+        distinct = first_book != other_book
+        keys = first_book[distinct] * width + other_book[distinct]
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        sums = np.bincount(inverse, weights=pair_weight[distinct], minlength=len(unique_keys))
+        first_book, other_book = unique_keys // width, unique_keys % width
+        scores = sums / np.sqrt(popularity[first_book] * popularity[other_book])
+
+        order = np.lexsort((other_book, -scores, first_book))
+        first_book, other_book, scores = first_book[order], other_book[order], scores[order]
+        ranks = _rank_in_groups(first_book)
+        top = ranks < top_k
+        high = max_book if end >= len(group_starts) else int(books[targets[group_starts[end]]]) - 1
+        yield high, list(zip(first_book[top].tolist(), ranks[top].tolist(), other_book[top].tolist(),
+                             scores[top].tolist()))
+        group = end
+
+
+def _rebuild_python(snapshot, top_k):
+    """标准库计算全部推荐（与 _rebuild_vectorized 的结果相同），逐块产生 (块内最大的书籍编号, 行)"""
+    users, books, days, ids, loans, weights = snapshot
+    history = defaultdict(list)
+    for user_id, book_id, day, loan_id in zip(users, books, days, ids):
+        history[user_id].append((day, loan_id, book_id))
+
+    profiles = {}
+    readers = defaultdict(list)
+    for user_id, loans_of_user in history.items():
+        loans_of_user.sort(reverse=True)
+        profile = profiles[user_id] = {}
+        for day, _, book_id in loans_of_user[:MAX_HISTORY]:
+            if book_id not in profile:
+                profile[book_id] = None
+                readers[book_id].append((day, user_id))
+    del history
+
+    max_book = max(max(readers, default=0), max(loans, default=0))
+    weights = defaultdict(lambda: 1.0, weights)
+    rows = []
+    pairs = 0
+    for book_id in sorted(readers):
+        chosen = [user_id for _, user_id in sorted(readers[book_id], reverse=True)[:MAX_READERS]]
+        top = _top_neighbors(book_id, chosen, profiles, weights, loans, top_k, False)
+        rows.extend((book_id, rank, other, score) for rank, (other, score) in enumerate(top))
+        pairs += sum(len(profiles[user_id]) for user_id in chosen)
+        if pairs >= PAIR_BLOCK:
+            yield book_id, rows
+            rows, pairs = [], 0
+    yield max_book, rows
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="借阅推荐（借过这本书的读者也借了）")
+    parser.add_argument("--db", default=DB_PATH, help="数据库文件")
+    parser.add_argument("--no-numpy", action="store_true", help="即使装有 NumPy 也用标准库计算")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild", help="按全部借阅记录重新计算")
+    refresh = commands.add_parser("refresh", help="更新有新借阅的书籍")
+    refresh.add_argument("--watch", type=float, help="每隔多少秒更新一次，不退出")
+    show = commands.add_parser("show", help="显示一本书的推荐")
+    show.add_argument("book_id", type=int, help="书籍 id")
+    args = parser.parse_args(argv)
+
+    manager = ConnectionManager(args.db, readers=1)
+    try:
+        manager.run_write(migrate)
+        recommender = Recommender(manager, vectorized=not args.no_numpy)
+        if args.command == "rebuild":
+            began = time.perf_counter()
+            books = recommender.rebuild(lambda done, total: print(f"\r{done}/{total}", end="", flush=True))
+            print(f"\r{books} 本书的推荐已重新计算（{'NumPy' if recommender.vectorized else '标准库'}），"
+                  f"耗时 {time.perf_counter() - began:.1f}s")
+        elif args.command == "refresh":
+            while True:
+                began = time.perf_counter()
+                refreshed = 0
+                while True:
+                    count = recommender.refresh()
+                    refreshed += count
+                    if count < REFRESH_BATCH:
+                        break
+                if refreshed or not args.watch:
+                    print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} 更新 {refreshed} 本书的推荐，"
+                          f"耗时 {time.perf_counter() - began:.1f}s", flush=True)
+                if not args.watch:
+                    break
+                time.sleep(args.watch)
+        else:
+            for book_id, title, author, status, score in manager.run_read(neighbors, args.book_id):
+                print(f"{score:8.4f}  {book_id} {title} / {author}（{status}）")
+        return 0
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        manager.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+﻿"""借阅到期调度：到期提醒与逾期标记
+
+    python bookscheduler.py            # 守护进程：一直运行，在下一个到期事件的时间醒来
+    python bookscheduler.py --once     # 只处理一次已到时间的事件（适合由系统计划任务调用）
+
+每次借阅有两个事件：应还日期前 REMIND_DAYS 天零点的到期提醒，应还日期次日零点的逾期。
+调度器只从到期索引中读取 WINDOW_DAYS 天内到期的借阅，把它们的事件放进按时间排序的最小堆；
+每次醒来只弹出已到时间的事件，在一个事务中批量标记逾期、写入提醒记录，然后睡到堆顶事件的时间。
+每次处理的开销与到期的借阅数成正比，与书籍总数无关。
+读取窗口之后在本进程借出的书由 add_loan() 加入，其他进程借出的书在每 RELOAD_INTERVAL 秒重新读取窗口时加入。
+每天零点后第一次醒来时，另外在一个事务中删除已过有效期的借阅预约（按有效期索引），并提醒预约的用户。
+"""
+import argparse
+from datetime import date, datetime, timedelta
+import heapq
+import sys
+import threading
+import time
+
+from bookdb import DB_PATH
+from bookservice import DUE_SOON, OVERDUE, BookService
+
+# 读入堆中的借阅：应还日期在今天之后多少天以内
+WINDOW_DAYS = 7
+
+# 应还日期前几天提醒
+REMIND_DAYS = 3
+
+# 重新读取窗口的间隔（秒）
+RELOAD_INTERVAL = 3600
+
+
+class DueScheduler:
+    """到期事件的最小堆；run_due() 通常在后台线程中调用，add_loan() 可以在任意线程中调用"""
+    def __init__(self, service, window_days=WINDOW_DAYS, remind_days=REMIND_DAYS,
+                 reload_interval=RELOAD_INTERVAL, clock=datetime.now):
+        self.service = service
+        self.window_days = window_days
+        self.remind_days = remind_days
+        self.reload_interval = reload_interval
+        self.clock = clock
+        self._heap = []
+        self._added = None
+        self._lock = threading.Lock()
+        self._horizon = None
+        self._reload_at = None
+        self._expire_at = None
+
+    def _events(self, book_id, borrower, due):
+        """一次借阅的事件 [(时间, 提醒类型, 书籍ID, 借阅人, 应还日期)]"""
+        try:
+            due_day = date.fromisoformat(due)
+        except ValueError:
+            return []
+        return [
+            (datetime.combine(due_day - timedelta(days=self.remind_days), datetime.min.time()), DUE_SOON, book_id, borrower, due),
+            (datetime.combine(due_day + timedelta(days=1), datetime.min.time()), OVERDUE, book_id, borrower, due),
+        ]
+
+    def reload(self, now=None):
+        """从到期索引重新读取窗口内尚未逾期的借阅，返回借阅数"""
+        now = now or self.clock()
+        horizon = (now.date() + timedelta(days=self.window_days)).isoformat()
+        with self._lock:
+            self._horizon = horizon
+            self._added = []
+        loans = self.service.upcoming_loans(horizon)
+        heap = [event for loan in loans for event in self._events(*loan)]
+        with self._lock:
+            # 读取期间加入的借阅可能不在读到的结果里，不能丢
+            heap.extend(self._added)
+            heapq.heapify(heap)
+            self._heap = heap
+            self._added = None
+            self._reload_at = now + timedelta(seconds=self.reload_interval)
+        return len(loans)
+
+    def add_loan(self, book_id, borrower, due):
+        """新借出的书：应还日期在窗口内时加入堆，返回是否加入"""
+        with self._lock:
+            if self._horizon is None or due > self._horizon:
+                return False
+            for event in self._events(book_id, borrower, due):
+                heapq.heappush(self._heap, event)
+                if self._added is not None:
+                    self._added.append(event)
+            return True
+
+    def expire_reservations(self, now=None):
+        """删除已过有效期的预约，定时到次日零点，返回删除的预约数"""
+        now = now or self.clock()
+        expired = self.service.expire_reservations(now.date().isoformat())
+        self._expire_at = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        return expired
+
+    def run_due(self, now=None):
+        """处理已到时间的事件（到了重新读取的时间先读取窗口），返回 (新标记逾期数, 新提醒数)
+
+        新提醒数包含过期预约的提醒。
+        """
+        now = now or self.clock()
+        if self._reload_at is None or now >= self._reload_at:
+            self.reload(now)
+        expired = 0
+        if self._expire_at is None or now >= self._expire_at:
+            expired = self.expire_reservations(now)
+
+        events = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                events.append(heapq.heappop(self._heap))
+        if not events:
+            return 0, expired
+        try:
+            marked, added = self.service.record_due(now.date().isoformat(), [event[1:] for event in events])
+            return marked, added + expired
+        except Exception:
+            # 写入失败时放回堆中，下次醒来重试
+            with self._lock:
+                for event in events:
+                    heapq.heappush(self._heap, event)
+            raise
+
+    def seconds_until_next(self, now=None):
+        """距离下一次需要醒来（堆顶事件、重新读取窗口或删除过期预约）的秒数"""
+        now = now or self.clock()
+        with self._lock:
+            wake = min(self._reload_at or now, self._expire_at or now)
+            if self._heap and self._heap[0][0] < wake:
+                wake = self._heap[0][0]
+        return max((wake - now).total_seconds(), 0)
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="借阅到期提醒与逾期标记")
+    parser.add_argument("--db", default=DB_PATH, help="数据库文件")
+    parser.add_argument("--once", action="store_true", help="只处理一次已到时间的事件")
+    parser.add_argument("--window-days", type=int, default=WINDOW_DAYS, help="读入内存的到期窗口（天）")
+    parser.add_argument("--remind-days", type=int, default=REMIND_DAYS, help="应还日期前几天提醒")
+    args = parser.parse_args(argv)
+
+    service = BookService(args.db, readers=1)
+    try:
+        service.migrate()
+        scheduler = DueScheduler(service, args.window_days, args.remind_days)
+        while True:
+            marked, reminded = scheduler.run_due()
+            if marked or reminded or args.once:
+                print(f"{datetime.now():%Y-%m-%d %H:%M:%S} 新逾期 {marked} 本，新提醒 {reminded} 条", flush=True)
+            if args.once:
+                return 0
+            time.sleep(scheduler.seconds_until_next())
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
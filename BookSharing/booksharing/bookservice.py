@@ -0,0 +1,844 @@
+﻿"""图书共享系统的业务逻辑
+
+BookService 不依赖界面：借阅、归还、权限检查、搜索和统计都在这里完成，
+Tk 界面和 HTTP 接口（bookapi.py）都只是它的客户端。
+每个方法在调用线程中同步执行，读操作使用读连接池，写操作在一个写事务（BEGIN IMMEDIATE）中完成。
+借还和修改都用条件更新检查书籍状态、拥有者和版本号，没有改到任何行时抛出对应的错误，不会重复借出。
+多本书的批量操作（update_books、delete_books、borrow_books、return_books）在一个写事务中用一次 IN 查询检查全部书籍，
+用 executemany 写入可以操作的书，其余的书连同原因列在结果中，不影响其他书。
+读取书籍的字段用兼容视图 books；筛选和写入直接使用以整数编号关联用户、分类和状态的 book_items、loans 表。
+"""
+from collections import namedtuple
+from datetime import date, datetime
+
+from bookdb import (AVAILABLE, BORROWING, DB_PATH, ID_BLOCK_BITS, RETURNED, SCHEMA_VERSION, SHARED, STATUSES,
+                    ConnectionManager, StatsCache, archive_tables, category_id, day_sql, fts_available, from_day,
+                    migrate, record_page_sql, schema_version, search_sql, to_day, user_id)
+from bookrecommend import REFRESH_BATCH, TOP_K, Recommender, neighbors
+
+# 搜索结果最多返回的条数（按相关度排序）
+SEARCH_LIMIT = 1000
+
+# 共享记录每页的条数
+RECORD_PAGE_SIZE = 200
+
+# 列表显示的字段
+LIST_COLUMNS = ("id", "title", "author", "category", "status", "owner", "borrower", "borrow_until")
+
+# 书籍的全部字段；version 每次修改加一，用于检测并发修改；overdue 为借阅已逾期的标记（由到期调度器设置）
+BOOK_COLUMNS = ("id", "title", "author", "isbn", "category", "publisher", "publish_year",
+                "status", "owner", "borrower", "borrow_until", "description", "version", "overdue")
+
+# 书籍信息中可以由用户填写的字段
+BOOK_FIELDS = ("title", "author", "isbn", "category", "publisher", "publish_year", "description")
+
+# 多本书批量修改时可以统一设置的字段
+BATCH_FIELDS = ("category", "publisher", "publish_year")
+
+# 批量操作一次最多处理的书籍数
+BATCH_LIMIT = 1000
+
+# 提醒类型
+DUE_SOON = "即将到期"
+OVERDUE = "已逾期"
+RESERVED = "预约到书"
+RESERVATION_EXPIRED = "预约已过期"
+
+# 预约的有效期（天）：期间没有轮到的预约由调度器删除
+RESERVATION_DAYS = 30
+
+# 行级变更：op 为 insert/update/delete，row 为变更后的列表行，old_row 为变更前的列表行
+BookDelta = namedtuple("BookDelta", ["op", "book_id", "row", "old_row"])
+
+# 批量操作的结果：deltas 为成功的书籍的 BookDelta，failures 为 [(书籍ID, 书名, 原因)]（书籍不存在时书名为 None）
+BatchResult = namedtuple("BatchResult", ["deltas", "failures"])
+
+# 共享记录的一页：total、borrowing 为符合筛选条件的记录总数和其中借阅中的数量（只在第一页计算，之后为 None），
+# next 为下一页的位置（作为 after 传入），没有更多记录时为 None
+RecordPage = namedtuple("RecordPage", ["rows", "total", "borrowing", "next"])
+
+# 示例数据：空数据库首次启动时插入
+SAMPLE_BOOKS = [
+    ("Python编程从入门到实践", "Eric Matthes", "9787115428028", "计算机", "人民邮电出版社", 2016, "可借阅", "张三", None, None, "Python编程经典入门书籍"),
+    ("深入理解计算机系统", "Randal E.Bryant", "9787111544937", "计算机", "机械工业出版社", 2016, "可借阅", "李四", None, None, "计算机系统经典教材"),
+    ("百年孤独", "加西亚·马尔克斯", "9787544253994", "文学", "南海出版公司", 2011, "共享中", "王五", "赵六", "2024-12-31", "魔幻现实主义文学代表作"),
+    ("人类简史", "尤瓦尔·赫拉利", "9787508647357", "历史", "中信出版社", 2014, "可借阅", "李四", None, None, "从人类进化到未来的全景历史"),
+    ("活着", "余华", "9787506365437", "文学", "作家出版社", 2012, "可借阅", "张三", None, None, "中国当代文学经典作品"),
+    ("算法导论", "Thomas H.Cormen", "9787111187776", "计算机", "机械工业出版社", 2006, "共享中", "王五", "张三", "2024-11-30", "算法领域经典著作"),
+    ("小王子", "圣埃克苏佩里", "9787020042494", "文学", "人民文学出版社", 2003, "可借阅", "赵六", None, None, "全球畅销的经典童话"),
+    ("经济学原理", "曼昆", "9787300127893", "经济", "北京大学出版社", 2009, "可借阅", "李四", None, None, "经济学入门经典教材"),
+]
+
+SAMPLE_RECORDS = [
+    (3, "赵六", "2024-10-15", None, "借阅中"),
+    (6, "张三", "2024-10-20", None, "借阅中"),
+]
+
+
+class ServiceError(Exception):
+    """业务错误，消息可以直接展示给用户；status 为对应的 HTTP 状态码"""
+    status = 400
+
+
+class ValidationError(ServiceError):
+    """书籍信息不合法"""
+    status = 400
+
+
+class BookNotFound(ServiceError):
+    """书籍不存在"""
+    status = 404
+
+    def __init__(self, message="书籍不存在"):
+        super().__init__(message)
+
+
+class PermissionDenied(ServiceError):
+    """用户无权操作这本书"""
+    status = 403
+
+
+class BookConflict(ServiceError):
+    """与其他用户的并发操作冲突，刷新后可以重试"""
+    status = 409
+
+
+class BookUnavailable(BookConflict):
+    """书籍当前状态不允许该操作（例如已被别人借走）"""
+
+
+class VersionConflict(BookConflict):
+    """书籍在读取之后已被其他用户修改"""
+
+    def __init__(self, message="书籍已被其他用户修改，请刷新后重试"):
+        super().__init__(message)
+
+
+def validate_book(fields):
+    """检查并整理书籍信息，返回只包含 BOOK_FIELDS 的字典"""
+    book = {name: fields.get(name) for name in BOOK_FIELDS}
+    for name in ("title", "author", "isbn", "category", "publisher", "description"):
+        book[name] = str(book[name] or "").strip()
+
+    if not book["title"]:
+        raise ValidationError("书名不能为空")
+    if not book["author"]:
+        raise ValidationError("作者不能为空")
+
+    year = book["publish_year"]
+    try:
+        book["publish_year"] = int(year) if year not in (None, "") else 0
+    except (TypeError, ValueError):
+        raise ValidationError("出版年份必须是数字") from None
+    return book
+
+
+def validate_batch_fields(fields):
+    """检查并整理批量修改的字段：只保留 BATCH_FIELDS 中填写了的，一项都没有时抛出 ValidationError"""
+    book = {}
+    for name in BATCH_FIELDS:
+        value = str(fields.get(name) or "").strip()
+        if value:
+            book[name] = value
+    if not book:
+        raise ValidationError("请至少填写一项要修改的内容")
+    if "publish_year" in book:
+        try:
+            book["publish_year"] = int(book["publish_year"])
+        except ValueError:
+            raise ValidationError("出版年份必须是数字") from None
+    return book
+
+
+def check_owner(book, user, action="编辑"):
+    """user 不是书籍的拥有者时抛出 PermissionDenied"""
+    if book[8] != user:
+        raise PermissionDenied(f"您只能{action}自己拥有的书籍")
+
+
+def _fetch_book(conn, book_id):
+    """读取一本书的全部字段"""
+    return conn.execute(f"SELECT {', '.join(BOOK_COLUMNS)} FROM books WHERE id = ?", (book_id,)).fetchone()
+
+
+def _fetch_row(conn, book_id):
+    """读取一本书在列表中显示的字段"""
+    return conn.execute(f"SELECT {', '.join(LIST_COLUMNS)} FROM books WHERE id = ?", (book_id,)).fetchone()
+
+
+def _record_filters(status, since, until):
+    """共享记录的筛选条件：状态名称，借阅日期的起止（YYYY-MM-DD，含当天），返回 (条件列表, 命名参数)"""
+    conditions = []
+    params = {}
+    if status:
+        codes = {name: code for code, name in STATUSES}
+        if status not in codes:
+            raise ValidationError(f"未知的状态：{status}")
+        conditions.append("l.status_code = :status")
+        params["status"] = codes[status]
+    for name, value, operator in (("since", since, ">="), ("until", until, "<=")):
+        if value:
+            try:
+                params[name] = to_day(value)
+            except ValueError:
+                raise ValidationError("日期格式应为 YYYY-MM-DD") from None
+            conditions.append(f"l.borrow_date {operator} :{name}")
+    return conditions, params
+
+
+def _record_page(conn, source, columns, params, after, limit, filters, ascending):
+    """按 (借阅日期, 记录ID) 键集分页读取共享记录，返回 RecordPage；source、columns 见 record_page_sql"""
+    conditions, filter_params = filters
+    params = dict(params, **filter_params)
+    if after is not None:
+        params["after_day"], params["after_id"] = after
+    # 多取一条，用来判断后面还有没有记录
+    params["limit"] = limit + 1
+    sql = record_page_sql(conn, source, columns, conditions, after is not None, ascending)
+    rows = conn.execute(sql, params).fetchall()
+    total = borrowing = None
+    if after is None:
+        total, borrowing = (rows[0][-2], rows[0][-1]) if rows else (0, 0)
+    next_after = (rows[limit - 1][-3], rows[limit - 1][0]) if len(rows) > limit else None
+    return RecordPage([row[:-3] for row in rows[:limit]], total, borrowing, next_after)
+
+
+def _queue_position(conn, book_id, reserver):
+    """用户在一本书的预约队列中排第几位（从 1 开始），没有预约时返回 None"""
+    return conn.execute('''
+        SELECT COUNT(*) FROM reservations q
+        JOIN reservations me ON me.book_id = q.book_id AND me.user_id = ?
+        WHERE q.book_id = ? AND (q.created_at, q.id) <= (me.created_at, me.id)
+    ''', (reserver, book_id)).fetchone()[0] or None
+
+
+def _hand_off(conn, book_id, day):
+    """归还后把书借给预约队列中排在最前的用户（在归还的写事务中），返回借到的用户 id；没有预约时返回 None
+
+    已过期的预约在这里顺带删除，不会轮到。
+    """
+    while True:
+        head = conn.execute(
+            "SELECT id, user_id, days, expires FROM reservations WHERE book_id = ? ORDER BY created_at, id LIMIT 1",
+            (book_id,),
+        ).fetchone()
+        if head is None:
+            return None
+        reservation_id, reserver, days, expires = head
+        conn.execute("DELETE FROM reservations WHERE id = ?", (reservation_id,))
+        if expires >= day:
+            break
+
+    conn.execute(f'''
+        UPDATE book_items
+        SET status_code={SHARED}, borrower_id=?, borrow_until=?, overdue=0, version=version + 1
+        WHERE id=?
+    ''', (reserver, day + days, book_id))
+    conn.execute(f'''
+        INSERT INTO loans (book_id, borrower_id, borrow_date, status_code)
+        VALUES (?, ?, ?, {BORROWING})
+    ''', (book_id, reserver, day))
+    conn.execute('''
+        INSERT OR IGNORE INTO reminders (book_id, borrower, due_date, kind, created_at)
+        SELECT ?, name, ?, ?, ? FROM users WHERE id = ?
+    ''', (book_id, from_day(day + days).isoformat(), RESERVED, datetime.now().isoformat(timespec="seconds"),
+          reserver))
+    return reserver
+
+
+def _book_values(conn, book):
+    """validate_book 的结果按 BOOK_FIELDS 的顺序排列，分类换成编号（须在写事务中）"""
+    return tuple(category_id(conn, book[name]) if name == "category" else book[name] for name in BOOK_FIELDS)
+
+
+class BookService:
+    """图书共享业务"""
+    def __init__(self, db_path=DB_PATH, **options):
+        self.manager = ConnectionManager(db_path, **options)
+        self.stats = StatsCache()
+        self.recommender = Recommender(self.manager)
+        self.fts_enabled = self.grams_enabled = False
+
+    def close(self):
+        """关闭数据库连接"""
+        self.manager.close()
+
+    # ---- 数据库 ----
+
+    def migrate(self):
+        """升级数据库结构，返回升级前的版本
+
+        先在读连接上检查版本号，已是最新版本时不开始写事务，启动时不必等待其他进程释放写锁。
+        """
+        version = self.manager.run_read(schema_version)
+        if version < SCHEMA_VERSION:
+            version = self.manager.run_write(migrate)
+        self.fts_enabled = self.manager.run_read(fts_available)
+        self.grams_enabled = self.manager.run_read(fts_available, "books_grams")
+        return version
+
+    def seed_sample_data(self):
+        """空数据库中插入示例数据（已有书籍时只读取一行，不开始写事务）"""
+        if self.manager.run_read(lambda conn: conn.execute("SELECT 1 FROM book_items LIMIT 1").fetchone()):
+            return False
+
+        def seed(conn):
+            if conn.execute("SELECT 1 FROM book_items LIMIT 1").fetchone():
+                return False
+            statuses = dict(conn.execute("SELECT name, code FROM statuses"))
+            conn.executemany('''
+                INSERT INTO book_items (title, author, isbn, category_id, publisher, publish_year, status_code,
+                                        owner_id, borrower_id, borrow_until, description)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [(title, author, isbn, category_id(conn, category), publisher, year, statuses[status],
+                   user_id(conn, owner, True), user_id(conn, borrower, True), to_day(until), description)
+                  for title, author, isbn, category, publisher, year, status, owner, borrower, until, description
+                  in SAMPLE_BOOKS])
+            conn.executemany('''
+                INSERT INTO loans (book_id, borrower_id, borrow_date, return_date, status_code)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(book_id, user_id(conn, borrower, True), to_day(borrow_date), to_day(return_date), statuses[status])
+                  for book_id, borrower, borrow_date, return_date, status in SAMPLE_RECORDS])
+            return True
+
+        seeded = self.manager.run_write(seed)
+        self.stats.invalidate()
+        return seeded
+
+    # ---- 查询 ----
+
+    def book_counts(self):
+        """各状态的书籍数量 {状态: 数量}"""
+        return dict(self.manager.run_read(self.stats.book_counts))
+
+    def user_counts(self, user):
+        """用户的 (借阅次数, 借阅中, 共享次数, 共享借阅中)"""
+        return self.manager.run_read(self.stats.user_counts, user)
+
+    def stats_changed(self):
+        """其他连接（包括其他程序实例）是否在上次检查之后提交过数据，有时统计需要重新读取"""
+        return self.manager.run_read(self.stats.changed)
+
+    def count_books(self):
+        """书籍总数"""
+        return sum(self.book_counts().values())
+
+    def get_book(self, book_id):
+        """一本书的全部字段（顺序同 BOOK_COLUMNS）"""
+        book = self.manager.run_read(_fetch_book, book_id)
+        if book is None:
+            raise BookNotFound()
+        return book
+
+    def get_own_book(self, user, book_id, action="编辑"):
+        """用户自己拥有的一本书；不是拥有者时抛出 PermissionDenied"""
+        book = self.get_book(book_id)
+        check_owner(book, user, action)
+        return book
+
+    def get_books(self, ids):
+        """一组书籍的全部字段（顺序同 BOOK_COLUMNS），不存在的书籍会被跳过"""
+        ids = list(ids)
+        if not ids:
+            return []
+        return self.manager.run_read(lambda conn: conn.execute(
+            f"SELECT {', '.join(BOOK_COLUMNS)} FROM books WHERE id IN ({','.join('?' * len(ids))})", ids
+        ).fetchall())
+
+    def list_books(self, after_id=0, limit=100):
+        """按 id 键集分页：id 大于 after_id 的 limit 本书（顺序同 LIST_COLUMNS）"""
+        return self.manager.run_read(lambda conn: conn.execute(
+            f"SELECT {', '.join(LIST_COLUMNS)} FROM books WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)
+        ).fetchall())
+
+    def book_id_at(self, index):
+        """按 id 排序后第 index 本书的 id，超出范围时返回 None
+
+        先累加 book_id_blocks 中各块的书籍数找到所在的块，再在块内用主键跳过（最多 2^ID_BLOCK_BITS 行），
+        耗时随块数（书籍数的千分之一）增长，而不是随 index 增长。
+        """
+        def query(conn):
+            block = conn.execute('''
+                SELECT block, total - count FROM (
+                    SELECT block, count, SUM(count) OVER (ORDER BY block) AS total FROM book_id_blocks
+                ) WHERE total > ? ORDER BY block LIMIT 1
+            ''', (index,)).fetchone()
+            if block is None:
+                return None
+            return conn.execute(
+                "SELECT id FROM book_items WHERE id >= ? ORDER BY id LIMIT 1 OFFSET ?",
+                (block[0] << ID_BLOCK_BITS, index - block[1]),
+            ).fetchone()
+
+        row = self.manager.run_read(query)
+        return row[0] if row else None
+
+    def books_by_ids(self, ids):
+        """按给定顺序读取一组书籍的列表字段，不存在的书籍会被跳过"""
+        ids = list(ids)
+        if not ids:
+            return []
+
+        def query(conn):
+            placeholders = ",".join("?" * len(ids))
+            return conn.execute(
+                f"SELECT {', '.join(LIST_COLUMNS)} FROM books WHERE id IN ({placeholders})", ids
+            ).fetchall()
+
+        by_id = {row[0]: row for row in self.manager.run_read(query)}
+        return [by_id[book_id] for book_id in ids if book_id in by_id]
+
+    def search(self, search_term, limit=SEARCH_LIMIT, ranked=True):
+        """搜索书名、作者、分类、描述和出版社，返回按相关度排序的书籍 id
+
+        ranked 为 False 时不排序，按索引顺序返回最先找到的 limit 本：
+        常见的词可能匹配几十万本书，全部算出相关度再排序要几秒，不排序时只需读取前几条。
+        """
+        terms = search_term.split()
+        if not terms:
+            return []
+        sql, params = search_sql(terms, self.fts_enabled, self.grams_enabled, ranked)
+        params["limit"] = limit
+        return self.manager.run_read(lambda conn: [row[0] for row in conn.execute(sql, params)])
+
+    def search_ranked(self, terms):
+        """这些搜索词的结果是否按相关度排序：有全文索引且有三个字及以上的词时按 BM25，否则按书籍 id"""
+        return self.fts_enabled and any(len(term) >= 3 for term in terms)
+
+    def search_fields(self, ids):
+        """一组书籍的可搜索字段 (id, 书名, 作者, 分类, 描述, 出版社)"""
+        ids = list(ids)
+        if not ids:
+            return []
+        return self.manager.run_read(lambda conn: conn.execute(
+            "SELECT id, title, author, category, description, publisher FROM books "
+            f"WHERE id IN ({','.join('?' * len(ids))})", ids
+        ).fetchall())
+
+    def owner_records(self, user, after=None, limit=RECORD_PAGE_SIZE, status=None, since=None, until=None,
+                      ascending=False):
+        """用户拥有的书籍被借阅的记录，一页 (记录ID, 书籍ID, 书名, 借阅人, 借阅日期, 归还日期, 状态)，返回 RecordPage
+
+        默认按借阅日期从新到旧排列；status 为状态名称，since、until 为借阅日期的范围，after 为上一页的 next。
+        """
+        filters = _record_filters(status, since, until)
+
+        def query(conn):
+            # 按拥有者筛选要先连接 book_items，这样的条件推不进 loan_history 视图，所以对每张分表分别连接
+            owner = user_id(conn, user)
+            if owner is None:
+                return RecordPage([], 0, 0, None)
+            return _record_page(
+                conn, "FROM book_items b JOIN {loans} l ON l.book_id = b.id WHERE b.owner_id = :user",
+                f'l.id, l.book_id, b.title, u.name, {day_sql("l.borrow_date")}, {day_sql("l.return_date")}, s.name',
+                {"user": owner}, after, limit, filters, ascending,
+            )
+        return self.manager.run_read(query)
+
+    def borrow_records(self, user, after=None, limit=RECORD_PAGE_SIZE, status=None, since=None, until=None,
+                       ascending=False):
+        """用户的借阅记录，一页 (记录ID, 书籍ID, 书名, 借阅日期, 归还日期, 状态)，返回 RecordPage；参数同 owner_records"""
+        filters = _record_filters(status, since, until)
+
+        def query(conn):
+            # 先查出借阅人编号，每张分表按借阅人索引（借阅人, 借阅日期）读取
+            borrower = user_id(conn, user)
+            if borrower is None:
+                return RecordPage([], 0, 0, None)
+            return _record_page(
+                conn, "FROM {loans} l WHERE l.borrower_id = :user",
+                f'l.id, l.book_id, b.title, {day_sql("l.borrow_date")}, {day_sql("l.return_date")}, s.name',
+                {"user": borrower}, after, limit, filters, ascending,
+            )
+        return self.manager.run_read(query)
+
+    # ---- 借阅到期 ----
+
+    def upcoming_loans(self, until):
+        """尚未标记逾期、应还日期不晚于 until（YYYY-MM-DD）的借阅 [(书籍ID, 借阅人, 应还日期)]，按应还日期排序"""
+        return self.manager.run_read(lambda conn: conn.execute(f'''
+            SELECT b.id, u.name, {day_sql("b.borrow_until")} FROM book_items b
+            JOIN users u ON u.id = b.borrower_id
+            WHERE b.overdue = 0 AND b.borrow_until <= ?
+            ORDER BY b.borrow_until
+        ''', (to_day(until),)).fetchall())
+
+    def overdue_books(self, limit=SEARCH_LIMIT):
+        """已逾期的书籍 (书籍ID, 书名, 借阅人, 拥有者, 应还日期)，按应还日期排序"""
+        return self.manager.run_read(lambda conn: conn.execute(f'''
+            SELECT b.id, b.title, u.name, o.name, {day_sql("b.borrow_until")} FROM book_items b
+            LEFT JOIN users u ON u.id = b.borrower_id
+            LEFT JOIN users o ON o.id = b.owner_id
+            WHERE b.overdue = 1 AND b.borrow_until IS NOT NULL
+            ORDER BY b.borrow_until LIMIT ?
+        ''', (limit,)).fetchall())
+
+    def record_due(self, today, events):
+        """在一个事务中批量处理到期事件 [(提醒类型, 书籍ID, 借阅人, 应还日期)]
+
+        已逾期的借阅加上逾期标记，并写入提醒记录；书已归还或重新借出时事件被忽略，重复的提醒不会再写入。
+        返回 (新标记逾期的书籍数, 新写入的提醒数)。
+        """
+        overdue = [(book_id, borrower, to_day(due)) for kind, book_id, borrower, due in events
+                   if kind == OVERDUE and due < today]
+        created_at = datetime.now().isoformat(timespec="seconds")
+        # 已经逾期的借阅不再发到期提醒
+        reminders = [(book_id, borrower, due, kind, created_at, to_day(due)) for kind, book_id, borrower, due in events
+                     if (kind == OVERDUE) == (due < today)]
+
+        def record(conn):
+            marked = added = 0
+            if overdue:
+                marked = conn.executemany('''
+                    UPDATE book_items SET overdue = 1
+                    WHERE id = ? AND borrower_id = (SELECT id FROM users WHERE name = ?)
+                      AND borrow_until = ? AND overdue = 0
+                ''', overdue).rowcount
+            if reminders:
+                added = conn.executemany('''
+                    INSERT OR IGNORE INTO reminders (book_id, borrower, due_date, kind, created_at)
+                    SELECT ?1, ?2, ?3, ?4, ?5
+                    WHERE EXISTS (SELECT 1 FROM book_items WHERE id = ?1 AND borrow_until = ?6
+                                  AND borrower_id = (SELECT id FROM users WHERE name = ?2))
+                ''', reminders).rowcount
+            return marked, added
+
+        return self.manager.run_write(record)
+
+    def reminders(self, user, limit=SEARCH_LIMIT):
+        """用户收到的提醒 (书籍ID, 书名, 应还日期, 提醒类型, 提醒时间)，最新的在前"""
+        return self.manager.run_read(lambda conn: conn.execute('''
+            SELECT r.book_id, b.title, r.due_date, r.kind, r.created_at
+            FROM reminders r
+            LEFT JOIN books b ON b.id = r.book_id
+            WHERE r.borrower = ?
+            ORDER BY r.created_at DESC LIMIT ?
+        ''', (user, limit)).fetchall())
+
+    # ---- 借阅推荐 ----
+
+    def similar_books(self, book_id, limit=TOP_K):
+        """借过这本书的读者也借了：[(id, 书名, 作者, 状态, 得分)]，读取预先算好的列表"""
+        return self.manager.run_read(neighbors, book_id, limit)
+
+    def refresh_recommendations(self, limit=REFRESH_BATCH):
+        """更新至多 limit 本有新借阅的书籍的推荐，返回更新的本数"""
+        return self.recommender.refresh(limit)
+
+    def compute_recommendations(self, limit=REFRESH_BATCH):
+        """只读：计算至多 limit 本有新借阅的书籍的推荐，结果交给 store_recommendations 写回"""
+        return self.recommender.compute(limit)
+
+    def store_recommendations(self, results):
+        """写回 compute_recommendations 的结果，返回书籍数"""
+        return self.recommender.store(results)
+
+    # ---- 借阅预约 ----
+
+    def reserve_book(self, user, book_id, days=30):
+        """预约借出中的书，轮到时自动借给 user days 天；返回在队列中的位置（已预约过时不重复排队）"""
+        today = to_day(date.today())
+
+        def reserve(conn):
+            row = conn.execute("SELECT status_code, borrower_id FROM book_items WHERE id = ?", (book_id,)).fetchone()
+            if row is None:
+                raise BookNotFound()
+            reserver = user_id(conn, user, True)
+            if row[0] == AVAILABLE:
+                raise BookUnavailable("该书籍当前可借阅，请直接借阅")
+            if row[1] == reserver:
+                raise BookUnavailable("您正在借阅这本书")
+            conn.execute('''
+                INSERT INTO reservations (book_id, user_id, days, created_at, expires) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (book_id, user_id) DO NOTHING
+            ''', (book_id, reserver, days, datetime.now().isoformat(timespec="seconds"), today + RESERVATION_DAYS))
+            return _queue_position(conn, book_id, reserver)
+
+        return self.manager.run_write(reserve)
+
+    def cancel_reservation(self, user, book_id):
+        """取消预约，返回是否有预约被取消"""
+        return self.manager.run_write(lambda conn: conn.execute(
+            "DELETE FROM reservations WHERE book_id = ? AND user_id = (SELECT id FROM users WHERE name = ?)",
+            (book_id, user),
+        ).rowcount > 0)
+
+    def reservations(self, user):
+        """用户的预约 (书籍ID, 书名, 状态, 排队位置, 预约时间, 有效期至)，先预约的在前"""
+        return self.manager.run_read(lambda conn: conn.execute(f'''
+            SELECT r.book_id, b.title, b.status,
+                   (SELECT COUNT(*) FROM reservations q
+                    WHERE q.book_id = r.book_id AND (q.created_at, q.id) <= (r.created_at, r.id)),
+                   r.created_at, {day_sql("r.expires")}
+            FROM reservations r JOIN books b ON b.id = r.book_id
+            WHERE r.user_id = (SELECT id FROM users WHERE name = ?)
+            ORDER BY r.created_at, r.id
+        ''', (user,)).fetchall())
+
+    def queue_length(self, book_id):
+        """一本书预约排队的人数"""
+        return self.manager.run_read(lambda conn: conn.execute(
+            "SELECT COUNT(*) FROM reservations WHERE book_id = ?", (book_id,)).fetchone()[0])
+
+    def expire_reservations(self, today):
+        """删除有效期在 today（YYYY-MM-DD）之前的预约，并通知预约的用户；返回删除的预约数"""
+        day = to_day(today)
+        created_at = datetime.now().isoformat(timespec="seconds")
+
+        def expire(conn):
+            conn.execute(f'''
+                INSERT OR IGNORE INTO reminders (book_id, borrower, due_date, kind, created_at)
+                SELECT r.book_id, u.name, {day_sql("r.expires")}, ?, ?
+                FROM reservations r JOIN users u ON u.id = r.user_id
+                WHERE r.expires < ?
+            ''', (RESERVATION_EXPIRED, created_at, day))
+            return conn.execute("DELETE FROM reservations WHERE expires < ?", (day,)).rowcount
+
+        return self.manager.run_write(expire)
+
+    # ---- 写操作：都返回 BookDelta ----
+
+    def _write(self, fn, *args):
+        """在写事务中执行，完成后统计缓存失效"""
+        delta = self.manager.run_write(fn, *args)
+        self.stats.invalidate()
+        return delta
+
+    def add_book(self, user, fields):
+        """添加一本书，拥有者为 user"""
+        book = validate_book(fields)
+
+        def insert(conn):
+            cursor = conn.execute(f'''
+                INSERT INTO book_items (title, author, isbn, category_id, publisher, publish_year, description,
+                                        owner_id, status_code)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, {AVAILABLE})
+            ''', _book_values(conn, book) + (user_id(conn, user, True),))
+            book_id = cursor.lastrowid
+            return BookDelta("insert", book_id, _fetch_row(conn, book_id), None)
+
+        return self._write(insert)
+
+    def update_book(self, user, book_id, fields, expected_version=None):
+        """修改书籍信息，只有拥有者可以修改；给出 expected_version 时书籍版本必须一致"""
+        book = validate_book(fields)
+
+        def update(conn):
+            old_row = _fetch_row(conn, book_id)
+            cursor = conn.execute('''
+                UPDATE book_items
+                SET title=?, author=?, isbn=?, category_id=?, publisher=?, publish_year=?, description=?,
+                    version=version + 1
+                WHERE id=? AND owner_id=? AND version=COALESCE(?, version)
+            ''', _book_values(conn, book) + (book_id, user_id(conn, user), expected_version))
+            if cursor.rowcount == 0:
+                self._raise_owner_conflict(conn, user, book_id, "编辑")
+            return BookDelta("update", book_id, _fetch_row(conn, book_id), old_row)
+
+        return self._write(update)
+
+    def delete_book(self, user, book_id, expected_version=None):
+        """删除书籍及其共享记录和预约，只有拥有者可以删除；给出 expected_version 时书籍版本必须一致"""
+        def delete(conn):
+            old_row = _fetch_row(conn, book_id)
+
+            # 先删共享记录，统计触发器需要查到书籍的拥有者；条件不满足时整个事务回滚
+            conn.execute("DELETE FROM loans WHERE book_id = ?", (book_id,))
+            for table in archive_tables(conn):
+                conn.execute(f"DELETE FROM {table} WHERE book_id = ?", (book_id,))
+            conn.execute("DELETE FROM reservations WHERE book_id = ?", (book_id,))
+            cursor = conn.execute(
+                "DELETE FROM book_items WHERE id = ? AND owner_id = ? AND version = COALESCE(?, version)",
+                (book_id, user_id(conn, user), expected_version),
+            )
+            if cursor.rowcount == 0:
+                self._raise_owner_conflict(conn, user, book_id, "删除")
+            return BookDelta("delete", book_id, None, old_row)
+
+        return self._write(delete)
+
+    def borrow_book(self, user, book_id, days=30, expected_version=None):
+        """借阅书籍 days 天；书籍已被借走时抛出 BookUnavailable，不会重复借出"""
+        borrow_day = to_day(date.today())
+
+        def borrow(conn):
+            old_row = _fetch_row(conn, book_id)
+
+            # 条件更新：只有仍可借阅时才会改到一行
+            borrower_id = user_id(conn, user, True)
+            cursor = conn.execute(f'''
+                UPDATE book_items
+                SET status_code={SHARED}, borrower_id=?, borrow_until=?, overdue=0, version=version + 1
+                WHERE id=? AND status_code={AVAILABLE} AND version=COALESCE(?, version)
+            ''', (borrower_id, borrow_day + days, book_id, expected_version))
+            if cursor.rowcount == 0:
+                self._raise_state_conflict(conn, book_id, expected_version, "可借阅", "该书籍当前不可借阅")
+
+            # 添加共享记录
+            conn.execute(f'''
+                INSERT INTO loans (book_id, borrower_id, borrow_date, status_code)
+                VALUES (?, ?, ?, {BORROWING})
+            ''', (book_id, borrower_id, borrow_day))
+            return BookDelta("update", book_id, _fetch_row(conn, book_id), old_row)
+
+        return self._write(borrow)
+
+    def return_book(self, user, book_id, expected_version=None):
+        """归还自己借阅的书籍；有人预约时在同一个事务中借给排在最前的预约者（返回的行中可以看到新的借阅人）"""
+        return_day = to_day(date.today())
+
+        def give_back(conn):
+            old_row = _fetch_row(conn, book_id)
+
+            # 条件更新：只有由 user 借阅中的书才会改到一行
+            borrower_id = user_id(conn, user)
+            cursor = conn.execute(f'''
+                UPDATE book_items
+                SET status_code={AVAILABLE}, borrower_id=NULL, borrow_until=NULL, overdue=0, version=version + 1
+                WHERE id=? AND status_code={SHARED} AND borrower_id=? AND version=COALESCE(?, version)
+            ''', (book_id, borrower_id, expected_version))
+            if cursor.rowcount == 0:
+                self._raise_state_conflict(conn, book_id, expected_version, "共享中", "该书籍未被借阅",
+                                           PermissionDenied("您只能归还自己借阅的书籍"))
+
+            # 更新共享记录
+            conn.execute(f'''
+                UPDATE loans
+                SET return_date=?, status_code={RETURNED}
+                WHERE book_id=? AND borrower_id=? AND status_code={BORROWING}
+            ''', (return_day, book_id, borrower_id))
+            _hand_off(conn, book_id, return_day)
+            return BookDelta("update", book_id, _fetch_row(conn, book_id), old_row)
+
+        return self._write(give_back)
+
+    # ---- 批量操作：一个写事务，返回 BatchResult ----
+
+    def _batch(self, book_ids, op, check, apply):
+        """批量写操作：在一个写事务中用一次 IN 查询读出全部书籍的列表行，check(行) 返回不能操作的原因（可以时返回 None），
+        apply(conn, 可以操作的 id 列表) 用 executemany 写入，最后再用一次 IN 查询读出修改后的行"""
+        book_ids = list(dict.fromkeys(book_ids))
+        if len(book_ids) > BATCH_LIMIT:
+            raise ValidationError(f"一次最多处理 {BATCH_LIMIT} 本书籍")
+
+        def run(conn):
+            query = f"SELECT {', '.join(LIST_COLUMNS)} FROM books WHERE id IN ({{}})"
+            old_rows = {row[0]: row for row in conn.execute(query.format(",".join("?" * len(book_ids))), book_ids)}
+            failures = []
+            ids = []
+            for book_id in book_ids:
+                row = old_rows.get(book_id)
+                reason = "书籍不存在" if row is None else check(row)
+                if reason:
+                    failures.append((book_id, row and row[1], reason))
+                else:
+                    ids.append(book_id)
+            if not ids:
+                return BatchResult([], failures)
+
+            apply(conn, ids)
+            if op == "delete":
+                return BatchResult([BookDelta(op, book_id, None, old_rows[book_id]) for book_id in ids], failures)
+            rows = {row[0]: row for row in conn.execute(query.format(",".join("?" * len(ids))), ids)}
+            return BatchResult([BookDelta(op, book_id, rows[book_id], old_rows[book_id]) for book_id in ids], failures)
+
+        return self._write(run)
+
+    def update_books(self, user, book_ids, fields):
+        """把多本书的 BATCH_FIELDS 中填写了的字段改成同样的值，只改 user 拥有的书"""
+        book = validate_batch_fields(fields)
+
+        def check(row):
+            return None if row[5] == user else "您只能编辑自己拥有的书籍"
+
+        def apply(conn, ids):
+            names = list(book)
+            values = tuple(category_id(conn, book[name]) if name == "category" else book[name] for name in names)
+            columns = ", ".join(f"{'category_id' if name == 'category' else name}=?" for name in names)
+            conn.executemany(f"UPDATE book_items SET {columns}, version=version + 1 WHERE id=?",
+                             [values + (book_id,) for book_id in ids])
+
+        return self._batch(book_ids, "update", check, apply)
+
+    def delete_books(self, user, book_ids):
+        """删除 user 拥有的多本书及其共享记录和预约"""
+        def check(row):
+            return None if row[5] == user else "您只能删除自己拥有的书籍"
+
+        def apply(conn, ids):
+            params = [(book_id,) for book_id in ids]
+            # 先删共享记录，统计触发器需要查到书籍的拥有者
+            conn.executemany("DELETE FROM loans WHERE book_id = ?", params)
+            for table in archive_tables(conn):
+                conn.executemany(f"DELETE FROM {table} WHERE book_id = ?", params)
+            conn.executemany("DELETE FROM reservations WHERE book_id = ?", params)
+            conn.executemany("DELETE FROM book_items WHERE id = ?", params)
+
+        return self._batch(book_ids, "delete", check, apply)
+
+    def borrow_books(self, user, book_ids, days=30):
+        """借阅多本可借阅的书 days 天"""
+        borrow_day = to_day(date.today())
+
+        def check(row):
+            return None if row[4] == "可借阅" else "该书籍当前不可借阅"
+
+        def apply(conn, ids):
+            borrower_id = user_id(conn, user, True)
+            conn.executemany(f'''
+                UPDATE book_items
+                SET status_code={SHARED}, borrower_id=?, borrow_until=?, overdue=0, version=version + 1
+                WHERE id=? AND status_code={AVAILABLE}
+            ''', [(borrower_id, borrow_day + days, book_id) for book_id in ids])
+            conn.executemany(f'''
+                INSERT INTO loans (book_id, borrower_id, borrow_date, status_code)
+                VALUES (?, ?, ?, {BORROWING})
+            ''', [(book_id, borrower_id, borrow_day) for book_id in ids])
+
+        return self._batch(book_ids, "update", check, apply)
+
+    def return_books(self, user, book_ids):
+        """归还 user 借阅的多本书；有人预约的书在同一个事务中借给排在最前的预约者"""
+        return_day = to_day(date.today())
+
+        def check(row):
+            if row[4] != "共享中":
+                return "该书籍未被借阅"
+            return None if row[6] == user else "您只能归还自己借阅的书籍"
+
+        def apply(conn, ids):
+            borrower_id = user_id(conn, user)
+            conn.executemany(f'''
+                UPDATE book_items
+                SET status_code={AVAILABLE}, borrower_id=NULL, borrow_until=NULL, overdue=0, version=version + 1
+                WHERE id=? AND borrower_id=?
+            ''', [(book_id, borrower_id) for book_id in ids])
+            conn.executemany(f'''
+                UPDATE loans
+                SET return_date=?, status_code={RETURNED}
+                WHERE book_id=? AND borrower_id=? AND status_code={BORROWING}
+            ''', [(return_day, book_id, borrower_id) for book_id in ids])
+            for book_id in ids:
+                _hand_off(conn, book_id, return_day)
+
+        return self._batch(book_ids, "update", check, apply)
+
+    def _raise_owner_conflict(self, conn, user, book_id, action):
+        """条件写入没有改到任何行时，找出原因并抛出对应的错误"""
+        row = conn.execute("SELECT owner FROM books WHERE id = ?", (book_id,)).fetchone()
+        if row is None:
+            raise BookNotFound()
+        if row[0] != user:
+            raise PermissionDenied(f"您只能{action}自己拥有的书籍")
+        raise VersionConflict()
+
+    def _raise_state_conflict(self, conn, book_id, expected_version, status, message, fallback=None):
+        """借还的条件更新没有改到任何行时，找出原因并抛出对应的错误"""
+        row = conn.execute("SELECT status, version FROM books WHERE id = ?", (book_id,)).fetchone()
+        if row is None:
+            raise BookNotFound()
+        if expected_version is not None and row[1] != expected_version:
+            raise VersionConflict()
+        if row[0] != status:
+            raise BookUnavailable(message)
+        raise fallback or BookUnavailable(message)
@@ -0,0 +1,453 @@
+﻿"""多馆分库：每个图书馆一个数据库文件，分布在若干分片目录中
+
+    python bookshard.py --root libraries init --shards 4
+    python bookshard.py --root libraries add 东校区              # 按馆名哈希选择分片
+    python bookshard.py --root libraries list
+    python bookshard.py --root libraries search 计算机网络        # 跨馆搜索
+    python bookshard.py --root libraries stats                    # 各馆和全部的书籍统计
+    python bookshard.py --root libraries move 东校区 --to 2       # 把一个馆迁到另一个分片
+
+SQLite 同一时刻只允许一个写事务，一个数据库文件的写吞吐量有上限；各馆的数据互不关联，
+放在各自的文件中后，不同馆的写事务互不等待，总的写吞吐量随馆（文件）数增长。
+分片是一个目录（可以在不同的磁盘上），目录数据库 directory.db 记录每个分片的路径和每个馆所在的分片；
+新馆按馆名哈希选择分片，迁移之后以目录中的记录为准。
+跨馆的搜索和统计用 ATTACH 把各馆文件以只读方式附加到同一个连接上，用一条 UNION ALL 查询完成
+（一个连接最多附加 ATTACH_LIMIT 个文件，更多的馆分批查询后合并）。
+迁移先在不阻塞写入的情况下复制快照，再持有源文件的写锁确认期间没有新的写入（有则在锁内重新复制），
+更新目录，并在源文件中加上拒绝写入的触发器：仍打开旧文件的进程写入时报错，不会写到已迁走的文件中。
+"""
+import argparse
+from collections import OrderedDict, defaultdict
+from contextlib import closing
+import os
+from pathlib import Path
+import sqlite3
+import sys
+import threading
+import zlib
+
+from bookdb import BUSY_TIMEOUT, ConnectionManager, connect, search_sql
+from bookservice import SEARCH_LIMIT, BookService, ServiceError, ValidationError
+
+# 目录数据库的文件名（在根目录下）
+DIRECTORY_FILE = "directory.db"
+
+# 同时打开的馆数据库个数，超过时关闭最久未使用的
+MAX_OPEN = 32
+
+# 一个连接最多附加的数据库个数（SQLite 默认的 SQLITE_MAX_ATTACHED）
+ATTACH_LIMIT = 10
+
+# 迁移后在旧文件中拒绝写入的表
+MOVED_TABLES = ("book_items", "loans")
+
+
+class LibraryNotFound(ServiceError):
+    """目录中没有这个馆"""
+    status = 404
+
+    def __init__(self, library):
+        super().__init__(f"图书馆不存在: {library}")
+
+
+def _create_directory(conn):
+    """建立目录表（可重复执行）"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS shards (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS libraries (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            shard_id INTEGER NOT NULL REFERENCES shards(id)
+        )
+    ''')
+
+
+def place(library, shard_ids):
+    """新馆所在的分片：馆名的 CRC32 对分片数取模（与进程和 Python 版本无关）"""
+    shard_ids = sorted(shard_ids)
+    if not shard_ids:
+        raise ValidationError("还没有分片，请先执行 init")
+    return shard_ids[zlib.crc32(library.encode("utf-8")) % len(shard_ids)]
+
+
+def attach_uri(path):
+    """以只读方式附加数据库文件的 URI"""
+    return Path(path).resolve().as_uri() + "?mode=ro"
+
+
+class ShardRouter:
+    """按馆路由到各自的数据库文件
+
+    service(library) 返回该馆的 BookService，按馆缓存，最多同时打开 max_open 个；
+    每次都从目录中读取馆所在的文件，其他进程迁移过的馆下一次调用时自动改用新文件。
+    其余参数原样传给 BookService（readers、busy_timeout、profiler 等）。
+    """
+    def __init__(self, root, max_open=MAX_OPEN, **options):
+        self.root = root
+        self.max_open = max_open
+        self.options = options
+        os.makedirs(root, exist_ok=True)
+        self.directory = ConnectionManager(os.path.join(root, DIRECTORY_FILE), readers=1,
+                                           busy_timeout=options.get("busy_timeout", BUSY_TIMEOUT))
+        self.directory.run_write(_create_directory)
+        self._services = OrderedDict()
+        self._lock = threading.Lock()
+
+    def close(self):
+        """关闭目录和所有打开的馆"""
+        with self._lock:
+            services = list(self._services.values())
+            self._services.clear()
+        for service in services:
+            service.close()
+        self.directory.close()
+
+    # ---- 目录 ----
+
+    def add_shard(self, path=None):
+        """增加一个分片目录（默认在根目录下按编号命名），返回分片编号"""
+        def add(conn):
+            shard_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM shards").fetchone()[0]
+            conn.execute("INSERT INTO shards (id, path) VALUES (?, ?)", (shard_id, path or f"shard-{shard_id:02d}"))
+            return shard_id
+
+        shard_id = self.directory.run_write(add)
+        os.makedirs(self.shard_path(shard_id), exist_ok=True)
+        return shard_id
+
+    def shard_path(self, shard_id):
+        """分片目录（相对路径相对于根目录）"""
+        row = self.directory.run_read(lambda conn: conn.execute(
+            "SELECT path FROM shards WHERE id = ?", (shard_id,)).fetchone())
+        if row is None:
+            raise ValidationError(f"分片不存在: {shard_id}")
+        return os.path.join(self.root, row[0])
+
+    def shards(self):
+        """所有分片 [(编号, 目录, 馆数)]"""
+        rows = self.directory.run_read(lambda conn: conn.execute('''
+            SELECT s.id, s.path, COUNT(l.id) FROM shards s LEFT JOIN libraries l ON l.shard_id = s.id
+            GROUP BY s.id ORDER BY s.id
+        ''').fetchall())
+        return [(shard_id, os.path.join(self.root, path), count) for shard_id, path, count in rows]
+
+    def add_library(self, library, shard_id=None):
+        """登记一个新馆并建立它的数据库，不指定分片时按馆名哈希选择，返回分片编号"""
+        library = library.strip()
+        if not library:
+            raise ValidationError("馆名不能为空")
+
+        def add(conn):
+            if conn.execute("SELECT 1 FROM libraries WHERE name = ?", (library,)).fetchone():
+                raise ValidationError(f"图书馆已存在: {library}")
+            shard_ids = [row[0] for row in conn.execute("SELECT id FROM shards")]
+            target = place(library, shard_ids) if shard_id is None else shard_id
+            if target not in shard_ids:
+                raise ValidationError(f"分片不存在: {target}")
+            conn.execute("INSERT INTO libraries (name, shard_id) VALUES (?, ?)", (library, target))
+            return target
+
+        target = self.directory.run_write(add)
+        self.service(library)
+        return target
+
+    def _locate(self, library):
+        """(馆编号, 分片编号, 数据库文件)"""
+        row = self.directory.run_read(lambda conn: conn.execute('''
+            SELECT l.id, l.shard_id, s.path FROM libraries l JOIN shards s ON s.id = l.shard_id WHERE l.name = ?
+        ''', (library,)).fetchone())
+        if row is None:
+            raise LibraryNotFound(library)
+        library_id, shard_id, path = row
+        return library_id, shard_id, os.path.join(self.root, path, f"library-{library_id}.db")
+
+    def library_path(self, library):
+        """馆的数据库文件"""
+        return self._locate(library)[2]
+
+    def libraries(self):
+        """所有馆 [(馆名, 分片编号, 数据库文件)]，按馆名排列"""
+        rows = self.directory.run_read(lambda conn: conn.execute('''
+            SELECT l.name, l.id, l.shard_id, s.path FROM libraries l JOIN shards s ON s.id = l.shard_id
+            ORDER BY l.name
+        ''').fetchall())
+        return [(name, shard_id, os.path.join(self.root, path, f"library-{library_id}.db"))
+                for name, library_id, shard_id, path in rows]
+
+    # ---- 按馆路由 ----
+
+    def service(self, library):
+        """馆的 BookService（首次打开时升级数据库结构）"""
+        path = self.library_path(library)
+        stale = None
+        with self._lock:
+            service = self._services.get(library)
+            if service is not None and service.manager.db_path != path:
+                stale, service = self._services.pop(library), None
+            if service is not None:
+                self._services.move_to_end(library)
+        if stale is not None:
+            stale.close()
+        if service is not None:
+            return service
+
+        service = BookService(path, **self.options)
+        service.migrate()
+        with self._lock:
+            existing = self._services.get(library)
+            if existing is not None and existing.manager.db_path == path:
+                evicted = [service]
+                service = existing
+            else:
+                evicted = [existing] if existing is not None else []
+                self._services[library] = service
+                while len(self._services) > self.max_open:
+                    evicted.append(self._services.popitem(last=False)[1])
+        for stale in evicted:
+            stale.close()
+        return service
+
+    def forget(self, library):
+        """关闭馆的缓存连接（下次使用时重新打开）"""
+        with self._lock:
+            service = self._services.pop(library, None)
+        if service is not None:
+            service.close()
+
+    # ---- 跨馆查询 ----
+
+    def _attached(self, libraries=None):
+        """按 ATTACH_LIMIT 分批附加各馆文件，逐批产生 (连接, [(别名, 馆名)])"""
+        located = [(name, path) for name, _, path in self.libraries()
+                   if libraries is None or name in libraries]
+        for start in range(0, len(located), ATTACH_LIMIT):
+            with closing(sqlite3.connect("file::memory:", uri=True, timeout=BUSY_TIMEOUT)) as conn:
+                schemas = []
+                for index, (name, path) in enumerate(located[start:start + ATTACH_LIMIT]):
+                    conn.execute("ATTACH ? AS ?", (attach_uri(path), f"lib{index}"))
+                    schemas.append((f"lib{index}", name))
+                yield conn, schemas
+
+    def search(self, search_term, limit=SEARCH_LIMIT, libraries=None):
+        """跨馆搜索书名、作者、分类、描述和出版社，返回 [(馆名, 书籍 id, 书名, 作者, 分类, 状态, 拥有者)]
+
+        各馆的结果在一条 UNION ALL 查询中按 BM25 合并排序；各馆的全文索引分别统计词频，分数只是近似可比。
+        全是一两个字的词时在一两个字的索引（books_grams）中匹配，没有全文索引的馆用 LIKE 匹配，都排在有分数的结果之后。
+        """
+        terms = search_term.split()
+        if not terms:
+            return []
+        found = []
+        for conn, schemas in self._attached(libraries):
+            arms = []
+            params = {"limit": limit}
+            for schema, library in schemas:
+                params[schema] = library
+                arm, arm_params = _search_arm(conn, schema, terms)
+                arms.append(f"SELECT :{schema} AS library, id, rank FROM ({arm})")
+                params.update(arm_params)
+            rows = conn.execute(f"{' UNION ALL '.join(arms)} ORDER BY rank LIMIT :limit", params).fetchall()
+            found.extend(_search_rows(conn, schemas, rows))
+        found.sort(key=lambda row: row[0])
+        return [row[1] for row in found[:limit]]
+
+    def book_counts(self, libraries=None):
+        """各馆各状态的书籍数量 {馆名: {状态: 数量}}，用全部之和即为全局统计"""
+        counts = {}
+        for conn, schemas in self._attached(libraries):
+            for _, library in schemas:
+                counts[library] = {}
+            sql = " UNION ALL ".join(
+                f"SELECT :{schema}, st.name, bs.count FROM {schema}.book_stats bs "
+                f"JOIN {schema}.statuses st ON st.code = bs.status_code"
+                for schema, _ in schemas
+            )
+            for library, status, count in conn.execute(sql, dict(schemas)):
+                counts[library][status] = count
+        return counts
+
+    # ---- 迁移 ----
+
+    def move_library(self, library, shard_id):
+        """把一个馆迁到另一个分片，返回新的数据库文件
+
+        复制快照期间不阻塞写入；之后持有源文件的写锁，期间有过写入则在锁内重新复制，
+        核对行数后更新目录、在源文件中拒绝写入，最后删除源文件（文件仍被打开而删不掉时保留）。
+        """
+        _, source_shard, source = self._locate(library)
+        if shard_id == source_shard:
+            raise ValidationError(f"{library} 已在分片 {shard_id}")
+        target = os.path.join(self.shard_path(shard_id), os.path.basename(source))
+        if os.path.exists(target):
+            raise ValidationError(f"目标文件已存在: {target}")
+
+        self.forget(library)
+        busy_timeout = self.options.get("busy_timeout", BUSY_TIMEOUT)
+        with closing(connect(source, busy_timeout)) as reader, closing(connect(source, busy_timeout)) as lock:
+            data_version = reader.execute("PRAGMA data_version").fetchone()[0]
+            _copy(reader, target)
+            lock.execute("BEGIN IMMEDIATE")
+            assigned = False
+            try:
+                # 读连接在复制之后又看到其他连接的提交时 data_version 会变化
+                if reader.execute("PRAGMA data_version").fetchone()[0] != data_version:
+                    _copy(reader, target)
+                _verify(reader, target)
+                self._assign(library, shard_id)
+                assigned = True
+                _refuse_writes(lock)
+                lock.commit()
+            except BaseException:
+                lock.rollback()
+                # 目录已经改到新分片时改回源分片，再删除复制的文件，馆仍在原来的文件中
+                try:
+                    if assigned:
+                        self._assign(library, source_shard)
+                finally:
+                    _remove(target)
+                raise
+        _remove(source)
+        return target
+
+    def _assign(self, library, shard_id):
+        """在目录中把馆登记到分片"""
+        self.directory.run_write(lambda conn: conn.execute(
+            "UPDATE libraries SET shard_id = ? WHERE name = ?", (shard_id, library)))
+
+
+def library_db(root, library):
+    """馆的数据库文件（只打开一个馆的界面和接口用 --shards/--library 指定）"""
+    router = ShardRouter(root, readers=1)
+    try:
+        return router.library_path(library)
+    finally:
+        router.close()
+
+
+def _search_arm(conn, schema, terms):
+    """一个馆的搜索子查询 SELECT id, rank 及其参数：与 BookService.search 相同的查询（参数名带上别名，各馆不重复）"""
+    tables = {name for (name,) in conn.execute(
+        f"SELECT name FROM {schema}.sqlite_master WHERE name IN ('books_fts', 'books_grams')")}
+    return search_sql(terms, "books_fts" in tables, "books_grams" in tables, schema=schema)
+
+
+def _search_rows(conn, schemas, rows):
+    """搜索结果补上显示的字段，返回 [((rank, 顺序), 行)]"""
+    by_library = defaultdict(list)
+    for library, book_id, _ in rows:
+        by_library[library].append(book_id)
+    fields = {}
+    for schema, library in schemas:
+        ids = by_library.get(library)
+        if ids:
+            for row in conn.execute(
+                f"SELECT id, title, author, category, status, owner FROM {schema}.books "
+                f"WHERE id IN ({','.join('?' * len(ids))})", ids
+            ):
+                fields[library, row[0]] = row
+    return [((rank, order), (library,) + fields[library, book_id])
+            for order, (library, book_id, rank) in enumerate(rows) if (library, book_id) in fields]
+
+
+def _copy(reader, target):
+    """用 SQLite 备份接口把 reader 当前的快照复制到 target（覆盖）"""
+    with closing(sqlite3.connect(target)) as destination:
+        reader.backup(destination)
+
+
+def _verify(reader, target):
+    """核对复制的结果：完整性检查和各表行数，不一致时抛出 RuntimeError"""
+    with closing(sqlite3.connect(target)) as conn:
+        check = conn.execute("PRAGMA quick_check").fetchone()[0]
+        if check != "ok":
+            raise RuntimeError(f"复制的数据库损坏: {check}")
+        for table in MOVED_TABLES:
+            expected = reader.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            actual = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            if expected != actual:
+                raise RuntimeError(f"{table} 复制了 {actual} 行，源文件中有 {expected} 行")
+
+
+def _refuse_writes(conn):
+    """在已迁走的文件中加上拒绝写入的触发器（须在写事务中）"""
+    for table in MOVED_TABLES:
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS moved_{table}_{event.lower()} BEFORE {event} ON {table}
+                BEGIN SELECT RAISE(ABORT, '图书馆已迁移到其他分片，请重新打开'); END
+            ''')
+
+
+def _remove(path):
+    """删除数据库文件及其 WAL 日志；文件仍被其他进程打开（Windows）时保留"""
+    for name in (path, path + "-wal", path + "-shm"):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            print(f"未能删除 {name}: {error}", file=sys.stderr)
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="图书共享系统多馆分库")
+    parser.add_argument("--root", default="libraries", help="目录数据库和分片所在的根目录")
+    commands = parser.add_subparsers(dest="command", required=True)
+    init = commands.add_parser("init", help="建立分片目录")
+    init.add_argument("--shards", type=int, default=4, help="分片数")
+    add = commands.add_parser("add", help="登记一个新馆")
+    add.add_argument("library", help="馆名")
+    add.add_argument("--shard", type=int, help="分片编号，默认按馆名哈希选择")
+    commands.add_parser("list", help="列出分片和各馆")
+    search = commands.add_parser("search", help="跨馆搜索")
+    search.add_argument("term", help="搜索词")
+    search.add_argument("--limit", type=int, default=20, help="最多显示的条数")
+    commands.add_parser("stats", help="各馆和全部的书籍统计")
+    move = commands.add_parser("move", help="把一个馆迁到另一个分片")
+    move.add_argument("library", help="馆名")
+    move.add_argument("--to", type=int, required=True, help="目标分片编号")
+    args = parser.parse_args(argv)
+
+    router = ShardRouter(args.root, readers=1)
+    try:
+        if args.command == "init":
+            existing = len(router.shards())
+            for _ in range(existing, args.shards):
+                router.add_shard()
+            print(f"{args.root}: {max(existing, args.shards)} 个分片")
+        elif args.command == "add":
+            print(f"{args.library} -> 分片 {router.add_library(args.library, args.shard)}")
+        elif args.command == "list":
+            for shard_id, path, count in router.shards():
+                print(f"分片 {shard_id}: {path}（{count} 个馆）")
+            for name, shard_id, path in router.libraries():
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                print(f"  {name}: 分片 {shard_id}，{path}，{size / 1024 / 1024:.1f} MB")
+        elif args.command == "search":
+            for library, book_id, title, author, category, status, owner in router.search(args.term, args.limit):
+                print(f"[{library}] {book_id} {title} / {author}（{category}，{status}，{owner}）")
+        elif args.command == "stats":
+            totals = defaultdict(int)
+            for library, counts in sorted(router.book_counts().items()):
+                print(f"{library}: " + "，".join(f"{status} {count}" for status, count in counts.items()))
+                for status, count in counts.items():
+                    totals[status] += count
+            print("全部: " + "，".join(f"{status} {count}" for status, count in totals.items()))
+        elif args.command == "move":
+            print(f"{args.library} -> {router.move_library(args.library, args.to)}")
+        return 0
+    except ServiceError as error:
+        print(error, file=sys.stderr)
+        return 1
+    finally:
+        router.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,245 @@
 ﻿import tkinter as tk
-from tkinter import ttk, messagebox, simpledialog
-import sqlite3
-from datetime import datetime, timedelta
+from tkinter import ttk, messagebox, simpledialog, filedialog
+from collections import OrderedDict
+from functools import partial
+from datetime import date
+import argparse
+import bisect
 import json
 import os
+import time
+
+from bookdb import DB_PATH, DBExecutor
+from bookexport import FORMATS, export_tables
+from bookimport import import_books
+from bookprofile import Profiler
+from bookrecommend import REFRESH_BATCH
+from bookscheduler import DueScheduler
+from bookservice import (BOOK_COLUMNS, LIST_COLUMNS, SEARCH_LIMIT, BookConflict, BookService, BookUnavailable,
+                         ServiceError, check_owner, validate_batch_fields, validate_book)
+from bookshard import library_db
+
+# 检查其他程序实例是否写入过数据的间隔（毫秒）；本程序的写入按增量修正统计，只有这时才重新读取统计表
+STATS_CHECK_INTERVAL = 2000
+
+# 界面线程检查数据库任务回调的间隔（毫秒）
+DB_POLL_INTERVAL = 20
+
+# 数据库任务超过该时长（秒）仍未完成时显示忙碌指示
+BUSY_DELAY = 0.2
+
+# 详情缓存的书籍数量
+DETAIL_CACHE_SIZE = 2000
+
+# 选中一本书时预取前后各多少本书的详情
+PREFETCH_RADIUS = 10
+
+# 输入搜索词后停顿多久（毫秒）才查询数据库
+SEARCH_DEBOUNCE = 200
+
+# 搜索先不排序地读取这么多本书立即显示，再在后台按相关度排序
+SEARCH_FIRST_BATCH = 100
+
+# 缓存最近多少次搜索的结果
+SEARCH_CACHE_SIZE = 32
+
+# 到期检查最长的间隔（秒），防止系统休眠等情况下定时器长时间不触发
+DUE_CHECK_MAX_DELAY = 600
+
+# 启动时第一页显示后才开始到期检查；第一页读取失败时最晚在启动后多少毫秒开始
+DUE_STARTUP_DELAY = 5000
+
+# 借出一本书后等多久（毫秒）更新推荐，连续借出时合并为一次
+RECOMMEND_DELAY = 2000
+
+# 推荐还有一批以上过期时，两批之间的间隔（毫秒），让界面的写操作可以插进来
+RECOMMEND_BATCH_GAP = 100
+
+# 检查其他程序实例新增的借阅、更新推荐的间隔（毫秒）
+RECOMMEND_INTERVAL = 60000
+
+# 批量操作的结果中最多逐本列出多少本失败的书
+BATCH_REPORT_LINES = 20
+
+# 记录耗时的界面处理函数（按钮、菜单、表格选择等的命令）
+PROFILED_HANDLERS = ("add_book", "edit_book", "delete_book", "borrow_book", "return_book", "reserve_book", "run_batch",
+                     "load_books", "on_tree_select", "show_details", "show_similar", "show_my_sharing", "show_borrow_records",
+                     "show_reservations", "show_overdue", "search_books", "on_search_changed", "run_search",
+                     "show_search_results", "update_stats", "check_due", "import_catalog", "export_table")
+
+# 诊断信息窗口中可选的抽样比例
+PROFILE_RATES = [("关闭", 0), ("抽样 1%", 0.01), ("抽样 5%", 0.05), ("全部", 1)]
+
+# 诊断信息窗口的刷新间隔（毫秒）
+DIAGNOSTICS_REFRESH = 1000
+
+# 共享记录窗口滚动到这个位置（0~1）之后读取下一页
+RECORDS_LOAD_AT = 0.9
+
+class ChangeFeed:
+    """变更通知：写操作发布行级增量，界面各部分按增量就地更新"""
+    def __init__(self):
+        self.subscribers = []
+    
+    def subscribe(self, callback, batch=None):
+        """订阅变更；给出 batch 时批量的变更一次交给 batch(增量列表)，否则逐条交给 callback"""
+        self.subscribers.append((callback, batch))
+    
+    def emit(self, delta):
+        """发布一条变更"""
+        for callback, _ in self.subscribers:
+            callback(delta)
+    
+    def emit_batch(self, deltas):
+        """发布批量操作的一组变更，列表和统计只刷新一次"""
+        if not deltas:
+            return
+        for callback, batch in self.subscribers:
+            if batch is not None:
+                batch(deltas)
+            else:
+                for delta in deltas:
+                    callback(delta)
+
+class BookDetailCache:
+    """书籍详情的 LRU 缓存：按 id 缓存 BookService.get_book 的结果，写操作的增量使对应的书失效
+
+    每次失效 epoch 加一；读取开始前记下 epoch，结果到达时 epoch 已变化则不缓存，避免写入前读到的旧数据进入缓存。
+    """
+    # 列表行的各列在详情中的位置，用于发现其他进程修改过的书
+    LIST_IN_BOOK = [BOOK_COLUMNS.index(name) for name in LIST_COLUMNS]
+
+    def __init__(self, capacity=DETAIL_CACHE_SIZE):
+        self.capacity = capacity
+        self.books = OrderedDict()
+        self.loading = set()
+        self.epoch = 0
+        self.hits = self.misses = self.prefetched = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, book_id, row=None):
+        """缓存中的一本书；给出列表中显示的行时，与行不一致的缓存视为过期"""
+        book = self.books.get(book_id)
+        if book is not None and row is not None:
+            if any(str("" if book[i] is None else book[i]) != str(value)
+                   for i, value in zip(self.LIST_IN_BOOK, row)):
+                del self.books[book_id]
+                book = None
+        if book is None:
+            self.misses += 1
+            return None
+        self.books.move_to_end(book_id)
+        self.hits += 1
+        return book
+
+    def put(self, books, epoch, prefetched=False):
+        """缓存读到的书籍；读取期间有书失效时丢弃"""
+        if prefetched:
+            self.loading.difference_update(book[0] for book in books)
+        if epoch != self.epoch:
+            return
+        for book in books:
+            self.books[book[0]] = book
+            self.books.move_to_end(book[0])
+        if prefetched:
+            self.prefetched += len(books)
+        while len(self.books) > self.capacity:
+            self.books.popitem(last=False)
+
+    def missing(self, ids):
+        """尚未缓存、也不在读取中的 id"""
+        return [book_id for book_id in ids if book_id not in self.books and book_id not in self.loading]
+
+    def invalidate(self, book_id):
+        self.epoch += 1
+        self.books.pop(book_id, None)
+
+    def clear(self):
+        self.epoch += 1
+        self.books.clear()
+        self.loading.clear()
+
+    def apply_delta(self, delta):
+        """写操作后使对应的书失效"""
+        self.invalidate(delta.book_id)
+
+class SearchCache:
+    """最近搜索结果的 LRU 缓存，键为小写的搜索词元组
+
+    结果完整（不到 SEARCH_LIMIT 本）时同时保存每本书的可搜索文本。新的搜索是缓存中某次搜索的细化
+    （旧的每个词都是新的某个词的子串）时，新结果一定包含在旧结果中，直接在内存中过滤，不再查询数据库。
+    过滤只保留旧结果的顺序，因此只用于不按相关度排序（按书籍 id）的搜索：ranked(词元组) 为 True 的搜索
+    按 BM25 排序，同样的词不论之前输入过什么都要得到同样的顺序，只能查询数据库。
+    """
+    def __init__(self, capacity=SEARCH_CACHE_SIZE, ranked=lambda terms: False):
+        self.capacity = capacity
+        self.ranked = ranked
+        self.entries = OrderedDict()
+        self.hits = self.narrowed = self.misses = 0
+
+    @staticmethod
+    def terms(search_term):
+        return tuple(search_term.lower().split())
+
+    def get(self, terms):
+        """缓存能回答时返回书籍 id 列表，否则返回 None"""
+        entry = self.entries.get(terms)
+        if entry is not None:
+            self.entries.move_to_end(terms)
+            self.hits += 1
+            return entry[0]
+
+        if self.ranked(terms):
+            self.misses += 1
+            return None
+        for old_terms, (ids, texts) in reversed(self.entries.items()):
+            if texts is not None and all(any(old in new for new in terms) for old in old_terms):
+                break
+        else:
+            self.misses += 1
+            return None
+        ids = [book_id for book_id in ids if all(term in texts[book_id] for term in terms)]
+        self.put(terms, ids, {book_id: texts[book_id] for book_id in ids})
+        self.narrowed += 1
+        return ids
+
+    def put(self, terms, ids, texts=None):
+        """缓存一次搜索的结果；texts 为 {id: 小写的可搜索文本}，结果不完整时为 None"""
+        self.entries[terms] = (ids, texts)
+        self.entries.move_to_end(terms)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
 
 class BookSharingSystem:
-    def __init__(self, root):
+    def __init__(self, root, db_path=DB_PATH, title="图书共享管理系统"):
         self.root = root
-        self.root.title("图书共享管理系统")
+        self.root.title(title)
         self.root.geometry("1200x700")
         
-        # 连接数据库
-        self.conn = sqlite3.connect('book_sharing.db')
-        self.cursor = self.conn.cursor()
+        # 业务逻辑在 BookService 中；界面线程只向后台线程提交任务，在回调中更新界面
+        self.db_path = db_path
+        
+        # 性能剖析：抽样记录 SQL 语句、界面处理函数和数据库回调的耗时（工具 → 诊断信息…）
+        self.profiler = Profiler()
+        for name in PROFILED_HANDLERS:
+            setattr(self, name, self.profiler.wrap("handler", name, getattr(self, name)))
+        self.service = BookService(self.db_path, profiler=self.profiler)
+        self.db = DBExecutor(self.service.manager, on_error=self.show_db_error)
+        self.total_books = self.available_books = self.shared_books = 0
+        
+        # 分阶段启动：数据库任务先提交到后台，界面同时建立；窗口不等数据库就显示，
+        # 统计数字和第一页到达后再填入。各阶段的耗时记入性能剖析（startup_*）
+        self.startup_began = time.perf_counter()
+        self.startup = {}
         
-        # 创建数据表
+        # 创建数据表（已是最新版本时只检查版本号）
         self.create_tables()
         
         # 加载初始数据
@@ -24,89 +248,87 @@ class BookSharingSystem:
         # 当前用户
         self.current_user = "张三"
         
+        # 行级变更通知
+        self.changes = ChangeFeed()
+        
+        # 书籍详情缓存
+        self.details = BookDetailCache()
+        self.changes.subscribe(self.details.apply_delta)
+        self._detail_job = None
+        self._shown_book = None
+        
+        # 边输入边搜索；书籍有任何修改时缓存的搜索结果作废
+        self.search_cache = SearchCache(ranked=self.service.search_ranked)
+        self.changes.subscribe(lambda delta: self.search_cache.clear())
+        self._search_timer = None
+        self._search_job = None
+        self._clearing_search = False
+        
         # 创建UI
         self.create_widgets()
+        self.mark_startup("shell")
+        
+        # 借阅到期调度：在下一个到期事件的时间醒来，标记逾期并写入提醒（启动时等第一页显示后开始）
+        self.scheduler = DueScheduler(self.service)
+        self._due_running = False
+        self.changes.subscribe(self.track_due)
+        self._due_timer = self.root.after(DUE_STARTUP_DELAY, self.check_due)
+        
+        # 借阅推荐：有新的借阅时在后台分批更新（第一页显示后开始，之后定时检查其他程序实例的借阅）
+        self._recommend_timer = None
+        self._recommend_running = False
+        self.changes.subscribe(self.track_loans)
         
         # 加载书籍列表
         self.load_books()
         
-    def create_tables(self):
-        """创建数据库表"""
-        # 书籍表
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS books (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                author TEXT NOT NULL,
-                isbn TEXT,
-                category TEXT,
-                publisher TEXT,
-                publish_year INTEGER,
-                status TEXT DEFAULT '可借阅',
-                owner TEXT NOT NULL,
-                borrower TEXT,
-                borrow_until TEXT,
-                description TEXT
-            )
-        ''')
-        
-        # 共享记录表
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sharing_records (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                book_id INTEGER NOT NULL,
-                book_title TEXT NOT NULL,
-                borrower TEXT NOT NULL,
-                borrow_date TEXT NOT NULL,
-                return_date TEXT,
-                status TEXT DEFAULT '借阅中',
-                FOREIGN KEY (book_id) REFERENCES books (id)
-            )
-        ''')
+        # 处理数据库任务的回调
+        self._busy_since = None
+        self._busy_shown = False
+        self.poll_db()
         
-        self.conn.commit()
-    
+    def create_tables(self):
+        """创建数据库表（按版本执行尚未执行的迁移）"""
+        self.db.submit(self.service.migrate, write=True)
+
     def load_initial_data(self):
         """加载初始数据"""
-        # 检查是否有数据
-        self.cursor.execute("SELECT COUNT(*) FROM books")
-        count = self.cursor.fetchone()[0]
-        
-        if count == 0:
-            # 插入示例数据
-            books = [
-                ("Python编程从入门到实践", "Eric Matthes", "9787115428028", "计算机", "人民邮电出版社", 2016, "可借阅", "张三", None, None, "Python编程经典入门书籍"),
-                ("深入理解计算机系统", "Randal E.Bryant", "9787111544937", "计算机", "机械工业出版社", 2016, "可借阅", "李四", None, None, "计算机系统经典教材"),
-                ("百年孤独", "加西亚·马尔克斯", "9787544253994", "文学", "南海出版公司", 2011, "共享中", "王五", "赵六", "2024-12-31", "魔幻现实主义文学代表作"),
-                ("人类简史", "尤瓦尔·赫拉利", "9787508647357", "历史", "中信出版社", 2014, "可借阅", "李四", None, None, "从人类进化到未来的全景历史"),
-                ("活着", "余华", "9787506365437", "文学", "作家出版社", 2012, "可借阅", "张三", None, None, "中国当代文学经典作品"),
-                ("算法导论", "Thomas H.Cormen", "9787111187776", "计算机", "机械工业出版社", 2006, "共享中", "王五", "张三", "2024-11-30", "算法领域经典著作"),
-                ("小王子", "圣埃克苏佩里", "9787020042494", "文学", "人民文学出版社", 2003, "可借阅", "赵六", None, None, "全球畅销的经典童话"),
-                ("经济学原理", "曼昆", "9787300127893", "经济", "北京大学出版社", 2009, "可借阅", "李四", None, None, "经济学入门经典教材"),
-            ]
-            
-            for book in books:
-                self.cursor.execute('''
-                    INSERT INTO books (title, author, isbn, category, publisher, publish_year, status, owner, borrower, borrow_until, description)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', book)
-            
-            # 插入共享记录
-            records = [
-                (3, "百年孤独", "赵六", "2024-10-15", None, "借阅中"),
-                (6, "算法导论", "张三", "2024-10-20", None, "借阅中"),
-            ]
-            
-            for record in records:
-                self.cursor.execute('''
-                    INSERT INTO sharing_records (book_id, book_title, borrower, borrow_date, return_date, status)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', record)
-            
-            self.conn.commit()
-    
+        # 空数据库中插入示例数据
+        self.db.submit(self.service.seed_sample_data, write=True)
+
+    def mark_startup(self, stage):
+        """记录启动阶段第一次到达的时间；第一页显示后开始到期检查、推荐更新和统计检查（不再排在第一页之前）"""
+        if stage in self.startup:
+            return
+        elapsed = time.perf_counter() - self.startup_began
+        self.startup[stage] = elapsed
+        self.profiler.record("handler", f"startup_{stage}", elapsed)
+        if stage == "first_page" and self._due_timer is not None:
+            self.root.after_cancel(self._due_timer)
+            self.check_due()
+        if stage == "first_page":
+            self.schedule_recommend(RECOMMEND_DELAY)
+            self.root.after(STATS_CHECK_INTERVAL, self.check_stats)
+
+    def create_menu(self):
+        """创建菜单栏"""
+        menubar = tk.Menu(self.root)
+        file_menu = tk.Menu(menubar, tearoff=0)
+        file_menu.add_command(label="导入书目…", command=self.import_catalog)
+        file_menu.add_command(label="导出书目…", command=partial(self.export_table, "books", "书目"))
+        file_menu.add_command(label="导出共享记录…", command=partial(self.export_table, "sharing_records", "共享记录"))
+        file_menu.add_separator()
+        file_menu.add_command(label="退出", command=self.root.destroy)
+        menubar.add_cascade(label="文件", menu=file_menu)
+        tools_menu = tk.Menu(menubar, tearoff=0)
+        tools_menu.add_command(label="诊断信息…", command=self.show_diagnostics)
+        menubar.add_cascade(label="工具", menu=tools_menu)
+        self.root.config(menu=menubar)
+
     def create_widgets(self):
         """创建界面组件"""
+        self.create_menu()
+        
         # 创建主框架
         main_frame = ttk.Frame(self.root, padding="10")
         main_frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
@@ -128,14 +350,15 @@ class BookSharingSystem:
         ttk.Label(user_frame, text=f"当前用户: {self.current_user}", font=("微软雅黑", 10)).grid(row=0, column=0, padx=5)
         
         # 统计信息
-        self.update_stats()
-        
         stats_frame = ttk.Frame(user_frame)
         stats_frame.grid(row=0, column=1, padx=20)
         
-        ttk.Label(stats_frame, text=f"可借阅: {self.available_books}").grid(row=0, column=0, padx=5)
-        ttk.Label(stats_frame, text=f"共享中: {self.shared_books}").grid(row=0, column=1, padx=5)
-        ttk.Label(stats_frame, text=f"总书籍: {self.total_books}").grid(row=0, column=2, padx=5)
+        self.available_label = ttk.Label(stats_frame, text=f"可借阅: {self.available_books}")
+        self.available_label.grid(row=0, column=0, padx=5)
+        self.shared_label = ttk.Label(stats_frame, text=f"共享中: {self.shared_books}")
+        self.shared_label.grid(row=0, column=1, padx=5)
+        self.total_label = ttk.Label(stats_frame, text=f"总书籍: {self.total_books}")
+        self.total_label.grid(row=0, column=2, padx=5)
         
         # 左侧控制面板
         control_frame = ttk.LabelFrame(main_frame, text="功能控制", padding="10")
@@ -149,6 +372,8 @@ class BookSharingSystem:
         ttk.Button(control_frame, text="归还书籍", command=self.return_book, width=20).pack(pady=5)
         ttk.Button(control_frame, text="我的共享", command=self.show_my_sharing, width=20).pack(pady=5)
         ttk.Button(control_frame, text="借阅记录", command=self.show_borrow_records, width=20).pack(pady=5)
+        ttk.Button(control_frame, text="我的预约", command=self.show_reservations, width=20).pack(pady=5)
+        ttk.Button(control_frame, text="逾期书籍", command=self.show_overdue, width=20).pack(pady=5)
         ttk.Button(control_frame, text="搜索书籍", command=self.search_books, width=20).pack(pady=5)
         ttk.Button(control_frame, text="刷新列表", command=self.load_books, width=20).pack(pady=5)
         
@@ -156,6 +381,16 @@ class BookSharingSystem:
         list_frame = ttk.LabelFrame(main_frame, text="书籍列表", padding="10")
         list_frame.grid(row=2, column=1, sticky=(tk.N, tk.S, tk.W, tk.E))
         
+        # 搜索框：输入时即时过滤列表
+        search_frame = ttk.Frame(list_frame)
+        search_frame.grid(row=0, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(0, 5))
+        ttk.Label(search_frame, text="搜索:").pack(side=tk.LEFT)
+        self.search_var = tk.StringVar()
+        self.search_entry = ttk.Entry(search_frame, textvariable=self.search_var)
+        self.search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        self.search_entry.bind("<Escape>", lambda e: self.search_var.set(""))
+        self.search_var.trace_add("write", self.on_search_changed)
+        
         # 创建表格
         columns = ("ID", "书名", "作者", "分类", "状态", "拥有者", "借阅者", "归还日期")
         self.tree = ttk.Treeview(list_frame, columns=columns, show="headings", height=20)
@@ -171,31 +406,47 @@ class BookSharingSystem:
         self.tree.column("ID", width=50)
         
         # 滚动条
-        scrollbar = ttk.Scrollbar(list_frame, orient=tk.VERTICAL, command=self.tree.yview)
-        self.tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar = ttk.Scrollbar(list_frame, orient=tk.VERTICAL)
         
         # 布局
-        self.tree.grid(row=0, column=0, sticky=(tk.N, tk.S, tk.W, tk.E))
-        scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
+        self.tree.grid(row=1, column=0, sticky=(tk.N, tk.S, tk.W, tk.E))
+        scrollbar.grid(row=1, column=1, sticky=(tk.N, tk.S))
+        
+        # 虚拟列表：分页读取数据，复用固定数量的行
+        self.book_list = VirtualBookList(self.tree, scrollbar, self.db, self.service)
+        self.book_list.render = self.profiler.wrap("handler", "render_books", self.book_list.render)
+        
+        # 写操作后按增量更新列表和统计（批量操作只刷新一次）
+        self.changes.subscribe(self.book_list.apply_delta, self.book_list.apply_deltas)
+        self.changes.subscribe(self.patch_stats, self.patch_stats_batch)
         
         # 配置网格权重
         list_frame.columnconfigure(0, weight=1)
-        list_frame.rowconfigure(0, weight=1)
+        list_frame.rowconfigure(1, weight=1)
         
         # 右侧详细信息面板
         detail_frame = ttk.LabelFrame(main_frame, text="书籍详情", padding="10")
         detail_frame.grid(row=2, column=2, sticky=(tk.N, tk.S, tk.W, tk.E), padx=(10, 0))
         
         # 详细信息标签
-        self.detail_text = tk.Text(detail_frame, height=20, width=30, wrap=tk.WORD)
+        self.detail_text = tk.Text(detail_frame, height=12, width=30, wrap=tk.WORD)
         self.detail_text.grid(row=0, column=0, sticky=(tk.N, tk.S, tk.W, tk.E))
         
+        # 借过这本书的读者也借了（双击显示这本书）
+        ttk.Label(detail_frame, text="借过这本书的读者也借了:").grid(row=1, column=0, sticky=tk.W, pady=(10, 5))
+        self.similar_tree = ttk.Treeview(detail_frame, columns=("书名", "作者", "状态"), show="headings", height=6)
+        for col, width in (("书名", 140), ("作者", 80), ("状态", 60)):
+            self.similar_tree.heading(col, text=col)
+            self.similar_tree.column(col, width=width)
+        self.similar_tree.grid(row=2, column=0, sticky=(tk.W, tk.E))
+        self.similar_tree.bind("<Double-1>", self.open_similar)
+        
         # 配置网格权重
         detail_frame.columnconfigure(0, weight=1)
         detail_frame.rowconfigure(0, weight=1)
         
         # 绑定选择事件
-        self.tree.bind("<<TreeviewSelect>>", self.on_tree_select)
+        self.tree.bind("<<TreeviewSelect>>", self.on_tree_select, add="+")
         
         # 底部状态栏
         status_frame = ttk.Frame(main_frame)
@@ -204,56 +455,195 @@ class BookSharingSystem:
         self.status_label = ttk.Label(status_frame, text="就绪")
         self.status_label.pack(side=tk.LEFT)
         
-    def update_stats(self):
+        # 数据库忙碌指示（有任务执行超过一段时间才显示）
+        self.busy_label = ttk.Label(status_frame, text="数据库处理中…")
+        self.busy_bar = ttk.Progressbar(status_frame, mode="indeterminate", length=100)
+        
+    def poll_db(self):
+        """在界面线程中执行数据库任务的回调，并更新忙碌指示"""
+        self.db.deliver()
+        
+        if self.db.busy:
+            if self._busy_since is None:
+                self._busy_since = time.monotonic()
+            elif time.monotonic() - self._busy_since >= BUSY_DELAY and not self._busy_shown:
+                self.busy_bar.pack(side=tk.RIGHT)
+                self.busy_label.pack(side=tk.RIGHT, padx=5)
+                self.busy_bar.start(10)
+                self._busy_shown = True
+        else:
+            self._busy_since = None
+            if self._busy_shown:
+                self.busy_bar.stop()
+                self.busy_bar.pack_forget()
+                self.busy_label.pack_forget()
+                self._busy_shown = False
+        
+        self.root.after(DB_POLL_INTERVAL, self.poll_db)
+    
+    def show_db_error(self, error):
+        """后台任务失败：业务错误提示用户，其他错误按数据库错误处理"""
+        if isinstance(error, ServiceError):
+            messagebox.showwarning("警告", str(error))
+            # 与其他用户的操作冲突时列表中的数据已过期，重新读取
+            if isinstance(error, BookConflict):
+                self.details.clear()
+                self.book_list.refresh()
+            return
+        messagebox.showerror("错误", f"数据库操作失败: {error}")
+        self.status_label.config(text="数据库操作失败")
+
+    def update_stats(self, then=None):
         """更新统计信息"""
-        # 总书籍数
-        self.cursor.execute("SELECT COUNT(*) FROM books")
-        self.total_books = self.cursor.fetchone()[0]
-        
-        # 可借阅书籍数
-        self.cursor.execute("SELECT COUNT(*) FROM books WHERE status = '可借阅'")
-        self.available_books = self.cursor.fetchone()[0]
+        def show(counts):
+            # 总书籍数
+            self.total_books = sum(counts.values())
+            
+            # 可借阅书籍数
+            self.available_books = counts.get('可借阅', 0)
+            
+            # 共享中书籍数
+            self.shared_books = counts.get('共享中', 0)
+            
+            self.show_stats()
+            if then:
+                then()
         
-        # 共享中书籍数
-        self.cursor.execute("SELECT COUNT(*) FROM books WHERE status = '共享中'")
-        self.shared_books = self.cursor.fetchone()[0]
+        self.db.submit(self.service.book_counts, callback=show)
+    
+    def show_stats(self):
+        """刷新统计标签"""
+        if not hasattr(self, 'total_label'):
+            return
+        self.available_label.config(text=f"可借阅: {self.available_books}")
+        self.shared_label.config(text=f"共享中: {self.shared_books}")
+        self.total_label.config(text=f"总书籍: {self.total_books}")
+    
+    def patch_stats(self, delta):
+        """按行级变更修正统计数字，无需重新计数"""
+        self.patch_stats_batch([delta])
+    
+    def patch_stats_batch(self, deltas):
+        """按一组行级变更修正统计数字（批量操作只刷新一次标签）"""
+        for delta in deltas:
+            for row, sign in ((delta.old_row, -1), (delta.row, 1)):
+                if row is None:
+                    continue
+                self.total_books += sign
+                if row[4] == '可借阅':
+                    self.available_books += sign
+                elif row[4] == '共享中':
+                    self.shared_books += sign
+        self.show_stats()
+    
+    def check_stats(self):
+        """定时检查其他连接是否写入过数据（data_version 变化），有变化时才重新读取统计表"""
+        def checked(changed):
+            if changed:
+                self.update_stats()
+            self.root.after(STATS_CHECK_INTERVAL, self.check_stats)
+        
+        self.db.submit(self.service.stats_changed, callback=checked,
+                       errback=lambda error: self.root.after(STATS_CHECK_INTERVAL, self.check_stats))
     
     def load_books(self):
         """加载书籍列表"""
-        # 清空当前列表
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        
-        # 从数据库获取数据
-        self.cursor.execute("SELECT id, title, author, category, status, owner, borrower, borrow_until FROM books")
-        books = self.cursor.fetchall()
-        
-        # 添加到树形视图
-        for book in books:
-            # 格式化日期
-            borrow_until = book[7] if book[7] else ""
-            self.tree.insert("", tk.END, values=book)
-        
-        # 更新统计信息
-        self.update_stats()
+        self.details.clear()
+        self.search_cache.clear()
+        
+        # 显示全部书籍时清空搜索框
+        self.cancel_search()
+        if self.search_var.get():
+            self._clearing_search = True
+            try:
+                self.search_var.set("")
+            finally:
+                self._clearing_search = False
+        
+        def loaded(total):
+            # 更新状态栏
+            self.status_label.config(text=f"已加载 {total} 本书籍")
+            self.mark_startup("first_page")
         
-        # 更新状态栏
-        self.status_label.config(text=f"已加载 {len(books)} 本书籍")
+        # 统计信息和列表同时在后台读取；重置虚拟列表，书籍数量和第一页由同一个任务读取
+        self.update_stats(then=partial(self.mark_startup, "stats"))
+        self.book_list.reset(then=loaded)
     
     def on_tree_select(self, event):
         """当选择书籍时显示详细信息"""
         selection = self.tree.selection()
+        if len(self.book_list.selected_ids) > 1:
+            self.status_label.config(text=f"已选择 {len(self.book_list.selected_ids)} 本书籍")
         if not selection:
             return
         
         item = self.tree.item(selection[0])
         book_id = item['values'][0]
+        if book_id == "":
+            return
         
-        # 从数据库获取详细信息
-        self.cursor.execute("SELECT * FROM books WHERE id = ?", (book_id,))
-        book = self.cursor.fetchone()
+        self.load_details(book_id, item['values'])
+        self.prefetch_details(book_id)
+    
+    def load_details(self, book_id, row=None):
+        """显示一本书的详情和推荐"""
+        # 先查详情缓存，命中时不访问数据库，并取消上一次尚未完成的查询
+        book = self.details.get(book_id, row)
+        if book is not None:
+            if self._detail_job is not None:
+                self.db.cancel(self._detail_job)
+                self._detail_job = None
+            self.show_details(book)
+        else:
+            # 从数据库获取详细信息（选择变化时取消上一次尚未完成的查询）
+            epoch = self.details.epoch
+            
+            def loaded(book):
+                self._detail_job = None
+                self.details.put([book], epoch)
+                self.show_details(book)
+            
+            self._detail_job = self.db.submit(self.service.get_book, book_id, callback=loaded, key="detail")
+        
+        self.show_similar(book_id)
+    
+    def prefetch_details(self, book_id):
+        """在后台读取选中书籍前后几本书的详情，方向键移动时直接从缓存显示"""
+        ids = self.details.missing(self.book_list.ids_near(book_id, PREFETCH_RADIUS))
+        if not ids:
+            return
+        self.details.loading.update(ids)
+        epoch = self.details.epoch
+        
+        def failed(error):
+            self.details.loading.difference_update(ids)
         
-        if book:
+        self.db.submit(self.service.get_books, ids, errback=failed,
+                       callback=lambda books: self.details.put(books, epoch, prefetched=True))
+    
+    def with_own_book(self, book_id, action, then):
+        """取得当前用户拥有的一本书后调用 then(book)，优先使用详情缓存；不是拥有者时提示用户"""
+        book = self.details.get(book_id)
+        if book is None:
+            epoch = self.details.epoch
+            
+            def loaded(book):
+                self.details.put([book], epoch)
+                then(book)
+            
+            self.db.submit(self.service.get_own_book, self.current_user, book_id, action, callback=loaded)
+            return
+        try:
+            check_owner(book, self.current_user, action)
+        except ServiceError as error:
+            self.show_db_error(error)
+            return
+        then(book)
+    
+    def show_details(self, book):
+        """在详情面板中显示书籍信息"""
+        if book and book != self._shown_book:
+            self._shown_book = book
             # 格式化详细信息
             details = f"""书名: {book[1]}
 作者: {book[2]}
@@ -264,7 +654,7 @@ ISBN: {book[3]}
 状态: {book[7]}
 拥有者: {book[8]}
 借阅者: {book[9] if book[9] else '无'}
-归还日期: {book[10] if book[10] else '无'}
+归还日期: {book[10] if book[10] else '无'}{'（已逾期）' if book[13] else ''}
 
 描述:
 {book[11]}"""
@@ -273,221 +663,232 @@ ISBN: {book[3]}
             self.detail_text.delete(1.0, tk.END)
             self.detail_text.insert(1.0, details)
     
+    def show_similar(self, book_id):
+        """读取借过这本书的读者也借了的书（预先算好，按主键读取一次），显示在详情下方"""
+        def loaded(books):
+            self.similar_tree.delete(*self.similar_tree.get_children())
+            for other_id, title, author, status, _ in books:
+                self.similar_tree.insert("", tk.END, iid=str(other_id), values=(title, author, status))
+        
+        self.db.submit(self.service.similar_books, book_id, callback=loaded, key="similar")
+    
+    def open_similar(self, event):
+        """双击推荐的书籍时显示它的详情和推荐"""
+        selection = self.similar_tree.selection()
+        if selection:
+            self.load_details(int(selection[0]))
+    
     def add_book(self):
         """添加新书"""
         dialog = BookDialog(self.root, "添加新书")
         if dialog.result:
-            # 插入数据库
-            self.cursor.execute('''
-                INSERT INTO books (title, author, isbn, category, publisher, publish_year, description, owner, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, '可借阅')
-            ''', (
-                dialog.result['title'],
-                dialog.result['author'],
-                dialog.result['isbn'],
-                dialog.result['category'],
-                dialog.result['publisher'],
-                dialog.result['publish_year'],
-                dialog.result['description'],
-                self.current_user
-            ))
+            result = dialog.result
             
-            self.conn.commit()
-            self.load_books()
+            def done(delta):
+                self.changes.emit(delta)
+                
+                messagebox.showinfo("成功", f"书籍《{result['title']}》添加成功！")
+                self.status_label.config(text=f"已添加书籍: {result['title']}")
             
-            messagebox.showinfo("成功", f"书籍《{dialog.result['title']}》添加成功！")
-            self.status_label.config(text=f"已添加书籍: {dialog.result['title']}")
-    
+            self.db.submit(self.service.add_book, self.current_user, result, callback=done, write=True)
+
     def edit_book(self):
-        """编辑书籍"""
-        selection = self.tree.selection()
-        if not selection:
-            messagebox.showwarning("警告", "请先选择一本书籍")
-            return
-        
-        item = self.tree.item(selection[0])
-        book_id = item['values'][0]
-        
-        # 从数据库获取详细信息
-        self.cursor.execute("SELECT * FROM books WHERE id = ?", (book_id,))
-        book = self.cursor.fetchone()
-        
-        if not book:
-            messagebox.showerror("错误", "书籍不存在")
+        """编辑书籍；选中多本时批量修改分类、出版社或出版年份"""
+        book_ids = self.selected_book_ids()
+        if len(book_ids) > 1:
+            dialog = BatchEditDialog(self.root, f"批量编辑 {len(book_ids)} 本书籍")
+            if dialog.result:
+                self.run_batch("编辑", self.service.update_books, book_ids, dialog.result)
             return
         
-        # 检查用户是否有权限编辑
-        if book[8] != self.current_user:
-            messagebox.showwarning("警告", "您只能编辑自己拥有的书籍")
+        book_id = self.selected_book_id()
+        if book_id is None:
             return
         
-        # 创建编辑对话框
-        dialog = BookDialog(
-            self.root, 
-            "编辑书籍",
-            title=book[1],
-            author=book[2],
-            isbn=book[3],
-            category=book[4],
-            publisher=book[5],
-            publish_year=book[6],
-            description=book[11]
-        )
-        
-        if dialog.result:
-            # 更新数据库
-            self.cursor.execute('''
-                UPDATE books 
-                SET title=?, author=?, isbn=?, category=?, publisher=?, publish_year=?, description=?
-                WHERE id=?
-            ''', (
-                dialog.result['title'],
-                dialog.result['author'],
-                dialog.result['isbn'],
-                dialog.result['category'],
-                dialog.result['publisher'],
-                dialog.result['publish_year'],
-                dialog.result['description'],
-                book_id
-            ))
-            
-            self.conn.commit()
-            self.load_books()
+        def edit(book):
+            # 创建编辑对话框
+            dialog = BookDialog(
+                self.root, 
+                "编辑书籍",
+                title=book[1],
+                author=book[2],
+                isbn=book[3],
+                category=book[4],
+                publisher=book[5],
+                publish_year=book[6],
+                description=book[11]
+            )
             
-            messagebox.showinfo("成功", f"书籍《{dialog.result['title']}》编辑成功！")
-            self.status_label.config(text=f"已编辑书籍: {dialog.result['title']}")
-    
+            if dialog.result:
+                result = dialog.result
+                
+                def done(delta):
+                    self.changes.emit(delta)
+                    
+                    messagebox.showinfo("成功", f"书籍《{result['title']}》编辑成功！")
+                    self.status_label.config(text=f"已编辑书籍: {result['title']}")
+                
+                # 带上读到的版本号，期间被其他用户修改过时会失败而不是覆盖对方的修改
+                self.db.submit(self.service.update_book, self.current_user, book_id, result, book[12],
+                               callback=done, write=True)
+        
+        # 读取书籍并检查用户是否有权限编辑
+        self.with_own_book(book_id, "编辑", edit)
+
     def delete_book(self):
-        """删除书籍"""
-        selection = self.tree.selection()
-        if not selection:
-            messagebox.showwarning("警告", "请先选择一本书籍")
+        """删除书籍；选中多本时批量删除"""
+        book_ids = self.selected_book_ids()
+        if len(book_ids) > 1:
+            if messagebox.askyesno("确认", f"确定要删除选中的 {len(book_ids)} 本书籍吗？"):
+                self.run_batch("删除", self.service.delete_books, book_ids)
             return
         
-        item = self.tree.item(selection[0])
-        book_id = item['values'][0]
-        book_title = item['values'][1]
-        
-        # 从数据库获取详细信息
-        self.cursor.execute("SELECT * FROM books WHERE id = ?", (book_id,))
-        book = self.cursor.fetchone()
-        
-        if not book:
-            messagebox.showerror("错误", "书籍不存在")
+        book_id = self.selected_book_id()
+        if book_id is None:
             return
         
-        # 检查用户是否有权限删除
-        if book[8] != self.current_user:
-            messagebox.showwarning("警告", "您只能删除自己拥有的书籍")
-            return
+        def confirm(book):
+            # 确认删除
+            if messagebox.askyesno("确认", f"确定要删除《{book[1]}》吗？"):
+                self.db.submit(self.service.delete_book, self.current_user, book_id, book[12],
+                               callback=done, write=True)
         
-        # 确认删除
-        if messagebox.askyesno("确认", f"确定要删除《{book_title}》吗？"):
-            # 删除数据库记录
-            self.cursor.execute("DELETE FROM books WHERE id = ?", (book_id,))
-            self.cursor.execute("DELETE FROM sharing_records WHERE book_id = ?", (book_id,))
-            
-            self.conn.commit()
-            self.load_books()
+        def done(delta):
+            self.changes.emit(delta)
             
+            book_title = delta.old_row[1]
             messagebox.showinfo("成功", f"书籍《{book_title}》删除成功！")
             self.status_label.config(text=f"已删除书籍: {book_title}")
-    
+        
+        # 读取书籍并检查用户是否有权限删除
+        self.with_own_book(book_id, "删除", confirm)
+
     def borrow_book(self):
-        """借阅书籍"""
-        selection = self.tree.selection()
-        if not selection:
-            messagebox.showwarning("警告", "请先选择一本书籍")
+        """借阅书籍；选中多本时批量借阅"""
+        book_ids = self.selected_book_ids()
+        if len(book_ids) > 1:
+            days = simpledialog.askinteger("借阅天数", f"借阅选中的 {len(book_ids)} 本书籍，请输入借阅天数（默认30天）:",
+                                           minvalue=1, maxvalue=365, initialvalue=30)
+            if days:
+                self.run_batch("借阅", self.service.borrow_books, book_ids, days)
             return
         
-        item = self.tree.item(selection[0])
-        book_id = item['values'][0]
-        book_title = item['values'][1]
-        status = item['values'][4]
-        
-        if status != "可借阅":
-            messagebox.showwarning("警告", "该书籍当前不可借阅")
+        book_id = self.selected_book_id()
+        if book_id is None:
             return
         
         # 获取借阅天数
         days = simpledialog.askinteger("借阅天数", "请输入借阅天数（默认30天）:", minvalue=1, maxvalue=365, initialvalue=30)
         
         if days:
-            # 计算归还日期
-            borrow_date = datetime.now()
-            return_date = borrow_date + timedelta(days=days)
-            return_date_str = return_date.strftime("%Y-%m-%d")
-            borrow_date_str = borrow_date.strftime("%Y-%m-%d")
-            
-            # 更新书籍状态
-            self.cursor.execute('''
-                UPDATE books 
-                SET status='共享中', borrower=?, borrow_until=?
-                WHERE id=?
-            ''', (self.current_user, return_date_str, book_id))
-            
-            # 添加共享记录
-            self.cursor.execute('''
-                INSERT INTO sharing_records (book_id, book_title, borrower, borrow_date, status)
-                VALUES (?, ?, ?, ?, '借阅中')
-            ''', (book_id, book_title, self.current_user, borrow_date_str))
+            def done(delta):
+                self.changes.emit(delta)
+                
+                book_title, return_date = delta.row[1], delta.row[7]
+                messagebox.showinfo("成功", f"书籍《{book_title}》借阅成功！请在{return_date}前归还。")
+                self.status_label.config(text=f"已借阅书籍: {book_title}")
             
-            self.conn.commit()
-            self.load_books()
+            def failed(error):
+                # 书已被借走时可以预约：归还时按预约顺序自动借出，不必反复尝试
+                if isinstance(error, BookUnavailable) and messagebox.askyesno(
+                        "预约", f"{error}。是否预约？轮到您时会自动借给您{days}天。"):
+                    self.details.clear()
+                    self.book_list.refresh()
+                    self.reserve_book(book_id, days)
+                else:
+                    self.show_db_error(error)
             
-            messagebox.showinfo("成功", f"书籍《{book_title}》借阅成功！请在{return_date_str}前归还。")
-            self.status_label.config(text=f"已借阅书籍: {book_title}")
+            # 是否可借阅由服务在写事务中判断
+            self.db.submit(self.service.borrow_book, self.current_user, book_id, days, callback=done, errback=failed,
+                           write=True)
     
+    def reserve_book(self, book_id, days):
+        """预约借出中的书"""
+        def done(position):
+            messagebox.showinfo("成功", f"预约成功，您排在第 {position} 位。")
+            self.status_label.config(text=f"已预约书籍 {book_id}，排在第 {position} 位")
+        
+        self.db.submit(self.service.reserve_book, self.current_user, book_id, days, callback=done, write=True)
+
     def return_book(self):
-        """归还书籍"""
-        selection = self.tree.selection()
-        if not selection:
-            messagebox.showwarning("警告", "请先选择一本书籍")
+        """归还书籍；选中多本时批量归还"""
+        book_ids = self.selected_book_ids()
+        if len(book_ids) > 1:
+            if messagebox.askyesno("确认", f"确定要归还选中的 {len(book_ids)} 本书籍吗？"):
+                self.run_batch("归还", self.service.return_books, book_ids)
             return
         
-        item = self.tree.item(selection[0])
-        book_id = item['values'][0]
-        book_title = item['values'][1]
-        borrower = item['values'][6]
-        status = item['values'][4]
-        
-        if status != "共享中":
-            messagebox.showwarning("警告", "该书籍未被借阅")
+        book_id = self.selected_book_id()
+        if book_id is None:
             return
         
-        if borrower != self.current_user:
-            messagebox.showwarning("警告", "您只能归还自己借阅的书籍")
-            return
+        book_title = self.tree.item(self.tree.selection()[0])['values'][1]
         
         # 确认归还
         if messagebox.askyesno("确认", f"确定要归还《{book_title}》吗？"):
-            return_date = datetime.now().strftime("%Y-%m-%d")
+            def done(delta):
+                self.changes.emit(delta)
+                
+                # 有人预约时书已在同一个事务中借给排在最前的预约者
+                handed = f"已按预约借给 {delta.row[6]}。" if delta.row[6] else ""
+                messagebox.showinfo("成功", f"书籍《{book_title}》归还成功！{handed}")
+                self.status_label.config(text=f"已归还书籍: {book_title}")
             
-            # 更新书籍状态
-            self.cursor.execute('''
-                UPDATE books 
-                SET status='可借阅', borrower=NULL, borrow_until=NULL
-                WHERE id=?
-            ''', (book_id,))
-            
-            # 更新共享记录
-            self.cursor.execute('''
-                UPDATE sharing_records 
-                SET return_date=?, status='已归还'
-                WHERE book_id=? AND borrower=? AND status='借阅中'
-            ''', (return_date, book_id, self.current_user))
-            
-            self.conn.commit()
-            self.load_books()
+            # 是否由当前用户借阅由服务在写事务中判断
+            self.db.submit(self.service.return_book, self.current_user, book_id, callback=done, write=True)
+    
+    def run_batch(self, action, method, book_ids, *args):
+        """在一个写事务中对多本书执行批量操作，完成后一次刷新列表，并在一个对话框中汇总失败的书籍"""
+        def done(result):
+            self.changes.emit_batch(result.deltas)
             
-            messagebox.showinfo("成功", f"书籍《{book_title}》归还成功！")
-            self.status_label.config(text=f"已归还书籍: {book_title}")
+            message = f"{action}成功 {len(result.deltas)} 本"
+            if result.failures:
+                lines = [f"{title or book_id}：{reason}" for book_id, title, reason in result.failures[:BATCH_REPORT_LINES]]
+                if len(result.failures) > BATCH_REPORT_LINES:
+                    lines.append(f"……另有 {len(result.failures) - BATCH_REPORT_LINES} 本")
+                messagebox.showwarning("批量" + action, f"{message}，失败 {len(result.failures)} 本：\n" + "\n".join(lines))
+            else:
+                messagebox.showinfo("成功", message + "。")
+            self.status_label.config(text=f"已批量{action} {len(result.deltas)} 本书籍")
+        
+        self.db.submit(method, self.current_user, book_ids, *args, callback=done, write=True)
+    
+    def selected_book_ids(self):
+        """选中的全部书籍 id（包括滚动到屏幕外的），按 id 排序"""
+        return sorted(self.book_list.selected_ids)
     
+    def selected_book_id(self):
+        """当前选中书籍的 id；未选中时提示用户并返回 None"""
+        selection = self.tree.selection()
+        if selection:
+            book_id = self.tree.item(selection[0])['values'][0]
+            if book_id != "":
+                return book_id
+        messagebox.showwarning("警告", "请先选择一本书籍")
+        return None
+
     def show_my_sharing(self):
         """显示我的共享记录"""
+        RecordListWindow(
+            self.root, self.db, "我的共享记录", ("ID", "书籍ID", "书名", "借阅人", "借阅日期", "归还日期", "状态"),
+            partial(self.service.owner_records, self.current_user),
+            lambda total, borrowing: f"总共享次数: {total}    借阅中: {borrowing}",
+        )
+    
+    def show_borrow_records(self):
+        """显示我的借阅记录"""
+        RecordListWindow(
+            self.root, self.db, "我的借阅记录", ("ID", "书籍ID", "书名", "借阅日期", "归还日期", "状态"),
+            partial(self.service.borrow_records, self.current_user),
+            lambda total, borrowing: f"总借阅次数: {total}    借阅中: {borrowing}",
+        )
+    
+    def show_overdue(self):
+        """显示已逾期的书籍"""
         # 创建新窗口
         window = tk.Toplevel(self.root)
-        window.title("我的共享记录")
+        window.title("逾期书籍")
         window.geometry("800x500")
         
         # 创建框架
@@ -495,7 +896,7 @@ ISBN: {book[3]}
         frame.pack(fill=tk.BOTH, expand=True)
         
         # 创建表格
-        columns = ("ID", "书籍ID", "书名", "借阅人", "借阅日期", "归还日期", "状态")
+        columns = ("书籍ID", "书名", "借阅者", "拥有者", "应还日期", "逾期天数")
         tree = ttk.Treeview(frame, columns=columns, show="headings", height=20)
         
         # 设置列标题
@@ -504,7 +905,6 @@ ISBN: {book[3]}
         
         # 调整列宽
         tree.column("书名", width=200)
-        tree.column("ID", width=50)
         tree.column("书籍ID", width=60)
         
         # 滚动条
@@ -515,134 +915,955 @@ ISBN: {book[3]}
         tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         
-        # 查询我的共享记录
-        self.cursor.execute('''
-            SELECT sr.id, b.id, b.title, sr.borrower, sr.borrow_date, sr.return_date, sr.status
-            FROM sharing_records sr
-            JOIN books b ON sr.book_id = b.id
-            WHERE b.owner = ?
-            ORDER BY sr.borrow_date DESC
-        ''', (self.current_user,))
-        
-        records = self.cursor.fetchall()
-        
-        # 添加到树形视图
-        for record in records:
-            tree.insert("", tk.END, values=record)
-        
-        # 统计信息
-        stats_frame = ttk.Frame(window, padding="10")
-        stats_frame.pack(fill=tk.X)
-        
-        # 查询统计
-        self.cursor.execute("SELECT COUNT(*) FROM sharing_records sr JOIN books b ON sr.book_id = b.id WHERE b.owner = ?", (self.current_user,))
-        total = self.cursor.fetchone()[0]
-        
-        self.cursor.execute("SELECT COUNT(*) FROM sharing_records sr JOIN books b ON sr.book_id = b.id WHERE b.owner = ? AND sr.status = '借阅中'", (self.current_user,))
-        borrowing = self.cursor.fetchone()[0]
+        def show(books):
+            if not window.winfo_exists():
+                return
+            today = date.today()
+            for book_id, title, borrower, owner, due in books:
+                days = (today - date.fromisoformat(due)).days
+                tree.insert("", tk.END, values=(book_id, title, borrower, owner, due, days))
+            
+            ttk.Label(window, text=f"共 {len(books)} 本逾期书籍", padding="10").pack(side=tk.LEFT)
         
-        ttk.Label(stats_frame, text=f"总共享次数: {total}").pack(side=tk.LEFT, padx=10)
-        ttk.Label(stats_frame, text=f"借阅中: {borrowing}").pack(side=tk.LEFT, padx=10)
+        self.db.submit(self.service.overdue_books, callback=show)
     
-    def show_borrow_records(self):
-        """显示我的借阅记录"""
-        # 创建新窗口
+    def show_reservations(self):
+        """显示我的预约，可以取消"""
         window = tk.Toplevel(self.root)
-        window.title("我的借阅记录")
-        window.geometry("800x500")
+        window.title("我的预约")
+        window.geometry("800x400")
         
-        # 创建框架
         frame = ttk.Frame(window, padding="10")
         frame.pack(fill=tk.BOTH, expand=True)
         
-        # 创建表格
-        columns = ("ID", "书籍ID", "书名", "借阅日期", "归还日期", "状态")
-        tree = ttk.Treeview(frame, columns=columns, show="headings", height=20)
-        
-        # 设置列标题
+        columns = ("书籍ID", "书名", "状态", "排队位置", "预约时间", "有效期至")
+        tree = ttk.Treeview(frame, columns=columns, show="headings", height=15)
         for col in columns:
             tree.heading(col, text=col)
-        
-        # 调整列宽
         tree.column("书名", width=200)
-        tree.column("ID", width=50)
         tree.column("书籍ID", width=60)
+        tree.column("排队位置", width=70)
         
-        # 滚动条
         scrollbar = ttk.Scrollbar(frame, orient=tk.VERTICAL, command=tree.yview)
         tree.configure(yscrollcommand=scrollbar.set)
-        
-        # 布局
         tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         
-        # 查询我的借阅记录
-        self.cursor.execute('''
-            SELECT sr.id, sr.book_id, sr.book_title, sr.borrow_date, sr.return_date, sr.status
-            FROM sharing_records sr
-            WHERE sr.borrower = ?
-            ORDER BY sr.borrow_date DESC
-        ''', (self.current_user,))
+        bottom = ttk.Frame(window, padding="10")
+        bottom.pack(fill=tk.X)
+        summary = ttk.Label(bottom)
+        summary.pack(side=tk.LEFT)
+        
+        def show(reservations):
+            if not window.winfo_exists():
+                return
+            tree.delete(*tree.get_children())
+            for reservation in reservations:
+                tree.insert("", tk.END, iid=str(reservation[0]), values=reservation)
+            summary.config(text=f"共 {len(reservations)} 个预约")
+        
+        def load():
+            self.db.submit(self.service.reservations, self.current_user, callback=show)
+        
+        def cancel():
+            selection = tree.selection()
+            if not selection:
+                messagebox.showwarning("警告", "请先选择一个预约", parent=window)
+                return
+            self.db.submit(self.service.cancel_reservation, self.current_user, int(selection[0]),
+                           callback=lambda cancelled: load(), write=True)
+        
+        ttk.Button(bottom, text="取消预约", command=cancel).pack(side=tk.RIGHT)
+        load()
+    
+    def check_due(self):
+        """处理已到期的借阅，然后定时到下一个到期事件"""
+        self._due_timer = None
+        self._due_running = True
+        
+        def done(result):
+            self._due_running = False
+            marked, _ = result
+            if marked:
+                self.status_label.config(text=f"{marked} 本书已逾期，可在“逾期书籍”中查看")
+            self.schedule_due_check()
+        
+        def failed(error):
+            self._due_running = False
+            self.status_label.config(text=f"到期检查失败: {error}")
+            self.schedule_due_check()
+        
+        self.db.submit(self.scheduler.run_due, callback=done, errback=failed, write=True)
+    
+    def schedule_due_check(self):
+        """按堆顶事件的时间重新设置到期检查的定时器"""
+        if self._due_running:
+            return
+        if self._due_timer is not None:
+            self.root.after_cancel(self._due_timer)
+        delay = min(self.scheduler.seconds_until_next(), DUE_CHECK_MAX_DELAY)
+        self._due_timer = self.root.after(int(delay * 1000) + 1, self.check_due)
+    
+    def track_due(self, delta):
+        """借出的书加入到期调度；到期时间比当前定时器更早时重新定时"""
+        if not delta.row or not delta.row[7] or (delta.old_row and delta.old_row[7] == delta.row[7]):
+            return
+        if self.scheduler.add_loan(delta.book_id, delta.row[6], delta.row[7]):
+            self.schedule_due_check()
+    
+    def refresh_recommendations(self):
+        """在后台更新一批有新借阅的书籍的推荐；一批已满时稍后继续，否则等下一次定时检查
+
+        计算只读，在单独的线程中执行，不占用读线程，也不排在写线程中让之后的翻页、搜索等待；只有写回结果是写任务。
+        """
+        self._recommend_timer = None
+        self._recommend_running = True
         
-        records = self.cursor.fetchall()
+        def computed(results):
+            self.db.submit(self.service.store_recommendations, results, callback=done, errback=failed, write=True)
         
-        # 添加到树形视图
-        for record in records:
-            tree.insert("", tk.END, values=record)
+        def done(count):
+            self._recommend_running = False
+            if count and self._shown_book:
+                self.show_similar(self._shown_book[0])
+            self.schedule_recommend(RECOMMEND_BATCH_GAP if count >= REFRESH_BATCH else RECOMMEND_INTERVAL)
         
-        # 统计信息
-        stats_frame = ttk.Frame(window, padding="10")
-        stats_frame.pack(fill=tk.X)
+        def failed(error):
+            self._recommend_running = False
+            self.schedule_recommend(RECOMMEND_INTERVAL)
+        
+        self.db.submit_job(self.service.compute_recommendations, callback=computed, errback=failed)
+    
+    def schedule_recommend(self, delay):
+        """delay 毫秒后更新推荐（正在更新时由它完成后重新定时）"""
+        if self._recommend_running:
+            return
+        if self._recommend_timer is not None:
+            self.root.after_cancel(self._recommend_timer)
+        self._recommend_timer = self.root.after(delay, self.refresh_recommendations)
+    
+    def track_loans(self, delta):
+        """借出一本书后稍后更新推荐"""
+        if delta.row and delta.row[6] and not (delta.old_row and delta.old_row[6] == delta.row[6]):
+            self.schedule_recommend(RECOMMEND_DELAY)
+    
+    def search_books(self):
+        """搜索书籍：焦点移到搜索框"""
+        self.search_entry.focus_set()
+        self.search_entry.select_range(0, tk.END)
+    
+    def on_search_changed(self, *args):
+        """搜索框内容改变：缓存能回答时立即显示，否则停顿 SEARCH_DEBOUNCE 毫秒后再查询"""
+        if self._clearing_search:
+            return
+        if self._search_timer is not None:
+            self.root.after_cancel(self._search_timer)
+            self._search_timer = None
         
-        # 查询统计
-        self.cursor.execute("SELECT COUNT(*) FROM sharing_records WHERE borrower = ?", (self.current_user,))
-        total = self.cursor.fetchone()[0]
+        search_term = self.search_var.get().strip()
+        if not search_term:
+            self.cancel_search()
+            self.load_books()
+            return
         
-        self.cursor.execute("SELECT COUNT(*) FROM sharing_records WHERE borrower = ? AND status = '借阅中'", (self.current_user,))
-        borrowing = self.cursor.fetchone()[0]
+        ids = self.search_cache.get(SearchCache.terms(search_term))
+        if ids is not None:
+            self.cancel_search()
+            self.show_search_results(ids, complete=len(ids) < SEARCH_LIMIT)
+            return
+        self._search_timer = self.root.after(SEARCH_DEBOUNCE, self.run_search, search_term)
+    
+    def cancel_search(self):
+        """取消尚未完成的搜索"""
+        if self._search_job is not None:
+            self.db.cancel(self._search_job)
+            self._search_job = None
+    
+    def run_search(self, search_term):
+        """查询数据库：先不排序地取第一批结果立即显示，再按相关度排序取全部结果"""
+        self._search_timer = None
+        terms = SearchCache.terms(search_term)
+        
+        def texts(fields):
+            return {row[0]: "\n".join(value or "" for value in row[1:]).lower() for row in fields}
+        
+        def complete(search_term):
+            # 在工作线程中执行：按相关度排序的结果；结果完整时同时取可搜索文本
+            ids = self.service.search(search_term)
+            return ids, texts(self.service.search_fields(ids)) if len(ids) < SEARCH_LIMIT else None
+        
+        def first_batch(search_term):
+            # 结果不满一批时就是全部结果，直接排序
+            ids = self.service.search(search_term, SEARCH_FIRST_BATCH, ranked=False)
+            if len(ids) < SEARCH_FIRST_BATCH:
+                return complete(search_term) + (True,)
+            return ids, None, False
+        
+        def ranked(result):
+            self._search_job = None
+            ids, fields = result
+            self.search_cache.put(terms, ids, fields)
+            self.show_search_results(ids, complete=fields is not None)
+        
+        def shown(result):
+            ids, fields, done = result
+            if done:
+                ranked((ids, fields))
+                return
+            # 第一批先显示，排序完成后替换；新的输入会取消尚未完成的排序
+            self.show_search_results(ids, complete=False, ranking=True)
+            self._search_job = self.db.submit(complete, search_term, callback=ranked, key="search")
+        
+        # 新的搜索会取消尚未完成的上一次搜索
+        self.status_label.config(text=f"正在搜索: {search_term}")
+        self._search_job = self.db.submit(first_batch, search_term, callback=shown, key="search")
+    
+    def show_search_results(self, ids, complete=True, ranking=False):
+        """在列表中显示搜索结果"""
+        total = self.book_list.reset_ids(ids)
         
-        ttk.Label(stats_frame, text=f"总借阅次数: {total}").pack(side=tk.LEFT, padx=10)
-        ttk.Label(stats_frame, text=f"借阅中: {borrowing}").pack(side=tk.LEFT, padx=10)
+        # 更新状态栏
+        if ranking:
+            self.status_label.config(text=f"已找到 {total} 本以上，正在按相关度排序…")
+        elif not complete:
+            self.status_label.config(text=f"显示最相关的 {total} 本书籍")
+        else:
+            self.status_label.config(text=f"找到 {total} 本相关书籍")
     
-    def search_books(self):
-        """搜索书籍"""
-        # 创建搜索对话框
-        search_term = simpledialog.askstring("搜索书籍", "请输入书名、作者或分类:")
-        
-        if search_term:
-            # 清空当前列表
-            for item in self.tree.get_children():
-                self.tree.delete(item)
-            
-            # 从数据库搜索数据
-            self.cursor.execute('''
-                SELECT id, title, author, category, status, owner, borrower, borrow_until 
-                FROM books 
-                WHERE title LIKE ? OR author LIKE ? OR category LIKE ?
-            ''', (f"%{search_term}%", f"%{search_term}%", f"%{search_term}%"))
-            
-            books = self.cursor.fetchall()
-            
-            # 添加到树形视图
-            for book in books:
-                self.tree.insert("", tk.END, values=book)
+    def import_catalog(self):
+        """从 CSV / JSON Lines 文件批量导入书目，拥有者为当前用户"""
+        path = filedialog.askopenfilename(
+            title="导入书目",
+            filetypes=[("书目文件", "*.csv *.jsonl *.ndjson"), ("所有文件", "*.*")],
+        )
+        if not path:
+            return
+        
+        # 进度窗口：导入在后台线程中进行，进度写入 state，由界面线程定时读取
+        window = tk.Toplevel(self.root)
+        window.title("导入书目")
+        window.geometry("420x120")
+        window.transient(self.root)
+        window.protocol("WM_DELETE_WINDOW", lambda: None)
+        
+        frame = ttk.Frame(window, padding="10")
+        frame.pack(fill=tk.BOTH, expand=True)
+        ttk.Label(frame, text=os.path.basename(path)).pack(anchor=tk.W)
+        bar = ttk.Progressbar(frame, mode="determinate", maximum=100, length=400)
+        bar.pack(fill=tk.X, pady=5)
+        label = ttk.Label(frame, text="正在读取…")
+        label.pack(anchor=tk.W)
+        
+        state = {"progress": None, "running": True}
+        
+        def progress(*values):
+            state["progress"] = values
+        
+        def watch():
+            if not state["running"] or not window.winfo_exists():
+                return
+            if state["progress"]:
+                done, total, rows, inserted, duplicates, invalid = state["progress"]
+                bar["value"] = done * 100 // total if total else 100
+                label.config(text=f"已读 {rows} 行，新增 {inserted}，重复 {duplicates}，无效 {invalid}")
+            window.after(100, watch)
+        
+        def finish():
+            state["running"] = False
+            if window.winfo_exists():
+                window.destroy()
+        
+        def done(result):
+            finish()
+            if result.already_done:
+                messagebox.showinfo("导入书目", "该文件已完整导入过")
+                return
+            resumed = f"（从第 {result.resumed_from + 1} 行继续）" if result.resumed_from else ""
+            messagebox.showinfo(
+                "导入书目",
+                f"共 {result.rows} 行{resumed}：新增 {result.inserted}，重复 {result.duplicates}，无效 {result.invalid}",
+            )
+            self.load_books()
+        
+        def failed(error):
+            finish()
+            messagebox.showerror("错误", f"导入失败（再次导入该文件会从中断处继续）: {error}")
+            self.load_books()
+        
+        # 导入耗时较长，在单独的线程中执行，不占用写线程和读线程：每批各自通过写连接提交，
+        # 期间界面上的其他读写可以穿插执行；进度由界面线程定时读取，完成后的回调由 poll_db 执行
+        self.db.submit_job(partial(import_books, progress=progress), self.service, path, self.current_user,
+                           callback=done, errback=failed)
+        watch()
+    
+    def export_table(self, table, name):
+        """把整张表导出为 CSV / JSON Lines / 列式文件（按扩展名选择格式）"""
+        path = filedialog.asksaveasfilename(
+            title=f"导出{name}",
+            initialfile=table + FORMATS["csv"],
+            defaultextension=FORMATS["csv"],
+            filetypes=[("CSV", "*.csv"), ("JSON Lines", "*.jsonl"), ("列式格式", "*.bkc")],
+        )
+        if not path:
+            return
+        
+        # 导出在单独的线程和只读连接的快照中进行，不占用读线程和连接池，也不阻塞写入；
+        # 已导出的行数由界面线程定时显示在状态栏，完成后的回调由 poll_db 执行
+        state = {"rows": 0, "running": True}
+        
+        def progress(_, rows):
+            state["rows"] = rows
+        
+        def watch():
+            if state["running"]:
+                self.status_label.config(text=f"正在导出{name}: {state['rows']} 行")
+                self.root.after(200, watch)
+        
+        def done(results):
+            state["running"] = False
+            result = results[0]
+            self.status_label.config(text=f"已导出 {result.rows} 条{name}")
+            messagebox.showinfo(f"导出{name}", f"已导出 {result.rows} 条{name}到\n{result.path}")
+        
+        def failed(error):
+            state["running"] = False
+            self.status_label.config(text="导出失败")
+            messagebox.showerror("错误", f"导出失败: {error}")
+        
+        self.db.submit_job(partial(export_tables, progress=progress), self.service, [(table, path)],
+                           callback=done, errback=failed)
+        watch()
+    
+    def show_diagnostics(self):
+        """诊断信息：各语句和处理函数的耗时统计、最近的慢查询及其执行计划，每秒刷新"""
+        window = tk.Toplevel(self.root)
+        window.title("诊断信息")
+        window.geometry("1100x650")
+        profiler = self.profiler
+        
+        # 工具栏：抽样比例、清空、导出
+        toolbar = ttk.Frame(window, padding="10 10 10 0")
+        toolbar.pack(fill=tk.X)
+        ttk.Label(toolbar, text="记录:").pack(side=tk.LEFT)
+        rates = dict(PROFILE_RATES)
+        current = next((label for label, rate in PROFILE_RATES if rate == profiler.sample_rate),
+                       f"抽样 {profiler.sample_rate:.0%}")
+        rate_var = tk.StringVar(value=current)
+        rate_box = ttk.Combobox(toolbar, textvariable=rate_var, values=list(rates), state="readonly", width=10)
+        rate_box.pack(side=tk.LEFT, padx=5)
+        rate_box.bind("<<ComboboxSelected>>", lambda e: setattr(profiler, "sample_rate", rates[rate_var.get()]))
+        summary_label = ttk.Label(toolbar)
+        summary_label.pack(side=tk.LEFT, padx=10)
+        ttk.Button(toolbar, text="导出 Prometheus…",
+                   command=partial(self.export_profile, "prometheus", window)).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(toolbar, text="导出 JSON…", command=partial(self.export_profile, "json", window)).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(toolbar, text="清空", command=lambda: (profiler.reset(), refresh(False))).pack(side=tk.RIGHT, padx=5)
+        
+        panes = ttk.PanedWindow(window, orient=tk.VERTICAL)
+        panes.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        
+        # 耗时统计，按总耗时排序
+        metrics_frame = ttk.Frame(panes)
+        columns = ("类型", "名称", "次数", "总计ms", "平均ms", "p50ms", "p99ms", "最长ms", "行数")
+        metrics = ttk.Treeview(metrics_frame, columns=columns, show="headings", height=14)
+        for col in columns:
+            metrics.heading(col, text=col)
+            metrics.column(col, width=70, anchor=tk.E)
+        metrics.column("类型", anchor=tk.W)
+        metrics.column("名称", width=480, anchor=tk.W)
+        metrics_scrollbar = ttk.Scrollbar(metrics_frame, orient=tk.VERTICAL, command=metrics.yview)
+        metrics.configure(yscrollcommand=metrics_scrollbar.set)
+        metrics.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        metrics_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        panes.add(metrics_frame, weight=3)
+        
+        # 慢查询，选中后在下方显示完整的 SQL、参数和执行计划
+        slow_frame = ttk.Frame(panes)
+        slow_columns = ("时间", "耗时ms", "行数", "SQL")
+        slow = ttk.Treeview(slow_frame, columns=slow_columns, show="headings", height=6)
+        for col in slow_columns:
+            slow.heading(col, text=col)
+            slow.column(col, width=80)
+        slow.column("时间", width=150)
+        slow.column("SQL", width=750)
+        slow.pack(fill=tk.BOTH, expand=True)
+        detail = tk.Text(slow_frame, height=8, wrap=tk.WORD)
+        detail.pack(fill=tk.X, pady=(5, 0))
+        panes.add(slow_frame, weight=2)
+        
+        kinds = {"query": "SQL", "handler": "界面操作", "callback": "回调", "job": "后台任务"}
+        entries = []
+        
+        def show_slow(event):
+            selection = slow.selection()
+            if not selection:
+                return
+            entry = entries[slow.index(selection[0])]
+            detail.delete("1.0", tk.END)
+            detail.insert(tk.END, f"{entry['sql']}\n\n参数: {entry['params']}\n\n执行计划:\n" + "\n".join(entry["plan"]))
+        
+        slow.bind("<<TreeviewSelect>>", show_slow)
+        
+        def refresh(repeat=True):
+            if not window.winfo_exists():
+                return
+            top = metrics.yview()[0]
+            metrics.delete(*metrics.get_children())
+            for metric in profiler.snapshot():
+                metrics.insert("", tk.END, values=(
+                    kinds[metric["kind"]], metric["name"], metric["count"], f"{metric['seconds'] * 1000:.1f}",
+                    f"{metric['seconds'] / metric['count'] * 1000:.2f}", f"{metric['p50'] * 1000:.2f}",
+                    f"{metric['p99'] * 1000:.2f}", f"{metric['max'] * 1000:.2f}", metric["rows"],
+                ))
+            metrics.yview_moveto(top)
             
-            # 更新状态栏
-            self.status_label.config(text=f"找到 {len(books)} 本相关书籍")
+            # 慢查询有变化时才重建列表，以免丢失选中的行
+            latest = profiler.slow_queries()
+            if latest != entries:
+                entries[:] = latest
+                slow.delete(*slow.get_children())
+                for entry in entries:
+                    slow.insert("", tk.END, values=(entry["time"], f"{entry['seconds'] * 1000:.0f}", entry["rows"], entry["sql"]))
+            summary_label.config(
+                text=f"自 {profiler.since:%H:%M:%S} 起，慢查询阈值 {profiler.slow_ms}ms，最近 {len(entries)} 条慢查询"
+            )
+            if repeat:
+                window.after(DIAGNOSTICS_REFRESH, refresh)
+        
+        refresh()
+    
+    def export_profile(self, fmt, parent=None):
+        """把性能剖析结果保存为 JSON 或 Prometheus 文本格式"""
+        extension = ".json" if fmt == "json" else ".prom"
+        path = filedialog.asksaveasfilename(
+            parent=parent,
+            title="导出诊断信息",
+            initialfile="profile" + extension,
+            defaultextension=extension,
+            filetypes=[("JSON", "*.json")] if fmt == "json" else [("Prometheus 文本格式", "*.prom"), ("文本文件", "*.txt")],
+        )
+        if not path:
+            return
+        try:
+            with open(path, "w", encoding="utf-8") as file:
+                if fmt == "json":
+                    json.dump(self.profiler.to_json(), file, ensure_ascii=False, indent=2)
+                else:
+                    file.write(self.profiler.to_prometheus())
+        except OSError as error:
+            messagebox.showerror("错误", f"导出失败: {error}", parent=parent)
+            return
+        self.status_label.config(text=f"诊断信息已导出到 {path}")
     
     def __del__(self):
         """析构函数，关闭数据库连接"""
-        if hasattr(self, 'conn'):
-            self.conn.close()
+        if hasattr(self, 'db'):
+            self.db.close()
+            self.service.close()
+
+class VirtualBookList:
+    """虚拟书籍列表：按 id 键集分页读取，复用固定数量的表格行
+
+    所有查询都通过 BookService 在后台执行，未读到的行先显示占位文字，数据到达后再填入。
+    """
+    PLACEHOLDER = ("", "加载中…")
+
+    def __init__(self, tree, scrollbar, db, service, page_size=100, max_pages=8):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.db = db
+        self.service = service
+        self.page_size = page_size
+        self.max_pages = max_pages
+
+        # 固定的行池，数量等于表格可见行数
+        self.visible_rows = int(tree.cget("height"))
+        self.pool = [tree.insert("", tk.END, values=()) for _ in range(self.visible_rows)]
+        self.attached = [True] * self.visible_rows
+
+        # 分页状态；ids 不为 None 时按给定顺序显示这些书籍，否则按 id 显示全部书籍
+        self.ids = None
+        self.total = 0
+        self.top = 0
+        self.pages = OrderedDict()
+        self.anchors = {0: 0}
+        self.loading = set()
+        self.generation = 0
+
+        # 选中的书籍 id（滚动后行会被复用，需要按 id 恢复选中）；按住 Ctrl/Shift 点击时保留滚出窗口的选中
+        self.selected_ids = set()
+        self._expected_selection = None
+        self._extending = False
+
+        self.scrollbar.configure(command=self.yview)
+        self.tree.bind("<<TreeviewSelect>>", self._on_select, add="+")
+        self.tree.bind("<MouseWheel>", self._on_mousewheel)
+        self.tree.bind("<Button-4>", lambda e: self._scroll_by(-3))
+        self.tree.bind("<Button-5>", lambda e: self._scroll_by(3))
+        self.tree.bind("<Up>", lambda e: self._on_arrow(-1))
+        self.tree.bind("<Down>", lambda e: self._on_arrow(1))
+        self.tree.bind("<Prior>", lambda e: self._scroll_by(-self.visible_rows))
+        self.tree.bind("<Next>", lambda e: self._scroll_by(self.visible_rows))
+        self.tree.bind("<Control-Button-1>", self._extend_selection)
+        self.tree.bind("<Shift-Button-1>", self._extend_selection)
+        self.tree.bind("<Control-a>", self.select_all)
+
+    def _clear(self):
+        """丢弃缓存页；进行中的读取结果按 generation 作废"""
+        self.generation += 1
+        self.pages.clear()
+        self.anchors = {0: 0}
+        self.loading.clear()
+
+    def reset(self, total=None, then=None):
+        """显示全部书籍并回到第一页，返回书籍数量
+
+        未传入数量时在一个后台任务中读取数量和第一页，到达后显示并调用 then(数量)。
+        """
+        self._clear()
+        self.ids = None
+        self.top = 0
+        self.selected_ids.clear()
+
+        if total is None:
+            self.total = 0
+            generation = self.generation
+
+            def loaded(result):
+                if generation != self.generation:
+                    return
+                self.total, rows = result
+                self._store_page(0, rows)
+                self.render()
+                if then:
+                    then(self.total)
+
+            self.db.submit(self._query_first, callback=loaded)
+        else:
+            self.total = total
+        self.render()
+        return self.total
+
+    def reset_ids(self, ids):
+        """按给定顺序显示一组书籍（如按相关度排序的搜索结果），返回书籍数量"""
+        self._clear()
+        self.ids = list(ids)
+        self.total = len(self.ids)
+        self.top = 0
+        self.selected_ids.clear()
+        self.render()
+        return self.total
+
+    def refresh(self):
+        """保留当前位置，丢弃缓存后重新绘制"""
+        self._clear()
+        if self.ids is not None:
+            self.total = len(self.ids)
+        else:
+            self._request_count()
+        self.render()
+
+    def _request_count(self):
+        """在后台统计书籍数量"""
+        generation = self.generation
+
+        def counted(total):
+            if generation == self.generation:
+                self.total = total
+                self.render()
+
+        self.db.submit(self.service.count_books, callback=counted)
+
+    def _query_first(self):
+        """(书籍数量, 第一页)"""
+        return self.service.count_books(), self.service.list_books(0, self.page_size)
+
+    def _query_page(self, anchor, page_no):
+        """按键集读取一页：WHERE id > ? LIMIT n；锚点未知时（拖动滚动条跳到远处）先由 id 分块计数定位，返回 (锚点, 行)"""
+        if anchor is None:
+            anchor = self.service.book_id_at(page_no * self.page_size - 1)
+            if anchor is None:
+                return None, []
+        return anchor, self.service.list_books(anchor, self.page_size)
+
+    def _query_ids(self, ids):
+        """按 id 读取一页，并保持给定的顺序"""
+        return None, self.service.books_by_ids(ids)
+
+    def _load(self, page_no):
+        """在后台读取一页（也用于预取）"""
+        if page_no in self.pages or page_no in self.loading or page_no * self.page_size >= self.total:
+            return
+        self.loading.add(page_no)
+
+        if self.ids is not None:
+            ids = tuple(self.ids[page_no * self.page_size:(page_no + 1) * self.page_size])
+            loader = partial(self._query_ids, ids=ids)
+        else:
+            loader = partial(self._query_page, anchor=self.anchors.get(page_no), page_no=page_no)
+        self.db.submit(loader, callback=partial(self._on_page, self.generation, page_no))
+
+    def _on_page(self, generation, page_no, result):
+        """一页数据到达"""
+        if generation != self.generation:
+            return
+        self.loading.discard(page_no)
+        anchor, rows = result
+        if anchor is not None:
+            self.anchors[page_no] = anchor
+        self._store_page(page_no, rows)
+
+        # 只有落在可见窗口内的页才需要重绘
+        first = self.top // self.page_size
+        last = (self.top + self.visible_rows - 1) // self.page_size
+        if first <= page_no <= last:
+            self.render()
+
+    def _store_page(self, page_no, rows):
+        """缓存一页数据，超出上限时淘汰最久未用的页"""
+        self.pages[page_no] = rows
+        self.pages.move_to_end(page_no)
+        if self.ids is None and len(rows) == self.page_size:
+            self.anchors[page_no + 1] = rows[-1][0]
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+
+    def _get_page(self, page_no):
+        """取得已缓存的一页；未缓存时在后台读取并返回 None"""
+        rows = self.pages.get(page_no)
+        if rows is None:
+            self._load(page_no)
+            return None
+        self.pages.move_to_end(page_no)
+        return rows
+
+    def render(self):
+        """把当前窗口内的数据填入行池"""
+        self.top = max(0, min(self.top, self.total - self.visible_rows))
+        selection = []
+
+        for i, item in enumerate(self.pool):
+            index = self.top + i
+            if index >= self.total:
+                if self.attached[i]:
+                    self.tree.detach(item)
+                    self.attached[i] = False
+                continue
+
+            rows = self._get_page(index // self.page_size)
+            offset = index % self.page_size
+            if rows is None:
+                values = self.PLACEHOLDER
+            elif offset < len(rows):
+                values = ["" if value is None else value for value in rows[offset]]
+            else:
+                values = ()
+
+            self.tree.item(item, values=values)
+            if not self.attached[i]:
+                self.tree.move(item, "", i)
+                self.attached[i] = True
+            if values and values[0] in self.selected_ids:
+                selection.append(item)
+
+        if tuple(selection) != tuple(self.tree.selection()):
+            self._expected_selection = tuple(selection)
+            self.tree.selection_set(selection)
+
+        # 更新滚动条位置
+        if self.total:
+            self.scrollbar.set(self.top / self.total, min(1.0, (self.top + self.visible_rows) / self.total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+        # 预取下一页
+        last_page = min(self.top + self.visible_rows, max(self.total - 1, 0)) // self.page_size
+        self._load(last_page + 1)
+
+    def apply_delta(self, delta):
+        """按行级变更就地修补缓存页和可见行"""
+        self._apply(delta)
+        self.render()
+
+    def apply_deltas(self, deltas):
+        """批量操作的一组变更：逐条修补缓存页，最后只绘制一次"""
+        for delta in deltas:
+            self._apply(delta)
+        self.render()
+
+    def _apply(self, delta):
+        """按一条变更修补缓存页"""
+        if delta.op == "update":
+            self._replace_row(delta.book_id, delta.row)
+        elif delta.op == "insert":
+            # 搜索结果在下次刷新时才显示新书
+            if self.ids is not None:
+                return
+            # 新书的 id 最大，只会追加在最后一页
+            page_no, offset = divmod(self.total, self.page_size)
+            rows = self.pages.get(page_no)
+            if rows is not None and len(rows) == offset:
+                rows.append(delta.row)
+                if len(rows) == self.page_size:
+                    self.anchors[page_no + 1] = delta.book_id
+            self.total += 1
+        elif delta.op == "delete":
+            self.selected_ids.discard(delta.book_id)
+            page_no = self._locate_page(delta.book_id)
+            if page_no is None:
+                return
+            # 删除后其后各页整体前移一行，丢弃受影响的缓存页与锚点
+            self.generation += 1
+            self.loading.clear()
+            for stale in [p for p in self.pages if p >= page_no]:
+                del self.pages[stale]
+            for stale in [p for p in self.anchors if p > page_no]:
+                del self.anchors[stale]
+            self.total -= 1
+
+    def ids_near(self, book_id, radius):
+        """已读到的页中，某本书前后各 radius 行的书籍 id（包括它自己）"""
+        for page_no, rows in self.pages.items():
+            for offset, row in enumerate(rows):
+                if row[0] != book_id:
+                    continue
+                index = page_no * self.page_size + offset
+                ids = []
+                for near in range(max(index - radius, 0), min(index + radius + 1, self.total)):
+                    rows_near = self.pages.get(near // self.page_size)
+                    if rows_near is not None and near % self.page_size < len(rows_near):
+                        ids.append(rows_near[near % self.page_size][0])
+                return ids
+        return [book_id]
+
+    def _replace_row(self, book_id, row):
+        """在缓存页中替换一行"""
+        for rows in self.pages.values():
+            for index, cached in enumerate(rows):
+                if cached[0] == book_id:
+                    rows[index] = row
+                    return
+
+    def _locate_page(self, book_id):
+        """根据锚点确定某本书所在的页；不在当前结果中时返回 None"""
+        if self.ids is not None:
+            if book_id not in self.ids:
+                return None
+            index = self.ids.index(book_id)
+            del self.ids[index]
+            return index // self.page_size
+        for page_no, rows in self.pages.items():
+            if rows and rows[0][0] <= book_id <= rows[-1][0]:
+                if any(r[0] == book_id for r in rows):
+                    return page_no
+                return None
+        anchors = sorted(self.anchors.items())
+        index = bisect.bisect_left([anchor for _, anchor in anchors], book_id) - 1
+        return anchors[max(index, 0)][0]
+
+    def yview(self, *args):
+        """滚动条回调"""
+        if not args:
+            return
+        if args[0] == "moveto":
+            self.top = int(float(args[1]) * self.total)
+        elif args[0] == "scroll":
+            step = int(args[1])
+            if args[2] == "pages":
+                step *= self.visible_rows
+            self.top += step
+        self.render()
+
+    def _scroll_by(self, rows):
+        self.top += rows
+        self.render()
+        return "break"
+
+    def _on_mousewheel(self, event):
+        return self._scroll_by(-3 if event.delta > 0 else 3)
+
+    def _on_arrow(self, step):
+        """方向键移动到窗口边缘时滚动列表，保持选中行跟随"""
+        selection = self.tree.selection()
+        if len(selection) != 1 or selection[0] not in self.pool:
+            return None
+        position = self.pool.index(selection[0])
+        at_edge = position == 0 if step < 0 else position == self.visible_rows - 1
+        if not at_edge:
+            return None
+
+        index = self.top + position + step
+        if not 0 <= index < self.total:
+            return "break"
+
+        # 选中相邻的书籍后再滚动一行（相邻页尚未读到时只滚动）
+        rows = self._get_page(index // self.page_size)
+        if rows is not None and index % self.page_size < len(rows):
+            self.selected_ids = {rows[index % self.page_size][0]}
+        self.top += step
+        self.render()
+        return "break"
+
+    def _extend_selection(self, event):
+        """Ctrl/Shift 点击：接下来的选择变化在原有选中的基础上增减（表格自己的绑定随后处理点击）"""
+        self._extending = True
+
+    def select_all(self, event=None):
+        """Ctrl+A：选中全部搜索结果；显示全部书籍时只选中窗口内的行"""
+        if self.ids is not None:
+            self.selected_ids = set(self.ids)
+        else:
+            self.selected_ids = {self.tree.item(item)["values"][0]
+                                 for item, attached in zip(self.pool, self.attached) if attached} - {""}
+        self.render()
+        return "break"
+
+    def _on_select(self, event):
+        """记录用户选中的书籍 id"""
+        selection = tuple(self.tree.selection())
+        if selection == self._expected_selection:
+            self._expected_selection = None
+            return
+        chosen = {self.tree.item(item)["values"][0] for item in selection} - {""}
+        if self._extending:
+            # 只有窗口内的行能被点击改变，滚出窗口的选中保持不变
+            visible = {self.tree.item(item)["values"][0] for item, attached in zip(self.pool, self.attached) if attached}
+            chosen |= self.selected_ids - visible
+            self._extending = False
+        self.selected_ids = chosen
+
+class RecordListWindow:
+    """共享记录窗口：一次读取一页，滚动接近底部时读取下一页；按状态、借阅日期筛选和排序都在数据库中完成
+
+    query(after=, status=, since=, until=, ascending=) 在后台线程中执行，返回 BookService 的 RecordPage；
+    第一页带有符合条件的记录总数和借阅中的数量，由 summary(total, borrowing) 生成底部的统计文字。
+    """
+    STATUS_FILTERS = ("全部", "借阅中", "已归还")
+    ORDERS = ("最新在前", "最早在前")
+
+    def __init__(self, root, db, title, columns, query, summary):
+        self.db = db
+        self.query = query
+        self.summary = summary
+        self.window = tk.Toplevel(root)
+        self.window.title(title)
+        self.window.geometry("800x500")
+
+        # 筛选条件：状态、借阅日期范围和排序，修改后从第一页重新读取
+        filter_frame = ttk.Frame(self.window, padding="10 10 10 0")
+        filter_frame.pack(fill=tk.X)
+        ttk.Label(filter_frame, text="状态:").pack(side=tk.LEFT)
+        self.status_var = tk.StringVar(value=self.STATUS_FILTERS[0])
+        status_box = ttk.Combobox(filter_frame, textvariable=self.status_var, values=self.STATUS_FILTERS,
+                                  state="readonly", width=8)
+        status_box.pack(side=tk.LEFT, padx=5)
+        status_box.bind("<<ComboboxSelected>>", lambda e: self.reload())
+        ttk.Label(filter_frame, text="借阅日期:").pack(side=tk.LEFT, padx=(10, 0))
+        self.since_var = tk.StringVar()
+        self.until_var = tk.StringVar()
+        for var, label in ((self.since_var, None), (self.until_var, "至")):
+            if label:
+                ttk.Label(filter_frame, text=label).pack(side=tk.LEFT)
+            entry = ttk.Entry(filter_frame, textvariable=var, width=12)
+            entry.pack(side=tk.LEFT, padx=5)
+            entry.bind("<Return>", lambda e: self.reload())
+        self.order_var = tk.StringVar(value=self.ORDERS[0])
+        order_box = ttk.Combobox(filter_frame, textvariable=self.order_var, values=self.ORDERS, state="readonly", width=10)
+        order_box.pack(side=tk.LEFT, padx=(10, 5))
+        order_box.bind("<<ComboboxSelected>>", lambda e: self.reload())
+        ttk.Button(filter_frame, text="查询", command=self.reload).pack(side=tk.LEFT, padx=5)
+
+        # 表格；点击“借阅日期”列标题切换排序
+        frame = ttk.Frame(self.window, padding="10")
+        frame.pack(fill=tk.BOTH, expand=True)
+        self.tree = ttk.Treeview(frame, columns=columns, show="headings", height=20)
+        for col in columns:
+            self.tree.heading(col, text=col)
+        self.tree.heading("借阅日期", command=self.toggle_order)
+        self.tree.column("书名", width=200)
+        self.tree.column("ID", width=50)
+        self.tree.column("书籍ID", width=60)
+        self.scrollbar = ttk.Scrollbar(frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=self._on_scroll)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        self.stats_label = ttk.Label(self.window, padding="10")
+        self.stats_label.pack(fill=tk.X)
+
+        # 每次重新查询 generation 加一，旧查询的结果到达时丢弃
+        self.generation = 0
+        self.next = None
+        self.loading = False
+        self.shown = 0
+        self.stats = ""
+        self.reload()
+
+    def reload(self):
+        """按当前的筛选条件从第一页重新读取"""
+        self.generation += 1
+        self.tree.delete(*self.tree.get_children())
+        self.next = None
+        self.shown = 0
+        self.stats_label.config(text="加载中…")
+        self._load(None)
+
+    def toggle_order(self):
+        """切换按借阅日期的排序方向"""
+        self.order_var.set(self.ORDERS[1] if self.order_var.get() == self.ORDERS[0] else self.ORDERS[0])
+        self.reload()
+
+    def _load(self, after):
+        """在后台读取 after 之后的一页"""
+        self.loading = True
+        status = self.status_var.get()
+        query = partial(
+            self.query, after=after,
+            status=None if status == self.STATUS_FILTERS[0] else status,
+            since=self.since_var.get().strip() or None,
+            until=self.until_var.get().strip() or None,
+            ascending=self.order_var.get() == self.ORDERS[1],
+        )
+        self.db.submit(query, callback=partial(self._on_page, self.generation),
+                       errback=partial(self._on_error, self.generation), key=self)
+
+    def _on_page(self, generation, page):
+        if generation != self.generation or not self.window.winfo_exists():
+            return
+        self.loading = False
+        for row in page.rows:
+            self.tree.insert("", tk.END, values=row)
+        self.shown += len(page.rows)
+        if page.total is not None:
+            self.stats = self.summary(page.total, page.borrowing)
+        self.next = page.next
+        more = "，滚动到底部继续加载" if self.next else ""
+        self.stats_label.config(text=f"{self.stats}    已显示: {self.shown}{more}")
+
+    def _on_error(self, generation, error):
+        if generation != self.generation or not self.window.winfo_exists():
+            return
+        self.loading = False
+        self.stats_label.config(text="查询失败")
+        if isinstance(error, ServiceError):
+            messagebox.showwarning("警告", str(error), parent=self.window)
+        elif self.db.on_error is not None:
+            self.db.on_error(error)
+
+    def _on_scroll(self, first, last):
+        """滚动条位置变化；接近底部且还有记录时读取下一页（第一页不满一屏时也会继续读取）"""
+        self.scrollbar.set(first, last)
+        if self.next is not None and not self.loading and float(last) >= RECORDS_LOAD_AT:
+            self._load(self.next)
 
 class BookDialog:
     """书籍信息对话框"""
-    def __init__(self, parent, title, **kwargs):
+    def __init__(self, parent, dialog_title, **kwargs):
         self.result = None
         
-        # 创建对话框
+        # 创建对话框（kwargs 中的 title 是书名，不能与对话框标题同名）
         self.dialog = tk.Toplevel(parent)
-        self.dialog.title(title)
+        self.dialog.title(dialog_title)
         self.dialog.geometry("400x500")
         self.dialog.transient(parent)
         self.dialog.grab_set()
@@ -711,31 +1932,76 @@ class BookDialog:
     
     def ok(self):
         """确定按钮"""
-        # 验证输入
-        if not self.title_entry.get():
-            messagebox.showwarning("警告", "书名不能为空")
+        # 验证输入（与服务使用同一套校验）
+        try:
+            self.result = validate_book({
+                'title': self.title_entry.get(),
+                'author': self.author_entry.get(),
+                'isbn': self.isbn_entry.get(),
+                'category': self.category_combobox.get(),
+                'publisher': self.publisher_entry.get(),
+                'publish_year': self.year_entry.get(),
+                'description': self.description_text.get(1.0, tk.END)
+            })
+        except ServiceError as error:
+            messagebox.showwarning("警告", str(error))
             return
         
-        if not self.author_entry.get():
-            messagebox.showwarning("警告", "作者不能为空")
-            return
+        self.dialog.destroy()
+    
+    def cancel(self):
+        """取消按钮"""
+        self.dialog.destroy()
+
+class BatchEditDialog:
+    """批量编辑对话框：只能修改多本书共有的字段，留空的字段保持不变"""
+    def __init__(self, parent, dialog_title):
+        self.result = None
         
+        self.dialog = tk.Toplevel(parent)
+        self.dialog.title(dialog_title)
+        self.dialog.geometry("400x220")
+        self.dialog.transient(parent)
+        self.dialog.grab_set()
+        
+        frame = ttk.Frame(self.dialog, padding="20")
+        frame.pack(fill=tk.BOTH, expand=True)
+        
+        ttk.Label(frame, text="分类:").grid(row=0, column=0, sticky=tk.W, pady=5)
+        self.category_combobox = ttk.Combobox(frame, values=["", "计算机", "文学", "历史", "经济", "科学", "艺术", "哲学", "其他"], width=28)
+        self.category_combobox.grid(row=0, column=1, sticky=(tk.W, tk.E), pady=5)
+        
+        ttk.Label(frame, text="出版社:").grid(row=1, column=0, sticky=tk.W, pady=5)
+        self.publisher_entry = ttk.Entry(frame, width=30)
+        self.publisher_entry.grid(row=1, column=1, sticky=(tk.W, tk.E), pady=5)
+        
+        ttk.Label(frame, text="出版年份:").grid(row=2, column=0, sticky=tk.W, pady=5)
+        self.year_entry = ttk.Entry(frame, width=30)
+        self.year_entry.grid(row=2, column=1, sticky=(tk.W, tk.E), pady=5)
+        
+        ttk.Label(frame, text="留空的字段保持不变").grid(row=3, column=0, columnspan=2, sticky=tk.W, pady=5)
+        
+        button_frame = ttk.Frame(frame)
+        button_frame.grid(row=4, column=0, columnspan=2, pady=10)
+        
+        ttk.Button(button_frame, text="确定", command=self.ok).pack(side=tk.LEFT, padx=10)
+        ttk.Button(button_frame, text="取消", command=self.cancel).pack(side=tk.LEFT, padx=10)
+        
+        frame.columnconfigure(1, weight=1)
+        
+        self.dialog.wait_window()
+    
+    def ok(self):
+        """确定按钮"""
         try:
-            year = int(self.year_entry.get()) if self.year_entry.get() else 0
-        except ValueError:
-            messagebox.showwarning("警告", "出版年份必须是数字")
-            return
-        
-        # 保存结果
-        self.result = {
-            'title': self.title_entry.get(),
-            'author': self.author_entry.get(),
-            'isbn': self.isbn_entry.get(),
-            'category': self.category_combobox.get(),
-            'publisher': self.publisher_entry.get(),
-            'publish_year': year,
-            'description': self.description_text.get(1.0, tk.END).strip()
-        }
+            self.result = validate_batch_fields({
+                'category': self.category_combobox.get(),
+                'publisher': self.publisher_entry.get(),
+                'publish_year': self.year_entry.get(),
+            })
+        except ServiceError as error:
+            messagebox.showwarning("警告", str(error))
+            return
         
         self.dialog.destroy()
     
@@ -743,10 +2009,23 @@ class BookDialog:
         """取消按钮"""
         self.dialog.destroy()
 
-def main():
+def main(argv=None):
     """主函数"""
+    parser = argparse.ArgumentParser(description="图书共享管理系统")
+    parser.add_argument("--db", default=DB_PATH, help="数据库文件")
+    parser.add_argument("--shards", default="libraries", help="多馆分库的根目录（bookshard.py）")
+    parser.add_argument("--library", help="馆名：打开该馆所在分片中的数据库文件，代替 --db")
+    args = parser.parse_args(argv)
+
+    db_path, title = args.db, "图书共享管理系统"
+    if args.library:
+        try:
+            db_path = library_db(args.shards, args.library)
+        except ServiceError as error:
+            parser.error(str(error))
+        title = f"图书共享管理系统 - {args.library}"
     root = tk.Tk()
-    app = BookSharingSystem(root)
+    app = BookSharingSystem(root, db_path, title)
     root.mainloop()
 
 if __name__ == "__main__":
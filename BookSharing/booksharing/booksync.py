@@ -0,0 +1,452 @@
+﻿"""离线优先的复制：图书共享节点之间按变更日志交换增量
+
+    python booksync.py --db a.db sync b.db        # 两个数据库文件双向同步（例如放在共享文件夹或 U 盘上的分馆数据库）
+    python booksync.py --db a.db status           # 本节点编号、日志位置和从各节点收到的位置
+    python booksync.py --db copy.db new-node      # 复制数据库文件建立新节点后执行一次
+
+每个数据库是一个节点（sync_node 保存节点编号和 Lamport 逻辑时钟，见 bookdb 的迁移 12）。
+book_items、loans 上的触发器在本地修改时推进时钟，把行的时间戳 (时钟, 节点) 记在 sync_rows 中，
+并向 change_log 追加一条，序号单调递增。行在各节点的 id 不同，节点之间用全局键 (创建它的节点, 它在那里的 id) 对应；
+用户和分类按名称对应。
+
+同步由接收方拉取：接收方给出上次从对方收到的位置，对方读取此后的日志，把涉及的行的当前内容打成 zlib 压缩的 JSON 批次
+（同一行多次修改只发送一次，从接收方收到的修改不再发回）；接收方在一个写事务中应用一批，并在同一个事务中记下新的位置，
+中断后重新同步不会漏掉或重复应用。读取的日志条数与变更的数量成正比，与数据库大小无关；
+只有第一次从某个节点同步时没有位置，对方按 id 顺序分批发送全部书籍和共享记录，第一批同时带上全部已删除书籍的墓碑。
+复制数据库文件建立新节点时，须复制已升级到版本 12 的数据库，再对副本执行 new-node；
+在各自升级前复制的两个数据库节点编号不同，原有的同一行会被当作两行。
+
+冲突按确定的规则处理，各节点收到同样的变更后得到同样的结果：
+同一行取时间戳大的版本（后写者胜，时钟相同时比较节点编号）；删除的书籍不会被其他节点的修改恢复；
+两个节点同时借出同一本书时，书籍行胜出的借阅人保留借阅，另一条借阅中的共享记录按借阅当天归还处理，并给借阅人写入提醒。
+预约和提醒只在本节点有效，不参与同步。
+"""
+import argparse
+from datetime import datetime
+import json
+import sys
+import time
+import uuid
+import zlib
+
+from bookdb import (BORROWING, DB_PATH, RETURNED, SHARED, ConnectionManager, archive_tables, category_id, from_day,
+                    loan_union, migrate, user_id)
+
+# 每批最多读取的变更日志条数（第一次同步时为每批的书籍或共享记录数）
+BATCH_SIZE = 2000
+
+# zlib 压缩级别
+COMPRESS_LEVEL = 6
+
+# 同步冲突中被取消的借阅写给借阅人的提醒类型
+SYNC_CONFLICT = "借阅冲突"
+
+# 发送的书籍字段：全局键、时间戳之后依次为书名、作者、ISBN、分类、出版社、出版年份、状态码、拥有者、借阅人、应还日期、简介
+BOOK_SELECT = '''
+    SELECT b.id, COALESCE(s.node, :node), COALESCE(s.origin_id, b.id), COALESCE(s.clock, 0), COALESCE(s.writer, :node),
+           b.title, b.author, b.isbn, c.name, b.publisher, b.publish_year, b.status_code, o.name, u.name,
+           b.borrow_until, b.description
+    FROM book_items b
+    LEFT JOIN sync_rows s ON s.tbl = 'book_items' AND s.row_id = b.id
+    LEFT JOIN categories c ON c.id = b.category_id
+    JOIN users o ON o.id = b.owner_id
+    LEFT JOIN users u ON u.id = b.borrower_id
+'''
+
+# 发送的共享记录字段（表名写作 {loans}，见 loan_union）：全局键、时间戳、书籍的全局键、借阅人、借阅日期、归还日期、状态码
+LOAN_SELECT = '''
+    SELECT l.id, COALESCE(s.node, :node), COALESCE(s.origin_id, l.id), COALESCE(s.clock, 0), COALESCE(s.writer, :node),
+           COALESCE(sb.node, :node), COALESCE(sb.origin_id, l.book_id), u.name, l.borrow_date, l.return_date,
+           l.status_code
+    FROM {{loans}} l
+    LEFT JOIN sync_rows s ON s.tbl = 'loans' AND s.row_id = l.id
+    LEFT JOIN sync_rows sb ON sb.tbl = 'book_items' AND sb.row_id = l.book_id
+    JOIN users u ON u.id = l.borrower_id
+    WHERE {condition}
+'''
+
+
+def encode(message):
+    """消息编码为压缩的 JSON"""
+    return zlib.compress(json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+                         COMPRESS_LEVEL)
+
+
+def decode(payload):
+    """解码 encode 的结果"""
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+
+def node_id(conn):
+    """本节点的编号"""
+    return conn.execute("SELECT node FROM sync_node").fetchone()[0]
+
+
+def _loan_rows(conn, node, condition, params, limit=-1):
+    """按条件读取共享记录（含已归档的），按 id 排序
+
+    各表都按主键顺序读取，SQLite 把它们归并起来（MERGE UNION ALL），取够 limit 条就停止。
+    """
+    sql = loan_union(conn, LOAN_SELECT.format(condition=condition)) + " ORDER BY 1 LIMIT :limit"
+    return conn.execute(sql, dict(params, node=node, limit=limit)).fetchall()
+
+
+def _snapshot(conn, node, cursor, limit):
+    """第一次同步：按 id 顺序发送一批书籍，书籍发完后发送共享记录；返回 (书籍, 墓碑, 共享记录, 下一个位置)
+
+    删除的书籍不在发送的书籍中，删除它的日志又在起始位置之前，所以第一批同时发送全部墓碑（包括从其他节点收到的），
+    否则对方从复制来的数据库中保留的这本书不会被删除。墓碑只有全局键和时间戳，不分批。
+    """
+    seq, book_after, loan_after = cursor
+    deleted = []
+    if book_after == 0 and loan_after == 0:
+        deleted = conn.execute(
+            "SELECT node, origin_id, clock, writer FROM sync_rows WHERE tbl = 'book_items' AND deleted = 1"
+        ).fetchall()
+    if loan_after == 0:
+        books = conn.execute(BOOK_SELECT + "WHERE b.id > :after ORDER BY b.id LIMIT :limit",
+                             {"node": node, "after": book_after, "limit": limit}).fetchall()
+        if books:
+            return books, deleted, [], [seq, books[-1][0], 0]
+    loans = _loan_rows(conn, node, "l.id > :after", {"after": loan_after}, limit)
+    if loans:
+        return [], deleted, loans, [seq, book_after, loans[-1][0]]
+    return [], deleted, [], [seq, None, None]
+
+
+def changes(conn, peer, cursor, limit=BATCH_SIZE):
+    """节点 peer 从 cursor 之后需要的一批变更
+
+    cursor 为 [日志序号, 书籍 id, 共享记录 id]，后两项不为 None 时表示第一次同步还没有发送完全部数据；
+    cursor 为 None 时从头开始第一次同步。
+    """
+    node = node_id(conn)
+    if cursor is None:
+        cursor = [conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0], 0, 0]
+    if cursor[1] is not None:
+        # 全部数据发完后还要接着发送第一批之后日志中的变更
+        books, deleted, loans, cursor = _snapshot(conn, node, cursor, limit)
+        more = True
+    else:
+        entries = conn.execute(
+            "SELECT seq, tbl, row_id, origin FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?", (cursor[0], limit)
+        ).fetchall()
+        # 同一行只看最后一条日志；最后一次修改来自 peer 的行对方已经有了
+        latest = {(tbl, row_id): origin for _, tbl, row_id, origin in entries}
+        book_ids = [row_id for (tbl, row_id), origin in latest.items() if tbl == "book_items" and origin != peer]
+        loan_ids = [row_id for (tbl, row_id), origin in latest.items() if tbl == "loans" and origin != peer]
+        ids = json.dumps(book_ids)
+        books = conn.execute(BOOK_SELECT + "WHERE b.id IN (SELECT value FROM json_each(:ids)) ORDER BY b.id",
+                             {"node": node, "ids": ids}).fetchall()
+        # CROSS JOIN 固定由 id 列表逐个查找，否则 SQLite 会按主键前缀 tbl 扫描全部书籍的记录
+        deleted = conn.execute('''
+            SELECT s.node, s.origin_id, s.clock, s.writer FROM json_each(?) j
+            CROSS JOIN sync_rows s ON s.tbl = 'book_items' AND s.row_id = j.value
+            WHERE s.deleted = 1
+        ''', (ids,)).fetchall()
+        loans = _loan_rows(conn, node, "l.id IN (SELECT value FROM json_each(:ids))", {"ids": json.dumps(loan_ids)})
+        more = len(entries) == limit
+        if entries:
+            cursor = [entries[-1][0], None, None]
+    return {
+        "node": node,
+        "cursor": cursor,
+        "more": more,
+        "books": [list(row[1:]) for row in books],
+        "deleted": [list(row) for row in deleted],
+        "loans": [list(row[1:]) for row in loans],
+    }
+
+
+def _lookup(conn, table, node, origin_id, self_node):
+    """全局键对应的本地行 (id, 时钟, 写入节点, 是否已删除)；本地没有时返回 None"""
+    row = conn.execute(
+        "SELECT row_id, clock, writer, deleted FROM sync_rows WHERE tbl = ? AND node = ? AND origin_id = ?",
+        (table, node, origin_id),
+    ).fetchone()
+    if row is not None or node != self_node:
+        return row
+    # 本节点在迁移前或批量生成的行没有 sync_rows 记录
+    source = "book_items" if table == "book_items" else "loan_history"
+    if conn.execute(f"SELECT 1 FROM {source} WHERE id = ?", (origin_id,)).fetchone():
+        return origin_id, 0, self_node, 0
+    return None
+
+
+def _record(conn, table, row_id, key, stamp, deleted, peer):
+    """记下应用的行的全局键和时间戳，并追加一条来自 peer 的变更日志（转发给其他节点用）"""
+    conn.execute('''
+        INSERT INTO sync_rows (tbl, row_id, node, origin_id, clock, writer, deleted) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (tbl, node, origin_id) DO UPDATE SET
+            row_id = excluded.row_id, clock = excluded.clock, writer = excluded.writer, deleted = excluded.deleted
+    ''', (table, row_id) + tuple(key) + tuple(stamp) + (deleted,))
+    if row_id is not None:
+        conn.execute("INSERT INTO change_log (tbl, row_id, origin) VALUES (?, ?, ?)", (table, row_id, peer))
+
+
+def _apply_book(conn, row, self_node, peer):
+    """应用一本书的新版本，返回本地的书籍 id；本地的版本更新或书籍已删除时返回 None"""
+    key, stamp = row[0:2], row[2:4]
+    title, author, isbn, category, publisher, year, status, owner, borrower, until, description = row[4:]
+    local = _lookup(conn, "book_items", *key, self_node)
+    if local is not None and (local[3] or tuple(stamp) <= tuple(local[1:3])):
+        return None
+    values = (title, author, isbn, category_id(conn, category), publisher, year, status,
+              user_id(conn, owner, True), user_id(conn, borrower, True), until, description)
+    if local is None:
+        book_id = conn.execute('''
+            INSERT INTO book_items (title, author, isbn, category_id, publisher, publish_year, status_code,
+                                    owner_id, borrower_id, borrow_until, description)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', values).lastrowid
+    else:
+        book_id = local[0]
+        # 借阅人或应还日期变了时逾期标记清零，由本节点的调度器重新判断
+        conn.execute('''
+            UPDATE book_items
+            SET overdue = CASE WHEN borrower_id IS ?9 AND borrow_until IS ?10 THEN overdue ELSE 0 END,
+                title=?1, author=?2, isbn=?3, category_id=?4, publisher=?5, publish_year=?6, status_code=?7,
+                owner_id=?8, borrower_id=?9, borrow_until=?10, description=?11, version=version + 1
+            WHERE id=?12
+        ''', values + (book_id,))
+    _record(conn, "book_items", book_id, key, stamp, 0, peer)
+    return book_id
+
+
+def _apply_delete(conn, row, self_node, peer):
+    """应用书籍的墓碑：删除书籍及其共享记录和预约（删除优先，不比较时间戳）；本地没有这本书时只记下墓碑"""
+    key, stamp = row[0:2], row[2:4]
+    local = _lookup(conn, "book_items", *key, self_node)
+    if local is None:
+        _record(conn, "book_items", None, key, stamp, 1, peer)
+        return False
+    if local[3]:
+        return False
+    book_id = local[0]
+    conn.execute("DELETE FROM loans WHERE book_id = ?", (book_id,))
+    for table in archive_tables(conn):
+        conn.execute(f"DELETE FROM {table} WHERE book_id = ?", (book_id,))
+    conn.execute("DELETE FROM reservations WHERE book_id = ?", (book_id,))
+    conn.execute("DELETE FROM book_items WHERE id = ?", (book_id,))
+    _record(conn, "book_items", book_id, key, stamp, 1, peer)
+    return True
+
+
+def _apply_loan(conn, row, self_node, peer):
+    """应用一条共享记录的新版本，返回书籍的本地 id；没有应用时返回 None"""
+    key, stamp, book_key = row[0:2], row[2:4], row[4:6]
+    borrower, borrow_date, return_date, status = row[6:]
+    book = _lookup(conn, "book_items", *book_key, self_node)
+    if book is None or book[3]:
+        return None
+    local = _lookup(conn, "loans", *key, self_node)
+    if local is not None and tuple(stamp) <= tuple(local[1:3]):
+        return None
+    values = (book[0], user_id(conn, borrower, True), borrow_date, return_date, status)
+    if local is None:
+        loan_id = conn.execute('''
+            INSERT INTO loans (book_id, borrower_id, borrow_date, return_date, status_code) VALUES (?, ?, ?, ?, ?)
+        ''', values).lastrowid
+    else:
+        # 已归档的记录都已归还，不会再有新的版本，这里只会改到 loans 中的行
+        loan_id = local[0]
+        conn.execute('''
+            UPDATE loans SET book_id=?, borrower_id=?, borrow_date=?, return_date=?, status_code=? WHERE id=?
+        ''', values + (loan_id,))
+    _record(conn, "loans", loan_id, key, stamp, 0, peer)
+    return book[0]
+
+
+def _reconcile(conn, book_id, self_node):
+    """一本书有多条借阅中的共享记录时（两个节点同时借出），只保留书籍当前借阅人的一条，返回取消的条数
+
+    书籍行已按时间戳确定了借阅人；同一借阅人有多条时保留全局键最小的一条。其余按借阅当天归还处理，并提醒借阅人。
+    这是每个节点按同样的数据各自得出的结果，不记变更日志，也不改变行的时间戳。
+    """
+    book = conn.execute("SELECT status_code, borrower_id FROM book_items WHERE id = ?", (book_id,)).fetchone()
+    if book is None:
+        return 0
+    loans = conn.execute(f'''
+        SELECT l.id, l.borrower_id, l.borrow_date, u.name FROM loans l
+        JOIN users u ON u.id = l.borrower_id
+        LEFT JOIN sync_rows s ON s.tbl = 'loans' AND s.row_id = l.id
+        WHERE l.book_id = ? AND l.status_code = {BORROWING}
+        ORDER BY COALESCE(s.node, ?), COALESCE(s.origin_id, l.id)
+    ''', (book_id, self_node)).fetchall()
+    keep = next((loan for loan in loans if book[0] == SHARED and loan[1] == book[1]), None)
+    cancelled = [loan for loan in loans if loan is not keep]
+    created_at = datetime.now().isoformat(timespec="seconds")
+    for loan_id, _, borrow_date, borrower in cancelled:
+        conn.execute(f"UPDATE loans SET status_code = {RETURNED}, return_date = borrow_date WHERE id = ?", (loan_id,))
+        conn.execute('''
+            INSERT OR IGNORE INTO reminders (book_id, borrower, due_date, kind, created_at) VALUES (?, ?, ?, ?, ?)
+        ''', (book_id, borrower, from_day(borrow_date).isoformat(), SYNC_CONFLICT, created_at))
+    return len(cancelled)
+
+
+def apply_batch(conn, batch):
+    """在当前写事务中应用对方的一批变更并记下新的位置，返回 (应用的行数, 因冲突取消的借阅数)"""
+    peer = batch["node"]
+    self_node = node_id(conn)
+    # 应用期间本地的同步触发器不执行，行的时间戳沿用对方的
+    conn.execute("UPDATE sync_node SET applying = ?", (peer,))
+    applied = 0
+    touched = set()
+    for row in batch["books"]:
+        book_id = _apply_book(conn, row, self_node, peer)
+        if book_id is not None:
+            applied += 1
+            touched.add(book_id)
+    for row in batch["deleted"]:
+        applied += _apply_delete(conn, row, self_node, peer)
+    for row in batch["loans"]:
+        book_id = _apply_loan(conn, row, self_node, peer)
+        if book_id is not None:
+            applied += 1
+            touched.add(book_id)
+    cancelled = sum(_reconcile(conn, book_id, self_node) for book_id in sorted(touched))
+
+    # Lamport 时钟：之后本地的修改排在收到的所有修改之后
+    clock = max((row[2] for rows in (batch["books"], batch["deleted"], batch["loans"]) for row in rows), default=0)
+    conn.execute("UPDATE sync_node SET clock = MAX(clock, ?), applying = NULL", (clock,))
+    seq, book_after, loan_after = batch["cursor"]
+    conn.execute('''
+        INSERT INTO sync_peers (node, seq, book_after, loan_after, synced_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (node) DO UPDATE SET
+            seq = excluded.seq, book_after = excluded.book_after, loan_after = excluded.loan_after,
+            synced_at = excluded.synced_at
+    ''', (peer, seq, book_after, loan_after, datetime.now().isoformat(timespec="seconds")))
+    return applied, cancelled
+
+
+def _peer_cursor(conn, peer):
+    """上次从 peer 收到的位置；从未同步过时为 None"""
+    row = conn.execute("SELECT seq, book_after, loan_after FROM sync_peers WHERE node = ?", (peer,)).fetchone()
+    return list(row) if row else None
+
+
+def new_node(conn):
+    """复制的数据库改用新的节点编号，返回新编号（须在写事务中）
+
+    原有的行改为显式记录原节点的全局键，与原数据库中的同一行仍然对应。
+    """
+    old = node_id(conn)
+    for table, source in (("book_items", "book_items"), ("loans", "loan_history")):
+        conn.execute(f'''
+            INSERT OR IGNORE INTO sync_rows (tbl, row_id, node, origin_id, clock, writer)
+            SELECT ?, id, ?, id, 0, ? FROM {source}
+            WHERE id NOT IN (SELECT row_id FROM sync_rows WHERE tbl = ? AND row_id IS NOT NULL)
+        ''', (table, old, old, table))
+    node = uuid.uuid4().hex
+    conn.execute("UPDATE sync_node SET node = ?", (node,))
+    return node
+
+
+class LocalTransport:
+    """进程内的传输：直接调用另一个节点的 serve（同一台机器上的两个数据库文件之间同步、测试用），并统计收发的字节数"""
+    def __init__(self, node):
+        self.node = node
+        self.sent = 0
+        self.received = 0
+
+    def request(self, payload):
+        """发送一个请求，返回对方的响应"""
+        self.sent += len(payload)
+        response = self.node.serve(payload)
+        self.received += len(response)
+        return response
+
+
+class SyncNode:
+    """一个数据库作为同步节点：serve 响应其他节点的请求，pull 从其他节点拉取变更"""
+    def __init__(self, manager, batch_size=BATCH_SIZE):
+        self.manager = manager
+        self.batch_size = batch_size
+
+    @property
+    def node(self):
+        """本节点的编号"""
+        return self.manager.run_read(node_id)
+
+    def serve(self, payload):
+        """处理一个请求：hello 返回节点编号，changes 返回请求方位置之后的一批变更"""
+        request = decode(payload)
+        if request["op"] == "hello":
+            return encode({"node": self.node})
+        return encode(self.manager.run_read(changes, request["node"], request["cursor"], self.batch_size))
+
+    def pull(self, transport):
+        """从 transport 另一端的节点拉取全部新的变更，返回 (批次数, 应用的行数, 因冲突取消的借阅数)"""
+        node = self.node
+        peer = decode(transport.request(encode({"op": "hello"})))["node"]
+        if peer == node:
+            raise ValueError("两个数据库的节点编号相同，复制的数据库须先执行 new-node")
+        batches = applied = cancelled = 0
+        while True:
+            cursor = self.manager.run_read(_peer_cursor, peer)
+            batch = decode(transport.request(encode({"op": "changes", "node": node, "cursor": cursor})))
+            rows, conflicts = self.manager.run_write(apply_batch, batch)
+            batches += 1
+            applied += rows
+            cancelled += conflicts
+            if not batch["more"]:
+                return batches, applied, cancelled
+
+
+def sync(first, second, transport=LocalTransport):
+    """两个节点双向同步：first 先从 second 拉取，second 再从 first 拉取，返回两次 pull 的结果"""
+    return first.pull(transport(second)), second.pull(transport(first))
+
+
+def status(conn):
+    """(本节点编号, 逻辑时钟, 日志最大序号, [(节点, 已收到的序号, 第一次同步是否完成, 同步时间)])"""
+    node, clock = conn.execute("SELECT node, clock FROM sync_node").fetchone()
+    seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+    peers = [(peer, seq_, book_after is None, synced_at) for peer, seq_, book_after, synced_at in conn.execute(
+        "SELECT node, seq, book_after, synced_at FROM sync_peers ORDER BY synced_at DESC")]
+    return node, clock, seq, peers
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="图书共享节点之间的增量同步")
+    parser.add_argument("--db", default=DB_PATH, help="本节点的数据库文件")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="每批最多的变更日志条数")
+    commands = parser.add_subparsers(dest="command", required=True)
+    other = commands.add_parser("sync", help="与另一个数据库文件双向同步")
+    other.add_argument("peer_db", help="另一个节点的数据库文件")
+    commands.add_parser("status", help="显示同步状态")
+    commands.add_parser("new-node", help="复制的数据库改用新的节点编号")
+    args = parser.parse_args(argv)
+
+    manager = ConnectionManager(args.db, readers=1)
+    try:
+        manager.run_write(migrate)
+        if args.command == "sync":
+            peer_manager = ConnectionManager(args.peer_db, readers=1)
+            try:
+                peer_manager.run_write(migrate)
+                began = time.perf_counter()
+                local, peer = SyncNode(manager, args.batch_size), SyncNode(peer_manager, args.batch_size)
+                for name, transport, target in (("收到", LocalTransport(peer), local),
+                                                ("发出", LocalTransport(local), peer)):
+                    batches, applied, cancelled = target.pull(transport)
+                    print(f"{name} {batches} 批（{transport.received} 字节），应用 {applied} 行，"
+                          f"取消冲突的借阅 {cancelled} 条")
+                print(f"耗时 {time.perf_counter() - began:.2f}s")
+            finally:
+                peer_manager.close()
+        elif args.command == "status":
+            node, clock, seq, peers = manager.run_read(status)
+            print(f"节点 {node}，逻辑时钟 {clock}，日志序号 {seq}")
+            for peer, peer_seq, complete, synced_at in peers:
+                print(f"  {peer}：已收到序号 {peer_seq}{'' if complete else '（第一次同步未完成）'}，{synced_at}")
+        else:
+            print(f"新的节点编号 {manager.run_write(new_node)}")
+        return 0
+    finally:
+        manager.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+﻿"""bookdb 的测试：常用查询的执行计划不能出现全表扫描
+
+    python -m unittest test_bookdb
+"""
+from contextlib import closing
+from datetime import date, timedelta
+import os
+import tempfile
+import unittest
+
+from bookdb import archive_loans, archive_tables, check_query_plans, connect, fts_available
+from bookservice import BookService
+
+
+class QueryPlanTest(unittest.TestCase):
+    """在新建并升级到最新版本的数据库上检查 HOT_QUERIES"""
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, "plans.db")
+        self.service = BookService(self.db_path, readers=1)
+        self.service.migrate()
+        self.service.seed_sample_data()
+
+    def tearDown(self):
+        self.service.close()
+        self.directory.cleanup()
+
+    def check(self, queries=None):
+        """在一个新连接上检查执行计划，返回问题列表"""
+        with closing(connect(self.db_path)) as conn:
+            return check_query_plans(conn) if queries is None else check_query_plans(conn, queries)
+
+    def test_hot_queries_use_indexes(self):
+        self.assertEqual(self.check(), [])
+
+    def test_hot_queries_use_indexes_with_archives(self):
+        # 借还一次后把它归档，查询共享记录的语句改为合并归档表
+        book_id = self.service.add_book("张三", {"title": "归档测试", "author": "作者"}).book_id
+        self.service.borrow_book("李四", book_id)
+        self.service.return_book("李四", book_id)
+        archive_loans(self.service.manager, today=date.today() + timedelta(days=400))
+        self.assertTrue(self.service.manager.run_read(archive_tables))
+        self.assertEqual(self.check(), [])
+
+    def test_archive_keeps_schema_and_stats(self):
+        # 归档时暂停统计触发器，不去掉再建立：归档表已有时数据库结构不变（其他连接不必重新编译语句），借阅次数不变
+        later = date.today() + timedelta(days=400)
+        for title in ("归档测试一", "归档测试二"):
+            book_id = self.service.add_book("张三", {"title": title, "author": "作者"}).book_id
+            self.service.borrow_book("李四", book_id)
+            self.service.return_book("李四", book_id)
+            if title == "归档测试一":
+                archive_loans(self.service.manager, today=later)
+
+        def state(conn):
+            return (conn.execute("PRAGMA schema_version").fetchone()[0],
+                    conn.execute("SELECT * FROM user_stats ORDER BY user_id").fetchall())
+        with closing(connect(self.db_path)) as conn:
+            before = state(conn)
+            self.assertEqual(archive_loans(self.service.manager, today=later), 1)
+            self.assertEqual(state(conn), before)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM paused_triggers").fetchone()[0], 0)
+
+    def test_full_scan_is_reported(self):
+        problems = self.check([("按书名查找", "SELECT id FROM book_items WHERE title = ?", ("三体",))])
+        self.assertEqual([name for name, _ in problems], ["按书名查找"])
+
+    def test_subquery_exemption_does_not_hide_table_scan(self):
+        # 与子查询同一层的真实表扫描仍须报告，豁免的只有读取子查询结果的 SCAN p
+        sql = '''
+            WITH page AS MATERIALIZED (SELECT id FROM book_items WHERE id > ? ORDER BY id LIMIT 10)
+            SELECT p.id, u.id FROM page p JOIN users u ON u.name LIKE ?
+        '''
+        problems = self.check([("子查询与扫描", sql, (0, "%张%"))])
+        self.assertEqual([detail.split()[1] for _, detail in problems], ["u"])
+
+    def test_partial_index_exemption_needs_its_condition(self):
+        # 带部分索引条件的查询读取部分索引，豁免；其他条件的查询扫描整张表，须报告
+        stale = "SELECT book_id FROM book_loans WHERE loans != refreshed LIMIT 20"
+        popular = "SELECT book_id FROM book_loans WHERE loans > 5"
+        problems = self.check([("推荐已过期", stale, ()), ("借阅多的书", popular, ())])
+        self.assertEqual([name for name, _ in problems], ["借阅多的书"])
+
+    def test_virtual_table_without_match_is_reported(self):
+        with closing(connect(self.db_path)) as conn:
+            if not fts_available(conn):
+                self.skipTest("SQLite 未编译 FTS5")
+        problems = self.check([("读取全部全文索引", "SELECT rowid FROM books_fts", ())])
+        self.assertEqual(len(problems), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
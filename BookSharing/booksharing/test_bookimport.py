@@ -0,0 +1,64 @@
+﻿"""bookimport 的测试：分批导入时暂停插入触发器，数据库结构不变，索引和计数与逐行插入时一致
+
+    python -m unittest test_bookimport
+"""
+from contextlib import closing
+import csv
+import os
+import tempfile
+import unittest
+
+from bookdb import connect
+from bookimport import import_books
+from bookservice import BookService
+
+
+class ImportTest(unittest.TestCase):
+    """在新建的数据库上分三批导入 25 本书"""
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, "import.db")
+        self.service = BookService(self.db_path, readers=1)
+        self.service.migrate()
+        self.path = os.path.join(self.directory.name, "catalog.csv")
+        with open(self.path, "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["书名", "作者", "ISBN", "分类", "出版社"])
+            for i in range(25):
+                writer.writerow([f"红楼梦第{i}册", "曹雪芹", f"978{i:010d}", "文学", "人民文学出版社"])
+
+    def tearDown(self):
+        self.service.close()
+        self.directory.cleanup()
+
+    def test_import_keeps_schema(self):
+        # 暂停触发器只改 paused_triggers 的数据：其他连接不必重新编译语句
+        with closing(connect(self.db_path)) as conn:
+            cookie = conn.execute("PRAGMA schema_version").fetchone()[0]
+            result = import_books(self.service, self.path, "张三", batch_size=10)
+            self.assertEqual(result.inserted, 25)
+            self.assertEqual(conn.execute("PRAGMA schema_version").fetchone()[0], cookie)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM paused_triggers").fetchone()[0], 0)
+
+    def test_import_fills_indexes_and_stats(self):
+        import_books(self.service, self.path, "张三", batch_size=10)
+        self.assertEqual(self.service.book_counts()["可借阅"], 25)
+        self.assertEqual(len(self.service.search("曹雪芹")), 25)
+        self.assertEqual(len(self.service.search("红楼")), 25)
+        # 导入之后逐行写入的触发器照常执行
+        self.service.add_book("张三", {"title": "红楼梦补", "author": "归锄子"})
+        self.assertEqual(len(self.service.search("红楼")), 26)
+        self.assertEqual(self.service.book_counts()["可借阅"], 26)
+
+    def test_import_skips_existing_isbn(self):
+        # 导入与添加书籍同样校验，不改写 ISBN：已有书籍的 ISBN 原样比较
+        self.service.add_book("张三", {"title": "红楼梦", "author": "曹雪芹", "isbn": "978-7-02-000220-4"})
+        with open(self.path, "a", encoding="utf-8", newline="") as file:
+            csv.writer(file).writerow(["红楼梦", "曹雪芹", "978-7-02-000220-4", "文学", "人民文学出版社"])
+        result = import_books(self.service, self.path, "张三", batch_size=10)
+        self.assertEqual((result.inserted, result.duplicates), (25, 1))
+        self.assertEqual(self.service.get_book(1)[3], "978-7-02-000220-4")
+
+
+if __name__ == "__main__":
+    unittest.main()
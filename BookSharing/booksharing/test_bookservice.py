@@ -0,0 +1,93 @@
+﻿"""bookservice 的测试：借还的条件更新抛出对应的错误，归还时按预约顺序交给下一位，批量操作逐本报告失败
+
+    python -m unittest test_bookservice
+"""
+from datetime import date
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from bookdb import to_day
+from bookservice import BookService, BookUnavailable, PermissionDenied, VersionConflict
+
+
+class BookServiceTest(unittest.TestCase):
+    """新建并升级到最新版本的数据库，张三拥有三本书"""
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, "service.db")
+        self.service = BookService(self.db_path, readers=1)
+        self.service.migrate()
+        self.ids = [self.service.add_book("张三", {"title": f"测试{i}", "author": "作者"}).book_id for i in range(3)]
+
+    def tearDown(self):
+        self.service.close()
+        self.directory.cleanup()
+
+    def borrower(self, book_id):
+        return self.service.get_book(book_id)[9]
+
+    def test_typed_errors(self):
+        book_id = self.ids[0]
+        version = self.service.get_book(book_id)[12]
+        self.service.borrow_book("李四", book_id, expected_version=version)
+        # 已被借走
+        with self.assertRaises(BookUnavailable):
+            self.service.borrow_book("王五", book_id)
+        # 读到的版本已过期
+        with self.assertRaises(VersionConflict):
+            self.service.return_book("李四", book_id, expected_version=version)
+        # 归还别人借的书，修改别人的书
+        with self.assertRaises(PermissionDenied):
+            self.service.return_book("王五", book_id)
+        with self.assertRaises(PermissionDenied):
+            self.service.update_book("李四", book_id, {"title": "改名", "author": "作者"})
+        self.assertEqual(self.borrower(book_id), "李四")
+        self.service.return_book("李四", book_id)
+        with self.assertRaises(BookUnavailable):
+            self.service.return_book("李四", book_id)
+
+    def test_hand_off_in_order_skipping_expired(self):
+        book_id = self.ids[0]
+        self.service.borrow_book("李四", book_id)
+        for user in ("王五", "赵六", "孙七"):
+            self.service.reserve_book(user, book_id)
+        self.assertEqual(self.service.reservations("孙七")[0][3], 3)
+
+        # 王五的预约昨天已过期（到期调度还没有删除它）：归还时跳过并删除，轮到赵六
+        yesterday = to_day(date.today()) - 1
+        self.service.manager.run_write(lambda conn: conn.execute(
+            "UPDATE reservations SET expires = ? WHERE user_id = (SELECT id FROM users WHERE name = '王五')",
+            (yesterday,)))
+        delta = self.service.return_book("李四", book_id)
+        self.assertEqual(delta.row[6], "赵六")
+        self.assertEqual(self.service.reservations("王五"), [])
+        self.assertEqual(self.service.queue_length(book_id), 1)
+
+        self.service.return_book("赵六", book_id)
+        self.assertEqual(self.borrower(book_id), "孙七")
+        self.service.return_book("孙七", book_id)
+        self.assertEqual(self.service.get_book(book_id)[7], "可借阅")
+
+    def test_batch_reports_failures(self):
+        taken, free, other = self.ids
+        self.service.borrow_book("李四", taken)
+        missing = max(self.ids) + 100
+        with mock.patch.object(self.service.manager, "run_write", wraps=self.service.manager.run_write) as run_write:
+            result = self.service.borrow_books("王五", [taken, free, missing, other])
+        # 其余的书在同一个写事务中借出
+        self.assertEqual(run_write.call_count, 1)
+        self.assertEqual([delta.book_id for delta in result.deltas], [free, other])
+        self.assertEqual(result.failures, [(taken, "测试0", "该书籍当前不可借阅"), (missing, None, "书籍不存在")])
+        self.assertEqual(self.borrower(taken), "李四")
+        self.assertEqual([self.borrower(book_id) for book_id in (free, other)], ["王五", "王五"])
+
+        # 归还：不是自己借的书逐本报告，自己的照常归还
+        result = self.service.return_books("王五", [taken, free])
+        self.assertEqual(result.failures, [(taken, "测试0", "您只能归还自己借阅的书籍")])
+        self.assertEqual(self.service.get_book(free)[7], "可借阅")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+﻿"""bookshard 的测试：迁移失败后馆仍在原来的文件中，数据完整
+
+    python -m unittest test_bookshard
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import bookshard
+from bookshard import ShardRouter
+
+
+class MoveLibraryTest(unittest.TestCase):
+    """两个分片，东校区登记在分片 1，有一本书"""
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.router = ShardRouter(self.directory.name, readers=1)
+        self.router.add_shard()
+        self.router.add_shard()
+        self.router.add_library("东校区", shard_id=1)
+        self.router.service("东校区").add_book("张三", {"title": "迁移测试", "author": "作者"})
+
+    def tearDown(self):
+        self.router.close()
+        self.directory.cleanup()
+
+    def test_move(self):
+        source = self.router.library_path("东校区")
+        target = self.router.move_library("东校区", 2)
+        self.assertEqual(self.router.library_path("东校区"), target)
+        self.assertFalse(os.path.exists(source))
+        self.assertEqual(self.router.book_counts()["东校区"].get("可借阅"), 1)
+
+    def test_failure_after_copy_keeps_source(self):
+        # 目录已改到新分片之后失败：目录须改回源分片，复制的文件删除，源文件照常读写
+        source = self.router.library_path("东校区")
+        target = os.path.join(self.router.shard_path(2), os.path.basename(source))
+        with mock.patch.object(bookshard, "_refuse_writes", side_effect=RuntimeError("模拟失败")):
+            with self.assertRaises(RuntimeError):
+                self.router.move_library("东校区", 2)
+        self.assertEqual(self.router.library_path("东校区"), source)
+        self.assertTrue(os.path.exists(source))
+        self.assertFalse(os.path.exists(target))
+        self.assertEqual(self.router.book_counts()["东校区"].get("可借阅"), 1)
+        service = self.router.service("东校区")
+        service.add_book("张三", {"title": "失败后添加", "author": "作者"})
+        self.assertEqual(self.router.book_counts()["东校区"].get("可借阅"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+﻿"""booksync 的测试：两个本地数据库文件经进程内传输同步，删除、修改和同时借出后两个节点一致
+
+    python -m unittest test_booksync
+"""
+from contextlib import closing
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from bookdb import connect
+from bookservice import BookService
+from booksync import SYNC_CONFLICT, SyncNode, new_node, sync
+
+
+class SyncTest(unittest.TestCase):
+    """节点 A 是有示例数据的数据库，节点 B 是它的副本（复制后执行 new-node）"""
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        paths = [os.path.join(self.directory.name, name) for name in ("a.db", "b.db")]
+        self.a = BookService(paths[0], readers=1)
+        self.a.migrate()
+        self.a.seed_sample_data()
+        with closing(connect(paths[0])) as conn, closing(sqlite3.connect(paths[1])) as destination:
+            conn.backup(destination)
+        self.b = BookService(paths[1], readers=1)
+        self.b.migrate()
+        self.b.manager.run_write(new_node)
+        self.nodes = SyncNode(self.a.manager, batch_size=3), SyncNode(self.b.manager, batch_size=3)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+        self.directory.cleanup()
+
+    def sync(self):
+        """双向同步两次（第二次应当没有可应用的变更），返回第一次同步中因冲突取消的借阅数"""
+        results = sync(*self.nodes)
+        again = sync(*self.nodes)
+        self.assertEqual([result[1] for result in again], [0, 0])
+        return sum(result[2] for result in results)
+
+    @staticmethod
+    def contents(service):
+        """不含 id 的书籍、共享记录和统计，两个节点一致时相等"""
+        def read(conn):
+            books = conn.execute(
+                "SELECT title, author, publisher, status, owner, borrower, borrow_until FROM books ORDER BY title"
+            ).fetchall()
+            loans = conn.execute('''
+                SELECT b.title, r.borrower, r.borrow_date, r.return_date, r.status
+                FROM sharing_records r JOIN books b ON b.id = r.book_id ORDER BY 1, 2, 3, 4, 5
+            ''').fetchall()
+            stats = conn.execute('''
+                SELECT s.name, book_stats.count FROM book_stats JOIN statuses s ON s.code = book_stats.status_code
+                WHERE book_stats.count != 0 ORDER BY 1
+            ''').fetchall()
+            return books, loans, stats
+        return service.manager.run_read(read)
+
+    def assertConverged(self):
+        self.assertEqual(self.contents(self.a), self.contents(self.b))
+
+    def book_id(self, service, title):
+        return service.manager.run_read(
+            lambda conn: conn.execute("SELECT id FROM book_items WHERE title = ?", (title,)).fetchone()[0])
+
+    def test_delete_before_first_sync(self):
+        # 删除发生在第一次同步之前，日志位置已经越过删除的那一条，墓碑须随全部数据一起发送
+        self.a.delete_book("张三", self.book_id(self.a, "活着"))
+        self.sync()
+        self.assertConverged()
+        self.assertNotIn("活着", [book[0] for book in self.contents(self.b)[0]])
+
+    def test_delete_after_first_sync(self):
+        self.sync()
+        self.b.delete_book("王五", self.book_id(self.b, "算法导论"))
+        self.a.update_book("李四", self.book_id(self.a, "人类简史"), {"title": "人类简史（新版）", "author": "尤瓦尔·赫拉利"})
+        self.sync()
+        self.assertConverged()
+        titles = [book[0] for book in self.contents(self.a)[0]]
+        self.assertNotIn("算法导论", titles)
+        self.assertIn("人类简史（新版）", titles)
+
+    def test_delete_wins_over_update(self):
+        self.sync()
+        self.a.update_book("张三", self.book_id(self.a, "活着"), {"title": "活着（修订版）", "author": "余华"})
+        self.b.delete_book("张三", self.book_id(self.b, "活着"))
+        self.sync()
+        self.assertConverged()
+        self.assertNotIn("活着（修订版）", [book[0] for book in self.contents(self.a)[0]])
+
+    def test_concurrent_updates(self):
+        # 后写者胜：B 的修改在 A 之后，时钟更大
+        self.sync()
+        self.a.update_book("李四", self.book_id(self.a, "经济学原理"), {"title": "经济学原理（A）", "author": "曼昆"})
+        self.b.update_book("李四", self.book_id(self.b, "经济学原理"), {"title": "经济学原理（B1）", "author": "曼昆"})
+        self.b.update_book("李四", self.book_id(self.b, "经济学原理（B1）"), {"title": "经济学原理（B2）", "author": "曼昆"})
+        self.sync()
+        self.assertConverged()
+        self.assertIn("经济学原理（B2）", [book[0] for book in self.contents(self.a)[0]])
+
+    def test_double_borrow(self):
+        # 两个节点同时借出同一本书：只保留一条借阅中的记录，另一条按当天归还，借阅人在借书的节点上收到提醒
+        # （哪一方胜出取决于节点编号；先被取消的借阅已按归还发给对方时，对方不必再取消）
+        self.sync()
+        self.a.borrow_book("李四", self.book_id(self.a, "小王子"))
+        self.b.borrow_book("王五", self.book_id(self.b, "小王子"))
+        self.assertIn(self.sync(), (1, 2))
+        self.assertConverged()
+        books, loans, _ = self.contents(self.a)
+        borrower = next(book[5] for book in books if book[0] == "小王子")
+        self.assertEqual([loan[1] for loan in loans if loan[0] == "小王子" and loan[4] == "借阅中"], [borrower])
+        cancelled, service = ("王五", self.b) if borrower == "李四" else ("李四", self.a)
+        self.assertEqual([reminder[3] for reminder in service.reminders(cancelled)], [SYNC_CONFLICT])
+
+
+if __name__ == "__main__":
+    unittest.main()
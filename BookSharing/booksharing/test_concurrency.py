@@ -0,0 +1,51 @@
+﻿"""多进程并发借还的测试：临时的 WAL 数据库上同时借还，不能重复借出、统计表与实际一致、没有锁超时
+
+    python -m unittest test_concurrency
+"""
+from contextlib import closing
+import os
+import tempfile
+import unittest
+
+from bookbench import run_concurrency
+from bookdb import BUSY_TIMEOUT, connect
+
+
+class ConcurrencyTest(unittest.TestCase):
+    """与 bookbench.py concurrency / contention 相同的做法，规模小一些"""
+    options = {"journal_mode": "WAL", "busy_timeout": BUSY_TIMEOUT}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, "concurrency.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_processes(self, processes, cycles, books, readers, hold=0):
+        summary, problems = run_concurrency(self.db_path, processes, cycles, books, readers, self.options, hold)
+        # check_consistency：全部归还、每次借阅恰好一条记录、book_stats 和 user_stats 与重新统计一致；
+        # 读取进程在写入期间也检查有没有重复借出
+        self.assertEqual(problems, [])
+        self.assertEqual(summary["double_bookings"], 0)
+        self.assertEqual(summary["failures"], 0)
+        self.assertEqual(summary["read_failures"], 0)
+        self.assertGreater(summary["borrowed"], 0)
+        self.assertGreater(summary["transactions_per_second"], 0)
+        self.assertGreater(summary["reads_per_second"], 0)
+        return summary
+
+    def test_borrow_and_return(self):
+        summary = self.run_processes(processes=4, cycles=50, books=10, readers=1)
+        with closing(connect(self.db_path)) as conn:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEqual(summary["borrowed"] + summary["conflicts"], 4 * 50)
+
+    def test_contention_on_one_book(self):
+        # 所有进程争抢同一本书，借到后持有一会儿：其余进程只能得到冲突，不能重复借出
+        summary = self.run_processes(processes=4, cycles=20, books=1, readers=1, hold=0.002)
+        self.assertGreater(summary["conflicts"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()